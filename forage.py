@@ -19,13 +19,49 @@ import os
 import sys
 import shutil
 import time
+import hashlib
+import cPickle
+import threading
 from datetime import datetime
+import numpy
 import pandas
 
 import forage_utils as forage
 import forage_century_link_utils as cent
+import forage_surrogate
+import forage_diet_table
+import forage_memory
+import forage_metrics
+import forage_timing
+import forage_trace
 import freer_param as FreerParam
 
+# time step of the livestock model, enforced by CENTURY.  It is passed to
+# functions of forage_utils that depend on it, rather than set for the whole
+# process with forage_utils.set_time_step, so that runs may execute
+# concurrently in threads of one process
+_TIME_STEP = 'month'
+# profiling, memory tracking, tracing and progress metrics are recorded by
+# forage_timing, forage_memory, forage_trace and forage_metrics for the whole
+# process, so a run that requests them must be the only run in the process.
+# Runs between setup and close are registered here (see Simulation.setup)
+_run_lock = threading.Lock()
+_active_runs = set()
+_instrumented_runs = set()
+# within a month of livestock sub-steps, diets selected at one sub-step are
+# reused at later sub-steps until biomass or crude protein of a forage type
+# has changed by more than this fraction since the diets were selected
+_SUBSTEP_TOLERANCE = 0.02
+# inputs that must match between a saved state and runs forked from it
+_STATE_INPUTS = ['start_year', 'start_month', 'livestock_step']
+# inputs that determine the CENTURY inputs staged by Simulation.setup and the
+# CENTURY spin-up, which cannot be changed by Simulation.restart
+_SETUP_INPUTS = [
+    'input_dir', 'century_dir', 'grass_csv', 'fix_file', 'start_year',
+    'start_month', 'spin_up_dir', 'fork_state_dir', 'century_surrogate',
+    'century_cache_dir', 'century_cache_size', 'removal_quantum',
+    'diet_table']
+
 
 def execute(args):
     """This function invokes the forage model given user inputs.
@@ -71,81 +107,1332 @@ def execute(args):
         args['diet_verbose'] - save details of diet selection?
         args['digestibility_flag'] - flag to use a particular regression
             equation to calculate digestibility from crude protein
+        args['livestock_step'] - (optional) time step of the livestock model
+            within each CENTURY month: 'month' (default), 'week' or 'day'.
+            With weekly or daily sub-steps, forage is interpolated between
+            consecutive CENTURY outputs and depleted by intake within the
+            month, and the removal accumulated over the month is sent to
+            CENTURY
+        args['spin_up_dir'] - (optional) directory containing saved CENTURY
+            spin-up results for each grass type, written by run_spin_up.  If
+            supplied, the spin-up simulation is not run again and the extend
+            simulation starts from the saved spin-up
+        args['century_cache_dir'] - (optional) directory of a cache of CENTURY
+            runs (see forage_century_link_utils.CenturyRunCache).  If
+            supplied, a monthly CENTURY run whose inputs match a cached run is
+            not launched, and the cached outputs are used instead
+        args['century_cache_size'] - (optional) maximum number of runs kept in
+            the cache; default 1000
+        args['removal_quantum'] - (optional) if supplied with a cache, the
+            fractions of live and standing dead biomass removed that are sent
+            to CENTURY are rounded to multiples of this value, so that more
+            runs share inputs
+        args['century_surrogate'] - (optional) fitted surrogate of monthly
+            CENTURY growth (forage_surrogate.GrowthSurrogate, or the path to
+            a file saved by GrowthSurrogate.save), or a dictionary of these
+            keyed by grass label.  If supplied, CENTURY is run only up to the
+            start of the simulation, and forage growth in each step is
+            predicted by the surrogate in place of launching CENTURY.  This
+            is intended for coarse screening runs
+        args['diet_table'] - (optional) diets tabulated by tabulate_diets
+            (forage_diet_table.DietTable, or the path to a file saved by
+            DietTable.save).  If supplied, the diet selected by each
+            herbivore class is interpolated from the table where the table
+            covers the herbivore class and forage, in place of diet selection
+        args['save_state_step'] - (optional) step at which to save the
+            complete state of the run: herbivores, forage, summary results so
+            far, CENTURY schedules and grazing parameters, and CENTURY
+            results.  The state is saved at the start of the step, i.e.
+            after step save_state_step - 1 is complete, and may be saved at
+            step num_months
+        args['save_state_dir'] - (optional) directory where the state is
+            saved; required with save_state_step
+        args['fork_state_dir'] - (optional) directory of a state saved by a
+            previous run.  If supplied, the run continues from the saved
+            state instead of starting at step 0.  Herbivores and forage are
+            those of the saved state; inputs that apply to later steps, such
+            as density_series and grz_months, are taken from args.
+            Summary results include the steps before the saved state
+        args['profile'] - (optional) time phases of the run (CENTURY
+            launches, file copies, schedule and graz file edits, reading
+            CENTURY outputs, diet selection, etc.; see forage_timing) and
+            write the times by step and by phase to profile_by_step.csv and
+            profile_by_phase.csv in args['outdir']
+        args['trace'] - (optional) write a trace of CENTURY launches, file
+            copies and moves, and schedule and graz file edits, one JSON
+            record per event (see forage_trace), to trace.jsonl in
+            args['outdir'].  The trace of the previous run in args['outdir'],
+            if any, is kept as trace.jsonl.1
+        args['metrics'] - (optional) write progress of the run (current
+            step, steps per minute, estimated time to completion, seconds in
+            CENTURY and in Python, files written and the latest total
+            offtake) in the Prometheus text format (see forage_metrics) at
+            most every 15 seconds and at the end of the run, to the path
+            args['metrics'] if it is a string, or else to metrics.prom in
+            args['outdir']
+        args['memory_profile'] - (optional) record memory use of the run
+            (see forage_memory): resident memory at the end of each step and
+            its change over each phase, and, where tracemalloc is available,
+            the lines of code holding the most memory at each step.  Written
+            to memory_by_step.csv, memory_by_phase.csv and
+            memory_top_allocators.csv in args['outdir']
+        args['write_csv'] - (optional) write results to csv files in
+            args['outdir']?  Default True.  Results are returned whether or
+            not they are written
 
-        returns nothing."""
+        returns a dictionary of pandas data frames keyed by the name of the
+            csv file each is written to: 'summary_results' and, if
+            args['diet_verbose'] is set, 'diet_segregation' and
+            '<herbivore>_diet'.  Missing values in summary results, written as
+            'NA' to summary_results.csv, are NaN."""
 
-    for opt_arg in [
-            'grz_months', 'density_series', 'digestibility_flag',
-            'diet_verbose']:
+    simulation = Simulation(args)
+    try:
+        simulation.setup()
+        simulation.run()
+    finally:
+        results = simulation.close()
+    return results
+
+
+class Simulation(object):
+
+    """A run of the coupled model that may be advanced step by step.
+
+    execute(args) is equivalent to
+
+        simulation = Simulation(args)
+        simulation.setup()
+        simulation.run()
+        results = simulation.close()
+
+    Between setup and close, the run may be advanced one step at a time
+    (step) or several steps at a time (run), and its state and results so
+    far inspected (state, results).  restart returns the run to its first
+    step, with herd or management inputs optionally changed, reusing the
+    CENTURY inputs staged in the CENTURY directory, the CENTURY spin-up, and
+    loaded diet tables, surrogates and the CENTURY run cache, so that
+    variants of a run do not each pay the cost of setup.
+
+    Runs may execute concurrently in threads of one process, but
+    profiling, memory tracking, tracing and progress metrics (args
+    'profile', 'memory_profile', 'trace' and 'metrics') record the state of
+    the whole process: setup raises an exception if a run requesting them
+    would overlap another run in the process.  Runs in separate processes,
+    as in forage_ensemble, forage_scenarios and forage_grid, are not
+    affected.
+    """
+
+    def __init__(self, args):
+        """Parameters:
+            args (dict): model inputs, see execute.  Missing optional inputs
+                are set to None in args
+        """
+        for opt_arg in [
+                'grz_months', 'density_series', 'digestibility_flag',
+                'diet_verbose', 'livestock_step', 'spin_up_dir',
+                'century_cache_dir', 'century_cache_size', 'removal_quantum',
+                'century_surrogate', 'diet_table', 'write_csv',
+                'save_state_step', 'save_state_dir', 'fork_state_dir',
+                'profile', 'trace', 'memory_profile', 'metrics']:
+            try:
+                val = args[opt_arg]
+            except KeyError:
+                args[opt_arg] = None
+        if args['livestock_step'] is None:
+            args['livestock_step'] = 'month'
+        if args['write_csv'] is None:
+            args['write_csv'] = True
+        if ((args['save_state_step'] is None) !=
+                (args['save_state_dir'] is None)):
+            er = ("Error: save_state_step and save_state_dir must be given "
+                  "together")
+            raise Exception(er)
+        self.args = args
+        self._step = None
+        self._results_dict = None
+        self._grass_labels = []
+        self._schedule_list = []
+        self._file_list = []
+        self._closed = False
+        self._registered = False
+        self._instrumented = False
+
+    def _instruments_requested(self):
+        args = self.args
+        return bool(args['profile'] or args['memory_profile'] or
+                    args['trace'] or args['metrics'])
+
+    def _register(self):
+        """Register the run as active in the process, checking that it does
+        not overlap a run with instrumentation, nor, if it requests
+        instrumentation itself, any other run."""
+        with _run_lock:
+            others = _active_runs - set([id(self)])
+            if others & _instrumented_runs or (
+                    others and self._instruments_requested()):
+                er = ("Error: profile, memory_profile, trace and metrics "
+                      "record the state of the whole process, and cannot be "
+                      "used while another run executes in the process")
+                raise Exception(er)
+            _active_runs.add(id(self))
+            self._registered = True
+            if self._instruments_requested():
+                _instrumented_runs.add(id(self))
+            else:
+                _instrumented_runs.discard(id(self))
+
+    def _unregister(self):
+        with _run_lock:
+            _active_runs.discard(id(self))
+            _instrumented_runs.discard(id(self))
+        self._registered = False
+
+    def _start_instruments(self):
+        """Start profiling, memory tracking, tracing and progress metrics of
+        the run, as requested in args."""
+        args = self.args
+        if args['profile']:
+            forage_timing.enable()
+        if args['memory_profile']:
+            forage_memory.enable()
+        if args['trace']:
+            forage_trace.enable(
+                os.path.join(args['outdir'], 'trace.jsonl'),
+                num_months=args[u'num_months'], outdir=args['outdir'],
+                century_dir=args[u'century_dir'])
+        if args['metrics']:
+            if isinstance(args['metrics'], basestring):
+                metrics_file = args['metrics']
+            else:
+                metrics_file = os.path.join(args['outdir'], 'metrics.prom')
+            forage_metrics.enable(
+                metrics_file, args[u'num_months'], outdir=args['outdir'])
+        self._instrumented = True
+
+    def _stop_instruments(self):
+        """Write reports of profiling and memory tracking to args['outdir'],
+        and stop instrumentation of the run."""
+        if not self._instrumented:
+            return
+        self._instrumented = False
+        args = self.args
+        if args['profile']:
+            forage_timing.write_report(args['outdir'])
+            forage_timing.disable()
+        if args['memory_profile']:
+            forage_memory.disable()
+            forage_memory.write_report(args['outdir'])
+        if args['trace']:
+            forage_trace.disable()
+        if args['metrics']:
+            forage_metrics.disable()
+
+    def _check_started(self):
+        if self._step is None:
+            er = "Error: the simulation has not been set up"
+            raise Exception(er)
+
+    def setup(self):
+        """Read model inputs, stage CENTURY inputs in the CENTURY directory,
+        and run the CENTURY spin-up and extend simulations for each grass
+        type up to the start of the run (or restore a saved spin-up or
+        state; see args['spin_up_dir'] and args['fork_state_dir'])."""
+        args = self.args
+        self._register()
+        if not os.path.exists(args['outdir']):
+            os.makedirs(args['outdir'])
+        self._start_instruments()
+        self._spin_up_outputs = os.path.join(
+            args['outdir'], 'CENTURY_outputs_spin_up')
+        if not os.path.exists(self._spin_up_outputs):
+            os.makedirs(self._spin_up_outputs)
+        forage.write_inputs_log(
+            args, datetime.now().strftime("%Y-%m-%d--%H_%M_%S"))
+        self._graz_file = os.path.join(args[u'century_dir'], 'graz.100')
+        self._century_cache = None
+        if args['century_cache_dir'] is not None:
+            self._century_cache = cent.CenturyRunCache(
+                args['century_cache_dir'], args['century_cache_size'] or 1000,
+                args['removal_quantum'])
+        self._read_livestock_inputs()
+        grass_list = read_grass(args)
+        if args['diet_table'] is not None:
+            args['diet_table'] = _read_diet_table(args)
+        self._grass_labels = [grass['label'] for grass in grass_list]
+        for grass in grass_list:
+            schedule = os.path.join(
+                args[u'input_dir'], (grass['label'] + '.sch'))
+            if os.path.exists(schedule):
+                self._schedule_list.append(schedule)
+            else:
+                er = "Error: schedule file not found"
+                raise Exception(er)
+            # write CENTURY batch file for spin-up simulation
+            hist_bat = os.path.join(
+                args[u'input_dir'], (grass['label'] + '_hist.bat'))
+            hist_schedule = grass['label'] + '_hist.sch'
+            hist_output = grass['label'] + '_hist'
+            cent.write_century_bat(
+                args[u'input_dir'], hist_bat, hist_schedule, hist_output,
+                args[u'fix_file'], 'outvars.txt')
+            # write CENTURY bat for extend simulation
+            extend_bat = os.path.join(
+                args[u'input_dir'], (grass['label'] + '.bat'))
+            schedule = grass['label'] + '.sch'
+            output = grass['label']
+            extend = grass['label'] + '_hist'
+            cent.write_century_bat(
+                args[u'input_dir'], extend_bat, schedule, output,
+                args[u'fix_file'], 'outvars.txt', extend)
+        # assume fix file is in the input directory, copy it to Century
+        # directory
+        forage_trace.copyfile(
+            os.path.join(args['input_dir'], args['fix_file']),
+            os.path.join(args['century_dir'], args['fix_file']))
+        # make a copy of the original graz params and schedule file
+        forage_trace.copyfile(
+            self._graz_file,
+            os.path.join(args[u'century_dir'], 'graz_orig.100'))
+        for schedule in self._schedule_list:
+            label = os.path.basename(schedule)[:-4]
+            copy_name = label + '_orig.sch'
+            forage_trace.copyfile(
+                schedule, os.path.join(args[u'input_dir'], copy_name))
+        file_list = self._file_list
+        for grass in grass_list:
+            move_outputs = [
+                grass['label']+'_hist_log.txt', grass['label']+'_hist.lis',
+                grass['label']+'_log.txt', grass['label']+'.lis',
+                grass['label']+'.bin']
+
+            # move CENTURY run files to CENTURY dir
+            hist_bat = os.path.join(
+                args[u'input_dir'], (grass['label'] + '_hist.bat'))
+            extend_bat = os.path.join(
+                args[u'input_dir'], (grass['label'] + '.bat'))
+            e_schedule = os.path.join(
+                args[u'input_dir'], grass['label'] + '.sch')
+            h_schedule = os.path.join(
+                args[u'input_dir'], grass['label'] + '_hist.sch')
+            site_file, weather_file = cent.get_site_weather_files(
+                e_schedule, args[u'input_dir'])
+            grass_files = [
+                hist_bat, extend_bat, e_schedule, h_schedule, site_file]
+            for file_name in grass_files:
+                file_list.append(file_name)
+            if weather_file != 'NA':
+                file_list.append(weather_file)
+            for file_name in file_list:
+                forage_trace.copyfile(
+                    file_name,
+                    os.path.join(
+                        args[u'century_dir'], os.path.basename(file_name)))
+            # run CENTURY for spin-up for each grass type up to start_year
+            # and start_month
+            hist_bat = os.path.join(
+                args[u'century_dir'], (grass['label'] + '_hist.bat'))
+            century_bat = os.path.join(
+                args[u'century_dir'], (grass['label'] + '.bat'))
+            if args['fork_state_dir'] is not None:
+                # CENTURY results are restored from the saved state, below
+                continue
+            with forage_timing.phase('century_spin_up'):
+                if args['spin_up_dir'] is not None:
+                    _restore_spin_up(
+                        grass['label'], args['spin_up_dir'],
+                        args[u'century_dir'], self._spin_up_outputs)
+                    move_outputs = move_outputs[2:]
+                else:
+                    cent.launch_CENTURY_subprocess(
+                        hist_bat, args[u'century_dir'])
+                cent.launch_CENTURY_subprocess(
+                    century_bat, args[u'century_dir'])
+
+            # save copies of CENTURY outputs, but remove from CENTURY dir
+            with forage_timing.phase('file_copy'):
+                for file_name in move_outputs:
+                    forage_trace.move(
+                        os.path.join(args[u'century_dir'], file_name),
+                        os.path.join(self._spin_up_outputs, file_name))
+        self._start_run()
+
+    def _read_livestock_inputs(self):
+        """Read herbivores, supplement and site descriptors from args."""
+        args = self.args
+        self._herbivore_list = _read_herbivores(args)
+        self._supp, self._supp_available = _read_supplement(args)
+        self._site = forage.SiteInfo(args[u'steepness'], args[u'latitude'])
+
+    def _start_run(self):
+        """Set the state of the run to that at its first step: step 0
+        following the CENTURY spin-up, or the step of a saved state."""
+        args = self.args
+        self._n_substeps = forage.find_substeps_per_month(
+            args['livestock_step'])
+        self._master_diet_dict = None
+        self._diet_segregation_dict = None
+        if args['diet_verbose']:
+            self._master_diet_dict = {}
+            self._diet_segregation_dict = {'step': [], 'segregation': []}
+        herbivore_list = self._herbivore_list
+        grass_list = read_grass(args)
+        self._results_dict = _init_results_dict(herbivore_list, grass_list)
+        self._intermediate_dir = self._spin_up_outputs
+        self._surrogate_dict = None
+        self._step = 0
+        if args['fork_state_dir'] is not None:
+            state = _restore_state(args, grass_list)
+            self._step = state['step']
+            herbivore_list = state['herbivore_list']
+            grass_list = state['grass_list']
+            self._available_forage = state['available_forage']
+            self._results_dict = state['results_dict']
+            self._surrogate_dict = state['surrogate_dict']
+            self._intermediate_dir = state['intermediate_dir']
+            if args['diet_verbose']:
+                self._master_diet_dict = state['master_diet_dict']
+                self._diet_segregation_dict = state['diet_segregation_dict']
+        else:
+            if args['century_surrogate'] is not None:
+                self._surrogate_dict = _read_surrogates(
+                    args, grass_list, self._intermediate_dir)
+                # keep loaded surrogates for later runs (see restart)
+                args['century_surrogate'] = dict(
+                    (label, entry['surrogate']) for label, entry in
+                    self._surrogate_dict.items())
+            _add_initial_results(
+                args, herbivore_list, self._results_dict, numpy.nan)
+            self._available_forage = None
+        self._herbivore_list = herbivore_list
+        self._grass_list = grass_list
+        if self._step == args[u'num_months']:
+            self._end_run()
+
+    def restart(self, overrides=None):
+        """Return the run to its first step, to run it again with inputs
+        changed by overrides.  CENTURY inputs staged by setup, the CENTURY
+        spin-up, and loaded diet tables, surrogates and the CENTURY run
+        cache are reused; herbivore, supplement and grass tables are read
+        again.  Reports of the previous run (profile, memory profile, trace
+        and metrics, if requested) are written before the restart; its
+        results should be collected first (see results).
+
+        Parameters:
+            overrides (dict): inputs of the new run that differ from args,
+                e.g. 'herbivore_csv', 'density_series', 'grz_months',
+                'mgmt_threshold' or 'outdir'.  Inputs that determine the
+                staged CENTURY inputs and spin-up (_SETUP_INPUTS) cannot be
+                changed
+
+        Returns:
+            None
+        """
+        self._check_started()
+        overrides = overrides or {}
+        for key in overrides:
+            if key in _SETUP_INPUTS:
+                er = ("Error: %s cannot be changed on restart; set up a new "
+                      "simulation" % key)
+                raise Exception(er)
+        self._stop_instruments()
+        self.args.update(overrides)
+        args = self.args
+        self._register()
+        if not os.path.exists(args['outdir']):
+            os.makedirs(args['outdir'])
+        self._start_instruments()
+        # undo edits of the previous run to schedules and grazing parameters
+        for schedule in self._schedule_list:
+            forage_trace.copyfile(
+                schedule, os.path.join(
+                    args[u'century_dir'], os.path.basename(schedule)))
+        forage_trace.copyfile(
+            os.path.join(args[u'century_dir'], 'graz_orig.100'),
+            self._graz_file)
+        spin_up_outputs = os.path.join(
+            args['outdir'], 'CENTURY_outputs_spin_up')
+        if spin_up_outputs != self._spin_up_outputs:
+            if not os.path.exists(spin_up_outputs):
+                shutil.copytree(self._spin_up_outputs, spin_up_outputs)
+            self._spin_up_outputs = spin_up_outputs
+        forage.write_inputs_log(
+            args, datetime.now().strftime("%Y-%m-%d--%H_%M_%S"))
+        self._read_livestock_inputs()
+        self._start_run()
+
+    def is_complete(self):
+        """Has the run reached its last step?"""
+        self._check_started()
+        return self._step >= self.args[u'num_months']
+
+    def step(self):
+        """Advance the run by one model step: update forage from CENTURY
+        outputs, select diets and graze, and send the removal of biomass to
+        CENTURY (or the surrogate of CENTURY).
+
+        Returns:
+            the next step; args['num_months'] when the run is complete
+        """
+        self._check_started()
+        args = self.args
+        if self.is_complete():
+            er = "Error: the run is complete"
+            raise Exception(er)
+        step = self._step
+        if step == args['save_state_step']:
+            _save_state(
+                args, self._grass_list, self._intermediate_dir, self.state())
+        forage_timing.set_step(step)
+        forage_trace.set_step(step)
+        forage_memory.set_step(step)
+        forage_metrics.set_step(step, _latest_offtake(self._results_dict))
+        month, year = find_step_date(args, step)
+
+        # get biomass and crude protein for each grass type from CENTURY
+        self._read_forage(month, year, args[u'user_define_protein'])
+        self._available_forage, diet_dict, consumed_dict = _livestock_step(
+            args, step, _TIME_STEP, self._n_substeps, self._herbivore_list,
+            self._grass_list, self._available_forage, self._site, self._supp,
+            self._supp_available, self._results_dict)
+        if args['diet_verbose']:
+            # save diet_dict across steps to be written out later
+            self._master_diet_dict[step] = diet_dict
+            diet_segregation = forage.calc_diet_segregation(diet_dict)
+            self._diet_segregation_dict['step'].append(step)
+            self._diet_segregation_dict['segregation'].append(
+                diet_segregation)
+
+        # send to CENTURY for this month's scheduled grazing event
+        if args['century_surrogate'] is not None:
+            _surrogate_step(
+                self._surrogate_dict, self._grass_list, consumed_dict, year,
+                month)
+        else:
+            self._century_step(step, month, year, consumed_dict)
+        self._step = step + 1
+        if self._step == args[u'num_months']:
+            self._end_run()
+        return self._step
+
+    def run(self, n_steps=None):
+        """Advance the run by n_steps steps, or to the end of the run if
+        n_steps is None or the run ends first.
+
+        Returns:
+            the next step; args['num_months'] when the run is complete
+        """
+        self._check_started()
+        n_done = 0
+        while not self.is_complete() and (
+                n_steps is None or n_done < n_steps):
+            self.step()
+            n_done += 1
+        return self._step
+
+    def _read_forage(self, month, year, user_define_protein):
+        """Update biomass and crude protein of each grass type from CENTURY
+        outputs (or the surrogate of CENTURY) for the month before month and
+        year."""
+        target_month = cent.find_prev_month(year, month)
+        for grass in self._grass_list:
+            if self.args['century_surrogate'] is not None:
+                row = _trajectory_row(
+                    self._surrogate_dict[grass['label']]['table'],
+                    target_month)
+                _update_grass(grass, row, user_define_protein)
+                continue
+            output_file = os.path.join(
+                self._intermediate_dir, grass['label'] + '.lis')
+            outputs = cent.read_CENTURY_outputs(
+                output_file, year - 1, year + 1)
+            outputs = outputs[~outputs.index.duplicated(keep='first')]
+            try:
+                row = outputs.loc[target_month]
+            except KeyError:
+                raise Exception("CENTURY outputs not as expected")
+            _update_grass(grass, row, user_define_protein)
+
+    def _century_step(self, step, month, year, consumed_dict):
+        """Schedule the removal of biomass by grazing in the month in
+        CENTURY schedules, run CENTURY for each grass type and move its
+        outputs to the output directory of the month."""
+        args = self.args
+        add_event = 1  # TODO should this ever be 0?
+        date = year + float('%.2f' % (month / 12.))
+        if self._century_cache is not None:
+            consumed_dict = self._century_cache.quantize_removal(
+                consumed_dict)
+        for grass in self._grass_list:
+            g_label = ';'.join([grass['label'], 'green'])
+            d_label = ';'.join([grass['label'], 'dead'])
+            # only modify schedule if any of this grass was grazed
+            if consumed_dict[g_label] > 0 or consumed_dict[d_label] > 0:
+                schedule = os.path.join(
+                    args[u'century_dir'], (grass['label'] + '.sch'))
+                target_dict = cent.find_target_month(
+                    add_event, schedule, date, 12)
+                if target_dict == 0:
+                    raise Exception, """Error: grazing event already
+                                        scheduled in file"""
+                new_code = cent.add_new_graz_level(
+                    grass, consumed_dict, self._graz_file,
+                    args[u'template_level'], args[u'outdir'], step)
+                cent.modify_schedule(
+                    schedule, add_event, target_dict, new_code,
+                    args[u'outdir'], step)
+
+            # call CENTURY from the batch file
+            century_bat = os.path.join(
+                args[u'century_dir'], (grass['label'] + '.bat'))
+            with forage_timing.phase('century_month'):
+                if self._century_cache is not None:
+                    cent.launch_CENTURY_cached(
+                        century_bat, self._century_cache,
+                        args[u'century_dir'])
+                else:
+                    cent.launch_CENTURY_subprocess(
+                        century_bat, args[u'century_dir'])
+
+            # save copies of CENTURY outputs, but remove from CENTURY dir
+            century_outputs = [
+                grass['label']+'_log.txt', grass['label']+'.lis',
+                grass['label']+'.bin']
+            self._intermediate_dir = os.path.join(
+                args['outdir'], 'CENTURY_outputs_m%d_y%d' % (month, year))
+            if not os.path.exists(self._intermediate_dir):
+                os.makedirs(self._intermediate_dir)
+            with forage_timing.phase('file_copy'):
+                for file_name in century_outputs:
+                    n_tries = 6
+                    while True:
+                        if n_tries == 0:
+                            break
+                        try:
+                            n_tries -= 1
+                            forage_trace.move(
+                                os.path.join(
+                                    args[u'century_dir'], file_name),
+                                os.path.join(
+                                    self._intermediate_dir, file_name),
+                                attempt=6 - n_tries)
+                            break
+                        except OSError:
+                            print (
+                                'OSError in moving %s, trying again' %
+                                file_name)
+                            time.sleep(1.0)
+
+    def _end_run(self):
+        """Save the state at the last step, if requested, and add final
+        standing biomass to summary results."""
+        args = self.args
+        step = args[u'num_months']
+        if step == args['save_state_step']:
+            _save_state(
+                args, self._grass_list, self._intermediate_dir, self.state())
+        forage_timing.set_step(step)
+        forage_trace.set_step(step)
+        forage_memory.set_step(step)
+        forage_metrics.set_step(step, _latest_offtake(self._results_dict))
+        month, year = find_step_date(args, step)
+        self._read_forage(month, year, 1)
+        _add_final_results(
+            self._grass_list, self._available_forage, self._results_dict)
+
+    def state(self):
+        """State of the run at the start of the next step.
+
+        Returns:
+            dictionary with entries 'step' (the next step), 'herbivore_list',
+                'grass_list', 'available_forage', 'results_dict' (summary
+                results so far), 'surrogate_dict', 'master_diet_dict' and
+                'diet_segregation_dict', as saved with args['save_state_step'].
+                Entries are the objects of the run, not copies
+        """
+        self._check_started()
+        return {
+            'step': self._step,
+            'herbivore_list': self._herbivore_list,
+            'grass_list': self._grass_list,
+            'available_forage': self._available_forage,
+            'results_dict': self._results_dict,
+            'surrogate_dict': self._surrogate_dict,
+            'master_diet_dict': self._master_diet_dict,
+            'diet_segregation_dict': self._diet_segregation_dict}
+
+    def results(self):
+        """Results of the run so far, as returned by execute."""
+        self._check_started()
+        if self.args['diet_verbose']:
+            return _results_frames(
+                self._results_dict, self._master_diet_dict,
+                self._diet_segregation_dict)
+        return _results_frames(self._results_dict)
+
+    def _cleanup(self):
+        """Restore the original grazing parameters in the CENTURY directory,
+        and remove files staged by setup and outputs of CENTURY left in the
+        CENTURY and input directories."""
+        args = self.args
+        graz_orig = os.path.join(args[u'century_dir'], 'graz_orig.100')
+        if os.path.isfile(graz_orig):
+            # replace graz params used by CENTURY with original file
+            os.remove(self._graz_file)
+            forage_trace.copyfile(graz_orig, self._graz_file)
+            os.remove(graz_orig)
+        files_to_remove = set(
+            os.path.join(args[u'century_dir'], os.path.basename(f)) for f in
+            self._file_list)
+        for label in self._grass_labels:
+            files_to_remove.add(
+                os.path.join(args[u'century_dir'], label + '_hist.bin'))
+            files_to_remove.add(
+                os.path.join(args[u'input_dir'], label + '_orig.sch'))
+            files_to_remove.add(
+                os.path.join(args[u'input_dir'], label + '_hist.bat'))
+            files_to_remove.add(
+                os.path.join(args[u'input_dir'], label + '.bat'))
+            for ext in ['.lis', '.bin', '_log.txt']:
+                files_to_remove.add(
+                    os.path.join(args[u'century_dir'], label + ext))
+        for file_name in files_to_remove:
+            if os.path.isfile(file_name):
+                os.remove(file_name)
+
+    def close(self):
+        """Restore the CENTURY and input directories, write results of the
+        run to csv files in args['outdir'] if args['write_csv'] is set, and
+        write reports of profiling and memory tracking, if requested.
+
+        Returns:
+            dictionary of pandas data frames, see execute, or None if setup
+                did not reach the start of the run
+        """
+        if self._closed:
+            er = "Error: the simulation is already closed"
+            raise Exception(er)
+        self._closed = True
+        if not self._registered:
+            # setup was refused, and staged nothing
+            return None
+        args = self.args
+        results = None
         try:
-            val = args[opt_arg]
-        except KeyError:
-            args[opt_arg] = None
-    now_str = datetime.now().strftime("%Y-%m-%d--%H_%M_%S")
-    if not os.path.exists(args['outdir']):
-        os.makedirs(args['outdir'])
-    intermediate_dir = os.path.join(
-        args['outdir'], 'CENTURY_outputs_spin_up')
+            self._cleanup()
+            if self._results_dict is not None:
+                results = self.results()
+                if args['write_csv']:
+                    with forage_timing.phase('write_results'):
+                        for name, df in results.items():
+                            save_as = os.path.join(
+                                args['outdir'], name + '.csv')
+                            if name == 'summary_results':
+                                df.to_csv(save_as, na_rep='NA')
+                            else:
+                                df.to_csv(save_as, index=False)
+                            forage_metrics.add_files()
+        finally:
+            try:
+                self._stop_instruments()
+            finally:
+                self._unregister()
+        return results
+
+
+def _latest_offtake(results_dict):
+    """Total offtake of the latest complete step, or None before the first
+    step is complete."""
+    if not results_dict['total_offtake']:
+        return None
+    return results_dict['total_offtake'][-1]
+
+
+def _results_frames(results_dict, master_diet_dict=None,
+                    diet_segregation_dict=None):
+    """Collect results of a model run into pandas data frames.
+
+    Parameters:
+        results_dict (dict): summary results, see _init_results_dict
+        master_diet_dict (dict): diets selected by each herbivore class,
+            keyed by step, if diet details were saved
+        diet_segregation_dict (dict): diet segregation at each step, if diet
+            details were saved
+
+    Returns:
+        dictionary of data frames keyed by the name of the csv file each is
+            written to: 'summary_results' and, if diet details were saved,
+            'diet_segregation' and '<herbivore>_diet'.  Missing values in
+            summary results are NaN
+    """
+    results = {}
+    filled_dict = forage.fill_dict(results_dict, numpy.nan)
+    results['summary_results'] = pandas.DataFrame(filled_dict)
+    if diet_segregation_dict is not None:
+        results['diet_segregation'] = pandas.DataFrame(diet_segregation_dict)
+    if master_diet_dict:
+        for h_label in master_diet_dict[0].keys():
+            new_dict = {}
+            new_dict['step'] = master_diet_dict.keys()
+            new_dict['DMDf'] = [
+                master_diet_dict[step][h_label].DMDf for step in
+                master_diet_dict.keys()]
+            new_dict['CPIf'] = [
+                master_diet_dict[step][h_label].CPIf for step in
+                master_diet_dict.keys()]
+            grass_labels = master_diet_dict[0][h_label].intake.keys()
+            for g_label in grass_labels:
+                new_dict['intake_' + g_label] = (
+                    [master_diet_dict[step][h_label].intake[g_label] for
+                        step in master_diet_dict.keys()])
+            results[h_label + '_diet'] = pandas.DataFrame(new_dict)
+    return results
+
+
+def run_spin_up(args, spin_up_dir):
+    """Run the CENTURY spin-up simulation for each grass type and save its
+    outputs to spin_up_dir, so that many runs of the model that share the
+    same spin-up can start from it (see args['spin_up_dir'] in execute).
+
+    Parameters:
+        args - a python dictionary of inputs to the model, as for execute
+        spin_up_dir - directory where spin-up outputs should be saved
+
+    Returns:
+        spin_up_dir"""
+
+    if not os.path.exists(spin_up_dir):
+        os.makedirs(spin_up_dir)
+    grass_list = read_grass(args)
+    shutil.copyfile(
+        os.path.join(args['input_dir'], args['fix_file']),
+        os.path.join(args['century_dir'], args['fix_file']))
+    for grass in grass_list:
+        hist_bat = os.path.join(
+            args[u'input_dir'], (grass['label'] + '_hist.bat'))
+        hist_schedule = grass['label'] + '_hist.sch'
+        hist_output = grass['label'] + '_hist'
+        cent.write_century_bat(
+            args[u'input_dir'], hist_bat, hist_schedule, hist_output,
+            args[u'fix_file'], 'outvars.txt')
+        h_schedule = os.path.join(args[u'input_dir'], hist_schedule)
+        site_file, weather_file = cent.get_site_weather_files(
+            h_schedule, args[u'input_dir'])
+        file_list = [hist_bat, h_schedule, site_file]
+        if weather_file != 'NA':
+            file_list.append(weather_file)
+        try:
+            for file_name in file_list:
+                shutil.copyfile(
+                    file_name, os.path.join(
+                        args[u'century_dir'], os.path.basename(file_name)))
+            cent.launch_CENTURY_subprocess(
+                os.path.join(args[u'century_dir'], os.path.basename(hist_bat)),
+                args[u'century_dir'])
+            for ext in ['.bin', '.lis', '_log.txt']:
+                shutil.move(
+                    os.path.join(args[u'century_dir'], hist_output + ext),
+                    os.path.join(spin_up_dir, hist_output + ext))
+        finally:
+            for file_name in file_list:
+                obj = os.path.join(
+                    args[u'century_dir'], os.path.basename(file_name))
+                if os.path.isfile(obj):
+                    os.remove(obj)
+            os.remove(hist_bat)
+    return spin_up_dir
+
+
+def _save_state(args, grass_list, intermediate_dir, state):
+    """Save the complete state of a model run at the start of a step, so
+    that other runs can continue from it (see args['fork_state_dir'] in
+    execute).  CENTURY schedules, grazing parameters, spin-up results and
+    the latest CENTURY outputs are copied to args['save_state_dir'], and the
+    state of the livestock model is pickled to 'state.pkl' there.
+
+    Parameters:
+        args (dict): model inputs, see execute
+        grass_list (list): grass types, see read_grass
+        intermediate_dir (string): directory containing the latest CENTURY
+            outputs
+        state (dict): state of the livestock model, including the step,
+            herbivores, forage and summary results so far
+
+    Returns:
+        None
+    """
+    state_dir = args['save_state_dir']
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    for grass in grass_list:
+        for file_name in [grass['label'] + '.sch',
+                          grass['label'] + '_hist.bin']:
+            shutil.copyfile(
+                os.path.join(args[u'century_dir'], file_name),
+                os.path.join(state_dir, file_name))
+        lis_file = os.path.join(intermediate_dir, grass['label'] + '.lis')
+        if os.path.isfile(lis_file):
+            shutil.copyfile(
+                lis_file, os.path.join(state_dir, grass['label'] + '.lis'))
+    shutil.copyfile(
+        os.path.join(args[u'century_dir'], 'graz.100'),
+        os.path.join(state_dir, 'graz.100'))
+    state = dict(state)
+    state['intermediate_dir'] = os.path.basename(intermediate_dir)
+    state['inputs'] = dict((key, args[key]) for key in _STATE_INPUTS)
+    with open(os.path.join(state_dir, 'state.pkl'), 'wb') as state_file:
+        cPickle.dump(state, state_file, cPickle.HIGHEST_PROTOCOL)
+
+
+def _restore_state(args, grass_list):
+    """Restore the state of a model run saved by _save_state in
+    args['fork_state_dir'], in place of running CENTURY and the livestock
+    model up to the step at which it was saved.
+
+    Returns:
+        dictionary of the saved state, with 'intermediate_dir' giving the
+            directory in args['outdir'] where the latest CENTURY outputs were
+            restored
+    """
+    state_dir = args['fork_state_dir']
+    state_pkl = os.path.join(state_dir, 'state.pkl')
+    if not os.path.isfile(state_pkl):
+        er = "Error: saved state not found in %s" % state_dir
+        raise Exception(er)
+    with open(state_pkl, 'rb') as state_file:
+        state = cPickle.load(state_file)
+    for key, val in state['inputs'].items():
+        if args[key] != val:
+            er = "Error: %s differs from the saved state (%s)" % (key, val)
+            raise Exception(er)
+    if state['step'] > args[u'num_months']:
+        er = "Error: state was saved after the last step of the run"
+        raise Exception(er)
+    if args['diet_verbose'] and state['master_diet_dict'] is None:
+        er = "Error: diet details were not saved with the state"
+        raise Exception(er)
+    if ((args['century_surrogate'] is None) !=
+            (state['surrogate_dict'] is None)):
+        er = "Error: century_surrogate must be used as in the saved state"
+        raise Exception(er)
+    intermediate_dir = os.path.join(args['outdir'], state['intermediate_dir'])
     if not os.path.exists(intermediate_dir):
         os.makedirs(intermediate_dir)
-    forage.write_inputs_log(args, now_str)
-    forage.set_time_step('month')  # current default, enforced by CENTURY
-    add_event = 1  # TODO should this ever be 0?
-    steps_per_year = forage.find_steps_per_year()
-    graz_file = os.path.join(args[u'century_dir'], 'graz.100')
-    cent.set_century_directory(args[u'century_dir'])
-    if args['diet_verbose']:
-        master_diet_dict = {}
-        diet_segregation_dict = {'step': [], 'segregation': []}
+    for grass in grass_list:
+        for file_name in [grass['label'] + '.sch',
+                          grass['label'] + '_hist.bin']:
+            shutil.copyfile(
+                os.path.join(state_dir, file_name),
+                os.path.join(args[u'century_dir'], file_name))
+        lis_file = os.path.join(state_dir, grass['label'] + '.lis')
+        if os.path.isfile(lis_file):
+            shutil.copyfile(
+                lis_file,
+                os.path.join(intermediate_dir, grass['label'] + '.lis'))
+    shutil.copyfile(
+        os.path.join(state_dir, 'graz.100'),
+        os.path.join(args[u'century_dir'], 'graz.100'))
+    state['intermediate_dir'] = intermediate_dir
+    return state
+
+
+def _restore_spin_up(label, spin_up_dir, century_dir, intermediate_dir):
+    """Copy saved spin-up results for one grass type into the CENTURY
+    directory, in place of running the spin-up simulation."""
+
+    hist_bin = os.path.join(spin_up_dir, label + '_hist.bin')
+    if not os.path.isfile(hist_bin):
+        er = "Error: spin-up results not found for %s" % label
+        raise Exception(er)
+    shutil.copyfile(hist_bin, os.path.join(century_dir, label + '_hist.bin'))
+    for file_name in [label + '_hist_log.txt', label + '_hist.lis']:
+        saved = os.path.join(spin_up_dir, file_name)
+        if os.path.isfile(saved):
+            shutil.copyfile(saved, os.path.join(intermediate_dir, file_name))
+
+
+def execute_from_trajectories(args, century_outputs):
+    """Run the livestock model against stored CENTURY outputs, without
+    launching CENTURY.
+
+    This is one-way coupling for screening: forage available to herbivores is
+    drawn from CENTURY outputs supplied by the caller, so offtake by
+    herbivores does not feed back to forage growth.  The fraction of live and
+    standing dead biomass removed at each step, which a coupled run would
+    send to CENTURY, is reported alongside summary results.  Nothing is read
+    from or written to the CENTURY directory.
+
+    Parameters:
+        args (dict): model inputs, as for execute. Entries describing
+            CENTURY inputs and outputs ('input_dir', 'century_dir',
+            'outdir', 'template_level', 'fix_file') are not used
+        century_outputs (dict): CENTURY outputs for each grass type, keyed
+            by grass label. Each entry is either a pandas data frame indexed
+            by CENTURY time and containing the columns 'aglivc', 'stdedc',
+            'aglive1' and 'stdede1', as returned by
+            forage_century_link_utils.read_CENTURY_outputs, or the path to a
+            CENTURY .lis file
+
+    Herbivore inputs may be supplied in memory, in place of
+    args['herbivore_csv'], as a list of dictionaries in
+    args['herbivore_inputs'], one per herbivore class with the columns of the
+    herbivore table as keys.  Diets may be interpolated from a table, as
+    described for args['diet_table'] in execute.
+
+    Returns:
+        tuple of pandas data frames (summary_df, removal_df). summary_df
+            contains the columns of summary_results.csv, with NaN where
+            execute writes 'NA'. removal_df contains one row per step giving
+            the fraction of live ('<grass>_flgrem') and standing dead
+            ('<grass>_fdgrem') biomass of each grass type removed
+    """
+    args = dict(args)
+    for opt_arg in [
+            'grz_months', 'density_series', 'digestibility_flag',
+            'livestock_step', 'diet_table']:
+        if opt_arg not in args:
+            args[opt_arg] = None
+    if args['livestock_step'] is None:
+        args['livestock_step'] = 'month'
+    n_substeps = forage.find_substeps_per_month(args['livestock_step'])
+    herbivore_list = _read_herbivores(args)
+    grass_list = read_grass(args)
+    if args['diet_table'] is not None:
+        args['diet_table'] = _read_diet_table(args)
+    supp, supp_available = _read_supplement(args)
+    site = forage.SiteInfo(args[u'steepness'], args[u'latitude'])
+    trajectory_dict = {}
+    for grass in grass_list:
+        trajectory_dict[grass['label']] = _trajectory_table(
+            century_outputs[grass['label']])
+
+    results_dict = _init_results_dict(herbivore_list, grass_list)
+    _add_initial_results(args, herbivore_list, results_dict, numpy.nan)
+    removal_columns = ['step', 'year', 'month']
+    for grass in grass_list:
+        removal_columns.append(grass['label'] + '_flgrem')
+        removal_columns.append(grass['label'] + '_fdgrem')
+    removal_dict = dict((column, []) for column in removal_columns)
+    available_forage = None
+    for step in xrange(args[u'num_months']):
+        month, year = find_step_date(args, step)
+        target_month = cent.find_prev_month(year, month)
+        for grass in grass_list:
+            row = _trajectory_row(trajectory_dict[grass['label']], target_month)
+            _update_grass(grass, row, args[u'user_define_protein'])
+        available_forage, diet_dict, consumed_dict = _livestock_step(
+            args, step, _TIME_STEP, n_substeps, herbivore_list, grass_list,
+            available_forage, site, supp, supp_available, results_dict)
+        removal_dict['step'].append(step)
+        removal_dict['year'].append(year)
+        removal_dict['month'].append(month)
+        for grass in grass_list:
+            removal_dict[grass['label'] + '_flgrem'].append(
+                consumed_dict[';'.join([grass['label'], 'green'])])
+            removal_dict[grass['label'] + '_fdgrem'].append(
+                consumed_dict[';'.join([grass['label'], 'dead'])])
+    month, year = find_step_date(args, args[u'num_months'])
+    target_month = cent.find_prev_month(year, month)
+    for grass in grass_list:
+        row = _trajectory_row(trajectory_dict[grass['label']], target_month)
+        _update_grass(grass, row, 1)
+    _add_final_results(grass_list, available_forage, results_dict)
+
+    summary_df = pandas.DataFrame(forage.fill_dict(results_dict, numpy.nan))
+    removal_df = pandas.DataFrame(removal_dict, columns=removal_columns)
+    return summary_df, removal_df
+
+
+def trajectory_digest(century_outputs):
+    """Digest of the content of stored CENTURY outputs, as taken by
+    execute_from_trajectories, so that caches of results of runs on them are
+    reused only for the same outputs.
+
+    Returns:
+        hexadecimal string
+    """
+    digest = hashlib.md5()
+    for label in sorted(century_outputs):
+        outputs_df = century_outputs[label]
+        digest.update(str(label))
+        digest.update(repr([str(c) for c in outputs_df.columns]))
+        digest.update(numpy.ascontiguousarray(
+            outputs_df.index.values, dtype=float).tobytes())
+        digest.update(numpy.ascontiguousarray(
+            outputs_df.values, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+def tabulate_diets(args, grid=None, save_as=None):
+    """Tabulate the diet selected by each herbivore class, and intermediate
+    quantities calculated from it, on a grid of forage biomass and crude
+    protein, so that diets can be interpolated from the table in place of
+    diet selection (see args['diet_table'] in execute).
+
+    Diets are tabulated for each state of the reproductive cycle of breeding
+    females.  Digestibility of forage is calculated from crude protein, or
+    taken from the grass table if args['user_define_digestibility'] is true.
+
+    Parameters:
+        args (dict): model inputs, as for execute. Entries describing
+            CENTURY inputs and outputs ('input_dir', 'century_dir',
+            'outdir', 'template_level', 'fix_file') are not used
+        grid (dict): values of biomass (kg/ha, key 'biomass') and crude
+            protein (proportion, key 'crude_protein') at which diets are
+            tabulated, shared by all forage types; by default
+            forage_diet_table.DEFAULT_GRID.  If args['user_define_protein']
+            is true, crude protein of each forage type is taken from the
+            grass table instead
+        save_as (string): if supplied, the table is saved to this file
+
+    Returns:
+        the table, of class forage_diet_table.DietTable
+    """
+    args = dict(args)
+    for opt_arg in [
+            'grz_months', 'density_series', 'digestibility_flag',
+            'diet_table']:
+        if opt_arg not in args:
+            args[opt_arg] = None
+    if grid is None:
+        grid = forage_diet_table.DEFAULT_GRID
+    herbivore_list = _read_herbivores(args)
+    grass_list = read_grass(args)
+    supp, supp_available = _read_supplement(args)
+    site = forage.SiteInfo(args[u'steepness'], args[u'latitude'])
+    total_SD = forage.calc_total_stocking_density(herbivore_list)
+
+    # forage types in the order of forage_utils.calc_feed_types
+    forage_types = []
+    axes = []
+    for grass in grass_list:
+        for green_or_dead in ['green', 'dead']:
+            forage_types.append((grass, green_or_dead))
+            axes.append(grid['biomass'])
+            if args[u'user_define_protein']:
+                axes.append([grass['cprotein_' + green_or_dead]])
+            else:
+                axes.append(grid['crude_protein'])
+    f_labels = []
+    digestibility = []
+    for f_index, (grass, green_or_dead) in enumerate(forage_types):
+        f_labels.append(';'.join([grass['label'], green_or_dead]))
+        f_dmd = []
+        for cprotein in axes[2 * f_index + 1]:
+            feed_type = forage.FeedType(
+                grass['label'], green_or_dead, 0.,
+                grass['DMD_' + green_or_dead], cprotein, grass['type'])
+            if not args[u'user_define_digestibility']:
+                feed_type.calc_digestibility_from_protein(
+                    args['digestibility_flag'])
+            f_dmd.append(feed_type.digestibility)
+        digestibility.append(f_dmd)
+    table = forage_diet_table.DietTable(
+        f_labels, axes, digestibility, forage_diet_table.table_inputs(args))
+    shape = [len(axis) for axis in axes]
+    n_outputs = len(table.output_names())
+
+    for herb_class in herbivore_list:
+        if herb_class.sex == 'breeding_female':
+            n_steps = int(herb_class.calving_interval)
+        else:
+            n_steps = 1
+        states = []
+        values = []
+        for step in xrange(n_steps):
+            herb_class.update(step)
+            state = forage_diet_table.herbivore_state(herb_class)
+            if state in states:
+                continue
+            states.append(state)
+            state_values = numpy.zeros(
+                shape + [n_outputs], dtype=numpy.float32)
+            for index in numpy.ndindex(*shape):
+                available_forage = []
+                for f_index, (grass, green_or_dead) in enumerate(
+                        forage_types):
+                    available_forage.append(forage.FeedType(
+                        grass['label'], green_or_dead,
+                        axes[2 * f_index][index[2 * f_index]],
+                        grass['DMD_' + green_or_dead],
+                        axes[2 * f_index + 1][index[2 * f_index + 1]],
+                        grass['type']))
+                sum_biomass = forage.calc_total_biomass(available_forage)
+                for feed_type in available_forage:
+                    feed_type.rel_availability = (
+                        feed_type.biomass / sum_biomass)
+                    if not args[u'user_define_digestibility']:
+                        feed_type.calc_digestibility_from_protein(
+                            args['digestibility_flag'])
+                diet = _select_diet(
+                    args, herb_class, available_forage, site, supp,
+                    supp_available, total_SD)
+                diet_interm = forage.calc_diet_intermediates(
+                    diet, herb_class, args[u'prop_legume'], args[u'DOY'],
+                    site, supp)
+                state_values[index] = (
+                    [diet.intake[f_label] for f_label in f_labels] +
+                    [diet.Is] + [
+                        getattr(diet_interm, name) for name in
+                        forage_diet_table.INTERMEDIATES])
+            values.append(state_values)
+        table.add_class(herb_class.label, states, numpy.array(values))
+    if save_as is not None:
+        table.save(save_as)
+    return table
+
+
+def _read_diet_table(args):
+    """Load the diet table named by args['diet_table'], if it is not already
+    loaded, and check that it was built for the model inputs in args."""
+
+    table = args['diet_table']
+    if not isinstance(table, forage_diet_table.DietTable):
+        table = forage_diet_table.DietTable.load(table)
+    table.check_inputs(args)
+    return table
+
+
+def _trajectory_table(outputs):
+    """Arrange CENTURY outputs for one grass type for fast lookup by date.
+
+    Parameters:
+        outputs (pandas data frame or string): CENTURY outputs as returned
+            by read_CENTURY_outputs, or the path to a CENTURY .lis file
+
+    Returns:
+        dictionary of CENTURY outputs for each month, keyed by CENTURY time
+            rounded to two decimals
+    """
+    if not isinstance(outputs, pandas.DataFrame):
+        outputs = cent.read_CENTURY_outputs(
+            outputs, float('-inf'), float('inf'))
+    outputs = outputs[~outputs.index.duplicated(keep='first')]
+    columns = ['aglivc', 'stdedc', 'aglive1', 'stdede1']
+    table = {}
+    for time_val, values in zip(
+            outputs.index, outputs[columns].values.tolist()):
+        table[round(time_val, 2)] = dict(zip(columns, values))
+    return table
+
+
+def _trajectory_row(table, target_month):
+    """Find CENTURY outputs for one month in a table made by
+    _trajectory_table."""
+
+    try:
+        return table[round(target_month, 2)]
+    except KeyError:
+        raise Exception("CENTURY outputs not as expected")
+
+
+def _read_surrogates(args, grass_list, intermediate_dir):
+    """Set up surrogates of CENTURY growth for each grass type, starting
+    from CENTURY outputs of the initial extend simulation.
+
+    Parameters:
+        args (dict): model inputs, as for execute
+        grass_list (list): descriptors of each grass type
+        intermediate_dir (string): directory containing CENTURY outputs of
+            the initial extend simulation
+
+    Returns:
+        dictionary keyed by grass label, where each entry is a dictionary
+            with entries 'surrogate' (forage_surrogate.GrowthSurrogate),
+            'table' (CENTURY outputs by month, as made by _trajectory_table,
+            to which months predicted by the surrogate are added) and
+            'weather' (as returned by forage_surrogate.read_monthly_weather)
+    """
+    surrogate_dict = {}
+    for grass in grass_list:
+        surrogate = args['century_surrogate']
+        if isinstance(surrogate, dict):
+            surrogate = surrogate[grass['label']]
+        if not isinstance(surrogate, forage_surrogate.GrowthSurrogate):
+            surrogate = forage_surrogate.GrowthSurrogate.load(surrogate)
+        schedule = os.path.join(args[u'input_dir'], grass['label'] + '.sch')
+        surrogate_dict[grass['label']] = {
+            'surrogate': surrogate,
+            'table': _trajectory_table(
+                os.path.join(intermediate_dir, grass['label'] + '.lis')),
+            'weather': forage_surrogate.read_monthly_weather(
+                schedule, args[u'input_dir'])}
+    return surrogate_dict
+
+
+def _surrogate_step(surrogate_dict, grass_list, consumed_dict, year, month):
+    """Predict CENTURY outputs at the end of one month for each grass type
+    with the surrogate, given the fraction of biomass removed in the month.
+
+    Modifies:
+        the table of CENTURY outputs of each grass type in surrogate_dict
+
+    Returns:
+        None
+    """
+    for grass in grass_list:
+        entry = surrogate_dict[grass['label']]
+        row = _trajectory_row(
+            entry['table'], cent.find_prev_month(year, month))
+        weather = forage_surrogate.monthly_weather(
+            entry['weather'], year, month)
+        flgrem = consumed_dict[';'.join([grass['label'], 'green'])]
+        fdgrem = consumed_dict[';'.join([grass['label'], 'dead'])]
+        entry['table'][round(year + month / 12., 2)] = entry['surrogate'].step(
+            row, weather, flgrem, fdgrem, month)
+
+
+def _read_herbivores(args):
+    """Read the herbivore table supplied by the user, or take herbivore
+    inputs supplied in memory as a list of dictionaries (one per herbivore
+    class) in args['herbivore_inputs'].
+
+    Parameter overrides in the column 'FParam_overrides' of the herbivore
+    table are given as json, e.g. {"CI1": 0.03} (see
+    forage_utils.parse_fparam_overrides).
+
+    Returns a list of class HerbivoreClass."""
+
     herbivore_list = []
-    if args[u'herbivore_csv'] is not None:
-        herbivore_input = (pandas.read_csv(
-            args[u'herbivore_csv'])).to_dict(orient='records')
+    if args.get('herbivore_inputs') is not None:
+        for herb_class in args['herbivore_inputs']:
+            herbivore_list.append(forage.HerbivoreClass(dict(herb_class)))
+    elif args[u'herbivore_csv'] is not None:
+        herbivore_input = forage.read_herbivore_csv(args[u'herbivore_csv'])
         for herb_class in herbivore_input:
             herd = forage.HerbivoreClass(herb_class)
             herbivore_list.append(herd)
+    return herbivore_list
+
+
+def read_grass(args):
+    """Read the grass table supplied by the user, as execute does, so that
+    drivers of many runs can see the grass types of a run.
+
+    Parameters:
+        args (dict): model inputs, as for execute; only args['grass_csv']
+            is read
+
+    Returns:
+        list of dictionaries, one per grass type, with the label of each
+        grass type given as a string
+    """
+
     grass_list = (pandas.read_csv(
         args[u'grass_csv'])).to_dict(orient='records')
     for grass in grass_list:
         if not isinstance(grass['label'], str):
             grass['label'] = str(grass['label'])
     forage.check_initial_biomass(grass_list)
-    results_dict = {'step': [], 'year': [], 'month': []}
-    for herb_class in herbivore_list:
-        results_dict[herb_class.label + '_MEItotal'] = []
-        results_dict[herb_class.label + '_DPLS'] = []
-        results_dict[herb_class.label + '_E_req'] = []
-        results_dict[herb_class.label + '_P_req'] = []
-        results_dict[herb_class.label + '_intake_forage_per_indiv_kg'] = []
-    for grass in grass_list:
-        results_dict[grass['label'] + '_green_kgha'] = []
-        results_dict[grass['label'] + '_dead_kgha'] = []
-    results_dict['total_offtake'] = []
-    schedule_list = []
-    for grass in grass_list:
-        schedule = os.path.join(args[u'input_dir'], (grass['label'] + '.sch'))
-        if os.path.exists(schedule):
-            schedule_list.append(schedule)
-        else:
-            er = "Error: schedule file not found"
-            raise Exception(er)
-        # write CENTURY batch file for spin-up simulation
-        hist_bat = os.path.join(
-            args[u'input_dir'], (grass['label'] + '_hist.bat'))
-        hist_schedule = grass['label'] + '_hist.sch'
-        hist_output = grass['label'] + '_hist'
-        cent.write_century_bat(
-            args[u'input_dir'], hist_bat, hist_schedule, hist_output,
-            args[u'fix_file'], 'outvars.txt')
-        # write CENTURY bat for extend simulation
-        extend_bat = os.path.join(
-            args[u'input_dir'], (grass['label'] + '.bat'))
-        schedule = grass['label'] + '.sch'
-        output = grass['label']
-        extend = grass['label'] + '_hist'
-        cent.write_century_bat(
-            args[u'input_dir'], extend_bat, schedule, output,
-            args[u'fix_file'], 'outvars.txt', extend)
+    return grass_list
+
+
+def _read_supplement(args):
+    """Read the supplement table supplied by the user, if any.
+
+    Returns a tuple (supp, supp_available), where supp is of class
+    Supplement or None and supp_available is 1 if supplement is offered."""
+
     supp_available = 0
     if 'supp_csv' in args.keys():
         supp_list = (pandas.read_csv(args[u'supp_csv'])).to_dict(
@@ -161,367 +1448,513 @@ def execute(args):
             supp_available = 1
     else:
         supp = None
-    # assume fix file is in the input directory, copy it to Century directory
-    shutil.copyfile(
-        os.path.join(args['input_dir'], args['fix_file']),
-        os.path.join(args['century_dir'], args['fix_file']))
-    # make a copy of the original graz params and schedule file
-    shutil.copyfile(
-        graz_file, os.path.join(args[u'century_dir'], 'graz_orig.100'))
-    for schedule in schedule_list:
-        label = os.path.basename(schedule)[:-4]
-        copy_name = label + '_orig.sch'
-        shutil.copyfile(
-            schedule, os.path.join(args[u'input_dir'], copy_name))
-    file_list = []
+    return supp, supp_available
+
+
+def _init_results_dict(herbivore_list, grass_list):
+    """Create the dictionary of summary results, with an empty list for each
+    column of summary_results.csv."""
+
+    results_dict = {'step': [], 'year': [], 'month': []}
+    for herb_class in herbivore_list:
+        results_dict[herb_class.label + '_MEItotal'] = []
+        results_dict[herb_class.label + '_DPLS'] = []
+        results_dict[herb_class.label + '_E_req'] = []
+        results_dict[herb_class.label + '_P_req'] = []
+        results_dict[herb_class.label + '_intake_forage_per_indiv_kg'] = []
     for grass in grass_list:
-        move_outputs = [
-            grass['label']+'_hist_log.txt', grass['label']+'_hist.lis',
-            grass['label']+'_log.txt', grass['label']+'.lis',
-            grass['label']+'.bin']
+        results_dict[grass['label'] + '_green_kgha'] = []
+        results_dict[grass['label'] + '_dead_kgha'] = []
+    results_dict['total_offtake'] = []
+    return results_dict
 
-        # move CENTURY run files to CENTURY dir
-        hist_bat = os.path.join(
-            args[u'input_dir'], (grass['label'] + '_hist.bat'))
-        extend_bat = os.path.join(
-            args[u'input_dir'], (grass['label'] + '.bat'))
-        e_schedule = os.path.join(args[u'input_dir'], grass['label'] + '.sch')
-        h_schedule = os.path.join(
-            args[u'input_dir'], grass['label'] + '_hist.sch')
-        site_file, weather_file = cent.get_site_weather_files(
-            e_schedule, args[u'input_dir'])
-        grass_files = [
-            hist_bat, extend_bat, e_schedule, h_schedule, site_file]
-        for file_name in grass_files:
-            file_list.append(file_name)
-        if weather_file != 'NA':
-            file_list.append(weather_file)
-        for file_name in file_list:
-            shutil.copyfile(
-                file_name,
-                os.path.join(args[u'century_dir'], os.path.basename(file_name)))
-        # run CENTURY for spin-up for each grass type up to start_year and
-        # start_month
-        hist_bat = os.path.join(
-            args[u'century_dir'], (grass['label'] + '_hist.bat'))
-        century_bat = os.path.join(
-            args[u'century_dir'], (grass['label'] + '.bat'))
-        cent.launch_CENTURY_subprocess(hist_bat)
-        cent.launch_CENTURY_subprocess(century_bat)
-
-        # save copies of CENTURY outputs, but remove from CENTURY dir
-        for file_name in move_outputs:
-            shutil.move(
-                os.path.join(args[u'century_dir'], file_name),
-                os.path.join(intermediate_dir, file_name))
 
-    stocking_density_dict = forage.populate_sd_dict(herbivore_list)
-    total_SD = forage.calc_total_stocking_density(herbivore_list)
-    site = forage.SiteInfo(args[u'steepness'], args[u'latitude'])
+def find_step_date(args, step):
+    """Find the month and year of a model step, where step 0 is the first
+    month of the simulation and step -1 holds starting conditions.
 
-    # add starting conditions to summary file
-    step = -1
-    step_month = args[u'start_month'] + step
-    if step_month == 0:
-        month = 12
-        year = args[u'start_year'] - 1
-    else:
-        month = step_month
-        year = args[u'start_year']
-    results_dict['step'].append(step)
+    Parameters:
+        args (dict): model inputs, as for execute; only
+            args['start_month'] and args['start_year'] are read
+        step (int): model step
+
+    Returns:
+        tuple of integers (month, year)
+    """
+
+    months_elapsed = args[u'start_month'] - 1 + step
+    month = months_elapsed % 12 + 1
+    year = args[u'start_year'] + months_elapsed // 12
+    return month, year
+
+
+def _add_initial_results(args, herbivore_list, results_dict, fill_val='NA'):
+    """Add starting conditions, following model spin-up, to summary results
+    as step -1.  Quantities that are undefined before the first step are
+    given the value fill_val."""
+
+    month, year = find_step_date(args, -1)
+    results_dict['step'].append(-1)
     results_dict['year'].append(year)
     results_dict['month'].append(month)
-    results_dict['total_offtake'].append('NA')
+    results_dict['total_offtake'].append(fill_val)
     for herb_class in herbivore_list:
-        results_dict[herb_class.label + '_MEItotal'].append('NA')
-        results_dict[herb_class.label + '_DPLS'].append('NA')
-        results_dict[herb_class.label + '_E_req'].append('NA')
-        results_dict[herb_class.label + '_P_req'].append('NA')
+        results_dict[herb_class.label + '_MEItotal'].append(fill_val)
+        results_dict[herb_class.label + '_DPLS'].append(fill_val)
+        results_dict[herb_class.label + '_E_req'].append(fill_val)
+        results_dict[herb_class.label + '_P_req'].append(fill_val)
         results_dict[herb_class.label +
-                     '_intake_forage_per_indiv_kg'].append('NA')
-    try:
-        for step in xrange(args[u'num_months']):
-            step_month = args[u'start_month'] + step
-            if step_month > 12:
-                mod = step_month % 12
-                if mod == 0:
-                    month = 12
-                    year = (step_month / 12) + args[u'start_year'] - 1
-                else:
-                    month = mod
-                    year = (step_month / 12) + args[u'start_year']
-            else:
-                month = step_month
-                year = (step / 12) + args[u'start_year']
-            for herb_class in herbivore_list:
-                herb_class.update(step)
-
-            # get biomass and crude protein for each grass type from CENTURY
-            for grass in grass_list:
-                output_file = os.path.join(
-                    intermediate_dir, grass['label'] + '.lis')
-                outputs = cent.read_CENTURY_outputs(
-                    output_file, year - 1, year + 1)
-                outputs = outputs[~outputs.index.duplicated(keep='first')]
-                target_month = cent.find_prev_month(year, month)
-                grass['prev_g_gm2'] = grass['green_gm2']
-                grass['prev_d_gm2'] = grass['dead_gm2']
-                try:
-                    grass['green_gm2'] = outputs.loc[target_month, 'aglivc']
-                except KeyError:
-                    raise Exception("CENTURY outputs not as expected")
-                grass['dead_gm2'] = outputs.loc[target_month, 'stdedc']
-                if grass['green_gm2'] == 0:
-                    grass['green_gm2'] = 0.000001
-                if grass['dead_gm2'] == 0:
-                    grass['dead_gm2'] = 0.000001
-                if not args[u'user_define_protein']:
-                    try:
-                        N_mult = grass['N_multiplier']
-                    except KeyError:
-                        N_mult = 1
-                    grass['cprotein_green'] = (
-                        outputs.loc[target_month, 'aglive1'] /
-                        outputs.loc[target_month, 'aglivc'] * N_mult)
-
-                    grass['cprotein_dead'] = (
-                        outputs.loc[target_month, 'stdede1'] /
-                        outputs.loc[target_month, 'stdedc'] * N_mult)
-            if step == 0:
-                available_forage = forage.calc_feed_types(grass_list)
-            else:
-                available_forage = forage.update_feed_types(
-                    grass_list, available_forage)
-            available_forage = forage.restrict_available_forage(
-                available_forage, args['mgmt_threshold'])
-            results_dict['step'].append(step)
-            results_dict['year'].append(year)
-            results_dict['month'].append(month)
-            for feed_type in available_forage:
-                results_dict[
-                    feed_type.label + '_' +
-                    feed_type.green_or_dead + '_kgha'].append(
-                        feed_type.biomass)
+                     '_intake_forage_per_indiv_kg'].append(fill_val)
 
-            if not args[u'user_define_digestibility']:
-                for feed_type in available_forage:
-                    feed_type.calc_digestibility_from_protein(
-                        args['digestibility_flag'])
-
-            diet_dict = {}
-            for herb_class in herbivore_list:
-                if (args['grz_months'] is not None and step not in
-                        args['grz_months']):
-                    diet = forage.Diet()
-                    diet.fill_intake_zero(available_forage)
-                    diet_dict[herb_class.label] = diet
-                    continue
-                if (args['density_series'] is not None and step in
-                        args['density_series'].keys()):
-                    herb_class.stocking_density = args['density_series'][step]
-                    stocking_density_dict = forage.populate_sd_dict(
-                        herbivore_list)
-                    total_SD = forage.calc_total_stocking_density(
-                        herbivore_list)
-                herb_class.calc_distance_walked(
-                    site.S, total_SD, available_forage)
-                max_intake = herb_class.calc_max_intake()
-
-                ZF = herb_class.calc_ZF()
-                HR = forage.calc_relative_height(available_forage)
-                diet = forage.diet_selection_t2(
-                    ZF, HR, args[u'prop_legume'], supp_available, max_intake,
-                    herb_class.FParam, available_forage, herb_class.f_w,
-                    herb_class.q_w, supp)
-                diet_interm = forage.calc_diet_intermediates(
-                    diet, herb_class, args[u'prop_legume'], args[u'DOY'], site,
-                    supp)
-                if herb_class.type != 'hindgut_fermenter':
-                    reduced_max_intake = forage.check_max_intake(
-                        diet, diet_interm, herb_class, max_intake)
-                    if reduced_max_intake < max_intake:
-                        diet = forage.diet_selection_t2(
-                            ZF, HR, args[u'prop_legume'], supp_available,
-                            reduced_max_intake, herb_class.FParam,
-                            available_forage, herb_class.f_w, herb_class.q_w,
-                            supp)
-                diet_dict[herb_class.label] = diet
-            forage.reduce_demand(
-                diet_dict, stocking_density_dict, available_forage)
-            total_intake_step = forage.calc_total_intake(
-                diet_dict, stocking_density_dict)
-            if args['diet_verbose']:
-                # save diet_dict across steps to be written out later
-                master_diet_dict[step] = diet_dict
-                diet_segregation = forage.calc_diet_segregation(diet_dict)
-                diet_segregation_dict['step'].append(step)
-                diet_segregation_dict['segregation'].append(diet_segregation)
-            for herb_class in herbivore_list:
-                diet = diet_dict[herb_class.label]
-                # if herb_class.type != 'hindgut_fermenter':
-                diet_interm = forage.calc_diet_intermediates(
-                    diet, herb_class, args[u'prop_legume'], args[u'DOY'], site,
-                    supp)
-                results_dict[herb_class.label + '_MEItotal'].append(
-                    diet_interm.MEItotal)
-                results_dict[herb_class.label + '_DPLS'].append(
-                    diet_interm.DPLS)
-                results_dict[herb_class.label + '_E_req'].append(
-                    diet_interm.MEm + diet_interm.MEc + diet_interm.MEl +
-                    diet_interm.NEw)
-                results_dict[herb_class.label + '_P_req'].append(
-                    diet_interm.Pm + diet_interm.Pc + diet_interm.Pl +
-                    diet_interm.Pw)
-                results_dict[
-                    herb_class.label + '_intake_forage_per_indiv_kg'].append(
-                        forage.convert_daily_to_step(diet.If))
-                if herb_class.sex == 'lac_female':
-                    results_dict['milk_prod_kg'].append(
-                        forage.convert_daily_to_step(milk_kg_day))
-
-            # calculate percent live and dead removed for each grass type
-            consumed_dict = forage.calc_percent_consumed(
-                available_forage, diet_dict, stocking_density_dict)
-
-            results_dict['total_offtake'].append(total_intake_step)
-            # send to CENTURY for this month's scheduled grazing event
-            date = year + float('%.2f' % (month / 12.))
-            for grass in grass_list:
-                g_label = ';'.join([grass['label'], 'green'])
-                d_label = ';'.join([grass['label'], 'dead'])
-                # only modify schedule if any of this grass was grazed
-                if consumed_dict[g_label] > 0 or consumed_dict[d_label] > 0:
-                    schedule = os.path.join(
-                        args[u'century_dir'], (grass['label'] + '.sch'))
-                    target_dict = cent.find_target_month(
-                        add_event, schedule, date, 12)
-                    if target_dict == 0:
-                        raise Exception, """Error: grazing event already
-                                            scheduled in file"""
-                    new_code = cent.add_new_graz_level(
-                        grass, consumed_dict, graz_file,
-                        args[u'template_level'], args[u'outdir'], step)
-                    cent.modify_schedule(
-                        schedule, add_event, target_dict, new_code,
-                        args[u'outdir'], step)
-
-                # call CENTURY from the batch file
-                century_bat = os.path.join(
-                    args[u'century_dir'], (grass['label'] + '.bat'))
-                cent.launch_CENTURY_subprocess(century_bat)
-
-                # save copies of CENTURY outputs, but remove from CENTURY dir
-                century_outputs = [
-                    grass['label']+'_log.txt', grass['label']+'.lis',
-                    grass['label']+'.bin']
-                intermediate_dir = os.path.join(
-                    args['outdir'], 'CENTURY_outputs_m%d_y%d' % (month, year))
-                if not os.path.exists(intermediate_dir):
-                    os.makedirs(intermediate_dir)
-                for file_name in century_outputs:
-                    n_tries = 6
-                    while True:
-                        if n_tries == 0:
-                            break
-                        try:
-                            n_tries -= 1
-                            shutil.move(
-                                os.path.join(args[u'century_dir'], file_name),
-                                os.path.join(intermediate_dir, file_name))
-                            break
-                        except OSError:
-                            print (
-                                'OSError in moving %s, trying again' %
-                                file_name)
-                            time.sleep(1.0)
-        # add final standing biomass to summary file
-        newstep = args[u'num_months']
-        step_month = args[u'start_month'] + newstep
-        if step_month > 12:
-            mod = step_month % 12
-            if mod == 0:
-                month = 12
-                year = (step_month / 12) + args[u'start_year'] - 1
-            else:
-                month = mod
-                year = (step_month / 12) + args[u'start_year']
-        else:
-            month = step_month
-            year = (newstep / 12) + args[u'start_year']
-        for grass in grass_list:
-            output_file = os.path.join(
-                intermediate_dir, grass['label'] + '.lis')
-            outputs = cent.read_CENTURY_outputs(
-                output_file, year - 1, year + 1)
-            outputs = outputs[~outputs.index.duplicated(keep='first')]
-            target_month = cent.find_prev_month(year, month)
-            grass['prev_g_gm2'] = grass['green_gm2']
-            grass['prev_d_gm2'] = grass['dead_gm2']
-            try:
-                grass['green_gm2'] = outputs.loc[target_month, 'aglivc']
-            except KeyError:
-                raise Exception("CENTURY outputs not as expected")
-            grass['dead_gm2'] = outputs.loc[target_month, 'stdedc']
+
+def _add_final_results(grass_list, available_forage, results_dict):
+    """Add standing biomass at the end of the simulation to summary results,
+    after grass_list has been updated from the final CENTURY outputs."""
+
+    available_forage = forage.update_feed_types(
+        grass_list, available_forage)
+    for feed_type in available_forage:
+        results_dict[
+            feed_type.label + '_' + feed_type.green_or_dead +
+            '_kgha'].append(feed_type.biomass)
+
+
+def _update_grass(grass, row, user_define_protein):
+    """Update biomass and crude protein of a grass type from CENTURY outputs
+    for one month.
+
+    Parameters:
+        grass (dict): descriptors of one grass type, from the grass table
+        row (dict or pandas Series): CENTURY outputs for the month, containing
+            'aglivc', 'stdedc', 'aglive1' and 'stdede1' as produced by
+            read_CENTURY_outputs
+        user_define_protein (int): if 1, crude protein is left as supplied
+            by the user; otherwise it is calculated from CENTURY outputs
+
+    Modifies:
+        grass
+
+    Returns:
+        None
+    """
+    grass['prev_g_gm2'] = grass['green_gm2']
+    grass['prev_d_gm2'] = grass['dead_gm2']
+    grass['green_gm2'] = row['aglivc']
+    grass['dead_gm2'] = row['stdedc']
+    if grass['green_gm2'] == 0:
+        grass['green_gm2'] = 0.000001
+    if grass['dead_gm2'] == 0:
+        grass['dead_gm2'] = 0.000001
+    if not user_define_protein:
+        try:
+            N_mult = grass['N_multiplier']
+        except KeyError:
+            N_mult = 1
+        grass['cprotein_green'] = (row['aglive1'] / row['aglivc'] * N_mult)
+        grass['cprotein_dead'] = (row['stdede1'] / row['stdedc'] * N_mult)
+
+
+def _livestock_step(args, step, time_step, n_substeps, herbivore_list,
+                    grass_list, available_forage, site, supp, supp_available,
+                    results_dict):
+    """Simulate diet selection and offtake by herbivores for one month, after
+    grass_list has been updated from CENTURY outputs for the month.
+
+    Parameters:
+        args (dict): model inputs, see execute
+        step (int): model step, i.e. month of the simulation
+        time_step (string): time step of the model, see _TIME_STEP
+        n_substeps (int): number of livestock sub-steps within the month
+        herbivore_list (list): list of class HerbivoreClass
+        grass_list (list): grass descriptors, updated for this month
+        available_forage (list): list of class FeedType from the previous
+            step, or None at the first step
+        site (SiteInfo): physical site
+        supp (Supplement): supplement offered, or None
+        supp_available (int): 1 if supplement is offered, else 0
+        results_dict (dict): summary results, see _init_results_dict
+
+    Modifies:
+        herbivore_list, results_dict
+
+    Returns:
+        tuple (available_forage, diet_dict, consumed_dict), where
+            consumed_dict gives the fraction of each forage type removed by
+            herbivores, keyed by '<grass label>;<green or dead>'
+    """
+    month, year = find_step_date(args, step)
+    for herb_class in herbivore_list:
+        herb_class.update(step)
+    if available_forage is None:
+        available_forage = forage.calc_feed_types(grass_list)
+        prev_forage = None
+    else:
+        prev_forage = _forage_snapshot(available_forage)
         available_forage = forage.update_feed_types(
             grass_list, available_forage)
-        for feed_type in available_forage:
-            results_dict[
-                feed_type.label + '_' + feed_type.green_or_dead +
-                '_kgha'].append(feed_type.biomass)
-    except:
-        raise
-    finally:
-        ### Cleanup files
-        # replace graz params used by CENTURY with original file
-        os.remove(graz_file)
-        shutil.copyfile(
-            os.path.join(args[u'century_dir'], 'graz_orig.100'), graz_file)
-        os.remove(os.path.join(args[u'century_dir'], 'graz_orig.100'))
-        file_list = set(file_list)
-        files_to_remove = [
-            os.path.join(args[u'century_dir'], os.path.basename(f)) for f in
-            file_list]
-        for file_name in files_to_remove:
-            os.remove(file_name)
-        for grass in grass_list:
-            os.remove(
-                os.path.join(
-                    args[u'century_dir'], grass['label'] + '_hist.bin'))
-        for schedule in schedule_list:
-            label = os.path.basename(schedule)[:-4]
-            orig_copy = os.path.join(args[u'input_dir'], label + '_orig.sch')
-            os.remove(orig_copy)
-        for grass in grass_list:
-            os.remove(
-                os.path.join(
-                    args[u'input_dir'], (grass['label'] + '_hist.bat')))
-            os.remove(os.path.join(args[u'input_dir'], (grass['label'] +
-                                   '.bat')))
-            for ext in ['.lis', '.bin', '_log.txt']:
-                obj = os.path.join(args[u'century_dir'], grass['label'] + ext)
-                if os.path.isfile(obj):
-                    os.remove(obj)
-        if args['diet_verbose']:
-            df = pandas.DataFrame(diet_segregation_dict)
-            save_as = os.path.join(args['outdir'], 'diet_segregation.csv')
-            df.to_csv(save_as, index=False)
-            for h_label in master_diet_dict[0].keys():
-                new_dict = {}
-                new_dict['step'] = master_diet_dict.keys()
-                new_dict['DMDf'] = [
-                    master_diet_dict[step][h_label].DMDf for step in
-                    master_diet_dict.keys()]
-                new_dict['CPIf'] = [
-                    master_diet_dict[step][h_label].CPIf for step in
-                    master_diet_dict.keys()]
-                grass_labels = master_diet_dict[0][h_label].intake.keys()
-                for g_label in grass_labels:
-                    new_dict['intake_' + g_label] = (
-                        [master_diet_dict[step][h_label].intake[g_label] for
-                            step in master_diet_dict.keys()])
-                df = pandas.DataFrame(new_dict)
-                save_as = os.path.join(args['outdir'], h_label + '_diet.csv')
-                df.to_csv(save_as, index=False)
-        filled_dict = forage.fill_dict(results_dict, 'NA')
-        df = pandas.DataFrame(filled_dict)
-        df.to_csv(os.path.join(args['outdir'], 'summary_results.csv'))
+    available_forage = forage.restrict_available_forage(
+        available_forage, args['mgmt_threshold'])
+    results_dict['step'].append(step)
+    results_dict['year'].append(year)
+    results_dict['month'].append(month)
+    for feed_type in available_forage:
+        results_dict[
+            feed_type.label + '_' +
+            feed_type.green_or_dead + '_kgha'].append(
+                feed_type.biomass)
+
+    if n_substeps > 1:
+        diet_dict, herb_results, consumed_dict, total_intake_step = (
+            _graze_substeps(
+                args, step, time_step, n_substeps, herbivore_list,
+                available_forage, prev_forage, site, supp,
+                supp_available))
+    else:
+        if not args[u'user_define_digestibility']:
+            for feed_type in available_forage:
+                feed_type.calc_digestibility_from_protein(
+                    args['digestibility_flag'])
+        interm_dict = {}
+        diet_dict = _select_diets(
+            args, step, herbivore_list, available_forage, site, supp,
+            supp_available, interm_dict)
+        stocking_density_dict = forage.populate_sd_dict(herbivore_list)
+        days_per_step = forage.find_days_per_step(time_step)
+        forage.reduce_demand(
+            diet_dict, stocking_density_dict, available_forage,
+            days_per_step)
+        total_intake_step = forage.calc_total_intake(
+            diet_dict, stocking_density_dict, days_per_step)
+        herb_results = {}
+        for herb_class in herbivore_list:
+            diet = diet_dict[herb_class.label]
+            diet_interm = _diet_intermediates(
+                args, diet, herb_class, site, supp, interm_dict)
+            herb_results[herb_class.label] = _herb_step_results(
+                diet, diet_interm, days_per_step)
+        # calculate percent live and dead removed for each grass type
+        consumed_dict = forage.calc_percent_consumed(
+            available_forage, diet_dict, stocking_density_dict,
+            days_per_step)
+    for herb_class in herbivore_list:
+        for key, val in herb_results[herb_class.label].items():
+            results_dict[herb_class.label + key].append(val)
+        if herb_class.sex == 'lac_female':
+            results_dict['milk_prod_kg'].append(
+                forage.convert_daily_to_step(milk_kg_day, time_step))
+    results_dict['total_offtake'].append(total_intake_step)
+    return available_forage, diet_dict, consumed_dict
+
+
+def _forage_snapshot(available_forage):
+    """Record biomass and crude protein of each forage type, so that forage
+    can later be interpolated from these values.
+
+    Returns a tuple of numpy arrays (biomass, crude_protein)."""
+
+    biomass = numpy.array(
+        [feed_type.biomass for feed_type in available_forage], dtype=float)
+    crude_protein = numpy.array(
+        [feed_type.crude_protein for feed_type in available_forage],
+        dtype=float)
+    return biomass, crude_protein
+
+
+def _forage_changed(reference, current, tolerance):
+    """Has biomass or crude protein of any forage type changed by more than
+    a fraction tolerance between two snapshots (see _forage_snapshot)?"""
+
+    for ref_values, cur_values in zip(reference, current):
+        change = numpy.abs(cur_values - ref_values)
+        if numpy.any(change > tolerance * numpy.abs(ref_values)):
+            return True
+    return False
+
+
+def _herb_step_results(diet, diet_interm, days):
+    """Collect the summary quantities reported for one herbivore class, where
+    `days` is the number of days over which the diet was eaten.
+
+    Returns a dictionary keyed by the suffix of the summary column."""
+
+    return {
+        '_MEItotal': diet_interm.MEItotal,
+        '_DPLS': diet_interm.DPLS,
+        '_E_req': (
+            diet_interm.MEm + diet_interm.MEc + diet_interm.MEl +
+            diet_interm.NEw),
+        '_P_req': (
+            diet_interm.Pm + diet_interm.Pc + diet_interm.Pl +
+            diet_interm.Pw),
+        '_intake_forage_per_indiv_kg': diet.If * days,
+    }
+
+
+@forage_timing.timed('diet_selection')
+def _select_diets(args, step, herbivore_list, available_forage, site, supp,
+                  supp_available, interm_dict=None):
+    """Perform diet selection for each herbivore class for one livestock step,
+    before intake is restricted by competition among herbivore classes.
+
+    Parameters:
+        args (dict): model inputs, see execute
+        step (int): model step, i.e. month of the simulation
+        herbivore_list (list): list of class HerbivoreClass
+        available_forage (list): list of class FeedType
+        site (SiteInfo): physical site
+        supp (Supplement): supplement offered, or None
+        supp_available (int): 1 if supplement is offered, else 0
+        interm_dict (dict): if supplied, intermediate quantities of diets
+            found in args['diet_table'] are added to it, keyed by herbivore
+            label (see _diet_intermediates)
+
+    Modifies:
+        stocking density of each herbivore class, if args['density_series']
+            specifies stocking density for this step
+
+    Returns:
+        dictionary of class Diet, keyed by herbivore label
+    """
+    diet_dict = {}
+    total_SD = forage.calc_total_stocking_density(herbivore_list)
+    for herb_class in herbivore_list:
+        if (args['grz_months'] is not None and step not in
+                args['grz_months']):
+            diet = forage.Diet()
+            diet.fill_intake_zero(available_forage)
+            diet_dict[herb_class.label] = diet
+            continue
+        if (args['density_series'] is not None and step in
+                args['density_series'].keys()):
+            herb_class.stocking_density = args['density_series'][step]
+            total_SD = forage.calc_total_stocking_density(herbivore_list)
+        if args['diet_table'] is not None:
+            found = args['diet_table'].lookup(herb_class, available_forage)
+            if found is not None:
+                diet_dict[herb_class.label] = found[0]
+                if interm_dict is not None:
+                    interm_dict[herb_class.label] = (found[0].If, found[1])
+                continue
+        diet_dict[herb_class.label] = _select_diet(
+            args, herb_class, available_forage, site, supp, supp_available,
+            total_SD)
+    return diet_dict
+
+
+def _select_diet(args, herb_class, available_forage, site, supp,
+                 supp_available, total_SD):
+    """Perform diet selection for one herbivore class, reducing maximum
+    intake if the diet selected is low in protein.
+
+    Parameters:
+        args (dict): model inputs, see execute
+        herb_class (HerbivoreClass): the herbivore class
+        available_forage (list): list of class FeedType
+        site (SiteInfo): physical site
+        supp (Supplement): supplement offered, or None
+        supp_available (int): 1 if supplement is offered, else 0
+        total_SD (float): total stocking density of all herbivore classes
+
+    Returns:
+        the diet selected, of class Diet
+    """
+    herb_class.calc_distance_walked(
+        site.S, total_SD, available_forage)
+    max_intake = herb_class.calc_max_intake()
+
+    ZF = herb_class.calc_ZF()
+    HR = forage.calc_relative_height(available_forage)
+    diet = forage.diet_selection_t2(
+        ZF, HR, args[u'prop_legume'], supp_available, max_intake,
+        herb_class.FParam, available_forage, herb_class.f_w,
+        herb_class.q_w, supp=supp)
+    diet_interm = forage.calc_diet_intermediates(
+        diet, herb_class, args[u'prop_legume'], args[u'DOY'], site,
+        supp)
+    if herb_class.type != 'hindgut_fermenter':
+        reduced_max_intake = forage.check_max_intake(
+            diet, diet_interm, herb_class, max_intake)
+        if reduced_max_intake < max_intake:
+            diet = forage.diet_selection_t2(
+                ZF, HR, args[u'prop_legume'], supp_available,
+                reduced_max_intake, herb_class.FParam,
+                available_forage, herb_class.f_w, herb_class.q_w,
+                supp=supp)
+    return diet
+
+
+def _diet_intermediates(args, diet, herb_class, site, supp, interm_dict):
+    """Calculate intermediate quantities of a diet, or take them from the
+    diet table if the diet was found there and was not reduced by
+    competition among herbivore classes.
+
+    Parameters:
+        args (dict): model inputs, see execute
+        diet (Diet): diet of the herbivore class
+        herb_class (HerbivoreClass): the herbivore class
+        site (SiteInfo): physical site
+        supp (Supplement): supplement offered, or None
+        interm_dict (dict): daily forage intake and intermediate quantities
+            of diets found in the diet table, keyed by herbivore label, as
+            filled by _select_diets
+
+    Returns:
+        intermediate quantities of the diet, of class DietIntermediates
+    """
+    if herb_class.label in interm_dict:
+        table_If, diet_interm = interm_dict[herb_class.label]
+        if abs(diet.If - table_If) <= 1e-9 * max(table_If, 1.):
+            return diet_interm
+    return forage.calc_diet_intermediates(
+        diet, herb_class, args[u'prop_legume'], args[u'DOY'], site, supp)
+
+
+def _graze_substeps(args, step, time_step, n_substeps, herbivore_list,
+                    available_forage, prev_forage, site, supp, supp_available):
+    """Simulate grazing within one CENTURY month as a series of livestock
+    sub-steps.
+
+    At each sub-step, biomass and crude protein of each forage type are
+    interpolated between the CENTURY outputs of the previous and current
+    month, and reduced by biomass already removed by herbivores within the
+    month.  The final sub-step therefore sees the same forage as the monthly
+    model, less earlier offtake.  Summary quantities that are daily rates
+    (energy and protein intake and requirements) are averaged over sub-steps;
+    intake and offtake are summed, and digestibility and crude protein intake
+    of the diet of the month are weighted by intake at each sub-step.
+
+    Diet selection is the costly part of a sub-step.  Diets selected at one
+    sub-step are therefore reused, with intake rationed afresh among
+    herbivore classes, until forage has changed by more than
+    _SUBSTEP_TOLERANCE since they were selected.
+
+    Parameters:
+        args (dict): model inputs, see execute
+        step (int): model step, i.e. month of the simulation
+        time_step (string): time step of the model, see _TIME_STEP
+        n_substeps (int): number of livestock sub-steps within the month
+        herbivore_list (list): list of class HerbivoreClass
+        available_forage (list): list of class FeedType, describing forage
+            at the current CENTURY output
+        prev_forage (tuple): biomass and crude protein of each forage type
+            at the previous CENTURY output (see _forage_snapshot), or None if
+            there is no previous output
+        site (SiteInfo): physical site
+        supp (Supplement): supplement offered, or None
+        supp_available (int): 1 if supplement is offered, else 0
+
+    Modifies:
+        stocking density of herbivore classes (see _select_diets)
+
+    Returns:
+        tuple (diet_dict, herb_results, consumed_dict, total_intake), where
+            diet_dict holds the diet of each herbivore class averaged over the
+            month, herb_results holds summary quantities for each herbivore
+            class (see _herb_step_results), consumed_dict gives the fraction
+            of each forage type removed during the month, and total_intake is
+            total offtake during the month (kg/ha)
+    """
+    end_biomass, end_cp = _forage_snapshot(available_forage)
+    if prev_forage is None:
+        start_biomass, start_cp = end_biomass, end_cp
+    else:
+        start_biomass, start_cp = prev_forage
+    month_days = forage.find_days_per_step(time_step)
+    days = month_days / n_substeps
+    hclass_labels = [herb_class.label for herb_class in herbivore_list]
+    f_labels = forage.feed_type_labels(available_forage)
+    consumed = numpy.zeros(len(available_forage))
+    month_intake = numpy.zeros((len(hclass_labels), len(f_labels)))
+    month_digestible = numpy.zeros(len(hclass_labels))
+    month_protein = numpy.zeros(len(hclass_labels))
+    selected_forage = None
+    herb_results = {}
+    for herb_class in herbivore_list:
+        herb_results[herb_class.label] = dict.fromkeys(
+            _herb_step_results(
+                forage.Diet(), forage.DietIntermediates(), days).keys(), 0.)
+    for substep in xrange(n_substeps):
+        forage.interpolate_feed_types(
+            available_forage, start_biomass, end_biomass, start_cp, end_cp,
+            float(substep + 1) / n_substeps, consumed)
+        forage.restrict_available_forage(
+            available_forage, args['mgmt_threshold'])
+        if not args[u'user_define_digestibility']:
+            for feed_type in available_forage:
+                feed_type.calc_digestibility_from_protein(
+                    args['digestibility_flag'])
+        substep_forage = _forage_snapshot(available_forage)
+        if selected_forage is None or _forage_changed(
+                selected_forage, substep_forage, _SUBSTEP_TOLERANCE):
+            interm_dict = {}
+            diet_dict = _select_diets(
+                args, step, herbivore_list, available_forage, site, supp,
+                supp_available, interm_dict)
+            selected_intake = forage.build_intake_matrix(
+                diet_dict, hclass_labels, f_labels)
+            selected_forage = substep_forage
+            # intermediate quantities of each diet, with the intake they
+            # were calculated from, keyed by herbivore label
+            interm_cache = {}
+        sd = numpy.array(
+            [herb_class.stocking_density for herb_class in herbivore_list],
+            dtype=float)
+        biomass_avail = numpy.array(
+            [feed_type.biomass_avail for feed_type in available_forage])
+        intake = forage.reduce_demand_matrix(
+            selected_intake, sd, biomass_avail, days)
+        digestibility = numpy.array(
+            [feed_type.digestibility for feed_type in available_forage])
+        crude_protein = numpy.array(
+            [feed_type.crude_protein for feed_type in available_forage])
+        forage.update_diets_from_matrix(
+            diet_dict, hclass_labels, f_labels, intake, digestibility,
+            crude_protein)
+        consumed += numpy.dot(sd, intake) * days
+        month_intake += intake * days
+        month_digestible += numpy.dot(intake, digestibility) * days
+        month_protein += numpy.dot(intake, crude_protein) * days
+        for h_index, herb_class in enumerate(herbivore_list):
+            diet = diet_dict[herb_class.label]
+            cached = interm_cache.get(herb_class.label)
+            if cached is not None and numpy.array_equal(
+                    cached[0], intake[h_index]):
+                diet_interm = cached[1]
+            else:
+                diet_interm = _diet_intermediates(
+                    args, diet, herb_class, site, supp, interm_dict)
+                interm_cache[herb_class.label] = (
+                    intake[h_index].copy(), diet_interm)
+            substep_results = _herb_step_results(diet, diet_interm, days)
+            month_results = herb_results[herb_class.label]
+            for key, val in substep_results.items():
+                if key == '_intake_forage_per_indiv_kg':
+                    month_results[key] += val
+                else:
+                    month_results[key] += val / n_substeps
+
+    # restore forage described by CENTURY, undepleted by herbivores within the
+    # month, so that growth to the next CENTURY output applies to it
+    forage.interpolate_feed_types(
+        available_forage, start_biomass, end_biomass, start_cp, end_cp, 1.)
+    month_diet_dict = {}
+    for herb_class in herbivore_list:
+        diet = forage.Diet()
+        diet.fill_intake_zero(available_forage)
+        month_diet_dict[herb_class.label] = diet
+    forage.update_diets_from_matrix(
+        month_diet_dict, hclass_labels, f_labels, month_intake / month_days,
+        digestibility, crude_protein)
+    # quality of the diet of the month, weighted by intake at each sub-step
+    month_If = month_intake.sum(axis=1)
+    for h_index, hclass_label in enumerate(hclass_labels):
+        diet = month_diet_dict[hclass_label]
+        if month_If[h_index] > 0:
+            diet.DMDf = float(month_digestible[h_index] / month_If[h_index])
+        diet.CPIf = float(month_protein[h_index] / month_days)
+    perc_removed = numpy.zeros(len(available_forage))
+    nonzero = end_biomass != 0
+    perc_removed[nonzero] = consumed[nonzero] / end_biomass[nonzero]
+    consumed_dict = dict(zip(f_labels, perc_removed.tolist()))
+    total_intake = float(consumed.sum())
+    return month_diet_dict, herb_results, consumed_dict, total_intake
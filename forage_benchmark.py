@@ -0,0 +1,480 @@
+"""Microbenchmarks of the livestock model and the CENTURY link.
+
+Each benchmark times one function on synthetic inputs generated from a
+fixed seed, at several sizes: number of grass types (each giving a green
+and a dead forage type) and herbivore classes for the livestock model, and
+length of schedule and .lis files and number of grazing levels for the
+CENTURY link.  Results (seconds per call, best of several repeats) are
+written to a json file, and may be compared against a baseline saved from
+an earlier run: a benchmark regresses if it is slower than the baseline by
+more than a threshold fraction.
+
+Usage:
+    python forage_benchmark.py <results.json> [--baseline <baseline.json>]
+        [--threshold 0.2] [--quick] [--min-time 0.05] [--repeats 5]
+"""
+
+import os
+import sys
+import json
+import shutil
+import platform
+import tempfile
+import argparse
+import timeit
+
+import numpy
+
+import forage_utils as forage
+import forage_century_link_utils as cent
+
+_timer = timeit.default_timer
+
+FORAGE_SIZES = {'n_grass': [1, 4, 16], 'n_classes': [1, 4, 16]}
+CENTURY_SIZES = {'n_years': [6, 30, 120], 'n_levels': [3, 100, 1000]}
+QUICK_FORAGE_SIZES = {'n_grass': [1, 4], 'n_classes': [1, 4]}
+QUICK_CENTURY_SIZES = {'n_years': [6, 30], 'n_levels': [3, 100]}
+
+# years in each block of synthetic schedules: CENTURY schedules give years
+# relative to the block in a field that allows at most 9 years
+_BLOCK_YEARS = 6
+_FIRST_YEAR = 2000
+
+
+def synthetic_grass(n_grass, rng):
+    """Grass types with CENTURY outputs from the previous and current
+    month, as read by forage.read_grass and updated by _update_grass."""
+    grass_list = []
+    for g_index in xrange(n_grass):
+        green = rng.uniform(20., 200.)
+        dead = rng.uniform(10., 100.)
+        cp_green = rng.uniform(0.05, 0.15)
+        grass_list.append({
+            'label': 'grass%d' % g_index,
+            'type': 'C4',
+            'percent_biomass': 1. / n_grass,
+            'DMD_green': 0.,
+            'DMD_dead': 0.,
+            'cprotein_green': cp_green,
+            'cprotein_dead': cp_green * 0.3,
+            'green_gm2': green,
+            'dead_gm2': dead,
+            'prev_g_gm2': green * rng.uniform(0.8, 1.2),
+            'prev_d_gm2': dead * rng.uniform(0.8, 1.2),
+        })
+    return grass_list
+
+
+def synthetic_forage(grass_list):
+    """Forage types calculated from grass types, with digestibility
+    calculated from crude protein."""
+    available_forage = forage.calc_feed_types(grass_list)
+    for feed_type in available_forage:
+        feed_type.calc_digestibility_from_protein()
+        feed_type.biomass_avail = feed_type.biomass * 0.5
+    return available_forage
+
+
+def synthetic_herbivores(n_classes, rng):
+    """Non-breeding herbivore classes of varying size and age."""
+    sexes = ['castrate', 'entire_m', 'herd_average']
+    herbivore_list = []
+    for h_index in xrange(n_classes):
+        herbivore_list.append(forage.HerbivoreClass({
+            'label': 'class%d' % h_index,
+            'type': 'B_indicus',
+            'sex': sexes[h_index % len(sexes)],
+            'age': rng.uniform(200., 1500.),
+            'weight': rng.uniform(150., 450.),
+            'stocking_density': rng.uniform(0.01, 0.1),
+            'SRW': 550.,
+            'SFW': 0,
+            'birth_weight': 34.7,
+        }))
+    return herbivore_list
+
+
+def _select_diet(herb_class, available_forage, site, total_SD):
+    """Diet selected by a herbivore class, as in forage._select_diet
+    without adjusting maximum intake for protein."""
+    herb_class.calc_distance_walked(site.S, total_SD, available_forage)
+    max_intake = herb_class.calc_max_intake()
+    ZF = herb_class.calc_ZF()
+    HR = forage.calc_relative_height(available_forage)
+    return forage.diet_selection_t2(
+        ZF, HR, 0., 0, max_intake, herb_class.FParam, available_forage,
+        herb_class.f_w, herb_class.q_w)
+
+
+def write_schedule(schedule, n_years, rng):
+    """Write a CENTURY schedule of n_years, in blocks of _BLOCK_YEARS
+    years, with grazing events in randomly chosen months of each year."""
+    last_year = _FIRST_YEAR + n_years - 1
+    lines = [
+        '%-13d Starting year' % _FIRST_YEAR,
+        '%-14d Last year' % last_year,
+        '0.100         Site file name',
+        '0             Labeling type',
+        '-1            Labeling year',
+        '-1.00         Microcosm',
+        '-1            CO2 Systems',
+        '-1            pH shift',
+        '-1            Soil Warming',
+        '0             N input scalar option',
+        '0             OMAD scalar option',
+        '0             Climate scalar option',
+        '1             Initial system',
+        'TRC4         Initial crop',
+        '              Initial tree',
+        '',
+        'Year Month Option']
+    block = 0
+    for block_start in xrange(_FIRST_YEAR, last_year + 1, _BLOCK_YEARS):
+        block += 1
+        block_last = min(block_start + _BLOCK_YEARS - 1, last_year)
+        block_years = block_last - block_start + 1
+        lines.extend([
+            '%-13d Block # simulations' % block,
+            '%-14d Last year' % block_last,
+            '%-13d Repeats # years' % block_years,
+            '%-13d Output starting year' % block_start,
+            '1             Output month',
+            '1             Output interval',
+            'M             Weather choice'])
+        for rel_year in xrange(1, block_years + 1):
+            lines.extend(['%4d %4d CROP' % (rel_year, 1), 'TRC4',
+                          '%4d %4d FRST' % (rel_year, 1)])
+            months = sorted(rng.choice(
+                range(2, 12), size=rng.randint(0, 6), replace=False))
+            for month in months:
+                lines.extend(['%4d %4d GRAZ' % (rel_year, month), 'GL'])
+            lines.append('%4d %4d LAST' % (rel_year, 12))
+        lines.append('-999 -999 X')
+    with open(schedule, 'w') as sch:
+        sch.write('\n'.join(lines) + '\n')
+    return last_year
+
+
+def write_graz_file(graz_file, n_levels):
+    """Write a CENTURY grazing parameter file with n_levels grazing levels,
+    the first of which is 'GL'."""
+    lines = []
+    for level in xrange(n_levels):
+        if level == 0:
+            lines.append('GL    (orig)')
+        else:
+            lines.append('L%03d  (added)' % level)
+        lines.extend([
+            '0.10000           \'FLGREM\'',
+            '0.01000           \'FDGREM\'',
+            '0.30000           \'GFCRET\'',
+            '0.50000           \'GRET(1)\'',
+            '0.95000           \'GRET(2)\'',
+            '0.95000           \'GRET(3)\'',
+            '0.00000           \'GRZEFF\'',
+            '0.50000           \'FECLIG\''])
+    with open(graz_file, 'w') as graz:
+        graz.write('\n'.join(lines) + '\n')
+
+
+def write_lis_file(lis_file, n_years, rng):
+    """Write a CENTURY .lis file with monthly outputs over n_years."""
+    columns = ['time', 'aglivc', 'stdedc', 'aglive(1)', 'stdede(1)']
+    with open(lis_file, 'w') as lis:
+        lis.write(''.join('%12s' % c for c in columns) + '\n\n')
+        for year in xrange(_FIRST_YEAR, _FIRST_YEAR + n_years):
+            for month in xrange(1, 13):
+                values = [year + month / 12.] + list(
+                    rng.uniform(0.1, 100., size=4))
+                lis.write(''.join('%12.4f' % v for v in values) + '\n')
+
+
+def _measure(call, setup=None, min_time=0.05, repeats=5):
+    """Time call, best of repeats.
+
+    Parameters:
+        call (function): function of no arguments to time
+        setup (function): if supplied, called (untimed) before each call,
+            e.g. to restore files that call modifies
+        min_time (float): minimum duration of each repeat (seconds); calls
+            are batched so that each repeat lasts about this long
+        repeats (int): number of repeats
+
+    Returns:
+        seconds per call, minimum over repeats
+    """
+    if setup is not None:
+        best = None
+        for _ in xrange(repeats):
+            n_calls = 0
+            elapsed = 0.
+            while elapsed < min_time or n_calls == 0:
+                setup()
+                start = _timer()
+                call()
+                elapsed += _timer() - start
+                n_calls += 1
+            per_call = elapsed / n_calls
+            best = per_call if best is None else min(best, per_call)
+        return best
+    n_calls = 1
+    while True:
+        start = _timer()
+        for _ in xrange(n_calls):
+            call()
+        elapsed = _timer() - start
+        if elapsed >= min_time:
+            break
+        n_calls *= 2
+    best = elapsed / n_calls
+    for _ in xrange(repeats - 1):
+        start = _timer()
+        for _ in xrange(n_calls):
+            call()
+        best = min(best, (_timer() - start) / n_calls)
+    return best
+
+
+def _forage_benchmarks(sizes, seed):
+    """Benchmarks of the livestock model.
+
+    Returns:
+        list of (name, params, call, setup)
+    """
+    days_per_step = forage.find_days_per_step('month')
+    site = forage.SiteInfo(1., 0.13)
+    benchmarks = []
+    for n_grass in sizes['n_grass']:
+        rng = numpy.random.RandomState(seed)
+        grass_list = synthetic_grass(n_grass, rng)
+        available_forage = synthetic_forage(grass_list)
+        herb_class = synthetic_herbivores(1, rng)[0]
+        diet = _select_diet(herb_class, available_forage, site, 0.05)
+        params = {'n_grass': n_grass}
+        benchmarks.append((
+            'diet_selection_t2', params,
+            lambda h=herb_class, f=available_forage: _select_diet(
+                h, f, site, 0.05), None))
+        benchmarks.append((
+            'calc_diet_intermediates', params,
+            lambda d=diet, h=herb_class: forage.calc_diet_intermediates(
+                d, h, 0., 150, site), None))
+        benchmarks.append((
+            'calc_relative_height', params,
+            lambda f=available_forage: forage.calc_relative_height(f), None))
+        benchmarks.append((
+            'update_feed_types', params,
+            lambda g=grass_list, f=available_forage: forage.update_feed_types(
+                g, f), lambda g=grass_list, f=available_forage:
+                _reset_forage(g, f)))
+        for n_classes in sizes['n_classes']:
+            herbivore_list = synthetic_herbivores(n_classes, rng)
+            diet_dict = {}
+            for h in herbivore_list:
+                diet_dict[h.label] = _select_diet(
+                    h, available_forage, site, 0.05)
+            sd_dict = forage.populate_sd_dict(herbivore_list)
+            benchmarks.append((
+                'reduce_demand', {'n_grass': n_grass, 'n_classes': n_classes},
+                lambda d=diet_dict, s=sd_dict, f=available_forage:
+                    forage.reduce_demand(d, s, f, days_per_step),
+                lambda d=diet_dict, c=_copy_diets(diet_dict):
+                    _restore_diets(d, c)))
+    return benchmarks
+
+
+def _reset_forage(grass_list, available_forage):
+    """Restore biomass of forage types modified by update_feed_types."""
+    fresh = forage.calc_feed_types(grass_list)
+    for feed_type, fresh_type in zip(available_forage, fresh):
+        feed_type.biomass = fresh_type.biomass
+
+
+def _copy_diets(diet_dict):
+    return dict((label, dict(diet.intake)) for label, diet in
+                diet_dict.items())
+
+
+def _restore_diets(diet_dict, intake_copy):
+    """Restore intake of diets modified by reduce_demand."""
+    for label, intake in intake_copy.items():
+        diet_dict[label].intake = dict(intake)
+        diet_dict[label].If = sum(intake.values())
+
+
+def _century_benchmarks(sizes, seed, workspace_dir):
+    """Benchmarks of the CENTURY link, on files written in workspace_dir.
+
+    Returns:
+        list of (name, params, call, setup)
+    """
+    benchmarks = []
+    for n_years in sizes['n_years']:
+        rng = numpy.random.RandomState(seed)
+        params = {'n_years': n_years}
+        lis_file = os.path.join(workspace_dir, 'y%d.lis' % n_years)
+        write_lis_file(lis_file, n_years, rng)
+        last_lis_year = _FIRST_YEAR + n_years - 1
+        benchmarks.append((
+            'read_CENTURY_outputs', params,
+            lambda l=lis_file, y=last_lis_year: cent.read_CENTURY_outputs(
+                l, y - 1, y + 1), None))
+        orig_sch = os.path.join(workspace_dir, 'y%d_orig.sch' % n_years)
+        schedule = os.path.join(workspace_dir, 'y%d.sch' % n_years)
+        last_year = write_schedule(orig_sch, n_years, rng)
+        shutil.copyfile(orig_sch, schedule)
+        benchmarks.append((
+            'read_events', params,
+            lambda s=orig_sch: cent.read_events(s), None))
+        benchmarks.append((
+            'read_graz_level', params,
+            lambda s=orig_sch: cent.read_graz_level(s), None))
+        date = last_year + 0.5
+        benchmarks.append((
+            'find_target_month', params,
+            lambda s=orig_sch, d=date: cent.find_target_month(1, s, d, 12),
+            None))
+        target_dict = cent.find_target_month(1, orig_sch, date, 12)
+        benchmarks.append((
+            'modify_schedule', params,
+            lambda s=schedule, t=target_dict: cent.modify_schedule(
+                s, 1, t, 'GL', workspace_dir, 'bench'),
+            lambda o=orig_sch, s=schedule: shutil.copyfile(o, s)))
+    grass = {'label': 'grass0'}
+    consumed = {'grass0;green': 0.1, 'grass0;dead': 0.01}
+    for n_levels in sizes['n_levels']:
+        orig_graz = os.path.join(workspace_dir, 'l%d_orig.100' % n_levels)
+        graz_file = os.path.join(workspace_dir, 'l%d.100' % n_levels)
+        write_graz_file(orig_graz, n_levels)
+        benchmarks.append((
+            'add_new_graz_level', {'n_levels': n_levels},
+            lambda g=graz_file: cent.add_new_graz_level(
+                grass, consumed, g, 'GL', workspace_dir, 'bench'),
+            lambda o=orig_graz, g=graz_file: shutil.copyfile(o, g)))
+    return benchmarks
+
+
+def benchmark_name(name, params):
+    """Identify a benchmark by function and size, e.g.
+    'reduce_demand[n_classes=4,n_grass=1]'."""
+    return '%s[%s]' % (name, ','.join(
+        '%s=%d' % (key, params[key]) for key in sorted(params)))
+
+
+def run_benchmarks(quick=False, seed=0, min_time=0.05, repeats=5,
+                   names=None):
+    """Run the benchmarks.
+
+    Parameters:
+        quick (boolean): run only the smaller sizes
+        seed (int): seed of synthetic inputs
+        min_time (float): minimum duration of each repeat (seconds)
+        repeats (int): number of repeats of each benchmark
+        names (list): if supplied, run only benchmarks of these functions
+
+    Returns:
+        dictionary of results, with entries 'machine' describing the Python
+            and platform, and 'benchmarks', a dictionary keyed by benchmark
+            name (see benchmark_name) giving for each benchmark the function,
+            size parameters and 'seconds' per call
+    """
+    if quick:
+        forage_sizes, century_sizes = QUICK_FORAGE_SIZES, QUICK_CENTURY_SIZES
+    else:
+        forage_sizes, century_sizes = FORAGE_SIZES, CENTURY_SIZES
+    workspace_dir = tempfile.mkdtemp()
+    try:
+        benchmarks = _forage_benchmarks(forage_sizes, seed)
+        benchmarks += _century_benchmarks(century_sizes, seed, workspace_dir)
+        results = {}
+        for name, params, call, setup in benchmarks:
+            if names is not None and name not in names:
+                continue
+            seconds = _measure(call, setup, min_time, repeats)
+            results[benchmark_name(name, params)] = {
+                'function': name, 'params': params, 'seconds': seconds}
+    finally:
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+    machine = {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+    }
+    return {'machine': machine, 'benchmarks': results}
+
+
+def compare_to_baseline(results, baseline, threshold=0.2):
+    """Compare benchmark results against a baseline.
+
+    Parameters:
+        results (dict): results of run_benchmarks
+        baseline (dict): results of an earlier run of run_benchmarks
+        threshold (float): a benchmark regresses if it takes more than
+            (1 + threshold) times as long as in the baseline
+
+    Returns:
+        list of dictionaries, one per benchmark in both results and
+            baseline, with entries 'name', 'seconds', 'baseline_seconds',
+            'ratio' and 'regression' (boolean), sorted by decreasing ratio
+    """
+    comparison = []
+    for name, result in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        baseline_seconds = baseline['benchmarks'][name]['seconds']
+        ratio = result['seconds'] / baseline_seconds
+        comparison.append({
+            'name': name,
+            'seconds': result['seconds'],
+            'baseline_seconds': baseline_seconds,
+            'ratio': ratio,
+            'regression': ratio > 1. + threshold})
+    comparison.sort(key=lambda c: -c['ratio'])
+    return comparison
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Microbenchmarks of the rangeland production model")
+    parser.add_argument('results', help="json file to write results to")
+    parser.add_argument(
+        '--baseline', help="json file of baseline results to compare to")
+    parser.add_argument(
+        '--threshold', type=float, default=0.2,
+        help="fraction by which a benchmark may be slower than the baseline")
+    parser.add_argument(
+        '--quick', action='store_true', help="run only the smaller sizes")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--min-time', type=float, default=0.05,
+        help="minimum duration of each repeat of a benchmark (seconds)")
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument(
+        '--quiet', action='store_true',
+        help="do not print results and regressions")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        quick=args.quick, seed=args.seed, min_time=args.min_time,
+        repeats=args.repeats)
+    with open(args.results, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+    if not args.quiet:
+        for name in sorted(results['benchmarks']):
+            print '%-55s %12.1f us' % (
+                name, 1e6 * results['benchmarks'][name]['seconds'])
+    if args.baseline is None:
+        return 0
+    with open(args.baseline, 'r') as baseline_file:
+        baseline = json.load(baseline_file)
+    comparison = compare_to_baseline(results, baseline, args.threshold)
+    regressions = [c for c in comparison if c['regression']]
+    if not args.quiet:
+        for c in regressions:
+            print 'REGRESSION %-44s %6.2fx baseline' % (
+                c['name'], c['ratio'])
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
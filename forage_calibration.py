@@ -0,0 +1,372 @@
+"""Calibrate livestock parameters against observations.
+
+Calibration parameters of each herbivore class (by default CM2, CM12, CK13,
+CG2 and the diet selection weights qual_weight and quant_weight) are fitted
+so that the livestock model reproduces observed outputs, e.g. forage intake
+per individual, in given months.  Parameters are named and bounded as
+factors of a sensitivity analysis (see forage_sensitivity.parse_factors), so
+that a parameter may be shared by all herbivore classes ('CM2') or fitted
+for one class ('breeding_cow:CM2').
+
+The objective is evaluated against fixed CENTURY forage trajectories
+(forage.execute_from_trajectories) and minimized with a Nelder-Mead simplex
+search in which the trial points of each iteration are evaluated in
+parallel.  Evaluations are memoized, optionally on disk.  The best candidate
+may be confirmed with one fully coupled run of the model (forage.execute).
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import multiprocessing
+
+import numpy
+import pandas
+
+import forage
+import forage_utils
+import forage_sensitivity
+
+# parameters fitted by default
+DEFAULT_PARAMETERS = [
+    ('CM2', 0.2, 0.5), ('CM12', 0.005, 0.025), ('CK13', 0.01, 0.06),
+    ('CG2', 0.5, 0.9), ('qual_weight', 0., 20.), ('quant_weight', 0., 20.)]
+
+# CENTURY outputs shared by all evaluations in a worker process
+_worker_century_outputs = None
+
+
+def read_observations(observations, args=None):
+    """Read observed model outputs.
+
+    Parameters:
+        observations (pandas data frame or string): observations, or the
+            path to a csv file of observations, with the columns 'label'
+            (herbivore class), 'variable' (summary output without the
+            herbivore label, e.g. 'intake_forage_per_indiv_kg'), 'value',
+            and either 'step' or 'year' and 'month'.  An optional column
+            'weight' gives the weight of each observation in the objective
+        args (dict): model inputs, used to find the step of observations
+            located by year and month
+
+    Returns:
+        pandas data frame with the columns 'step', 'column', 'value',
+            'weight' and 'scale', where 'column' names the summary column
+            predicting the observation and 'scale' is the mean absolute
+            observed value of that column
+    """
+    if not isinstance(observations, pandas.DataFrame):
+        observations = pandas.read_csv(observations)
+    obs_df = observations.copy()
+    if 'step' not in obs_df.columns:
+        if args is None:
+            er = "Error: model inputs needed to locate observations by date"
+            raise ValueError(er)
+        obs_df['step'] = (
+            (obs_df['year'] - args[u'start_year']) * 12 +
+            obs_df['month'] - args[u'start_month'])
+    if 'weight' not in obs_df.columns:
+        obs_df['weight'] = 1.
+    obs_df['column'] = obs_df['label'].astype(str) + '_' + obs_df['variable']
+    scale = obs_df.groupby('column')['value'].transform(
+        lambda values: numpy.mean(numpy.abs(values)))
+    obs_df['scale'] = scale.where(scale > 0, 1.)
+    return obs_df[['step', 'column', 'value', 'weight', 'scale']].reset_index(
+        drop=True)
+
+
+def calc_objective(summary_df, obs_df):
+    """Weighted sum of squared relative differences between predicted and
+    observed values.
+
+    Parameters:
+        summary_df (pandas data frame): summary results of a model run
+        obs_df (pandas data frame): observations, as returned by
+            read_observations
+
+    Returns:
+        float, the objective; infinite if any prediction is missing
+    """
+    predicted_df = summary_df.set_index('step')
+    total = 0.
+    for row in obs_df.itertuples(index=False):
+        try:
+            predicted = float(predicted_df.loc[row.step, row.column])
+        except (KeyError, ValueError):
+            er = "Error: no prediction for %s at step %d" % (
+                row.column, row.step)
+            raise Exception(er)
+        if numpy.isnan(predicted):
+            return float('inf')
+        total += row.weight * ((predicted - row.value) / row.scale) ** 2
+    return total
+
+
+def _init_worker(century_outputs):
+    """Store CENTURY outputs in a worker process."""
+    global _worker_century_outputs
+    _worker_century_outputs = century_outputs
+
+
+def _evaluate_candidate(task):
+    """Evaluate the objective for one candidate.
+
+    Parameters:
+        task (tuple): (args, herbivore_input, parsed_parameters, obs_df, x)
+
+    Returns:
+        float, the objective
+    """
+    args, herbivore_input, parsed_parameters, obs_df, x = task
+    args = dict(args)
+    args['herbivore_inputs'] = forage_sensitivity.apply_sample(
+        herbivore_input, parsed_parameters, x)
+    summary_df, _ = forage.execute_from_trajectories(
+        args, _worker_century_outputs)
+    return calc_objective(summary_df, obs_df)
+
+
+class Calibration:
+
+    """Fit livestock parameters to observations, evaluating candidates in
+    parallel against stored CENTURY outputs."""
+
+    def __init__(self, args, observations, century_outputs, parameters=None,
+                 n_workers=None, cache_file=None):
+        """Set up the calibration.
+
+        Parameters:
+            args (dict): model inputs, see forage.execute
+            observations (pandas data frame or string): observed outputs,
+                see read_observations
+            century_outputs (dict): CENTURY outputs for each grass type,
+                see forage.execute_from_trajectories
+            parameters (list): tuples (name, lower, upper) giving the
+                parameters to fit and their bounds. Defaults to
+                DEFAULT_PARAMETERS
+            n_workers (int): number of worker processes. Defaults to the
+                number of CPUs
+            cache_file (string): path to a json file where evaluated
+                candidates are saved, and from which they are loaded if the
+                file exists and was written for the same inputs
+        """
+        if parameters is None:
+            parameters = DEFAULT_PARAMETERS
+        self.args = dict(args)
+        if args.get('herbivore_inputs') is not None:
+            self.herbivore_input = [dict(h) for h in args['herbivore_inputs']]
+            self._herd_columns = []
+        else:
+            self.herbivore_input = forage_utils.read_herbivore_csv(
+                args['herbivore_csv'])
+            # columns of the calibrated herbivore table follow those read
+            self._herd_columns = list(pandas.read_csv(
+                args['herbivore_csv'], nrows=0).columns)
+        self.parameters = forage_sensitivity.parse_factors(parameters)
+        self.obs_df = read_observations(observations, args)
+        self.century_outputs = century_outputs
+        self.n_workers = n_workers
+        self.cache_file = cache_file
+        # evaluations are cached under a signature of the inputs, so that a
+        # cache file is not reused for different observations, parameters or
+        # CENTURY outputs
+        self._signature = hashlib.md5(repr((
+            sorted((str(k), repr(v)) for k, v in self.args.items()),
+            repr(self.herbivore_input), self.parameters,
+            self.obs_df.to_csv(index=False),
+            forage.trajectory_digest(century_outputs)))).hexdigest()
+        self._saved = {}
+        if cache_file is not None and os.path.isfile(cache_file):
+            with open(cache_file, 'r') as read_file:
+                self._saved = json.load(read_file)
+        self.cache = self._saved.setdefault(self._signature, {})
+        self.n_evaluations = 0
+        self._pool = None
+
+    def close(self):
+        """Shut down worker processes and save evaluated candidates."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self.save_cache()
+
+    def save_cache(self):
+        """Save evaluated candidates to the cache file, if there is one."""
+        if self.cache_file is not None:
+            with open(self.cache_file, 'w') as new_file:
+                json.dump(self._saved, new_file)
+
+    def _key(self, x):
+        return ','.join(['%.9f' % value for value in x])
+
+    def evaluate(self, points):
+        """Evaluate the objective at each point of the unit hypercube not
+        already evaluated.
+
+        Returns:
+            list of floats, the objective at each point
+        """
+        points = [numpy.clip(point, 0., 1.) for point in points]
+        keys = [self._key(point) for point in points]
+        pending = []
+        for key, point in zip(keys, points):
+            if key not in self.cache and key not in [k for k, _ in pending]:
+                pending.append((key, point))
+        if pending:
+            tasks = [
+                (self.args, self.herbivore_input, self.parameters,
+                 self.obs_df, point) for _, point in pending]
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(
+                    self.n_workers, _init_worker, (self.century_outputs,))
+            values = self._pool.map(_evaluate_candidate, tasks)
+            for (key, _), value in zip(pending, values):
+                self.cache[key] = value
+            self.n_evaluations += len(pending)
+        return [self.cache[key] for key in keys]
+
+    def initial_point(self):
+        """Starting point of the search: values given in the herbivore table
+        where all classes share them, otherwise the middle of the bounds."""
+        x0 = numpy.repeat(0.5, len(self.parameters))
+        for index, (name, label, param, lower, upper) in enumerate(
+                self.parameters):
+            values = set()
+            for herb_class in self.herbivore_input:
+                if label is not None and herb_class['label'] != label:
+                    continue
+                value = herb_class.get(param)
+                if value is not None and not pandas.isnull(value):
+                    values.add(float(value))
+            if len(values) == 1:
+                x0[index] = numpy.clip(
+                    (values.pop() - lower) / (upper - lower), 0., 1.)
+        return x0
+
+    def minimize(self, x0=None, max_evaluations=500, xatol=1e-3,
+                 fatol=1e-6, initial_step=0.1):
+        """Minimize the objective with a Nelder-Mead simplex search over the
+        unit hypercube.  The reflection, expansion and both contraction
+        points of each iteration are evaluated together in parallel.
+
+        Returns:
+            tuple (x, objective) giving the best point found
+        """
+        if x0 is None:
+            x0 = self.initial_point()
+        n_params = len(x0)
+        simplex = [numpy.clip(x0, 0., 1.)]
+        for index in xrange(n_params):
+            vertex = simplex[0].copy()
+            if vertex[index] + initial_step <= 1.:
+                vertex[index] += initial_step
+            else:
+                vertex[index] -= initial_step
+            simplex.append(vertex)
+        values = self.evaluate(simplex)
+        start_evaluations = self.n_evaluations
+        while self.n_evaluations - start_evaluations < max_evaluations:
+            order = numpy.argsort(values)
+            simplex = [simplex[i] for i in order]
+            values = [values[i] for i in order]
+            spread = max(numpy.max(numpy.abs(vertex - simplex[0])) for
+                         vertex in simplex[1:])
+            if (spread <= xatol and
+                    abs(values[-1] - values[0]) <= fatol):
+                break
+            centroid = numpy.mean(simplex[:-1], axis=0)
+            worst = simplex[-1]
+            reflected = numpy.clip(centroid + (centroid - worst), 0., 1.)
+            expanded = numpy.clip(
+                centroid + 2. * (centroid - worst), 0., 1.)
+            outside = numpy.clip(
+                centroid + 0.5 * (reflected - centroid), 0., 1.)
+            inside = numpy.clip(centroid + 0.5 * (worst - centroid), 0., 1.)
+            f_r, f_e, f_oc, f_ic = self.evaluate(
+                [reflected, expanded, outside, inside])
+            if f_r < values[0]:
+                if f_e < f_r:
+                    simplex[-1], values[-1] = expanded, f_e
+                else:
+                    simplex[-1], values[-1] = reflected, f_r
+            elif f_r < values[-2]:
+                simplex[-1], values[-1] = reflected, f_r
+            elif f_r < values[-1] and f_oc <= f_r:
+                simplex[-1], values[-1] = outside, f_oc
+            elif f_r >= values[-1] and f_ic < values[-1]:
+                simplex[-1], values[-1] = inside, f_ic
+            else:
+                # shrink toward the best vertex
+                simplex = [simplex[0]] + [
+                    simplex[0] + 0.5 * (vertex - simplex[0]) for vertex in
+                    simplex[1:]]
+                values = [values[0]] + self.evaluate(simplex[1:])
+        best = int(numpy.argmin(values))
+        return simplex[best], values[best]
+
+    def parameter_values(self, x):
+        """Parameter values at a point of the unit hypercube, keyed by
+        parameter name."""
+        return dict(
+            (name, lower + value * (upper - lower)) for value,
+            (name, label, param, lower, upper) in zip(x, self.parameters))
+
+    def fit(self, max_evaluations=500, confirm=False, outdir=None, **kwargs):
+        """Fit parameters to observations.
+
+        Parameters:
+            max_evaluations (int): maximum number of evaluations of the
+                objective
+            confirm (bool): confirm the fitted parameters with a fully
+                coupled run of the model (forage.execute). The run is made
+                with the CENTURY and input directories given in args
+            outdir (string): directory where the calibrated herbivore table,
+                'herbivore_calibrated.csv', is written, and where outputs of
+                the confirmation run are saved. If None, nothing is written
+                and confirmation outputs are saved in a temporary directory
+            kwargs: further arguments to minimize
+
+        Returns:
+            dictionary with entries 'parameters' (fitted values keyed by
+                parameter name), 'objective', 'n_evaluations',
+                'herbivore_inputs' (calibrated herbivore inputs) and, if
+                confirm is True, 'confirmed_objective'
+        """
+        try:
+            x, objective = self.minimize(
+                max_evaluations=max_evaluations, **kwargs)
+        finally:
+            self.close()
+        herbivore_inputs = forage_sensitivity.apply_sample(
+            self.herbivore_input, self.parameters, x)
+        result = {
+            'parameters': self.parameter_values(x),
+            'objective': objective,
+            'n_evaluations': self.n_evaluations,
+            'herbivore_inputs': herbivore_inputs,
+        }
+        if outdir is not None:
+            if not os.path.exists(outdir):
+                os.makedirs(outdir)
+            calibrated_df = pandas.DataFrame(herbivore_inputs)
+            calibrated_df['FParam_overrides'] = calibrated_df[
+                'FParam_overrides'].apply(json.dumps)
+            columns = [c for c in self._herd_columns if c in
+                       calibrated_df.columns]
+            columns += [c for c in calibrated_df.columns if c not in columns]
+            calibrated_df = calibrated_df[columns]
+            calibrated_df.to_csv(
+                os.path.join(outdir, 'herbivore_calibrated.csv'), index=False)
+        if confirm:
+            args = dict(self.args)
+            args['herbivore_inputs'] = herbivore_inputs
+            if outdir is not None:
+                args['outdir'] = os.path.join(outdir, 'confirmation_run')
+            else:
+                args['outdir'] = tempfile.mkdtemp()
+            summary_df = forage.execute(args)['summary_results']
+            result['confirmed_objective'] = calc_objective(
+                summary_df, self.obs_df)
+        return result
@@ -11,43 +11,108 @@ import random
 import string
 from subprocess import Popen
 import time
+import glob
+import hashlib
 
-global _century_dir
+import forage_metrics
+import forage_timing
+import forage_trace
+
+# CENTURY directory used by functions below when none is passed to them
+# (see set_century_directory); runs that may execute concurrently in one
+# process pass their CENTURY directory instead
+_century_dir = None
 
 # disable setting with copy warning
 pandas.options.mode.chained_assignment = None
 
+# extensions of CENTURY inputs and outputs that model runs may write in
+# place.  CENTURY results (.bin, .lis) are included: runs overwrite them, e.g.
+# when restoring a saved spin-up or state, and a hard-linked copy would write
+# through to the original
+_MODIFIED_EXTENSIONS = ['.100', '.sch', '.bat', '.wth', '.txt', '.bin',
+                        '.lis']
+
 
 def set_century_directory(century_dir):
+    """Set the CENTURY directory used by functions that are not passed
+    one."""
     global _century_dir
     _century_dir = century_dir
 
 
-def launch_CENTURY_subprocess(bat_file):
-    """Launch CENTURY subprocess and check that it completed successfully."""
+def _trace_launch_start(bat_file, argv):
+    """Record the start of a CENTURY launch in the trace (see forage_trace),
+    with the commands of the batch file."""
+
+    if not forage_trace.is_enabled():
+        return
+    with open(bat_file, 'r') as read_file:
+        commands = [line.strip() for line in read_file if line.strip()]
+    forage_trace.event(
+        'century_start', bat=bat_file,
+        label=os.path.basename(bat_file)[:-4], argv=argv, commands=commands)
+
+
+def _trace_launch_end(bat_file, start, exit_status, log_file, log_reads,
+                     success):
+    """Record the end of a CENTURY launch in the trace (see forage_trace),
+    and its duration in progress metrics (see forage_metrics)."""
 
-    p = Popen(["cmd.exe", "/c " + bat_file], cwd=_century_dir)
-    stdout, stderr = p.communicate()
-    p.wait()
+    if forage_metrics.is_enabled():
+        forage_metrics.add_century_seconds(time.time() - start)
+    if not forage_trace.is_enabled():
+        return
+    try:
+        log_bytes = os.path.getsize(log_file)
+    except OSError:
+        log_bytes = None
+    forage_trace.event(
+        'century_end', bat=bat_file, label=os.path.basename(bat_file)[:-4],
+        start=start, end=time.time(), exit_status=exit_status,
+        log_bytes=log_bytes, log_reads=log_reads, success=success)
+
+
+def launch_CENTURY_subprocess(bat_file, century_dir=None):
+    """Launch CENTURY subprocess and check that it completed successfully.
+    CENTURY runs in century_dir, or if century_dir is None, in the directory
+    set by set_century_directory."""
+
+    if century_dir is None:
+        century_dir = _century_dir
+    argv = ["cmd.exe", "/c " + bat_file]
+    _trace_launch_start(bat_file, argv)
+    start = time.time()
+    with forage_timing.phase('century_process'):
+        p = Popen(argv, cwd=century_dir)
+        stdout, stderr = p.communicate()
+        p.wait()
     log_file = bat_file[:-4] + "_log.txt"
     success = 0
     error = []
     num_tries = 3
     tries = 0
-    while tries < num_tries:
-        with open(log_file, 'r') as file:
-            for line in file:
-                if 'Execution success.' in line:
-                    success = 1
-                    return
-        if not success:
+    with forage_timing.phase('century_log_poll'):
+        while tries < num_tries:
             with open(log_file, 'r') as file:
-                error = [line.strip() for line in file]
-                if len(error) == 0:
-                    error = "CENTURY log file is empty"
-                time.sleep(1.0)
-                tries = tries + 1
-    if error == ['', 'Model is running...']:  # special case?
+                for line in file:
+                    if 'Execution success.' in line:
+                        success = 1
+                        _trace_launch_end(
+                            bat_file, start, p.returncode, log_file,
+                            tries + 1, True)
+                        return
+            if not success:
+                with open(log_file, 'r') as file:
+                    error = [line.strip() for line in file]
+                    if len(error) == 0:
+                        error = "CENTURY log file is empty"
+                    time.sleep(1.0)
+                    tries = tries + 1
+    special_case = error == ['', 'Model is running...']  # special case?
+    _trace_launch_end(
+        bat_file, start, p.returncode, log_file, tries, special_case)
+    if special_case:
         return
     raise Exception(error)
 
@@ -139,9 +204,12 @@ def modify_intensity(diff, graz_file, graz_level, outdir, suffix):
     else:
         # make a copy of the grazing parameters file and stash it in the outdir
         new_graz_params = os.path.join(outdir, ('graz_' + str(suffix) + '.100'))
-        shutil.copyfile(abs_path, new_graz_params)
-        shutil.copyfile(abs_path, graz_file)
+        forage_trace.copyfile(abs_path, new_graz_params)
+        forage_trace.copyfile(abs_path, graz_file)
         os.remove(abs_path)
+        forage_trace.event(
+            'graz_edit', graz_file=graz_file, level=graz_level,
+            change=diff, bytes=os.path.getsize(graz_file))
         return 1
 
 
@@ -328,6 +396,7 @@ def process_graz_level(glevel_df, gparam_df):
     return repeated_indexed
 
 
+@forage_timing.timed('read_lis')
 def read_CENTURY_outputs(cent_file, first_year, last_year):
     """Read biomass outputs from CENTURY for each month of CENTURY output within
     the specified range (between 'first_year' and 'last_year')."""
@@ -462,6 +531,7 @@ def fill_schedule(graz_schedule, first_year, first_month, end_year, end_month):
     return filled_schedule
 
 
+@forage_timing.timed('schedule_parse')
 def find_target_month(add_event, schedule, empirical_date, n_months):
     """Find the target month to add or remove grazing events from the schedule
     used by CENTURY.  This month should be immediately prior to the
@@ -547,6 +617,7 @@ def find_target_month(add_event, schedule, empirical_date, n_months):
     return target_dict
 
 
+@forage_timing.timed('schedule_edit')
 def modify_schedule(schedule, add_event, target_dict, graz_level, outdir,
                     suffix):
     """Add or remove a grazing event in the target month and year from the
@@ -608,13 +679,19 @@ def modify_schedule(schedule, add_event, target_dict, graz_level, outdir,
         # save a copy of the modified schedule for future reference
         label = os.path.basename(schedule)[:-4]
         new_sch = os.path.join(outdir, (label + '_' + str(suffix) + '.sch'))
-        shutil.copyfile(abs_path, new_sch)
+        forage_trace.copyfile(abs_path, new_sch)
         # replace the schedule used by CENTURY with this modified schedule
-        shutil.copyfile(abs_path, schedule)
+        forage_trace.copyfile(abs_path, schedule)
         os.remove(abs_path)
+        forage_trace.event(
+            'schedule_edit', schedule=schedule, add_event=add_event,
+            level=graz_level, target_year=target_dict['target_year'],
+            target_month=target_dict['target_month'],
+            bytes=os.path.getsize(schedule))
         return
 
 
+@forage_timing.timed('graz_file')
 def add_new_graz_level(grass, consumed, graz_file, template_level, outdir,
                        suffix):
     """Add a new graz level to the graz.100 file, taking flgrem (percent live
@@ -684,10 +761,14 @@ def add_new_graz_level(grass, consumed, graz_file, template_level, outdir,
         # if we successfully modified the graz file
         # save a copy of the modified graz params for future reference
         new_graz_params = os.path.join(outdir, 'graz_' + str(suffix) + '.100')
-        shutil.copyfile(abs_path, new_graz_params)
+        forage_trace.copyfile(abs_path, new_graz_params)
         # replace the graz params used by CENTURY with this modified file
-        shutil.copyfile(abs_path, graz_file)
+        forage_trace.copyfile(abs_path, graz_file)
         os.remove(abs_path)
+        forage_trace.event(
+            'graz_edit', graz_file=graz_file, label=grass['label'],
+            level=new_code, flgrem=consumed[flgrem_key],
+            fdgrem=consumed[fdgrem_key], bytes=os.path.getsize(graz_file))
         return new_code
 
 
@@ -742,3 +823,462 @@ def get_site_weather_files(schedule_file, input_dir):
                     w_name = re.search('(.+?).wth', line).group(1) + '.wth'
                     w_file = os.path.join(input_dir, w_name)
     return s_file, w_file
+
+
+def copy_century_workspace(century_dir, input_dir, workspace_dir,
+                           link=False):
+    """Make private copies of the CENTURY directory and the input directory
+    inside workspace_dir, so that a model run can modify CENTURY parameter
+    files, schedules and batch files without interfering with other runs.
+
+    Parameters:
+        century_dir (string): directory containing the CENTURY executable
+            and global parameter files
+        input_dir (string): directory containing inputs to run CENTURY
+        workspace_dir (string): directory in which to place the copies. It
+            is created if it does not exist
+        link (boolean): if True, files that model runs only read (the
+            CENTURY executables) are hard-linked rather than copied, where
+            the platform supports it.  Files that model runs may write in
+            place (parameter, schedule, batch and weather files, and CENTURY
+            results) are always copied
+
+    Returns:
+        tuple of strings (century_dir, input_dir) giving the location of the
+            copies
+    """
+    if not os.path.exists(workspace_dir):
+        os.makedirs(workspace_dir)
+    ws_century_dir = os.path.join(workspace_dir, 'century')
+    ws_input_dir = os.path.join(workspace_dir, 'input')
+    if link and hasattr(os, 'link'):
+        _link_tree(century_dir, ws_century_dir)
+        _link_tree(input_dir, ws_input_dir)
+    else:
+        shutil.copytree(century_dir, ws_century_dir)
+        shutil.copytree(input_dir, ws_input_dir)
+    return ws_century_dir, ws_input_dir
+
+
+def _link_tree(src_dir, dst_dir):
+    """Replicate src_dir in dst_dir, hard-linking files that model runs only
+    read and copying files that may be modified in place."""
+    for root, dirs, files in os.walk(src_dir):
+        dst_root = os.path.join(dst_dir, os.path.relpath(root, src_dir))
+        os.makedirs(dst_root)
+        for file_name in files:
+            src = os.path.join(root, file_name)
+            dst = os.path.join(dst_root, file_name)
+            if (os.path.splitext(file_name)[1].lower() in
+                    _MODIFIED_EXTENSIONS):
+                shutil.copy2(src, dst)
+                continue
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+
+
+def read_weather_file(wth_file):
+    """Read a CENTURY weather file.  Each line of the weather file gives the
+    values of one weather variable (e.g., 'prec', 'tmin', 'tmax') for each
+    month of one year.
+
+    Returns a pandas data frame with columns 'variable', 'year' and one
+    column for each month, 1 through 12."""
+
+    records = []
+    with open(wth_file, 'r') as read_file:
+        for line in read_file:
+            fields = line.split()
+            if len(fields) < 14:
+                continue
+            record = {'variable': fields[0], 'year': int(fields[1])}
+            for month in xrange(1, 13):
+                record[month] = float(fields[month + 1])
+            records.append(record)
+    weather_df = pandas.DataFrame(
+        records, columns=['variable', 'year'] + range(1, 13))
+    return weather_df
+
+
+def write_weather_file(weather_df, wth_file):
+    """Write a CENTURY weather file from a data frame in the format returned
+    by read_weather_file."""
+
+    with open(wth_file, 'wb') as new_file:
+        for row in weather_df.itertuples(index=False):
+            values = ''.join(['%7.2f' % val for val in row[2:14]])
+            new_file.write('%-4s%6d%s\n' % (row[0], row[1], values))
+
+
+def set_schedule_weather_file(schedule, wth_name):
+    """Modify a CENTURY schedule file so that weather is read from the named
+    weather file.  Weather is read from the start of the file in the first
+    block ('F') and continues to be read from the file in later blocks
+    ('C')."""
+
+    fh, abs_path = mkstemp()
+    os.close(fh)
+    first_block = True
+    with open(schedule, 'rb') as sch:
+        lines = sch.readlines()
+    with open(abs_path, 'wb') as new_file:
+        line_index = 0
+        while line_index < len(lines):
+            line = lines[line_index]
+            line_index += 1
+            if 'Weather choice' not in line:
+                new_file.write(line)
+                continue
+            # drop the weather file named for this block, if any
+            if line_index < len(lines) and '.wth' in lines[line_index]:
+                line_index += 1
+            if first_block:
+                new_file.write('F             Weather choice\n')
+                new_file.write(wth_name + '\n')
+                first_block = False
+            else:
+                new_file.write('C             Weather choice\n')
+    shutil.copyfile(abs_path, schedule)
+    os.remove(abs_path)
+
+
+def set_schedule_site_file(schedule, site_name):
+    """Modify a CENTURY schedule file so that site parameters are read
+    from the named site file."""
+
+    with open(schedule, 'rb') as sch:
+        lines = sch.readlines()
+    with open(schedule, 'wb') as new_file:
+        for line in lines:
+            if 'Site file name' in line:
+                eol = line[len(line.rstrip('\r\n')):] or '\n'
+                line = '%-13s Site file name%s' % (site_name, eol)
+            new_file.write(line)
+
+
+def read_schedule_blocks(schedule):
+    """Read a CENTURY schedule file into its header and blocks, keeping the
+    text of each line so that the schedule can be written back with
+    write_schedule_blocks.
+
+    Returns:
+        tuple (header, blocks), where header is the list of lines preceding
+            the first block and blocks is a list of dictionaries, one per
+            block, with entries 'header' (lines from the block number to the
+            weather choice), 'start_year', 'last_year', 'repeats', 'events'
+            (list of [relative year, month, lines] for each scheduled event,
+            where lines include the event option, if any) and 'end' (the
+            line closing the block)
+    """
+    with open(schedule, 'rb') as sch:
+        lines = sch.readlines()
+    header = []
+    index = 0
+    while 'Year Month Option' not in lines[index]:
+        header.append(lines[index])
+        if 'Starting year' in lines[index]:
+            start_year = int(lines[index].split()[0])
+        index += 1
+    header.append(lines[index])
+    index += 1
+    blocks = []
+    while index < len(lines):
+        if lines[index].strip() == '':
+            index += 1
+            continue
+        block_header = []
+        while 'Weather choice' not in lines[index]:
+            block_header.append(lines[index])
+            if 'Last year' in lines[index]:
+                last_year = int(lines[index].split()[0])
+            if 'Repeats # years' in lines[index]:
+                repeats = int(lines[index].split()[0])
+            index += 1
+        block_header.append(lines[index])
+        index += 1
+        if index < len(lines) and '.wth' in lines[index]:
+            block_header.append(lines[index])
+            index += 1
+        events = []
+        while '-999' not in lines[index]:
+            match = re.match(r'\s*(\d+)\s+(\d+)\s+\S', lines[index])
+            if match:
+                events.append(
+                    [int(match.group(1)), int(match.group(2)),
+                     [lines[index]]])
+            else:
+                events[-1][2].append(lines[index])
+            index += 1
+        blocks.append({
+            'header': block_header, 'start_year': start_year,
+            'last_year': last_year, 'repeats': repeats, 'events': events,
+            'end': lines[index]})
+        index += 1
+        start_year = last_year + 1
+    return header, blocks
+
+
+def _set_schedule_value(line, value):
+    """Replace the value at the start of a line of a schedule file."""
+
+    match = re.match(r'\s*\S+\s+', line)
+    width = max(match.end(), len(str(value)) + 1)
+    return str(value).ljust(width) + line[match.end():]
+
+
+def write_schedule_blocks(header, blocks, schedule):
+    """Write a CENTURY schedule file from a header and blocks in the format
+    returned by read_schedule_blocks.  The starting and last year of the
+    schedule, and the last year, number of repeated years and output
+    starting year of each block, are written from the block entries."""
+
+    eol = header[0][len(header[0].rstrip('\r\n')):] or '\n'
+    with open(schedule, 'wb') as new_file:
+        for line in header:
+            if 'Starting year' in line:
+                line = _set_schedule_value(line, blocks[0]['start_year'])
+            elif 'Last year' in line:
+                line = _set_schedule_value(line, blocks[-1]['last_year'])
+            new_file.write(line)
+        for block in blocks:
+            for line in block['header']:
+                if 'Last year' in line:
+                    line = _set_schedule_value(line, block['last_year'])
+                elif 'Repeats # years' in line:
+                    line = _set_schedule_value(line, block['repeats'])
+                elif 'Output starting year' in line:
+                    value = max(int(line.split()[0]), block['start_year'])
+                    line = _set_schedule_value(line, value)
+                new_file.write(line)
+            for event in block['events']:
+                for line in event[2]:
+                    new_file.write(line)
+            end = block['end']
+            if block is not blocks[-1] and not end.endswith('\n'):
+                end = end + eol
+            new_file.write(end)
+
+
+def split_schedule_blocks(blocks, split_year):
+    """Split the blocks of a schedule at the start of split_year, so that a
+    simulation can be run up to the end of the previous year and extended
+    from there.  A block spanning the split is divided in two, which is only
+    possible if the block does not repeat.
+
+    Returns:
+        tuple (pre_blocks, post_blocks) of lists of blocks, in the format
+            returned by read_schedule_blocks. Event years of a divided block
+            are renumbered relative to the start of each part
+    """
+    pre_blocks = []
+    post_blocks = []
+    for block in blocks:
+        if block['last_year'] < split_year:
+            pre_blocks.append(block)
+        elif block['start_year'] >= split_year:
+            post_blocks.append(block)
+        else:
+            n_years = block['last_year'] - block['start_year'] + 1
+            if block['repeats'] < n_years:
+                er = "Error: CENTURY schedule file must contain non-repeating sequence for years to be manipulated"
+                raise Exception(er)
+            offset = split_year - block['start_year']
+            pre = dict(block)
+            pre['last_year'] = split_year - 1
+            pre['repeats'] = offset
+            pre['events'] = [
+                event for event in block['events'] if event[0] <= offset]
+            post = dict(block)
+            post['start_year'] = split_year
+            post['repeats'] = n_years - offset
+            post['events'] = []
+            for rel_year, month, lines in block['events']:
+                if rel_year > offset:
+                    new_lines = [re.sub(
+                        r'^\s*\d+', '%4d' % (rel_year - offset), lines[0],
+                        count=1)] + lines[1:]
+                    post['events'].append([rel_year - offset, month, new_lines])
+            pre_blocks.append(pre)
+            post_blocks.append(post)
+    return pre_blocks, post_blocks
+
+
+def read_graz_blocks(graz_file):
+    """Read the parameters of each grazing level from a grazing parameter
+    definition file.
+
+    Returns a dictionary keyed by grazing level code, where each entry is a
+    list of (parameter name, value) tuples in the order of the file."""
+
+    graz_blocks = {}
+    code = None
+    with open(graz_file, 'r') as read_file:
+        for line in read_file:
+            fields = line.split()
+            if len(fields) == 0:
+                continue
+            try:
+                value = float(fields[0])
+            except ValueError:
+                code = fields[0]
+                graz_blocks[code] = []
+                continue
+            if code is not None and len(fields) > 1:
+                graz_blocks[code].append((fields[1].strip("'"), value))
+    return graz_blocks
+
+
+def _parse_century_bat(bat_file):
+    """Find the fix file, schedule, output, extend and output variables
+    files named in a CENTURY batch file written by write_century_bat."""
+
+    with open(bat_file, 'r') as read_file:
+        text = read_file.read()
+    fix_file = re.search(r'copy (\S+) fix.100', text).group(1)
+    run = re.search(r'century_46 -s (\S+) -n (\S+)( -e (\S+))?', text)
+    outvars = re.search(r'list100_46 \S+ \S+ (\S+)', text).group(1)
+    return {
+        'fix_file': fix_file, 'schedule': run.group(1),
+        'output': run.group(2), 'extend': run.group(4), 'outvars': outvars}
+
+
+class CenturyRunCache:
+
+    """Local cache of CENTURY runs, keyed by the content of everything that
+    determines the outputs of a run: the schedule, with grazing level codes
+    replaced by the parameters of each level, the global parameter files in
+    the CENTURY directory (including site and fix files), the weather file,
+    the output variables file, and the binary file extended by the run.
+    Outputs of the least recently used runs are discarded once the cache
+    holds max_entries runs.
+
+    Removal fractions written by the model (FLGREM and FDGREM) may be
+    quantized to multiples of `quantum` with quantize_removal, so that runs
+    with nearly equal removal share outputs."""
+
+    _output_ext = ['.lis', '.bin', '_log.txt']
+
+    def __init__(self, cache_dir, max_entries=1000, quantum=None):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.quantum = quantum
+        self.hits = 0
+        self.misses = 0
+
+    def quantize_removal(self, consumed_dict):
+        """Round removal fractions to multiples of the quantum, if any."""
+        if not self.quantum:
+            return consumed_dict
+        return dict(
+            (key, round(val / self.quantum) * self.quantum) for key, val in
+            consumed_dict.items())
+
+    def _hash_file(self, path):
+        """Hash of the contents of a file.  The contents are read on every
+        call: the files are small, and size and modification time do not
+        reliably reveal a file rewritten between runs."""
+        with open(path, 'rb') as read_file:
+            return hashlib.sha1(read_file.read()).hexdigest()
+
+    def key(self, bat_file, century_dir):
+        """Content key of the run described by a CENTURY batch file."""
+        run = _parse_century_bat(bat_file)
+        digest = hashlib.sha1()
+        graz_blocks = read_graz_blocks(os.path.join(century_dir, 'graz.100'))
+        schedule = os.path.join(century_dir, run['schedule'] + '.sch')
+        with open(schedule, 'r') as sch:
+            lines = sch.readlines()
+        graz_option = False
+        for line in lines:
+            if graz_option:
+                # grazing level codes are arbitrary: use level parameters
+                digest.update(repr(graz_blocks.get(line.strip())) + '\n')
+            else:
+                digest.update(line.strip() + '\n')
+            graz_option = line.strip().endswith('GRAZ')
+        site_file, weather_file = get_site_weather_files(
+            schedule, century_dir)
+        for path in sorted(glob.glob(os.path.join(century_dir, '*.100'))):
+            name = os.path.basename(path)
+            if name.startswith('graz'):
+                continue
+            digest.update(name + self._hash_file(path))
+        if weather_file != 'NA':
+            digest.update(self._hash_file(weather_file))
+        inputs = [os.path.join(century_dir, run['outvars'])]
+        if run['extend'] is not None:
+            inputs.append(os.path.join(century_dir, run['extend'] + '.bin'))
+        for path in inputs:
+            if os.path.isfile(path):
+                digest.update(os.path.basename(path) + self._hash_file(path))
+        return digest.hexdigest()
+
+    def fetch(self, key, century_dir, output):
+        """Copy cached outputs of a run into the CENTURY directory under the
+        output name.  Returns True if the run was found in the cache."""
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry):
+            self.misses += 1
+            return False
+        for ext in self._output_ext:
+            cached = os.path.join(entry, 'output' + ext)
+            if os.path.isfile(cached):
+                shutil.copyfile(
+                    cached, os.path.join(century_dir, output + ext))
+        os.utime(entry, None)
+        self.hits += 1
+        return True
+
+    def store(self, key, century_dir, output):
+        """Save outputs of a run to the cache, discarding the least recently
+        used runs if the cache is full."""
+        entry = os.path.join(self.cache_dir, key)
+        tmp_entry = entry + '.tmp%d' % os.getpid()
+        if not os.path.exists(tmp_entry):
+            os.makedirs(tmp_entry)
+        for ext in self._output_ext:
+            produced = os.path.join(century_dir, output + ext)
+            if os.path.isfile(produced):
+                shutil.copyfile(
+                    produced, os.path.join(tmp_entry, 'output' + ext))
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # stored concurrently by another run
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Discard the least recently used runs beyond max_entries."""
+        entries = [
+            os.path.join(self.cache_dir, name) for name in
+            os.listdir(self.cache_dir) if '.tmp' not in name]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=os.path.getmtime)
+        for entry in entries[:len(entries) - self.max_entries]:
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def launch_CENTURY_cached(bat_file, cache, century_dir=None):
+    """Launch CENTURY from a batch file, unless outputs of a run with the
+    same inputs are found in the cache, in which case they are copied to the
+    CENTURY directory in place of running CENTURY.  The CENTURY directory is
+    century_dir, or if century_dir is None, the directory set by
+    set_century_directory."""
+
+    if century_dir is None:
+        century_dir = _century_dir
+    run = _parse_century_bat(bat_file)
+    key = cache.key(bat_file, century_dir)
+    if cache.fetch(key, century_dir, run['output']):
+        forage_trace.event(
+            'century_cache_hit', bat=bat_file,
+            label=os.path.basename(bat_file)[:-4], key=key)
+        return
+    launch_CENTURY_subprocess(bat_file, century_dir)
+    cache.store(key, century_dir, run['output'])
@@ -0,0 +1,363 @@
+"""Lookup tables of the diet selected by each herbivore class.
+
+For a herbivore class in a given physiological state, the diet selected
+(forage_utils.diet_selection_t2, with maximum intake checked against the
+protein content of the diet) and the intermediate quantities calculated from
+it (forage_utils.calc_diet_intermediates) depend only on the biomass,
+digestibility and crude protein of each forage type; relative height and
+relative availability are calculated from biomass.  Unless supplied by the
+user, digestibility is calculated from crude protein.  A DietTable holds
+these responses, tabulated on a regular grid of biomass and crude protein of
+each forage type by forage.tabulate_diets, and interpolates between grid
+points to stand in for the full equations (see args['diet_table'] in
+forage.execute).
+
+Diet selection fills the diet with forage types in order of
+digestibility, so diets change abruptly where that order changes.  Lookup
+falls back to the full equations within grid cells where the order changes,
+as it does for forage outside the grid and herbivore states that were not
+tabulated.  The grid grows as a power of the number of forage types, so
+tables are practical for one or two grass types.
+"""
+
+import json
+import bisect
+import itertools
+
+import numpy
+
+import forage_utils as forage
+
+# intermediate quantities of the diet that are tabulated
+INTERMEDIATES = [
+    'MEItotal', 'DPLS', 'MEm', 'MEc', 'MEl', 'NEw', 'Pm', 'Pc', 'Pl', 'Pw',
+    'L', 'RDPR', 'RDPIf', 'RDPIs']
+
+# inputs to the model that the tabulated responses depend on
+_TABLE_INPUTS = [
+    'prop_legume', 'DOY', 'latitude', 'steepness', 'user_define_protein',
+    'user_define_digestibility', 'digestibility_flag']
+
+# default grid: forage biomass (kg/ha) and crude protein (proportion)
+DEFAULT_GRID = {
+    'biomass': [
+        1., 50., 100., 200., 350., 500., 750., 1000., 1500., 2000., 3000.,
+        5000., 10000.],
+    'crude_protein': [0.01, 0.03, 0.05, 0.07, 0.09, 0.12, 0.15, 0.2, 0.3],
+}
+
+
+def table_inputs(args):
+    """Model inputs that tabulated diets depend on, from args as supplied to
+    forage.execute."""
+
+    return dict((key, args.get(key)) for key in _TABLE_INPUTS)
+
+
+def herbivore_state(herb_class):
+    """Physiological state of a herbivore class that, with forage, determines
+    its diet.  Weight is not simulated, so the state changes only with the
+    reproductive cycle of breeding females."""
+
+    return [
+        round(float(herb_class.W), 6), herb_class.reproductive_status,
+        herb_class.A_foet, herb_class.A_y]
+
+
+class DietTable:
+
+    """Diet selected by each herbivore class, and intermediate quantities
+    calculated from it, tabulated on a grid of forage descriptors."""
+
+    def __init__(self, f_labels, axes, digestibility, inputs):
+        """Parameters:
+            f_labels (list): labels of forage types, in the order of
+                available forage (see forage_utils.feed_type_labels)
+            axes (list): grid values of biomass and crude protein of each
+                forage type, in that order, i.e. [biomass of f_labels[0],
+                crude protein of f_labels[0], biomass of f_labels[1], ...]
+            digestibility (list): digestibility of each forage type at each
+                grid value of its crude protein
+            inputs (dict): model inputs that the table was built for
+        """
+        self.f_labels = list(f_labels)
+        self.axes = [numpy.asarray(axis, dtype=float) for axis in axes]
+        self.digestibility = [
+            numpy.asarray(dmd, dtype=float) for dmd in digestibility]
+        self.inputs = inputs
+        self.classes = {}
+        self.n_lookups = 0
+        self.n_fallbacks = 0
+        self._flat_values = {}
+        # offset between consecutive grid values of each axis in flattened
+        # tabulated values
+        shape = [len(axis) for axis in self.axes]
+        self._strides = [
+            int(numpy.prod(shape[dim + 1:])) for dim in xrange(len(shape))]
+        self._axis_lists = [axis.tolist() for axis in self.axes]
+        self._dmd_lists = [dmd.tolist() for dmd in self.digestibility]
+
+    def output_names(self):
+        """Names of the tabulated responses, in the order of the last
+        dimension of tabulated values."""
+
+        return ['intake;' + label for label in self.f_labels] + [
+            'Is'] + INTERMEDIATES
+
+    def add_class(self, label, states, values):
+        """Add tabulated responses of one herbivore class.
+
+        Parameters:
+            label (string): herbivore label
+            states (list): states of the herbivore class (see
+                herbivore_state) for which responses were tabulated
+            values (numpy array): tabulated responses, with one entry of the
+                first dimension for each state, one dimension for each axis
+                and a last dimension holding the responses named by
+                output_names
+        """
+        values = numpy.asarray(values, dtype=numpy.float32)
+        self.classes[label] = ([list(state) for state in states], values)
+        self._flat_values[label] = values.reshape(
+            values.shape[0], -1, values.shape[-1])
+
+    def check_inputs(self, args):
+        """Raise an exception if the table was built for different model
+        inputs than args."""
+
+        for key, val in table_inputs(args).items():
+            if val != self.inputs.get(key):
+                raise Exception(
+                    "Diet table was built for %s = %s, not %s" % (
+                        key, self.inputs.get(key), val))
+
+    def _find_cell(self, point):
+        """Find the grid cell containing a point.
+
+        Returns:
+            tuple (index, frac) giving, for each axis, the index of the lower
+                grid value of the cell and the fractional position of the
+                point within the cell, or None if the point lies outside the
+                grid
+        """
+        index = []
+        frac = []
+        for axis, x in zip(self._axis_lists, point):
+            if len(axis) == 1:
+                if abs(x - axis[0]) > 1e-9 * max(abs(axis[0]), 1.):
+                    return None
+                index.append(0)
+                frac.append(0.)
+                continue
+            if x < axis[0] or x > axis[-1]:
+                return None
+            idx = min(bisect.bisect_right(axis, x) - 1, len(axis) - 2)
+            index.append(idx)
+            frac.append((x - axis[idx]) / (axis[idx + 1] - axis[idx]))
+        return index, frac
+
+    def _same_order(self, index, frac, order):
+        """Check that the order of forage types by digestibility (descending,
+        ties in order of available forage) is `order` throughout a grid
+        cell."""
+
+        bounds = []
+        for f_index, dmd in enumerate(self._dmd_lists):
+            cp_index = index[2 * f_index + 1]
+            if frac[2 * f_index + 1] > 0:
+                low, high = sorted(dmd[cp_index:cp_index + 2])
+            else:
+                low = high = dmd[cp_index]
+            bounds.append((low, high))
+        for first, second in zip(order[:-1], order[1:]):
+            if bounds[first][0] < bounds[second][1]:
+                return False
+            if (bounds[first][0] == bounds[second][1] and
+                    first > second):
+                return False
+        return True
+
+    def _interpolate(self, values, index, frac):
+        """Multilinear interpolation of tabulated values within a grid cell
+        found by _find_cell, where values holds the responses at each grid
+        point of one herbivore state, flattened to two dimensions."""
+
+        corners = [(0, 1.)]
+        for idx, dim_frac, stride in zip(index, frac, self._strides):
+            base = idx * stride
+            if dim_frac > 0:
+                corners = [
+                    (offset + base + step, weight * step_weight) for
+                    offset, weight in corners for step, step_weight in
+                    ((0, 1. - dim_frac), (stride, dim_frac))]
+            else:
+                corners = [(offset + base, weight) for offset, weight in
+                           corners]
+        offsets, weights = zip(*corners)
+        return numpy.dot(weights, values[list(offsets)]).tolist()
+
+    def lookup(self, herb_class, available_forage):
+        """Find the diet selected by a herbivore class from the table.
+
+        Returns:
+            tuple (diet, diet_interm) of class Diet and DietIntermediates, or
+                None if the herbivore class, its state or the forage are not
+                covered by the table
+        """
+        self.n_lookups += 1
+        try:
+            states, values = self.classes[herb_class.label]
+            state_index = states.index(herbivore_state(herb_class))
+        except (KeyError, ValueError):
+            self.n_fallbacks += 1
+            return None
+        if forage.feed_type_labels(available_forage) != self.f_labels:
+            self.n_fallbacks += 1
+            return None
+        point = []
+        for feed_type in available_forage:
+            point.append(feed_type.biomass)
+            point.append(feed_type.crude_protein)
+        cell = self._find_cell(point)
+        order = sorted(
+            range(len(available_forage)),
+            key=lambda f_index: -available_forage[f_index].digestibility)
+        if cell is None or not self._same_order(cell[0], cell[1], order):
+            self.n_fallbacks += 1
+            return None
+        result = self._interpolate(
+            self._flat_values[herb_class.label][state_index], cell[0],
+            cell[1])
+        n_f = len(self.f_labels)
+        diet = forage.Diet()
+        for f_index, label in enumerate(self.f_labels):
+            f_intake = max(result[f_index], 0.)
+            feed_type = available_forage[f_index]
+            diet.intake[label] = f_intake
+            diet.If += f_intake
+            diet.DMDf += f_intake * feed_type.digestibility
+            diet.CPIf += f_intake * feed_type.crude_protein
+        if diet.If > 0:
+            diet.DMDf = diet.DMDf / diet.If
+        diet.Is = max(result[n_f], 0.)
+        diet_interm = forage.DietIntermediates()
+        for name, val in zip(INTERMEDIATES, result[n_f + 1:]):
+            setattr(diet_interm, name, val)
+        return diet, diet_interm
+
+    def interpolate_points(self, label, state_index, points):
+        """Interpolate tabulated responses of one herbivore class at many
+        points at once, e.g. for many sites or scenarios.
+
+        Parameters:
+            label (string): herbivore label
+            state_index (int): index of the herbivore state in the states
+                tabulated for the class
+            points (numpy array): one row per point and one column per axis
+                of the table, i.e. biomass and crude protein of each forage
+                type
+
+        Returns:
+            numpy array of responses (see output_names) with one row per
+                point, holding NaN for points outside the grid or in grid
+                cells where the order of forage types by digestibility changes
+        """
+        points = numpy.atleast_2d(numpy.asarray(points, dtype=float))
+        flat = self._flat_values[label][state_index]
+        n_points = points.shape[0]
+        base = numpy.zeros(n_points, dtype=int)
+        inside = numpy.ones(n_points, dtype=bool)
+        index = []
+        frac = []
+        for dim, axis in enumerate(self.axes):
+            x = points[:, dim]
+            if len(axis) == 1:
+                inside &= (
+                    numpy.abs(x - axis[0]) <= 1e-9 * max(abs(axis[0]), 1.))
+                idx = numpy.zeros(n_points, dtype=int)
+                dim_frac = numpy.zeros(n_points)
+            else:
+                inside &= (x >= axis[0]) & (x <= axis[-1])
+                idx = numpy.clip(
+                    numpy.searchsorted(axis, x, side='right') - 1, 0,
+                    len(axis) - 2)
+                dim_frac = numpy.clip(
+                    (x - axis[idx]) / (axis[idx + 1] - axis[idx]), 0., 1.)
+            base += idx * self._strides[dim]
+            index.append(idx)
+            frac.append(dim_frac)
+
+        # digestibility of each forage type at each point, and its range
+        # within the grid cell of the point
+        dmd = []
+        bounds = []
+        for f_index, f_dmd in enumerate(self.digestibility):
+            cp_dim = 2 * f_index + 1
+            low = f_dmd[index[cp_dim]]
+            if len(f_dmd) == 1:
+                high = low
+            else:
+                high = f_dmd[index[cp_dim] + 1]
+            dmd.append(low + frac[cp_dim] * (high - low))
+            high = numpy.where(frac[cp_dim] > 0, high, low)
+            bounds.append((numpy.minimum(low, high), numpy.maximum(low, high)))
+        for first in xrange(len(dmd)):
+            for second in xrange(len(dmd)):
+                if first == second:
+                    continue
+                if first < second:
+                    ahead = dmd[first] >= dmd[second]
+                    kept = bounds[first][0] >= bounds[second][1]
+                else:
+                    ahead = dmd[first] > dmd[second]
+                    kept = bounds[first][0] > bounds[second][1]
+                inside &= ~ahead | kept
+
+        result = numpy.zeros((n_points, flat.shape[1]))
+        for corner in itertools.product((0, 1), repeat=len(self.axes)):
+            weight = numpy.ones(n_points)
+            offset = base.copy()
+            for dim, upper in enumerate(corner):
+                if upper:
+                    if len(self.axes[dim]) == 1:
+                        weight = None
+                        break
+                    weight = weight * frac[dim]
+                    offset += self._strides[dim]
+                else:
+                    weight = weight * (1. - frac[dim])
+            if weight is None:
+                continue
+            result += weight[:, numpy.newaxis] * flat[offset]
+        result[~inside] = numpy.nan
+        return result
+
+    def save(self, save_as):
+        """Save the table to a numpy .npz file."""
+
+        labels = sorted(self.classes.keys())
+        meta = {
+            'f_labels': self.f_labels,
+            'axes': [axis.tolist() for axis in self.axes],
+            'digestibility': [dmd.tolist() for dmd in self.digestibility],
+            'inputs': self.inputs,
+            'labels': labels,
+            'states': [self.classes[label][0] for label in labels]}
+        arrays = dict(
+            ('values_%d' % idx, self.classes[label][1]) for idx, label in
+            enumerate(labels))
+        numpy.savez_compressed(save_as, meta=json.dumps(meta), **arrays)
+
+    @classmethod
+    def load(cls, npz_file):
+        """Load a table saved by DietTable.save."""
+
+        saved = numpy.load(npz_file)
+        meta = json.loads(str(saved['meta']))
+        table = cls(
+            meta['f_labels'], meta['axes'], meta['digestibility'],
+            meta['inputs'])
+        for idx, label in enumerate(meta['labels']):
+            table.add_class(
+                label, meta['states'][idx], saved['values_%d' % idx])
+        return table
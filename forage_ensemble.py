@@ -0,0 +1,414 @@
+"""Run the forage model under an ensemble of weather series and summarize
+the distribution of model outputs across members.
+
+Each member of the ensemble is a fully coupled run of the forage model
+(forage.execute) in which the weather of the extend period is replaced by a
+resampled or perturbed version of the site weather file.  All members start
+from a single CENTURY spin-up, which is run once and shared.  Members are run
+in parallel, each in a private copy of the CENTURY and input directories, and
+the summary results of each member are folded into running percentile
+estimates as soon as the member finishes, so that memory use does not depend
+on the number of members.
+"""
+
+import os
+import math
+import shutil
+import tempfile
+import traceback
+import multiprocessing
+
+import numpy
+import pandas
+
+import forage
+import forage_century_link_utils as cent
+import forage_metrics
+
+# name of the weather file written for each member of the ensemble
+_MEMBER_WTH = 'ensemble.wth'
+
+
+class StreamingQuantiles:
+
+    """Estimate quantiles of a stream of arrays, element by element, with the
+    P-square algorithm (Jain and Chlamtac 1985).  Five markers are kept for
+    each element and each quantile, regardless of the number of arrays
+    added."""
+
+    def __init__(self, shape, probs):
+        """Set up the estimator.
+
+        Parameters:
+            shape (tuple): shape of each array added
+            probs (list): quantiles to estimate, each between 0 and 1
+        """
+        self.shape = tuple(shape)
+        self.probs = numpy.asarray(probs, dtype=float)
+        n_cells = int(numpy.prod(self.shape))
+        n_probs = len(self.probs)
+        p = numpy.repeat(self.probs[numpy.newaxis, :], n_cells, axis=0)
+        p = p.ravel()
+        self.n = 0
+        self.count = numpy.zeros(n_cells)
+        self.total = numpy.zeros(n_cells)
+        self._buffer = []
+        self._n_probs = n_probs
+        self._height = None
+        self._pos = numpy.tile(numpy.arange(1., 6.), (len(p), 1))
+        self._desired = numpy.column_stack(
+            [numpy.ones(len(p)), 1 + 2 * p, 1 + 4 * p, 3 + 2 * p,
+             numpy.repeat(5., len(p))])
+        self._incr = numpy.column_stack(
+            [numpy.zeros(len(p)), p / 2., p, (1 + p) / 2.,
+             numpy.ones(len(p))])
+
+    def add(self, values):
+        """Add one array to the stream."""
+        values = numpy.asarray(values, dtype=float).ravel()
+        valid = ~numpy.isnan(values)
+        self.count += valid
+        self.total += numpy.where(valid, values, 0.)
+        x = numpy.repeat(values, self._n_probs)
+        self.n += 1
+        if self._height is None:
+            self._buffer.append(x)
+            if len(self._buffer) == 5:
+                self._height = numpy.sort(
+                    numpy.column_stack(self._buffer), axis=1)
+                self._buffer = []
+            return
+        q = self._height
+        pos = self._pos
+        k = numpy.sum(q[:, 1:4] <= x[:, numpy.newaxis], axis=1)
+        q[:, 0] = numpy.minimum(q[:, 0], x)
+        q[:, 4] = numpy.maximum(q[:, 4], x)
+        pos += numpy.arange(5)[numpy.newaxis, :] > k[:, numpy.newaxis]
+        self._desired += self._incr
+        for i in xrange(1, 4):
+            d = self._desired[:, i] - pos[:, i]
+            move = (((d >= 1) & (pos[:, i + 1] - pos[:, i] > 1)) |
+                    ((d <= -1) & (pos[:, i - 1] - pos[:, i] < -1)))
+            if not numpy.any(move):
+                continue
+            d = numpy.where(move, numpy.sign(d), 0.)
+            parabolic = q[:, i] + d / (pos[:, i + 1] - pos[:, i - 1]) * (
+                (pos[:, i] - pos[:, i - 1] + d) * (q[:, i + 1] - q[:, i]) /
+                (pos[:, i + 1] - pos[:, i]) +
+                (pos[:, i + 1] - pos[:, i] - d) * (q[:, i] - q[:, i - 1]) /
+                (pos[:, i] - pos[:, i - 1]))
+            q_adj = numpy.where(d > 0, q[:, i + 1], q[:, i - 1])
+            pos_adj = numpy.where(d > 0, pos[:, i + 1], pos[:, i - 1])
+            linear = q[:, i] + d * (q_adj - q[:, i]) / (pos_adj - pos[:, i])
+            within = (q[:, i - 1] < parabolic) & (parabolic < q[:, i + 1])
+            new_height = numpy.where(within, parabolic, linear)
+            q[:, i] = numpy.where(move, new_height, q[:, i])
+            pos[:, i] += d
+
+    def quantiles(self):
+        """Current quantile estimates, an array of the shape of arrays added
+        with a final axis indexing quantiles."""
+        if self._height is not None:
+            est = self._height[:, 2]
+        elif self._buffer:
+            stacked = numpy.column_stack(self._buffer)
+            est = numpy.array([
+                numpy.percentile(row, 100. * p) for row, p in
+                zip(stacked, numpy.tile(self.probs, len(stacked) /
+                                        self._n_probs))])
+        else:
+            est = numpy.repeat(numpy.nan, len(self._pos))
+        return est.reshape(self.shape + (self._n_probs,))
+
+    def mean(self):
+        """Mean of the arrays added, ignoring missing values."""
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = self.total / self.count
+        return mean.reshape(self.shape)
+
+
+def schedule_years(schedule):
+    """Starting and last year of the simulation described by a CENTURY
+    schedule file."""
+    with open(schedule, 'r') as sch:
+        for line in sch:
+            if 'Starting year' in line:
+                first_year = int(line.split()[0])
+            if 'Last year' in line:
+                last_year = int(line.split()[0])
+                break
+    return first_year, last_year
+
+
+def resample_weather(weather_df, years, rng):
+    """Build a weather series for the given years by drawing whole years,
+    with replacement, from the years recorded in weather_df.  Variables
+    recorded for the same year are kept together.
+
+    Parameters:
+        weather_df (pandas.DataFrame): site weather, see
+            cent.read_weather_file
+        years (list): years of the weather series to build
+        rng (numpy.random.RandomState): random number generator
+
+    Returns:
+        pandas data frame in the format of weather_df
+    """
+    source_years = sorted(set(weather_df['year']))
+    blocks = []
+    for year in years:
+        source = source_years[rng.randint(len(source_years))]
+        block = weather_df[weather_df['year'] == source].copy()
+        block['year'] = year
+        blocks.append(block)
+    return pandas.concat(blocks, ignore_index=True)
+
+
+def perturb_weather(weather_df, years, rng, precip_cv=0.2, temp_sd=0.5):
+    """Build a weather series for the given years by perturbing the recorded
+    weather of each year.  Monthly precipitation is multiplied by a lognormal
+    factor with mean 1 and coefficient of variation precip_cv; the same
+    normally distributed shift, with standard deviation temp_sd (deg C), is
+    added to monthly minimum and maximum temperature.  Years missing from the
+    record are first drawn from the recorded years.
+
+    Returns:
+        pandas data frame in the format of weather_df
+    """
+    recorded = set(weather_df['year'])
+    blocks = []
+    for year in years:
+        if year in recorded:
+            block = weather_df[weather_df['year'] == year].copy()
+        else:
+            block = resample_weather(weather_df, [year], rng)
+        blocks.append(block)
+    perturbed = pandas.concat(blocks, ignore_index=True)
+    months = range(1, 13)
+    sigma = math.sqrt(math.log(1. + precip_cv ** 2))
+    for year in years:
+        year_mask = perturbed['year'] == year
+        factor = rng.lognormal(-0.5 * sigma ** 2, sigma, 12)
+        shift = rng.normal(0., temp_sd, 12)
+        prec = year_mask & (perturbed['variable'] == 'prec')
+        perturbed.loc[prec, months] = perturbed.loc[prec, months] * factor
+        temp = year_mask & perturbed['variable'].isin(['tmin', 'tmax'])
+        perturbed.loc[temp, months] = perturbed.loc[temp, months] + shift
+    return perturbed
+
+
+def member_weather(weather_df, years, member, method='resample', seed=0,
+                   precip_cv=0.2, temp_sd=0.5):
+    """Weather series for one member of the ensemble.  The series depends
+    only on the member index and seed, so that a member can be regenerated
+    independently of the others."""
+    rng = numpy.random.RandomState(seed + member)
+    if method == 'resample':
+        return resample_weather(weather_df, years, rng)
+    elif method == 'perturb':
+        return perturb_weather(weather_df, years, rng, precip_cv, temp_sd)
+    else:
+        raise ValueError("method must be 'resample' or 'perturb'")
+
+
+def generate_weather_ensemble(wth_file, n_members, out_dir, first_year,
+                              last_year, method='resample', seed=0,
+                              precip_cv=0.2, temp_sd=0.5):
+    """Write the weather file for each member of an ensemble.
+
+    Returns:
+        list of paths to the weather files written
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    weather_df = cent.read_weather_file(wth_file)
+    years = range(first_year, last_year + 1)
+    base = os.path.basename(wth_file)[:-4]
+    file_list = []
+    for member in xrange(n_members):
+        member_df = member_weather(
+            weather_df, years, member, method, seed, precip_cv, temp_sd)
+        save_as = os.path.join(out_dir, '%s_%d.wth' % (base, member))
+        cent.write_weather_file(member_df, save_as)
+        file_list.append(save_as)
+    return file_list
+
+
+def _run_member(task):
+    """Run the forage model for one member of the ensemble.
+
+    Parameters:
+        task (tuple): (args, member, weather_df, years, weather_options,
+            workspace_root, metrics), where args are model inputs including
+            args['spin_up_dir'], member is the member index, weather_df and
+            years describe the site weather and the years to generate,
+            weather_options is a dictionary of keyword arguments to
+            member_weather, and metrics is True if totals of the run are to
+            be counted (see forage_metrics)
+
+    Returns:
+        tuple (member, summary_df, totals, error), where summary_df gives
+            numeric columns of summary results for the member, totals are
+            those of forage_metrics.run_totals, or None if not counted, and
+            error is None, or the traceback of the error raised by a run
+            that failed, in which case summary_df and totals are None
+    """
+    (args, member, weather_df, years, weather_options, workspace_root,
+     metrics) = task
+    args = dict(args)
+    workspace_dir = tempfile.mkdtemp(dir=workspace_root)
+    try:
+        args['century_dir'], args['input_dir'] = cent.copy_century_workspace(
+            args['century_dir'], args['input_dir'], workspace_dir)
+        args['outdir'] = os.path.join(workspace_dir, 'output')
+        member_df = member_weather(
+            weather_df, years, member, **weather_options)
+        cent.write_weather_file(
+            member_df, os.path.join(args['input_dir'], _MEMBER_WTH))
+        for grass in forage.read_grass(args):
+            schedule = os.path.join(
+                args['input_dir'], grass['label'] + '.sch')
+            cent.set_schedule_weather_file(schedule, _MEMBER_WTH)
+        args['write_csv'] = False
+        args['metrics'] = metrics
+        summary_df = forage.execute(args)['summary_results']
+        totals = forage_metrics.run_totals() if metrics else None
+        return member, summary_df, totals, None
+    except Exception:
+        return member, None, None, traceback.format_exc()
+    finally:
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+
+
+def run_weather_ensemble(args, n_members, method='resample',
+                         percentiles=(5, 25, 50, 75, 95), seed=0,
+                         precip_cv=0.2, temp_sd=0.5, weather_file=None,
+                         n_workers=None, workspace_dir=None,
+                         metrics_file=None):
+    """Run the coupled forage model for each member of a weather ensemble
+    and summarize the distribution of summary results across members.
+
+    The CENTURY spin-up is run once and shared by all members.  Summary
+    results of each member are folded into streaming percentile estimates as
+    members finish, so memory use does not grow with n_members.  Results are
+    written to 'ensemble_summary.csv' in args['outdir']: one row per row of
+    summary_results.csv, with a column for the mean and for each percentile
+    of each summary column (e.g. 'total_offtake_p50').
+
+    Parameters:
+        args (dict): model inputs, see forage.execute
+        n_members (int): number of ensemble members
+        method (string): 'resample' to draw whole years from the site weather
+            record, or 'perturb' to perturb recorded weather
+        percentiles (list): percentiles of summary results to estimate
+        seed (int): seed of the random weather series
+        precip_cv (float): coefficient of variation of the multiplicative
+            precipitation perturbation, for method 'perturb'
+        temp_sd (float): standard deviation (deg C) of the temperature
+            perturbation, for method 'perturb'
+        weather_file (string): site weather file to resample or perturb.
+            Defaults to the weather file named in the schedule of the first
+            grass type
+        n_workers (int): number of worker processes. Defaults to the number
+            of CPUs
+        workspace_dir (string): directory where members are run. Defaults to
+            a temporary directory
+        metrics_file (string): if supplied, progress of the ensemble
+            (members finished, members per minute, estimated time to
+            completion, and steps, CENTURY and Python seconds and files
+            written by finished members) is written to this file in the
+            Prometheus text format (see forage_metrics.BatchMetrics)
+
+    Returns:
+        pandas data frame of ensemble statistics
+    """
+    grass_list = forage.read_grass(args)
+    schedule = os.path.join(args['input_dir'], grass_list[0]['label'] + '.sch')
+    if weather_file is None:
+        site_file, weather_file = cent.get_site_weather_files(
+            schedule, args['input_dir'])
+        if weather_file == 'NA':
+            er = "Error: no weather file found in schedule file"
+            raise Exception(er)
+    weather_df = cent.read_weather_file(weather_file)
+    first_year, last_year = schedule_years(schedule)
+    years = range(first_year, last_year + 1)
+    weather_options = {
+        'method': method, 'seed': seed, 'precip_cv': precip_cv,
+        'temp_sd': temp_sd}
+
+    if not os.path.exists(args['outdir']):
+        os.makedirs(args['outdir'])
+    remove_workspace = workspace_dir is None
+    if workspace_dir is None:
+        workspace_dir = tempfile.mkdtemp()
+    elif not os.path.exists(workspace_dir):
+        os.makedirs(workspace_dir)
+    pool = None
+    batch_metrics = None
+    try:
+        spin_up_dir = os.path.join(workspace_dir, 'spin_up')
+        spin_up_ws = tempfile.mkdtemp(dir=workspace_dir)
+        spin_up_args = dict(args)
+        spin_up_args['century_dir'], spin_up_args['input_dir'] = \
+            cent.copy_century_workspace(
+                args['century_dir'], args['input_dir'], spin_up_ws)
+        forage.run_spin_up(spin_up_args, spin_up_dir)
+        shutil.rmtree(spin_up_ws, ignore_errors=True)
+
+        member_args = dict(args)
+        member_args['spin_up_dir'] = spin_up_dir
+        tasks = [
+            (member_args, member, weather_df, years, weather_options,
+             workspace_dir, metrics_file is not None) for member in
+            xrange(n_members)]
+        if metrics_file is not None:
+            batch_metrics = forage_metrics.BatchMetrics(
+                metrics_file, n_members, batch='weather_ensemble')
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(n_workers)
+        stats = None
+        failures = []
+        for member, summary_df, totals, error in pool.imap_unordered(
+                _run_member, tasks):
+            if batch_metrics is not None:
+                batch_metrics.add_run(totals, failed=error is not None)
+            if error is not None:
+                failures.append((member, error))
+                continue
+            if stats is None:
+                columns = list(summary_df.columns)
+                index_df = summary_df[['step', 'year', 'month']]
+                stat_columns = [c for c in columns if c not in
+                                ('step', 'year', 'month')]
+                stats = StreamingQuantiles(
+                    (len(summary_df), len(stat_columns)),
+                    [p / 100. for p in percentiles])
+            stats.add(summary_df[stat_columns].values)
+        pool.close()
+        pool.join()
+        pool = None
+        if failures:
+            member, error = min(failures)
+            er = "Error: %d of %d ensemble members failed; member %d:\n%s" % (
+                len(failures), n_members, member, error)
+            raise Exception(er)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if batch_metrics is not None:
+            batch_metrics.close()
+        if remove_workspace:
+            shutil.rmtree(workspace_dir, ignore_errors=True)
+
+    ensemble_df = index_df.reset_index(drop=True)
+    quantiles = stats.quantiles()
+    mean = stats.mean()
+    for col_idx, col in enumerate(stat_columns):
+        ensemble_df[col + '_mean'] = mean[:, col_idx]
+        for p_idx, p in enumerate(percentiles):
+            ensemble_df['%s_p%g' % (col, p)] = quantiles[:, col_idx, p_idx]
+    ensemble_df.to_csv(
+        os.path.join(args['outdir'], 'ensemble_summary.csv'), index=False)
+    return ensemble_df
@@ -0,0 +1,170 @@
+"""Stand-in for the CENTURY executable, for tests and benchmarks of the
+coupled model on machines where CENTURY is not installed.
+
+launch takes the place of forage_century_link_utils.launch_CENTURY_subprocess
+(see install).  It reads the batch file, schedule, site and weather files and
+grazing parameters as CENTURY would, simulates live and standing dead
+above-ground biomass from the first year of the schedule to the last, and
+writes the .lis, .bin and log files that the model reads and moves.  The
+growth equations are deliberately crude: the stand-in reproduces the file
+traffic and the cost structure of CENTURY runs (each run, including an
+extend run, simulates the whole schedule and writes a .lis file covering
+the output period), not its ecology.
+"""
+
+import os
+import time
+
+import numpy
+
+import forage_century_link_utils as cent
+import forage_surrogate
+import forage_timing
+
+LIS_COLUMNS = ['time', 'aglivc', 'stdedc', 'aglive(1)', 'stdede(1)']
+
+# carbon in live biomass at the start of a run not extending another run
+# (g per square m)
+_INITIAL_LIVE = 50.
+_INITIAL_DEAD = 50.
+# monthly growth per cm of precipitation, and maximum live biomass
+# (g C per square m)
+_GROWTH_PER_CM = 8.
+_MAX_LIVE = 400.
+_SENESCENCE = 0.1
+_DECAY = 0.05
+# nitrogen content of live and standing dead biomass (g N per g C)
+_N_LIVE = 0.03
+_N_DEAD = 0.01
+
+_original_launch = None
+
+
+def install():
+    """Run the stand-in in place of CENTURY for subsequent model runs."""
+    global _original_launch
+    if _original_launch is None:
+        _original_launch = cent.launch_CENTURY_subprocess
+    cent.launch_CENTURY_subprocess = launch
+
+
+def uninstall():
+    """Launch CENTURY again for subsequent model runs."""
+    global _original_launch
+    if _original_launch is not None:
+        cent.launch_CENTURY_subprocess = _original_launch
+        _original_launch = None
+
+
+def write_century_dir(century_dir):
+    """Write the files that model runs expect to find in the CENTURY
+    directory: grazing parameter definitions (levels 'GH', 'GL' and 'GLP')
+    and the list of output variables."""
+    if not os.path.exists(century_dir):
+        os.makedirs(century_dir)
+    levels = [('GH', 0.3, 0.03), ('GL', 0.1, 0.01), ('GLP', 0.05, 0.01)]
+    with open(os.path.join(century_dir, 'graz.100'), 'w') as graz:
+        for code, flgrem, fdgrem in levels:
+            graz.write('%-6s(orig)\n' % code)
+            graz.write("%.5f           'FLGREM'\n" % flgrem)
+            graz.write("%.5f           'FDGREM'\n" % fdgrem)
+            graz.write("0.30000           'GFCRET'\n")
+            graz.write("0.50000           'GRET(1)'\n")
+            graz.write("0.95000           'GRET(2)'\n")
+            graz.write("0.95000           'GRET(3)'\n")
+            graz.write("0.00000           'GRZEFF'\n")
+            graz.write("0.80000           'FECLIG'\n")
+    with open(os.path.join(century_dir, 'outvars.txt'), 'w') as outvars:
+        outvars.write('\n'.join(LIS_COLUMNS[1:]) + '\n')
+
+
+def _output_period(blocks):
+    """First year and interval (months) of output requested by the blocks of
+    a schedule: those of the first block whose output starting year falls
+    within the schedule."""
+    for block in blocks:
+        values = {}
+        for line in block['header']:
+            for key in ['Output starting year', 'Output interval']:
+                if key in line:
+                    values[key] = int(line.split()[0])
+        if values['Output starting year'] <= blocks[-1]['last_year']:
+            return values['Output starting year'], values['Output interval']
+    return blocks[-1]['last_year'], 12
+
+
+def _fail(bat_file, start, log_file, message):
+    with open(log_file, 'w') as log:
+        log.write(message + '\n')
+    cent._trace_launch_end(bat_file, start, 1, log_file, 1, False)
+    raise Exception([message])
+
+
+def launch(bat_file, century_dir=None):
+    """Run the stand-in for the CENTURY run described by a batch file
+    written by forage_century_link_utils.write_century_bat, in century_dir,
+    or if century_dir is None, in the CENTURY directory set by
+    forage_century_link_utils.set_century_directory."""
+    if century_dir is None:
+        century_dir = cent._century_dir
+    cent._trace_launch_start(bat_file, ['forage_fake_century', bat_file])
+    start = time.time()
+    with forage_timing.phase('century_process'):
+        run = cent._parse_century_bat(bat_file)
+        log_file = os.path.join(century_dir, run['output'] + '_log.txt')
+        schedule = os.path.join(century_dir, run['schedule'] + '.sch')
+        fix_file = os.path.join(century_dir, run['fix_file'])
+        for required in [schedule, fix_file]:
+            if not os.path.isfile(required):
+                _fail(bat_file, start, log_file,
+                      'File not found: %s' % required)
+        live, dead = _INITIAL_LIVE, _INITIAL_DEAD
+        if run['extend'] is not None:
+            extend_bin = os.path.join(century_dir, run['extend'] + '.bin')
+            if not os.path.isfile(extend_bin):
+                _fail(bat_file, start, log_file,
+                      'File not found: %s' % extend_bin)
+            live, dead = numpy.fromfile(extend_bin).reshape(-1, 3)[-1, 1:]
+        header, blocks = cent.read_schedule_blocks(schedule)
+        weather = forage_surrogate.read_monthly_weather(schedule, century_dir)
+        removal = forage_surrogate.read_removal(
+            schedule, os.path.join(century_dir, 'graz.100'))
+        output_year, interval = _output_period(blocks)
+
+        states = []
+        month_count = 0
+        for year in xrange(blocks[0]['start_year'],
+                           blocks[-1]['last_year'] + 1):
+            for month in xrange(1, 13):
+                # the state at the start of each output interval is written
+                # with the date of the end of the previous month
+                if year >= output_year:
+                    if month_count % interval == 0:
+                        states.append(
+                            [year + float('%.2f' % ((month - 1) / 12.)), live,
+                             dead])
+                    month_count += 1
+                prec = forage_surrogate.monthly_weather(
+                    weather, year, month)[0]
+                live += _GROWTH_PER_CM * prec * max(1. - live / _MAX_LIVE, 0.)
+                senesced = _SENESCENCE * live
+                live = max(live - senesced, 1.)
+                dead = dead + senesced - _DECAY * dead
+                flgrem, fdgrem = removal.get((year, month), (0., 0.))
+                live = max(live * (1. - flgrem), 1.)
+                dead = dead * (1. - fdgrem)
+        # the final state is always written, to be extended by later runs
+        end_time = blocks[-1]['last_year'] + 1.
+        if not states or states[-1][0] != end_time:
+            states.append([end_time, live, dead])
+        states = numpy.array(states)
+        states.tofile(os.path.join(century_dir, run['output'] + '.bin'))
+        with open(os.path.join(century_dir, run['output'] + '.lis'),
+                  'w') as lis:
+            lis.write(''.join('%12s' % c for c in LIS_COLUMNS) + '\n\n')
+            for date, live_c, dead_c in states:
+                lis.write('%12.2f%12.4f%12.4f%12.4f%12.4f\n' % (
+                    date, live_c, dead_c, live_c * _N_LIVE, dead_c * _N_DEAD))
+        with open(log_file, 'w') as log:
+            log.write('Execution success.\n')
+    cent._trace_launch_end(bat_file, start, 0, log_file, 1, True)
@@ -0,0 +1,517 @@
+"""Run the forage model over a grid of pixels, simulating each unique
+combination of pixel inputs once.
+
+Each pixel of the grid has its own site, weather, grass composition and
+stocking density, given by layers of the same shape: integer codes of site,
+weather and grass composition, which index tables of site files, weather
+files and grass tables, and the stocking density of each herbivore class
+(animals per ha).  Layers may be numpy arrays, .npy files or, where GDAL is
+installed, single-band rasters, and are read in blocks of rows so that
+memory use does not depend on the size of the grid.
+
+Pixels with identical inputs give identical results, and most landscapes
+have far fewer unique combinations of inputs than pixels.  Pixels are
+therefore grouped by their inputs (see find_groups), and the coupled model
+is run once for each group (see run_grid).  The CENTURY spin-up, which does
+not depend on the weather of the run or on stocking, is run once for each
+combination of site and grass composition and shared by the groups that
+have it.  Spin-ups and groups are run in parallel, each in a private copy of
+the CENTURY and input directories.  Monthly outputs of each group are then
+written to every pixel of the group, in memory-mapped .npy arrays of shape
+(steps, rows, columns).
+"""
+
+import os
+import shutil
+import tempfile
+import traceback
+import multiprocessing
+
+import numpy
+import pandas
+from numpy.lib.format import open_memmap
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+import forage
+import forage_century_link_utils as cent
+import forage_metrics
+
+# layers describing the inputs of each pixel, in the order of group keys
+GRID_LAYERS = ['site', 'weather', 'grass', 'stocking']
+# outputs written by default: total offtake, and live and standing dead
+# biomass summed over grass types (kg/ha)
+DEFAULT_OUTPUTS = ('total_offtake', 'green_kgha', 'dead_kgha')
+# code of a pixel whose inputs are missing
+NODATA = -1
+
+
+class _RasterBand(object):
+
+    """First band of a raster, read by rows with GDAL.  Pixels equal to the
+    NoData value of the band are read as NaN."""
+
+    def __init__(self, path):
+        if gdal is None:
+            er = "Error: GDAL is required to read raster %s" % path
+            raise Exception(er)
+        self.dataset = gdal.Open(path)
+        if self.dataset is None:
+            er = "Error: could not open raster %s" % path
+            raise Exception(er)
+        self.band = self.dataset.GetRasterBand(1)
+        self.nodata = self.band.GetNoDataValue()
+        self.shape = (self.dataset.RasterYSize, self.dataset.RasterXSize)
+
+    def read_rows(self, row_start, row_end):
+        values = self.band.ReadAsArray(
+            0, row_start, self.shape[1], row_end - row_start).astype(float)
+        if self.nodata is not None:
+            values[values == self.nodata] = numpy.nan
+        return values
+
+
+def open_layer(source):
+    """Open a layer of pixel inputs for reading by rows.
+
+    Parameters:
+        source: a 2-D numpy array, the path to a .npy file, which is memory
+            mapped, or the path to a raster readable by GDAL
+
+    Returns:
+        object with attribute shape, to be read with read_rows
+    """
+    if isinstance(source, basestring):
+        if source.lower().endswith('.npy'):
+            source = numpy.load(source, mmap_mode='r')
+        else:
+            return _RasterBand(source)
+    source = numpy.asanyarray(source)
+    if source.ndim != 2:
+        er = "Error: layers of the grid must have two dimensions"
+        raise Exception(er)
+    return source
+
+
+def read_rows(layer, row_start, row_end):
+    """Rows row_start to row_end (exclusive) of a layer opened with
+    open_layer, as an array of floats."""
+    if isinstance(layer, _RasterBand):
+        return layer.read_rows(row_start, row_end)
+    return numpy.asarray(layer[row_start:row_end], dtype=float)
+
+
+def _open_layers(layers):
+    """Open the layers supplied and check that they have the same shape.
+
+    Returns:
+        tuple (opened, shape), where opened gives the opened layer, or None,
+            for each of GRID_LAYERS
+    """
+    unknown = set(layers) - set(GRID_LAYERS)
+    if unknown:
+        er = "Error: unknown grid layers: %s" % ', '.join(sorted(unknown))
+        raise Exception(er)
+    opened = [None if layers.get(name) is None else
+              open_layer(layers[name]) for name in GRID_LAYERS]
+    shapes = set(layer.shape for layer in opened if layer is not None)
+    if len(shapes) == 0:
+        er = "Error: at least one grid layer must be supplied"
+        raise Exception(er)
+    if len(shapes) > 1:
+        er = "Error: grid layers differ in shape"
+        raise Exception(er)
+    return opened, shapes.pop()
+
+
+def find_groups(layers, group_id_file, block_rows=256, nodata=NODATA,
+                stocking_decimals=4):
+    """Group the pixels of a grid by their inputs.
+
+    The key of a group gives, for each of GRID_LAYERS, the code or stocking
+    density shared by its pixels, or None where the layer is not supplied.
+    Pixels with the nodata code in any code layer, or with missing or
+    negative stocking density, belong to no group.
+
+    Parameters:
+        layers (dict): layer of pixel inputs (see open_layer) keyed by name
+            in GRID_LAYERS.  Layers that are not supplied are taken from the
+            model inputs of the run
+        group_id_file (string): path of a .npy file to which the index of
+            the group of each pixel, or -1, is written
+        block_rows (int): number of rows read at once
+        nodata (int): code of pixels whose inputs are missing
+        stocking_decimals (int): stocking densities are rounded to this
+            number of decimal places before pixels are grouped
+
+    Returns:
+        tuple (keys, n_pixels), giving the key and the number of pixels of
+            each group, in order of group index
+    """
+    opened, shape = _open_layers(layers)
+    group_id = open_memmap(
+        group_id_file, mode='w+', dtype=numpy.int32, shape=shape)
+    group_index = {}
+    keys = []
+    n_pixels = []
+    for row_start in xrange(0, shape[0], block_rows):
+        row_end = min(row_start + block_rows, shape[0])
+        n_block = (row_end - row_start) * shape[1]
+        columns = []
+        valid = numpy.ones(n_block, dtype=bool)
+        for name, layer in zip(GRID_LAYERS, opened):
+            if layer is None:
+                columns.append(numpy.zeros(n_block))
+                continue
+            values = read_rows(layer, row_start, row_end).ravel()
+            if name == 'stocking':
+                values = numpy.round(values, stocking_decimals)
+                with numpy.errstate(invalid='ignore'):
+                    valid &= values >= 0
+            else:
+                valid &= values != nodata
+            valid &= ~numpy.isnan(values)
+            columns.append(values)
+        block_id = numpy.full(n_block, -1, dtype=numpy.int32)
+        if numpy.any(valid):
+            pixel_keys = numpy.column_stack(columns)[valid]
+            unique_keys, inverse = numpy.unique(
+                pixel_keys, axis=0, return_inverse=True)
+            counts = numpy.bincount(inverse, minlength=len(unique_keys))
+            local_to_global = numpy.empty(len(unique_keys), dtype=numpy.int32)
+            for local, values in enumerate(unique_keys):
+                key = tuple(
+                    None if layer is None else
+                    (float(value) if name == 'stocking' else int(value))
+                    for name, layer, value in zip(
+                        GRID_LAYERS, opened, values))
+                if key not in group_index:
+                    group_index[key] = len(keys)
+                    keys.append(key)
+                    n_pixels.append(0)
+                local_to_global[local] = group_index[key]
+                n_pixels[group_index[key]] += counts[local]
+            block_id[valid] = local_to_global[inverse]
+        group_id[row_start:row_end] = block_id.reshape(-1, shape[1])
+    group_id.flush()
+    del group_id
+    return keys, n_pixels
+
+
+def _table_value(tables, name, code):
+    """Entry of tables[name] for a code of layer name."""
+    try:
+        return tables[name][code]
+    except KeyError:
+        er = "Error: %s code %s not found in %s table" % (name, code, name)
+        raise Exception(er)
+
+
+def _input_file(input_dir, file_name):
+    """Copy a site or weather file into input_dir, unless it is there
+    already, and return its name.  file_name may be a path, or a name in
+    input_dir."""
+    name = os.path.basename(file_name)
+    if os.path.isfile(file_name) and not os.path.isfile(
+            os.path.join(input_dir, name)):
+        shutil.copyfile(file_name, os.path.join(input_dir, name))
+    if not os.path.isfile(os.path.join(input_dir, name)):
+        er = "Error: file not found: %s" % file_name
+        raise Exception(er)
+    return name
+
+
+def _prepare_inputs(args, site_file, weather_file, grass_csv):
+    """Set the site file, weather file and grass table of a run in a
+    private input directory, args['input_dir'].  The site file is named in
+    the schedule of the run and the spin-up schedule of each grass type, and
+    the weather file in the schedule of the run.  Inputs that are None are
+    left as they are.
+
+    Modifies:
+        args, and schedules in args['input_dir']
+    """
+    if grass_csv is not None:
+        args['grass_csv'] = grass_csv
+    for grass in forage.read_grass(args):
+        schedule = os.path.join(args['input_dir'], grass['label'] + '.sch')
+        hist_schedule = os.path.join(
+            args['input_dir'], grass['label'] + '_hist.sch')
+        if site_file is not None:
+            site_name = _input_file(args['input_dir'], site_file)
+            for sch in [schedule, hist_schedule]:
+                if os.path.isfile(sch):
+                    cent.set_schedule_site_file(sch, site_name)
+        if weather_file is not None:
+            cent.set_schedule_weather_file(
+                schedule, _input_file(args['input_dir'], weather_file))
+
+
+def _run_spin_up(task):
+    """Run the CENTURY spin-up for one combination of site and grass
+    composition.
+
+    Parameters:
+        task (tuple): (args, site_file, grass_csv, spin_up_dir,
+            workspace_root)
+
+    Returns:
+        spin_up_dir
+    """
+    args, site_file, grass_csv, spin_up_dir, workspace_root = task
+    args = dict(args)
+    workspace_dir = tempfile.mkdtemp(dir=workspace_root)
+    try:
+        args['century_dir'], args['input_dir'] = cent.copy_century_workspace(
+            args['century_dir'], args['input_dir'], workspace_dir)
+        _prepare_inputs(args, site_file, None, grass_csv)
+        return forage.run_spin_up(args, spin_up_dir)
+    finally:
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+
+
+def grid_values(summary_df, outputs):
+    """Monthly values of grid outputs from the summary results of a run.
+
+    Parameters:
+        summary_df (pandas.DataFrame): summary results, see forage.execute
+        outputs (list): names of outputs: a column of summary results, e.g.
+            'total_offtake', or 'green_kgha' or 'dead_kgha' for live or
+            standing dead biomass summed over grass types
+
+    Returns:
+        numpy array of shape (len(outputs), steps)
+    """
+    steps_df = summary_df[summary_df['step'] >= 0].sort_values('step')
+    values = []
+    for name in outputs:
+        if name in ('green_kgha', 'dead_kgha'):
+            columns = [c for c in steps_df.columns if
+                       c.endswith('_' + name)]
+            values.append(steps_df[columns].sum(axis=1).values)
+        elif name in steps_df.columns:
+            values.append(steps_df[name].values)
+        else:
+            er = "Error: output %s not found in summary results" % name
+            raise Exception(er)
+    return numpy.array(values, dtype=float)
+
+
+def _run_group(task):
+    """Run the coupled model for one group of pixels.
+
+    Parameters:
+        task (tuple): (args, group, site_file, weather_file, grass_csv,
+            density, outputs, workspace_root, metrics), where args are model
+            inputs including args['spin_up_dir'], group is the index of the
+            group, density is the stocking density of each herbivore class
+            or None, and metrics is True if totals of the run are to be
+            counted (see forage_metrics)
+
+    Returns:
+        tuple (group, steps_df, values, totals, error), where steps_df gives
+            the step, year and month of each step, values are those of
+            grid_values, totals are those of forage_metrics.run_totals, or
+            None if not counted, and error is None, or the traceback of the
+            error raised by a run that failed, in which case steps_df, values
+            and totals are None
+    """
+    (args, group, site_file, weather_file, grass_csv, density, outputs,
+     workspace_root, metrics) = task
+    args = dict(args)
+    workspace_dir = tempfile.mkdtemp(dir=workspace_root)
+    try:
+        args['century_dir'], args['input_dir'] = cent.copy_century_workspace(
+            args['century_dir'], args['input_dir'], workspace_dir)
+        _prepare_inputs(args, site_file, weather_file, grass_csv)
+        if density is not None:
+            args['density_series'] = dict(
+                (step, density) for step in xrange(args['num_months']))
+        args['outdir'] = os.path.join(workspace_dir, 'output')
+        args['write_csv'] = False
+        args['metrics'] = metrics
+        summary_df = forage.execute(args)['summary_results']
+        steps_df = summary_df.loc[
+            summary_df['step'] >= 0, ['step', 'year', 'month']].sort_values(
+            'step')
+        values = grid_values(summary_df, outputs)
+        totals = forage_metrics.run_totals() if metrics else None
+        return group, steps_df, values, totals, None
+    except Exception:
+        return group, None, None, None, traceback.format_exc()
+    finally:
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+
+
+def run_grid(args, layers, tables=None, outputs=DEFAULT_OUTPUTS,
+             out_dir=None, block_rows=256, nodata=NODATA,
+             stocking_decimals=4, n_workers=None, workspace_dir=None,
+             metrics_file=None):
+    """Run the coupled forage model over a grid of pixels, once for each
+    unique combination of pixel inputs.
+
+    Written to out_dir: 'group_id.npy', the index of the group of each
+    pixel (see find_groups); 'grid_groups.csv', the inputs and number of
+    pixels of each group; 'grid_steps.csv', the step, year and month of each
+    step; and for each output, '<output>.npy', a float32 array of shape
+    (steps, rows, columns) giving the output of each pixel by step, NaN for
+    pixels that belong to no group.  Arrays are written block by block
+    through memory maps, and may be read the same way, e.g. with
+    numpy.load(path, mmap_mode='r').
+
+    Parameters:
+        args (dict): model inputs, see forage.execute.  Inputs of pixels not
+            given by layers are taken from args
+        layers (dict): layers of pixel inputs keyed by name in GRID_LAYERS:
+            'site', 'weather' and 'grass' give codes that index tables, and
+            'stocking' gives the stocking density of each herbivore class
+            (animals per ha).  Each layer is a 2-D numpy array, a .npy file
+            or a raster (see open_layer)
+        tables (dict): for each code layer supplied, a dictionary keyed by
+            code giving the site file, weather file or grass table (see
+            args['grass_csv']) of the code.  Site and weather files are
+            paths, or names of files in args['input_dir']
+        outputs (list): outputs written for each pixel, see grid_values
+        out_dir (string): directory where outputs are written.  Defaults to
+            args['outdir']
+        block_rows (int): number of rows of layers and outputs processed at
+            once
+        nodata (int): code of pixels whose inputs are missing
+        stocking_decimals (int): stocking densities are rounded to this
+            number of decimal places before pixels are grouped
+        n_workers (int): number of worker processes. Defaults to the number
+            of CPUs
+        workspace_dir (string): directory where spin-ups and groups are run.
+            Defaults to a temporary directory
+        metrics_file (string): if supplied, progress of the groups is
+            written to this file in the Prometheus text format (see
+            forage_metrics.BatchMetrics)
+
+    Returns:
+        pandas data frame of groups, as written to 'grid_groups.csv'
+    """
+    if tables is None:
+        tables = {}
+    for name in ['site', 'weather', 'grass']:
+        if layers.get(name) is not None and name not in tables:
+            er = "Error: %s layer supplied without a %s table" % (name, name)
+            raise Exception(er)
+    if out_dir is None:
+        out_dir = args['outdir']
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    shape = _open_layers(layers)[1]
+    keys, n_pixels = find_groups(
+        layers, os.path.join(out_dir, 'group_id.npy'), block_rows, nodata,
+        stocking_decimals)
+    if len(keys) == 0:
+        er = "Error: no pixel of the grid has complete inputs"
+        raise Exception(er)
+
+    # inputs of each group: site file, weather file, grass table, density
+    group_inputs = []
+    for site, weather, grass, stocking in keys:
+        group_inputs.append((
+            None if site is None else _table_value(tables, 'site', site),
+            None if weather is None else
+            _table_value(tables, 'weather', weather),
+            None if grass is None else _table_value(tables, 'grass', grass),
+            stocking))
+    spin_up_keys = sorted(set((site, grass) for site, weather, grass,
+                              stocking in keys))
+
+    remove_workspace = workspace_dir is None
+    if workspace_dir is None:
+        workspace_dir = tempfile.mkdtemp()
+    elif not os.path.exists(workspace_dir):
+        os.makedirs(workspace_dir)
+    pool = None
+    batch_metrics = None
+    try:
+        spin_up_dirs = {}
+        spin_up_tasks = []
+        for index, (site, grass) in enumerate(spin_up_keys):
+            spin_up_dirs[(site, grass)] = os.path.join(
+                workspace_dir, 'spin_up_%d' % index)
+            spin_up_tasks.append((
+                args,
+                None if site is None else _table_value(tables, 'site', site),
+                None if grass is None else
+                _table_value(tables, 'grass', grass),
+                spin_up_dirs[(site, grass)], workspace_dir))
+        group_tasks = []
+        for group, key in enumerate(keys):
+            group_args = dict(args)
+            group_args['spin_up_dir'] = spin_up_dirs[(key[0], key[2])]
+            group_tasks.append(
+                (group_args, group) + group_inputs[group] +
+                (list(outputs), workspace_dir, metrics_file is not None))
+        if metrics_file is not None:
+            batch_metrics = forage_metrics.BatchMetrics(
+                metrics_file, len(keys), batch='grid')
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(n_workers)
+        pool.map(_run_spin_up, spin_up_tasks)
+        group_values = None
+        steps_df = None
+        failures = []
+        for group, group_steps, values, totals, error in (
+                pool.imap_unordered(_run_group, group_tasks)):
+            if batch_metrics is not None:
+                batch_metrics.add_run(totals, failed=error is not None)
+            if error is not None:
+                failures.append((group, error))
+                continue
+            if group_values is None:
+                steps_df = group_steps
+                # the extra group, filled with NaN, is that of pixels with
+                # group index -1
+                group_values = numpy.full(
+                    (len(outputs), values.shape[1], len(keys) + 1), numpy.nan)
+            group_values[:, :, group] = values
+        pool.close()
+        pool.join()
+        pool = None
+        if failures:
+            group, error = min(failures)
+            er = "Error: %d of %d groups of pixels failed; group %d:\n%s" % (
+                len(failures), len(keys), group, error)
+            raise Exception(er)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if batch_metrics is not None:
+            batch_metrics.close()
+        if remove_workspace:
+            shutil.rmtree(workspace_dir, ignore_errors=True)
+
+    group_id = numpy.load(
+        os.path.join(out_dir, 'group_id.npy'), mmap_mode='r')
+    out_arrays = [
+        open_memmap(os.path.join(out_dir, name + '.npy'), mode='w+',
+                    dtype=numpy.float32,
+                    shape=(group_values.shape[1],) + shape)
+        for name in outputs]
+    for row_start in xrange(0, shape[0], block_rows):
+        row_end = min(row_start + block_rows, shape[0])
+        block_id = numpy.asarray(group_id[row_start:row_end])
+        for out_idx, out_array in enumerate(out_arrays):
+            out_array[:, row_start:row_end, :] = group_values[
+                out_idx][:, block_id]
+    for out_array in out_arrays:
+        out_array.flush()
+    del out_arrays, group_id
+
+    steps_df.to_csv(os.path.join(out_dir, 'grid_steps.csv'), index=False)
+    groups_df = pandas.DataFrame(keys, columns=GRID_LAYERS)
+    groups_df.insert(0, 'group', range(len(keys)))
+    groups_df['site_file'] = [inputs[0] for inputs in group_inputs]
+    groups_df['weather_file'] = [inputs[1] for inputs in group_inputs]
+    groups_df['grass_csv'] = [inputs[2] for inputs in group_inputs]
+    groups_df['n_pixels'] = n_pixels
+    groups_df.to_csv(os.path.join(out_dir, 'grid_groups.csv'), index=False)
+    return groups_df
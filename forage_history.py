@@ -0,0 +1,456 @@
+"""Calibrate the grazing history of a site so that CENTURY reproduces
+biomass measured at the site.
+
+Grazing in the n_months up to and including the month of the biomass
+measurement (the window) is adjusted: the intensity of grazing in the window
+(FLGREM, the fraction of live biomass removed, with FDGREM set to 10% of
+FLGREM as in modify_intensity) and, if the heaviest grazing allowed still
+leaves too much biomass, the number of grazing events, which are added in
+ungrazed months of the window closest to the measurement as in
+find_target_month.
+
+Rather than re-running CENTURY from the start of the schedule for each
+trial, the simulation is run once up to the start of the year containing the
+window, and each trial extends that saved state over the window only.
+Several trials are evaluated at once, each in its own copy of the CENTURY
+directory, and the search narrows the intensity bracketing the measured
+biomass until simulated biomass matches within a tolerance.
+"""
+
+import os
+import math
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy
+import pandas
+
+import forage_century_link_utils as cent
+
+# heaviest grazing intensity (FLGREM) tried
+_MAX_FLGREM = 0.95
+
+
+def find_window(empirical_date, n_months):
+    """Find the first month of the window of n_months ending with the month
+    of the empirical date.
+
+    Parameters:
+        empirical_date (float): CENTURY date of the measurement, e.g.
+            2015.42 for May 2015
+        n_months (int): number of months in the window, including the month
+            of the measurement
+
+    Returns:
+        tuple (first_month, first_year, empirical_month, empirical_year)
+    """
+    empirical_year = int(math.floor(empirical_date))
+    empirical_month = int(round((empirical_date - empirical_year) * 12))
+    if empirical_month == 0:
+        empirical_month = 12
+        empirical_year -= 1
+    first_month, first_year = cent.find_first_month_and_year(
+        n_months, empirical_month, empirical_year)
+    return first_month, first_year, empirical_month, empirical_year
+
+
+def window_months(first_month, first_year, empirical_month, empirical_year,
+                  block_start_year):
+    """List the months of the window as (relative year, month) of the block
+    starting in block_start_year, in order."""
+    months = []
+    year, month = first_year, first_month
+    while (year, month) <= (empirical_year, empirical_month):
+        months.append((year - block_start_year + 1, month))
+        month += 1
+        if month > 12:
+            month = 1
+            year += 1
+    return months
+
+
+def _event_name(event):
+    return event[2][0].split()[2]
+
+
+def edit_window(block, window, graz_level, n_added):
+    """Edit the grazing events of a block within the window: every grazing
+    event in the window is set to graz_level, and grazing events at
+    graz_level are added in the n_added ungrazed months of the window
+    closest to its end.
+
+    Returns:
+        tuple (block, n_available), the edited copy of the block and the
+            number of ungrazed months in the window where events could be
+            added
+    """
+    block = dict(block)
+    first_line = block['header'][0]
+    eol = first_line[len(first_line.rstrip('\r\n')):] or '\n'
+    events = []
+    grazed = set()
+    for rel_year, month, lines in block['events']:
+        if ((rel_year, month) in window and
+                _event_name([rel_year, month, lines]) == 'GRAZ'):
+            lines = [lines[0], graz_level + eol]
+            grazed.add((rel_year, month))
+        events.append([rel_year, month, lines])
+    ungrazed = [m for m in reversed(window) if m not in grazed]
+    for rel_year, month in ungrazed[:n_added]:
+        new_event = [
+            rel_year, month, ['%4d%5d GRAZ' % (rel_year, month) + eol,
+                              graz_level + eol]]
+        position = len(events)
+        for index, event in enumerate(events):
+            if ((event[0], event[1]) > (rel_year, month) or
+                    ((event[0], event[1]) == (rel_year, month) and
+                     _event_name(event) == 'LAST')):
+                position = index
+                break
+        events.insert(position, new_event)
+    block['events'] = events
+    return block, len(ungrazed)
+
+
+def _prepare_graz_file(graz_base, graz_file, label, flgrem, template_level,
+                       outdir):
+    """Write graz_file as graz_base with a new grazing level removing flgrem
+    of live and 0.1 * flgrem of standing dead biomass.
+
+    Returns the code of the new grazing level."""
+    shutil.copyfile(graz_base, graz_file)
+    consumed = {label + ';green': flgrem, label + ';dead': 0.1 * flgrem}
+    return cent.add_new_graz_level(
+        {'label': label}, consumed, graz_file, template_level, outdir,
+        'calibrated')
+
+
+def _run_candidate(task):
+    """Extend the saved CENTURY state over the window for one candidate and
+    report simulated biomass at the empirical date.
+
+    Parameters:
+        task (tuple): (workspace, settings, n_added, flgrem), where settings
+            is a dictionary describing the window run
+
+    Returns:
+        float, total standing biomass (live and standing dead, g per square
+            m) at the empirical date
+    """
+    workspace, settings, n_added, flgrem = task
+    label = settings['label']
+    graz_level = _prepare_graz_file(
+        os.path.join(workspace, 'graz_base.100'),
+        os.path.join(workspace, 'graz.100'), label, flgrem,
+        settings['template_level'], workspace)
+    window_block, _ = edit_window(
+        settings['blocks'][0], settings['window'], graz_level, n_added)
+    cent.write_schedule_blocks(
+        settings['header'], [window_block] + settings['blocks'][1:],
+        os.path.join(workspace, label + '_win.sch'))
+    output = os.path.join(workspace, label + '_win')
+    try:
+        cent.launch_CENTURY_subprocess(output + '.bat', workspace)
+        outputs = cent.read_CENTURY_outputs(
+            output + '.lis', settings['first_year'], settings['last_year'])
+        index = numpy.argmin(
+            numpy.abs(outputs.index.values - settings['empirical_date']))
+        return float(outputs['total'].iloc[index])
+    finally:
+        for ext in ['.lis', '.bin', '_log.txt']:
+            if os.path.isfile(output + ext):
+                os.remove(output + ext)
+
+
+class GrazingHistoryCalibration:
+
+    """Adjust grazing in a window before a biomass measurement until CENTURY
+    matches the measurement, branching each trial from CENTURY state saved
+    at the start of the window."""
+
+    def __init__(self, label, century_dir, input_dir, fix_file,
+                 empirical_date, empirical_biomass, n_months=12,
+                 template_level='GL', n_workers=None, workspace_dir=None,
+                 spin_up_dir=None, outvars='outvars.txt'):
+        """Set up the calibration.
+
+        Parameters:
+            label (string): site label. The schedule '<label>.sch' and
+                spin-up schedule '<label>_hist.sch', and the site and
+                weather files they name, reside in input_dir
+            century_dir (string): directory containing the CENTURY executable
+                and global parameter files
+            input_dir (string): directory containing inputs to run CENTURY
+            fix_file (string): basename of the CENTURY fix file, in
+                input_dir
+            empirical_date (float): CENTURY date of the biomass measurement
+            empirical_biomass (float): measured total standing biomass (live
+                and standing dead, g per square m)
+            n_months (int): number of months up to and including the month
+                of measurement in which grazing is adjusted
+            template_level (string): grazing level whose parameters, apart
+                from FLGREM and FDGREM, are used for grazing in the window
+            n_workers (int): number of trials evaluated at once. Defaults to
+                the number of CPUs
+            workspace_dir (string): directory where CENTURY is run. Defaults
+                to a temporary directory
+            spin_up_dir (string): directory containing saved spin-up results
+                (see forage.run_spin_up); if None, the spin-up is run
+            outvars (string): CENTURY output variables file
+        """
+        schedule = os.path.join(input_dir, label + '.sch')
+        cent.check_schedule(schedule, n_months, empirical_date)
+        self.label = label
+        self.century_dir = century_dir
+        self.input_dir = input_dir
+        self.fix_file = fix_file
+        self.empirical_date = empirical_date
+        self.empirical_biomass = float(empirical_biomass)
+        self.template_level = template_level
+        self.outvars = outvars
+        self.spin_up_dir = spin_up_dir
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        self.n_workers = n_workers
+        self._remove_workspace = workspace_dir is None
+        if workspace_dir is None:
+            workspace_dir = tempfile.mkdtemp()
+        self.workspace_dir = workspace_dir
+
+        first_month, first_year, empirical_month, empirical_year = (
+            find_window(empirical_date, n_months))
+        self.header, blocks = cent.read_schedule_blocks(schedule)
+        self.pre_blocks, post_blocks = cent.split_schedule_blocks(
+            blocks, first_year)
+        # trials run only up to the end of the block containing the
+        # measurement
+        last_year = post_blocks[0]['last_year']
+        self.post_blocks = post_blocks
+        self.settings = {
+            'label': label,
+            'template_level': template_level,
+            'header': self.header,
+            'blocks': [post_blocks[0]],
+            'window': window_months(
+                first_month, first_year, empirical_month, empirical_year,
+                first_year),
+            'first_year': first_year,
+            'last_year': last_year,
+            'empirical_date': empirical_date,
+        }
+        self.workspaces = []
+        self.history = []
+        self._pool = None
+
+    def setup(self):
+        """Run CENTURY up to the start of the window once, and make a copy
+        of the CENTURY directory holding the saved state for each worker."""
+        if self.workspaces:
+            return
+        base_dir = os.path.join(self.workspace_dir, 'base')
+        shutil.copytree(self.century_dir, base_dir)
+        schedule = os.path.join(self.input_dir, self.label + '.sch')
+        hist_schedule = os.path.join(self.input_dir, self.label + '_hist.sch')
+        input_files = [os.path.join(self.input_dir, self.fix_file)]
+        for sch in [schedule, hist_schedule]:
+            for file_name in cent.get_site_weather_files(sch, self.input_dir):
+                if file_name != 'NA' and file_name not in input_files:
+                    input_files.append(file_name)
+        for file_name in input_files + [hist_schedule]:
+            shutil.copyfile(
+                file_name,
+                os.path.join(base_dir, os.path.basename(file_name)))
+        hist_output = self.label + '_hist'
+        saved_hist = None
+        if self.spin_up_dir is not None:
+            saved_hist = os.path.join(self.spin_up_dir, hist_output + '.bin')
+        if saved_hist is not None and os.path.isfile(saved_hist):
+            shutil.copyfile(
+                saved_hist, os.path.join(base_dir, hist_output + '.bin'))
+        else:
+            cent.write_century_bat(
+                base_dir, hist_output + '.bat', hist_output + '.sch',
+                hist_output, self.fix_file, self.outvars)
+            cent.launch_CENTURY_subprocess(
+                os.path.join(base_dir, hist_output + '.bat'), base_dir)
+        extend = hist_output
+        if self.pre_blocks:
+            pre_output = self.label + '_pre'
+            cent.write_schedule_blocks(
+                self.header, self.pre_blocks,
+                os.path.join(base_dir, pre_output + '.sch'))
+            cent.write_century_bat(
+                base_dir, pre_output + '.bat', pre_output + '.sch',
+                pre_output, self.fix_file, self.outvars, hist_output)
+            cent.launch_CENTURY_subprocess(
+                os.path.join(base_dir, pre_output + '.bat'), base_dir)
+            extend = pre_output
+        shutil.copyfile(
+            os.path.join(base_dir, 'graz.100'),
+            os.path.join(base_dir, 'graz_base.100'))
+        win_output = self.label + '_win'
+        cent.write_century_bat(
+            base_dir, win_output + '.bat', win_output + '.sch', win_output,
+            self.fix_file, self.outvars, extend)
+        for index in xrange(self.n_workers):
+            workspace = os.path.join(self.workspace_dir, 'worker_%d' % index)
+            shutil.copytree(base_dir, workspace)
+            self.workspaces.append(workspace)
+
+    def close(self):
+        """Shut down worker processes and remove the workspace, if it was
+        created by the calibration."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._remove_workspace:
+            shutil.rmtree(self.workspace_dir, ignore_errors=True)
+            self.workspaces = []
+
+    def evaluate(self, candidates):
+        """Simulate biomass at the empirical date for each candidate, a tuple
+        (number of grazing events added, FLGREM).
+
+        Returns:
+            list of floats, simulated biomass for each candidate
+        """
+        self.setup()
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.n_workers)
+        biomass = []
+        for start in xrange(0, len(candidates), self.n_workers):
+            chunk = candidates[start:start + self.n_workers]
+            tasks = [
+                (workspace, self.settings, n_added, flgrem) for
+                workspace, (n_added, flgrem) in zip(self.workspaces, chunk)]
+            biomass.extend(self._pool.map(_run_candidate, tasks))
+        for (n_added, flgrem), value in zip(candidates, biomass):
+            self.history.append({
+                'n_added': n_added, 'flgrem': flgrem, 'biomass': value})
+        return biomass
+
+    def calibrate(self, tolerance=0.05, max_rounds=10, outdir=None):
+        """Search for the grazing history that matches measured biomass.
+
+        Each round evaluates n_workers values of FLGREM spanning the current
+        interval and narrows the interval to the values whose simulated
+        biomass brackets the measurement.  If the heaviest grazing leaves
+        too much biomass, grazing events are added to the window.
+
+        Parameters:
+            tolerance (float): acceptable difference between simulated and
+                measured biomass, as a fraction of measured biomass
+            max_rounds (int): maximum number of rounds
+            outdir (string): if supplied, the calibrated schedule
+                ('<label>_calibrated.sch'), grazing parameters
+                ('graz_calibrated.100') and all candidates evaluated
+                ('calibration_history.csv') are written here
+
+        Returns:
+            dictionary with entries 'n_added', 'flgrem', 'biomass' (simulated
+                at the empirical date), 'error' (simulated minus measured) and
+                'converged'
+        """
+        target = self.empirical_biomass
+        n_grid = max(self.n_workers, 3)
+        _, n_available = edit_window(
+            self.settings['blocks'][0], self.settings['window'], 'X', 0)
+        lower, upper = 0., _MAX_FLGREM
+        n_added = 0
+        best = None
+        try:
+            for _ in xrange(max_rounds):
+                grid = list(numpy.linspace(lower, upper, n_grid))
+                biomass = self.evaluate([(n_added, f) for f in grid])
+                errors = [abs(b - target) for b in biomass]
+                index = int(numpy.argmin(errors))
+                if best is None or errors[index] < abs(best[2] - target):
+                    best = (n_added, grid[index], biomass[index])
+                if errors[index] <= tolerance * target:
+                    break
+                if min(biomass) > target:
+                    # even the heaviest grazing tried leaves too much biomass
+                    if upper < _MAX_FLGREM:
+                        lower, upper = upper, _MAX_FLGREM
+                    elif n_added < n_available:
+                        n_added, added_biomass = self._add_events(
+                            n_added, n_available, n_grid, target)
+                        if abs(added_biomass - target) < abs(
+                                best[2] - target):
+                            best = (n_added, _MAX_FLGREM, added_biomass)
+                        lower, upper = 0., _MAX_FLGREM
+                    else:
+                        break
+                    continue
+                if max(biomass) < target:
+                    # even the lightest grazing tried leaves too little
+                    if lower > 0.:
+                        lower, upper = 0., lower
+                        continue
+                    break
+                # simulated biomass decreases with intensity: narrow the
+                # interval to the values bracketing the measurement
+                bracket = [
+                    i for i in xrange(len(grid) - 1) if
+                    biomass[i] >= target >= biomass[i + 1]]
+                if bracket:
+                    lower, upper = grid[bracket[0]], grid[bracket[0] + 1]
+                else:
+                    lower = grid[max(index - 1, 0)]
+                    upper = grid[min(index + 1, len(grid) - 1)]
+                if upper - lower < 1e-4:
+                    break
+        finally:
+            self.close()
+        n_added, flgrem, simulated = best
+        result = {
+            'n_added': n_added,
+            'flgrem': flgrem,
+            'biomass': simulated,
+            'error': simulated - target,
+            'converged': abs(simulated - target) <= tolerance * target,
+        }
+        if outdir is not None:
+            self.save_calibrated(outdir, n_added, flgrem)
+        return result
+
+    def _add_events(self, n_added, n_available, n_grid, target):
+        """Evaluate adding up to n_grid more grazing events at the heaviest
+        intensity, and choose the smallest number of events added for which
+        simulated biomass falls to the measurement, or the largest number
+        tried.
+
+        Returns:
+            tuple (n_added, biomass), the number of events added and the
+                biomass simulated with them
+        """
+        added = range(n_added + 1, min(n_available, n_added + n_grid) + 1)
+        added_biomass = self.evaluate([(n, _MAX_FLGREM) for n in added])
+        chosen = len(added) - 1
+        for index, value in enumerate(added_biomass):
+            if value <= target:
+                chosen = index
+                break
+        return added[chosen], added_biomass[chosen]
+
+    def save_calibrated(self, outdir, n_added, flgrem):
+        """Write the calibrated schedule, grazing parameters, and all
+        candidates evaluated, to outdir."""
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        graz_file = os.path.join(outdir, 'graz_calibrated.100')
+        graz_level = _prepare_graz_file(
+            os.path.join(self.century_dir, 'graz.100'), graz_file,
+            self.label, flgrem, self.template_level, outdir)
+        window_block, _ = edit_window(
+            self.post_blocks[0], self.settings['window'], graz_level,
+            n_added)
+        cent.write_schedule_blocks(
+            self.header,
+            self.pre_blocks + [window_block] + self.post_blocks[1:],
+            os.path.join(outdir, self.label + '_calibrated.sch'))
+        pandas.DataFrame(
+            self.history, columns=['n_added', 'flgrem', 'biomass']).to_csv(
+                os.path.join(outdir, 'calibration_history.csv'), index=False)
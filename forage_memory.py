@@ -0,0 +1,280 @@
+"""Memory use of a model run, by model step and phase.
+
+While memory tracking is enabled, the resident memory of the process (RSS)
+is sampled at the start and end of each phase timed by forage_timing
+(CENTURY launches, reading CENTURY outputs, diet selection, etc.) and at the
+end of each model step.  For each phase, the change in RSS and the increase
+in peak RSS over the phase are accumulated by step; a phase with a large
+increase in peak RSS is where the memory high-water mark of the run was
+raised.  Where the tracemalloc module is available (Python 3), memory
+allocated by Python is also tracked, and the lines of code holding the most
+memory are recorded at the end of each step.
+
+Peak RSS is the high-water mark of the whole process, including memory used
+before the run started; it is the quantity that matters when sizing the
+number of runs that fit on a node (see workers_for_memory).
+"""
+
+import os
+import sys
+
+import pandas
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+_MB = 1024. ** 2
+
+_enabled = False
+# whether enable() started tracemalloc, so that disable() leaves tracing
+# started elsewhere running
+_started_tracemalloc = False
+_step = -1
+_top_n = 10
+# [number of calls, RSS change, increase in peak RSS, maximum RSS at end,
+# change in traced memory] keyed by (step, phase)
+_phases = {}
+# one row per step: [step, RSS, peak RSS, traced memory, traced peak]
+_steps = []
+# one row per step and allocator: [step, rank, location, size, count]
+_allocators = []
+
+
+def _rss_bytes():
+    """Current resident memory of this process (bytes), or None if unknown.
+    Read from /proc where available."""
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _peak_rss_bytes():
+    """Peak resident memory of this process (bytes), or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # bytes, rather than kilobytes
+        return peak
+    return peak * 1024
+
+
+def _traced_bytes():
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[0]
+
+
+def sample():
+    """Current and peak RSS, and memory traced by tracemalloc, in bytes.
+    Values that cannot be measured are None."""
+    return (_rss_bytes(), _peak_rss_bytes(), _traced_bytes())
+
+
+def _mb(value):
+    return None if value is None else value / _MB
+
+
+def _difference(after, before):
+    if after is None or before is None:
+        return 0
+    return after - before
+
+
+def enable(top_n=10, frames=1):
+    """Discard memory use recorded so far and start tracking memory.
+
+    Parameters:
+        top_n (int): number of lines of code holding the most memory
+            recorded at each step, where tracemalloc is available
+        frames (int): number of frames of the traceback of each allocation
+            kept by tracemalloc
+    """
+    global _enabled, _top_n, _started_tracemalloc
+    reset()
+    _top_n = top_n
+    if tracemalloc is not None and not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        _started_tracemalloc = True
+    _enabled = True
+
+
+def disable():
+    """Stop tracking memory.  Memory use recorded so far is kept.
+    tracemalloc is stopped only if enable() started it."""
+    global _enabled, _started_tracemalloc
+    if _enabled:
+        _record_step()
+    _enabled = False
+    if _started_tracemalloc and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _started_tracemalloc = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Discard memory use recorded so far."""
+    global _step
+    _phases.clear()
+    del _steps[:]
+    del _allocators[:]
+    _step = -1
+
+
+def _record_step():
+    """Record memory use at the end of the current step."""
+    rss, peak, traced = sample()
+    traced_peak = None
+    if traced is not None:
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        statistics = tracemalloc.take_snapshot().statistics('lineno')
+        for rank, stat in enumerate(statistics[:_top_n]):
+            frame = stat.traceback[0]
+            _allocators.append([
+                _step, rank + 1, '%s:%d' % (frame.filename, frame.lineno),
+                _mb(stat.size), stat.count])
+    _steps.append([_step, _mb(rss), _mb(peak), _mb(traced),
+                   _mb(traced_peak)])
+
+
+def set_step(step):
+    """Record memory use at the end of the current model step, and
+    attribute subsequent memory use to step.  Step -1 is the setup of a run,
+    before the first step."""
+    global _step
+    if _enabled:
+        _record_step()
+    _step = step
+
+
+def phase_end(name, start):
+    """Record memory use over a phase.
+
+    Parameters:
+        name (string): name of the phase
+        start (tuple): memory sampled at the start of the phase (see sample)
+    """
+    end = sample()
+    entry = _phases.get((_step, name))
+    if entry is None:
+        entry = [0, 0, 0, 0, 0]
+        _phases[(_step, name)] = entry
+    entry[0] += 1
+    entry[1] += _difference(end[0], start[0])
+    entry[2] += _difference(end[1], start[1])
+    entry[3] = max(entry[3], end[0] or 0)
+    entry[4] += _difference(end[2], start[2])
+
+
+def step_report():
+    """Memory use at the end of each step recorded so far.
+
+    Returns:
+        pandas data frame with columns 'step', 'rss_mb', 'peak_rss_mb',
+            'traced_mb' and 'traced_peak_mb'; traced memory is missing
+            where tracemalloc is not available
+    """
+    return pandas.DataFrame(_steps, columns=[
+        'step', 'rss_mb', 'peak_rss_mb', 'traced_mb', 'traced_peak_mb'])
+
+
+def phase_report():
+    """Memory use over phases recorded so far, by model step and phase.
+
+    Returns:
+        pandas data frame with columns 'step', 'phase', 'calls',
+            'rss_change_mb' (total change in RSS over calls of the phase),
+            'peak_increase_mb' (total increase in peak RSS), 'max_rss_mb'
+            (largest RSS at the end of a call) and 'traced_change_mb'
+            (total change in memory traced by tracemalloc)
+    """
+    rows = [[step, name, entry[0], _mb(entry[1]), _mb(entry[2]),
+             _mb(entry[3]), _mb(entry[4])] for (step, name), entry in
+            sorted(_phases.items())]
+    return pandas.DataFrame(rows, columns=[
+        'step', 'phase', 'calls', 'rss_change_mb', 'peak_increase_mb',
+        'max_rss_mb', 'traced_change_mb'])
+
+
+def allocator_report():
+    """Lines of code holding the most memory at the end of each step, where
+    tracemalloc is available.
+
+    Returns:
+        pandas data frame with columns 'step', 'rank', 'location' (file and
+            line), 'size_mb' and 'count' (number of allocated blocks)
+    """
+    return pandas.DataFrame(_allocators, columns=[
+        'step', 'rank', 'location', 'size_mb', 'count'])
+
+
+def peak_rss_mb():
+    """Peak RSS of this process (MB), or None if unknown."""
+    return _mb(_peak_rss_bytes())
+
+
+def write_report(outdir):
+    """Write memory use recorded so far to 'memory_by_step.csv',
+    'memory_by_phase.csv' and, where tracemalloc is available,
+    'memory_top_allocators.csv' in outdir (see step_report, phase_report
+    and allocator_report)."""
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    step_report().to_csv(
+        os.path.join(outdir, 'memory_by_step.csv'), index=False)
+    phase_report().to_csv(
+        os.path.join(outdir, 'memory_by_phase.csv'), index=False)
+    if tracemalloc is not None:
+        allocator_report().to_csv(
+            os.path.join(outdir, 'memory_top_allocators.csv'), index=False)
+
+
+def available_memory_mb():
+    """Memory available for new processes (MB), from /proc/meminfo, or None
+    where /proc is not available."""
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        return None
+
+
+def workers_for_memory(run_peak_mb, available_mb=None, headroom=0.2,
+                       max_workers=None):
+    """Number of runs that may be made at once in worker processes without
+    exceeding available memory, given the peak RSS of one run (e.g. the
+    largest 'peak_rss_mb' of memory_by_step.csv of a comparable run).
+
+    Parameters:
+        run_peak_mb (float): peak RSS of one run (MB)
+        available_mb (float): memory available to the workers (MB).
+            Defaults to the memory available on this machine
+        headroom (float): fraction of available memory left unused
+        max_workers (int): upper limit, e.g. the number of CPUs
+
+    Returns:
+        number of workers, at least 1
+    """
+    if available_mb is None:
+        available_mb = available_memory_mb()
+    if available_mb is None or run_peak_mb <= 0:
+        n_workers = max_workers or 1
+    else:
+        n_workers = int(available_mb * (1. - headroom) / run_peak_mb)
+        if max_workers is not None:
+            n_workers = min(n_workers, max_workers)
+    return max(n_workers, 1)
@@ -0,0 +1,302 @@
+"""Progress metrics of model runs, written as a Prometheus text file.
+
+While metrics are enabled, the progress of a run is written to a metrics
+file in the Prometheus text exposition format: the current step and the
+number of steps in the run, steps completed per minute, the estimated time
+to completion, cumulative seconds spent in CENTURY and in Python, the number
+of files copied, moved or written by the run and the latest total offtake.
+The file is rewritten at most once per interval and when the run ends, by
+writing a temporary file and renaming it, so that a reader such as the
+textfile collector of a local node exporter never sees a partial file.  No
+network service is started.
+
+Runs of a batch (ensemble members, scenario alternatives) are summarized by
+BatchMetrics, which writes aggregate counters for the batch to a metrics
+file in the same format.  When metrics are disabled, as they are by default,
+a call that counts toward them costs one check of a module-level flag.
+"""
+
+import os
+import timeit
+
+_timer = timeit.default_timer
+
+_enabled = False
+_metrics_file = None
+_labels = {}
+_interval = 15.
+_run_start = None
+_last_write = None
+_total_steps = 0
+_first_step = None
+_step = -1
+_total_offtake = None
+_century_seconds = 0.
+_files_written = 0
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace(
+        '"', '\\"')
+
+
+def _format_value(value):
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def format_metrics(metrics, labels=None):
+    """Metrics in the Prometheus text exposition format.
+
+    Parameters:
+        metrics (list): (name, type, help, value) tuples, where type is
+            'gauge' or 'counter'.  Metrics with value None are omitted
+        labels (dict): labels attached to every metric
+
+    Returns:
+        string
+    """
+    if labels:
+        label_str = '{%s}' % ','.join(
+            '%s="%s"' % (key, _escape(labels[key])) for key in
+            sorted(labels))
+    else:
+        label_str = ''
+    lines = []
+    for name, metric_type, help_str, value in metrics:
+        if value is None:
+            continue
+        lines.append('# HELP %s %s' % (name, help_str))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        lines.append('%s%s %s' % (name, label_str, _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics_file(metrics_file, metrics, labels=None):
+    """Write metrics to metrics_file in the Prometheus text exposition
+    format (see format_metrics), replacing the file in one step."""
+    metrics_dir = os.path.dirname(metrics_file)
+    if metrics_dir and not os.path.exists(metrics_dir):
+        os.makedirs(metrics_dir)
+    temp_file = '%s.%d.tmp' % (metrics_file, os.getpid())
+    with open(temp_file, 'w') as write_file:
+        write_file.write(format_metrics(metrics, labels))
+    try:
+        os.rename(temp_file, metrics_file)
+    except OSError:  # Windows does not rename over an existing file
+        os.remove(metrics_file)
+        os.rename(temp_file, metrics_file)
+
+
+def enable(metrics_file, total_steps, interval=15., **labels):
+    """Start counting toward the metrics of a new run.
+
+    Parameters:
+        metrics_file (string): path of the metrics file, or None to count
+            without writing a file (see run_totals)
+        total_steps (int): number of steps in the run
+        interval (float): minimum seconds between rewrites of the file
+        labels: labels attached to every metric, e.g. outdir
+    """
+    global _enabled, _metrics_file, _labels, _interval, _run_start, \
+        _last_write, _total_steps, _first_step, _step, _total_offtake, \
+        _century_seconds, _files_written
+    _metrics_file = metrics_file
+    _labels = labels
+    _interval = interval
+    _run_start = _timer()
+    _last_write = None
+    _total_steps = total_steps
+    _first_step = None
+    _step = -1
+    _total_offtake = None
+    _century_seconds = 0.
+    _files_written = 0
+    _enabled = True
+
+
+def disable():
+    """Write the final metrics of the run and stop counting.  Totals of the
+    run remain available from run_totals."""
+    global _enabled
+    if not _enabled:
+        return
+    _write(finished=True)
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def add_century_seconds(seconds):
+    """Count seconds spent in a CENTURY run."""
+    global _century_seconds
+    _century_seconds += seconds
+
+
+def add_files(n_files=1):
+    """Count files copied, moved or written by the run."""
+    global _files_written
+    _files_written += n_files
+
+
+def set_step(step, total_offtake=None):
+    """Record that the run has reached step, i.e. that steps before it are
+    complete, and rewrite the metrics file if the interval has elapsed since
+    it was last written.
+
+    Parameters:
+        step (int): current model step
+        total_offtake (float): total offtake of the latest complete step,
+            if any
+    """
+    global _step, _first_step, _total_offtake
+    if not _enabled:
+        return
+    if _first_step is None:
+        _first_step = step
+    _step = step
+    if total_offtake is not None:
+        _total_offtake = total_offtake
+    if _last_write is None or _timer() - _last_write >= _interval:
+        _write()
+
+
+def run_totals():
+    """Totals of the current or latest run.
+
+    Returns:
+        dictionary with entries 'steps' (steps completed), 'wall_seconds',
+            'century_seconds', 'python_seconds' and 'files_written'
+    """
+    wall_seconds = 0. if _run_start is None else _timer() - _run_start
+    return {
+        'steps': 0 if _first_step is None else _step - _first_step,
+        'wall_seconds': wall_seconds,
+        'century_seconds': _century_seconds,
+        'python_seconds': max(wall_seconds - _century_seconds, 0.),
+        'files_written': _files_written,
+    }
+
+
+def _write(finished=False):
+    global _last_write
+    _last_write = _timer()
+    if _metrics_file is None:
+        return
+    totals = run_totals()
+    steps_per_minute = None
+    eta_seconds = None
+    if totals['steps'] > 0 and totals['wall_seconds'] > 0:
+        steps_per_minute = 60. * totals['steps'] / totals['wall_seconds']
+        eta_seconds = (
+            60. * max(_total_steps - _step, 0) / steps_per_minute)
+    if finished:
+        eta_seconds = 0.
+    write_metrics_file(_metrics_file, [
+        ('forage_step', 'gauge', 'Current model step.', _step),
+        ('forage_steps', 'gauge', 'Number of steps in the run.',
+         _total_steps),
+        ('forage_steps_per_minute', 'gauge',
+         'Steps completed per minute of wall time.', steps_per_minute),
+        ('forage_eta_seconds', 'gauge',
+         'Estimated seconds until the run is complete.', eta_seconds),
+        ('forage_century_seconds_total', 'counter',
+         'Seconds spent in CENTURY runs.', totals['century_seconds']),
+        ('forage_python_seconds_total', 'counter',
+         'Seconds spent outside CENTURY runs.', totals['python_seconds']),
+        ('forage_files_written_total', 'counter',
+         'Files copied, moved or written by the run.',
+         totals['files_written']),
+        ('forage_total_offtake', 'gauge',
+         'Total offtake of the latest complete step.', _total_offtake),
+        ('forage_run_finished', 'gauge', '1 if the run has ended.',
+         int(finished)),
+    ], _labels)
+
+
+class BatchMetrics(object):
+
+    """Aggregate progress metrics of a batch of runs, written to a metrics
+    file in the Prometheus text exposition format."""
+
+    def __init__(self, metrics_file, total_runs, interval=15., **labels):
+        """
+        Parameters:
+            metrics_file (string): path of the metrics file
+            total_runs (int): number of runs in the batch
+            interval (float): minimum seconds between rewrites of the file
+            labels: labels attached to every metric, e.g. batch
+        """
+        self.metrics_file = metrics_file
+        self.total_runs = total_runs
+        self.interval = interval
+        self.labels = labels
+        self.start = _timer()
+        self.last_write = None
+        self.runs_finished = 0
+        self.runs_failed = 0
+        self.totals = {
+            'steps': 0, 'century_seconds': 0., 'python_seconds': 0.,
+            'files_written': 0}
+        self.write()
+
+    def add_run(self, totals=None, failed=False):
+        """Count a finished run, with its totals (see run_totals) if
+        known, and rewrite the metrics file if the interval has elapsed."""
+        self.runs_finished += 1
+        if failed:
+            self.runs_failed += 1
+        if totals is not None:
+            for key in self.totals:
+                self.totals[key] += totals[key]
+        if self.last_write is None or (
+                _timer() - self.last_write >= self.interval):
+            self.write()
+
+    def write(self, finished=False):
+        """Write the metrics of the batch so far."""
+        self.last_write = _timer()
+        wall_seconds = self.last_write - self.start
+        runs_per_minute = None
+        eta_seconds = 0. if finished else None
+        if self.runs_finished > 0 and wall_seconds > 0:
+            runs_per_minute = 60. * self.runs_finished / wall_seconds
+            if not finished:
+                eta_seconds = 60. * max(
+                    self.total_runs - self.runs_finished, 0) / runs_per_minute
+        write_metrics_file(self.metrics_file, [
+            ('forage_batch_runs', 'gauge', 'Number of runs in the batch.',
+             self.total_runs),
+            ('forage_batch_runs_finished_total', 'counter',
+             'Runs finished.', self.runs_finished),
+            ('forage_batch_runs_failed_total', 'counter', 'Runs failed.',
+             self.runs_failed),
+            ('forage_batch_runs_per_minute', 'gauge',
+             'Runs finished per minute of wall time.', runs_per_minute),
+            ('forage_batch_eta_seconds', 'gauge',
+             'Estimated seconds until the batch is complete.', eta_seconds),
+            ('forage_batch_steps_total', 'counter',
+             'Model steps completed by finished runs.',
+             self.totals['steps']),
+            ('forage_batch_century_seconds_total', 'counter',
+             'Seconds spent in CENTURY runs by finished runs.',
+             self.totals['century_seconds']),
+            ('forage_batch_python_seconds_total', 'counter',
+             'Seconds spent outside CENTURY runs by finished runs.',
+             self.totals['python_seconds']),
+            ('forage_batch_files_written_total', 'counter',
+             'Files copied, moved or written by finished runs.',
+             self.totals['files_written']),
+            ('forage_batch_finished', 'gauge', '1 if the batch has ended.',
+             int(finished)),
+        ], self.labels)
+
+    def close(self):
+        """Write the final metrics of the batch."""
+        self.write(finished=True)
@@ -0,0 +1,561 @@
+"""Search for the stocking density and grazing calendar that satisfy
+management targets, evaluating candidate runs of the forage model in parallel.
+
+A candidate is a stocking density (animals per ha, applied to every herbivore
+class through args['density_series']) and a grazing calendar (the months of
+the simulation when grazing takes place, args['grz_months']).  A candidate is
+feasible if residual biomass after offtake stays above a target, by default
+the management threshold, and diet sufficiency (energy and protein intake
+relative to requirements) stays above a target in every grazed month.
+
+Candidates are evaluated either with the fully coupled model (forage.execute,
+run in a private copy of the CENTURY and input directories) or, for
+screening, against stored CENTURY outputs (forage.execute_from_trajectories).
+"""
+
+import os
+import json
+import random
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy
+
+import forage
+import forage_utils
+import forage_century_link_utils as cent
+
+# CENTURY outputs shared by all candidates evaluated in a worker process
+_worker_century_outputs = None
+# number of times the starting stocking density may be doubled in search of
+# an infeasible density, if no maximum density is given
+_MAX_DOUBLINGS = 20
+
+
+def candidate_metrics(summary_df, grz_months=None):
+    """Summarize a model run in terms of management targets.
+
+    Note that in summary results, standing biomass of each grass type is
+    reported one row ahead of the step to which it applies: the row for step
+    -1 gives biomass available at step 0, and so on.
+
+    Parameters:
+        summary_df (pandas data frame): summary results of a model run, as
+            written to summary_results.csv
+        grz_months (list): months of the simulation when grazing took place,
+            or None if grazing took place in every month
+
+    Returns:
+        dictionary with the following entries:
+            'min_residual': minimum biomass (kg/ha) remaining after offtake
+                in any step
+            'min_energy_sufficiency': minimum ratio of metabolizable energy
+                intake to energy requirements, across herbivore classes and
+                grazed steps
+            'min_protein_sufficiency': minimum ratio of digestible protein
+                leaving the stomach to protein requirements, across
+                herbivore classes and grazed steps
+            'total_offtake': total biomass removed by herbivores (kg/ha)
+    """
+    biomass_cols = [
+        col for col in summary_df.columns if col.endswith('_green_kgha') or
+        col.endswith('_dead_kgha')]
+    standing = summary_df[biomass_cols].astype(float).sum(axis=1).values[:-1]
+    offtake = summary_df['total_offtake'].astype(float).values[1:]
+    steps = summary_df['step'].values[1:]
+    residual = standing - offtake
+
+    if grz_months is None:
+        grazed = numpy.ones(len(steps), dtype=bool)
+    else:
+        grazed = numpy.array([step in grz_months for step in steps])
+    energy_suff = []
+    protein_suff = []
+    for col in summary_df.columns:
+        if not col.endswith('_MEItotal'):
+            continue
+        h_label = col[:-len('_MEItotal')]
+        MEItotal = summary_df[col].astype(float).values[1:]
+        E_req = summary_df[h_label + '_E_req'].astype(float).values[1:]
+        DPLS = summary_df[h_label + '_DPLS'].astype(float).values[1:]
+        P_req = summary_df[h_label + '_P_req'].astype(float).values[1:]
+        energy_suff.extend((MEItotal / E_req)[grazed])
+        protein_suff.extend((DPLS / P_req)[grazed])
+    metrics = {
+        'min_residual': float(numpy.nanmin(residual)),
+        'min_energy_sufficiency': (
+            float(numpy.nanmin(energy_suff)) if energy_suff else numpy.inf),
+        'min_protein_sufficiency': (
+            float(numpy.nanmin(protein_suff)) if protein_suff else
+            numpy.inf),
+        'total_offtake': float(numpy.nansum(offtake)),
+    }
+    return metrics
+
+
+def calendar_from_months_of_year(args, months_of_year):
+    """Make a grazing calendar that grazes in the same months of each year.
+
+    Parameters:
+        args (dict): model inputs, see forage.execute
+        months_of_year (list): months of the year (1-12) when grazing should
+            take place
+
+    Returns:
+        list of months of the simulation when grazing takes place, suitable
+            for args['grz_months']
+    """
+    return [
+        step for step in xrange(args[u'num_months']) if
+        forage.find_step_date(args, step)[0] in months_of_year]
+
+
+def _init_worker(century_outputs):
+    """Store CENTURY outputs shared by all candidates evaluated in this
+    worker process."""
+
+    global _worker_century_outputs
+    _worker_century_outputs = century_outputs
+
+
+def _run_candidate(task):
+    """Run the forage model for one candidate and summarize the run.
+
+    Parameters:
+        task (tuple): (args, density, grz_months, workspace_root), where
+            args are model inputs, density is stocking density applied to
+            every herbivore class, grz_months is the grazing calendar, and
+            workspace_root is the directory in which coupled runs are made
+
+    Returns:
+        dictionary of metrics, see candidate_metrics
+    """
+    args, density, grz_months, workspace_root = task
+    args = dict(args)
+    args['density_series'] = dict(
+        (step, density) for step in xrange(args[u'num_months']))
+    args['grz_months'] = grz_months
+    if _worker_century_outputs is not None:
+        summary_df, _ = forage.execute_from_trajectories(
+            args, _worker_century_outputs)
+        return candidate_metrics(summary_df, grz_months)
+
+    workspace_dir = tempfile.mkdtemp(dir=workspace_root)
+    try:
+        args['century_dir'], args['input_dir'] = cent.copy_century_workspace(
+            args['century_dir'], args['input_dir'], workspace_dir)
+        args['outdir'] = os.path.join(workspace_dir, 'output')
+        args['write_csv'] = False
+        summary_df = forage.execute(args)['summary_results']
+        return candidate_metrics(summary_df, grz_months)
+    finally:
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+
+
+class ManagementOptimizer:
+
+    """Evaluate candidate stocking densities and grazing calendars in
+    parallel, caching the result of each candidate evaluated, and search for
+    the highest feasible stocking density and the best grazing calendar."""
+
+    def __init__(self, args, sufficiency_target=1., residual_target=None,
+                 century_outputs=None, n_workers=None, workspace_dir=None,
+                 cache_file=None):
+        """Set up the optimizer.
+
+        Parameters:
+            args (dict): model inputs, see forage.execute. Entries
+                'density_series' and 'grz_months' are supplied by the
+                optimizer
+            sufficiency_target (float): minimum ratio of energy and protein
+                intake to requirements for every herbivore class in every
+                grazed month
+            residual_target (float): minimum biomass (kg/ha) that must
+                remain after offtake. Defaults to args['mgmt_threshold']
+            century_outputs (dict): if supplied, candidates are evaluated
+                against these stored CENTURY outputs rather than with the
+                coupled model (see forage.execute_from_trajectories)
+            n_workers (int): number of worker processes. Defaults to the
+                number of CPUs
+            workspace_dir (string): directory where coupled runs are made.
+                Defaults to a new temporary directory
+            cache_file (string): if supplied, results of evaluated
+                candidates are read from and saved to this file, so that
+                they can be reused by later searches
+        """
+        self.args = dict(args)
+        self.sufficiency_target = sufficiency_target
+        if residual_target is None:
+            residual_target = args['mgmt_threshold']
+        self.residual_target = residual_target
+        self.century_outputs = century_outputs
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        self.n_workers = n_workers
+        self._own_workspace = workspace_dir is None
+        if workspace_dir is None:
+            workspace_dir = tempfile.mkdtemp()
+        elif not os.path.exists(workspace_dir):
+            os.makedirs(workspace_dir)
+        self.workspace_dir = workspace_dir
+        self.cache_file = cache_file
+        self.cache = {}
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, 'r') as cache_handle:
+                for record in json.load(cache_handle):
+                    self.cache[self._key(
+                        record['density'], record['grz_months'])] = (
+                            record['metrics'])
+        self.n_evaluated = 0
+        self.n_pruned = 0
+        self._pool = None
+
+    def close(self):
+        """Shut down worker processes, save the cache and remove the
+        workspace created by the optimizer."""
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self.save_cache()
+        if self._own_workspace:
+            shutil.rmtree(self.workspace_dir, ignore_errors=True)
+
+    def save_cache(self):
+        """Save results of evaluated candidates to the cache file, if one
+        was supplied."""
+
+        if self.cache_file is None:
+            return
+        records = []
+        for (density, grz_months), metrics in self.cache.items():
+            records.append({
+                'density': density,
+                'grz_months': (
+                    list(grz_months) if grz_months is not None else None),
+                'metrics': metrics})
+        with open(self.cache_file, 'w') as cache_handle:
+            json.dump(records, cache_handle)
+
+    @staticmethod
+    def _key(density, grz_months):
+        """Identify a candidate in the cache."""
+
+        if grz_months is not None:
+            grz_months = tuple(sorted(set(int(m) for m in grz_months)))
+        return (round(float(density), 9), grz_months)
+
+    def is_feasible(self, metrics):
+        """Check whether a candidate summarized by metrics (see
+        candidate_metrics) satisfies the management targets."""
+
+        return (
+            metrics['min_residual'] >= self.residual_target and
+            metrics['min_energy_sufficiency'] >= self.sufficiency_target and
+            metrics['min_protein_sufficiency'] >= self.sufficiency_target)
+
+    def _clearly_infeasible(self, key):
+        """Check whether a candidate is dominated by a candidate already
+        found to be infeasible, i.e. it grazes at least as many animals in
+        at least the same months.  Such a candidate can only leave less
+        residual biomass and less forage per animal, and need not be run."""
+
+        density, grz_months = key
+        for (other_density, other_months), metrics in self.cache.items():
+            if metrics is None or self.is_feasible(metrics):
+                continue
+            if density < other_density:
+                continue
+            if other_months is None:
+                if grz_months is None:
+                    return True
+                continue
+            if grz_months is None or set(other_months) <= set(grz_months):
+                return True
+        return False
+
+    def evaluate(self, candidates):
+        """Evaluate candidates in parallel, reusing cached results.
+
+        Parameters:
+            candidates (list): list of tuples (density, grz_months)
+
+        Returns:
+            list of dictionaries of metrics (see candidate_metrics), in the
+                order of candidates.  Candidates that are clearly infeasible
+                (see _clearly_infeasible) are not run, and have metrics None
+        """
+        keys = [self._key(density, grz_months) for density, grz_months in
+                candidates]
+        to_run = []
+        for key in keys:
+            if key in self.cache or key in to_run:
+                continue
+            if self._clearly_infeasible(key):
+                self.n_pruned += 1
+                continue
+            to_run.append(key)
+        if to_run:
+            tasks = [
+                (self.args, density,
+                 list(grz_months) if grz_months is not None else None,
+                 self.workspace_dir) for density, grz_months in to_run]
+            if self.n_workers > 1 and len(tasks) > 1:
+                if self._pool is None:
+                    self._pool = multiprocessing.Pool(
+                        self.n_workers, _init_worker,
+                        (self.century_outputs,))
+                results = self._pool.map(_run_candidate, tasks)
+            else:
+                _init_worker(self.century_outputs)
+                results = [_run_candidate(task) for task in tasks]
+            for key, metrics in zip(to_run, results):
+                self.cache[key] = metrics
+            self.n_evaluated += len(to_run)
+        return [self.cache.get(key) for key in keys]
+
+    def maximize_density(self, grz_months=None, low=0., high=None,
+                         tolerance=1e-4, max_density=None):
+        """Find the highest stocking density that is feasible with a given
+        grazing calendar, by bisection.  With several workers, each round
+        evaluates one density per worker spaced evenly within the current
+        interval, so the interval shrinks by a factor of (n_workers + 1) per
+        round.  Feasibility is assumed to decrease with stocking density.
+
+        Parameters:
+            grz_months (list): grazing calendar, or None to graze every month
+            low (float): stocking density known or assumed to be feasible
+            high (float): stocking density at which to begin the search. If
+                None, it is found by doubling from the highest stocking
+                density of any herbivore class in the herbivore table, up to
+                max_density
+            tolerance (float): width of the final interval (animals per ha)
+            max_density (float): highest stocking density tried when high is
+                None.  If it is feasible, e.g. because nothing is grazed, it
+                is returned.  Defaults to the starting density doubled
+                _MAX_DOUBLINGS times
+
+        Returns:
+            tuple (density, metrics) giving the highest feasible stocking
+                density found and its metrics, or (None, None) if no
+                stocking density above low is feasible
+        """
+        if high is None:
+            herbivore_input = forage_utils.read_herbivore_csv(
+                self.args[u'herbivore_csv'])
+            high = max(
+                max(float(h['stocking_density']) for h in herbivore_input),
+                tolerance)
+            if max_density is None:
+                max_density = high * 2. ** _MAX_DOUBLINGS
+            high = min(high, max_density)
+            while True:
+                metrics = self.evaluate([(high, grz_months)])[0]
+                if metrics is None or not self.is_feasible(metrics):
+                    break
+                if high >= max_density:
+                    return high, metrics
+                low = high
+                high = min(high * 2., max_density)
+        best = None
+        if low > 0:
+            metrics = self.evaluate([(low, grz_months)])[0]
+            if metrics is not None and self.is_feasible(metrics):
+                best = (low, metrics)
+        n_points = max(self.n_workers, 1)
+        while high - low > tolerance:
+            densities = [
+                low + (high - low) * (i + 1) / float(n_points + 1) for i in
+                xrange(n_points)]
+            results = self.evaluate(
+                [(density, grz_months) for density in densities])
+            new_low, new_high = low, high
+            for density, metrics in zip(densities, results):
+                if metrics is not None and self.is_feasible(metrics):
+                    new_low = density
+                    best = (density, metrics)
+                else:
+                    new_high = density
+                    break
+            low, high = new_low, new_high
+        if best is None:
+            return None, None
+        return best
+
+    def _calendar_fitness(self, metrics):
+        """Rank a candidate calendar: feasible candidates by total offtake,
+        infeasible candidates below all feasible ones by their shortfall."""
+
+        if metrics is None:
+            return -numpy.inf
+        if self.is_feasible(metrics):
+            return metrics['total_offtake']
+        shortfall = (
+            max(0., self.residual_target - metrics['min_residual']) /
+            max(self.residual_target, 1.) +
+            max(0., self.sufficiency_target -
+                metrics['min_energy_sufficiency']) +
+            max(0., self.sufficiency_target -
+                metrics['min_protein_sufficiency']))
+        return -shortfall
+
+    def search_calendars(self, density, calendars=None, method='grid',
+                         population_size=20, n_generations=20,
+                         mutation_rate=0.1, seed=None):
+        """Search for the grazing calendar giving the greatest total offtake
+        while satisfying management targets, at a given stocking density.
+
+        Calendars are described by the months of the year (1-12) when
+        grazing takes place, repeated in every year of the simulation.
+
+        Parameters:
+            density (float): stocking density applied to every herbivore
+                class
+            calendars (list): for method 'grid', the calendars to evaluate,
+                each a list of months of the year. If None, every
+                combination of months of the year is evaluated
+            method (string): 'grid' to evaluate every calendar, or
+                'evolutionary' to evolve a population of calendars
+            population_size (int): number of calendars in each generation,
+                for method 'evolutionary'
+            n_generations (int): number of generations, for method
+                'evolutionary'
+            mutation_rate (float): probability that each month is switched
+                on or off in an offspring calendar, for method
+                'evolutionary'
+            seed (int): seed for the random number generator, for method
+                'evolutionary'
+
+        Returns:
+            tuple (months_of_year, metrics) for the best calendar found, or
+                (None, None) if no calendar evaluated is feasible
+        """
+        if method == 'grid':
+            if calendars is None:
+                calendars = [
+                    [m + 1 for m in xrange(12) if mask & (1 << m)] for mask
+                    in xrange(1, 1 << 12)]
+            results = self._evaluate_calendars(density, calendars)
+            scored = [
+                (self._calendar_fitness(metrics), months, metrics) for
+                months, metrics in zip(calendars, results)]
+        elif method == 'evolutionary':
+            scored = self._evolve_calendars(
+                density, population_size, n_generations, mutation_rate, seed)
+        else:
+            raise ValueError("Error: unknown search method %s" % method)
+        feasible = [
+            entry for entry in scored if entry[2] is not None and
+            self.is_feasible(entry[2])]
+        if not feasible:
+            return None, None
+        best = max(feasible, key=lambda entry: entry[0])
+        return sorted(best[1]), best[2]
+
+    def _evaluate_calendars(self, density, calendars):
+        """Evaluate calendars described by months of the year."""
+
+        candidates = [
+            (density, calendar_from_months_of_year(self.args, months)) for
+            months in calendars]
+        return self.evaluate(candidates)
+
+    def _evolve_calendars(self, density, population_size, n_generations,
+                          mutation_rate, seed):
+        """Evolve calendars by tournament selection, uniform crossover and
+        mutation, keeping the best calendar of each generation.
+
+        Returns a list of (fitness, months_of_year, metrics) for every
+        calendar evaluated."""
+
+        rng = random.Random(seed)
+
+        def to_months(mask):
+            return [m + 1 for m in xrange(12) if mask[m]]
+
+        population = [
+            [rng.random() < 0.5 for _ in xrange(12)] for _ in
+            xrange(population_size)]
+        scored = {}
+        for _ in xrange(n_generations):
+            population = [mask for mask in population if any(mask)] or [
+                [True] * 12]
+            new_masks = [
+                mask for mask in population if tuple(mask) not in scored]
+            results = self._evaluate_calendars(
+                density, [to_months(mask) for mask in new_masks])
+            for mask, metrics in zip(new_masks, results):
+                scored[tuple(mask)] = (
+                    self._calendar_fitness(metrics), to_months(mask),
+                    metrics)
+            ranked = sorted(
+                population, key=lambda mask: scored[tuple(mask)][0],
+                reverse=True)
+            offspring = [ranked[0]]
+            while len(offspring) < population_size:
+                parents = []
+                for _ in xrange(2):
+                    contenders = rng.sample(ranked, min(3, len(ranked)))
+                    parents.append(max(
+                        contenders, key=lambda mask: scored[tuple(mask)][0]))
+                child = [
+                    parents[rng.random() < 0.5][m] for m in xrange(12)]
+                child = [
+                    (not month) if rng.random() < mutation_rate else month
+                    for month in child]
+                offspring.append(child)
+            population = offspring
+        return scored.values()
+
+    def optimize(self, calendars=None, method='grid', n_rounds=2,
+                 tolerance=1e-4, max_density=None, **search_kwargs):
+        """Alternate between searching for the best grazing calendar at the
+        current stocking density and the highest feasible stocking density
+        with the current calendar.
+
+        Parameters:
+            calendars (list): calendars to evaluate, see search_calendars
+            method (string): calendar search method, see search_calendars
+            n_rounds (int): number of rounds of calendar and density search
+            tolerance (float): tolerance of the density search
+            max_density (float): highest stocking density tried, see
+                maximize_density
+            search_kwargs: further arguments to search_calendars
+
+        Returns:
+            dictionary with entries 'density', 'months_of_year', 'grz_months'
+                and 'metrics' describing the best candidate found, or None if
+                no feasible candidate was found
+        """
+        density, metrics = self.maximize_density(
+            None, tolerance=tolerance, max_density=max_density)
+        months_of_year = range(1, 13)
+        if density is None:
+            return None
+        for _ in xrange(n_rounds):
+            best_months, calendar_metrics = self.search_calendars(
+                density, calendars, method, **search_kwargs)
+            if best_months is None:
+                break
+            months_of_year = best_months
+            grz_months = calendar_from_months_of_year(
+                self.args, months_of_year)
+            new_density, new_metrics = self.maximize_density(
+                grz_months, low=density, tolerance=tolerance,
+                max_density=max_density)
+            if new_density is None:
+                metrics = calendar_metrics
+                break
+            if new_density <= density + tolerance:
+                density, metrics = new_density, new_metrics
+                break
+            density, metrics = new_density, new_metrics
+        return {
+            'density': density,
+            'months_of_year': months_of_year,
+            'grz_months': calendar_from_months_of_year(
+                self.args, months_of_year),
+            'metrics': metrics,
+        }
@@ -0,0 +1,250 @@
+"""Scaling of complete runs of the coupled model with the length of the run
+and the number of grass types and herbivore classes.
+
+Each point of the sweep runs forage.execute end to end on synthetic inputs
+(see forage_workload), with CENTURY replaced by the stand-in of forage_fake_century, in a fresh
+worker process so that the peak resident memory of the process belongs to
+that run alone.  Wall time, peak resident memory, and files and bytes written
+are recorded for each point.  The sweep varies one dimension at a time from
+a base point (12 months, 1 grass type, 1 herbivore class), and a scaling
+exponent is fitted to each measure in each dimension: the slope of log
+measure against log size, over all sizes and over the upper half of sizes.
+An exponent above 1 in num_months shows the cost of each month growing with
+the length of the run, e.g. because CENTURY is re-run over the whole
+schedule each month and the .lis, schedule and graz.100 files grow.
+
+Usage:
+    python forage_scaling.py <outdir> [--quick] [--seed 0]
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import argparse
+import timeit
+import multiprocessing
+
+import numpy
+import pandas
+
+import forage
+import forage_fake_century
+import forage_workload
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_timer = timeit.default_timer
+
+SIZES = {
+    'num_months': [12, 24, 48, 96, 192, 384, 600],
+    'n_grass': [1, 2, 5, 10, 20, 50],
+    'n_classes': [1, 10, 100, 1000],
+}
+QUICK_SIZES = {
+    'num_months': [12, 24, 48],
+    'n_grass': [1, 2, 4],
+    'n_classes': [1, 10, 100],
+}
+DIMENSIONS = ['num_months', 'n_grass', 'n_classes']
+BASE_POINT = {'num_months': 12, 'n_grass': 1, 'n_classes': 1}
+MEASURES = ['wall_seconds', 'peak_rss_mb', 'files_written', 'bytes_written']
+
+
+def _peak_rss_mb():
+    """Peak resident memory of this process (MB), or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # bytes, rather than kilobytes
+        return peak / 1024. ** 2
+    return peak / 1024.
+
+
+def _io_bytes_written():
+    """Bytes written by this process to files and pipes, from /proc, or None
+    where /proc is not available."""
+    try:
+        with open('/proc/self/io', 'r') as io_file:
+            for line in io_file:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+
+def _directory_size(directory):
+    """Number of files in directory and its subdirectories, and their total
+    size (bytes)."""
+    n_files = 0
+    n_bytes = 0
+    for root, dirs, files in os.walk(directory):
+        for file_name in files:
+            n_files += 1
+            n_bytes += os.path.getsize(os.path.join(root, file_name))
+    return n_files, n_bytes
+
+
+def _run_point(task):
+    """Run the model at one point of the sweep, in a fresh worker process.
+
+    Returns:
+        dictionary of the sizes of the point and its measures: wall_seconds,
+            peak_rss_mb, files_written and bytes_written (number and size
+            of files in the output directory), and io_bytes_written (all
+            bytes written by the process, including to files later moved or
+            removed, where known)
+    """
+    point, seed = task
+    workspace_dir = tempfile.mkdtemp()
+    try:
+        args = forage_workload.write_workload(
+            workspace_dir, point['num_months'], point['n_grass'],
+            point['n_classes'], seed)
+        forage_fake_century.install()
+        io_start = _io_bytes_written()
+        start = _timer()
+        forage.execute(args)
+        wall_seconds = _timer() - start
+        io_end = _io_bytes_written()
+        files_written, bytes_written = _directory_size(args['outdir'])
+    finally:
+        forage_fake_century.uninstall()
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+    result = dict(point)
+    result.update({
+        'wall_seconds': wall_seconds,
+        'peak_rss_mb': _peak_rss_mb(),
+        'files_written': files_written,
+        'bytes_written': bytes_written,
+        'io_bytes_written': (
+            None if io_start is None else io_end - io_start),
+    })
+    return result
+
+
+def sweep_points(sizes):
+    """Points of a one-at-a-time sweep: BASE_POINT, and each size of each
+    dimension with the other dimensions at their base values.
+
+    Returns:
+        list of (dimension, point) tuples, where dimension is None for the
+            base point
+    """
+    points = [(None, dict(BASE_POINT))]
+    for dimension in DIMENSIONS:
+        for size in sizes[dimension]:
+            if size == BASE_POINT[dimension]:
+                continue
+            point = dict(BASE_POINT)
+            point[dimension] = size
+            points.append((dimension, point))
+    return points
+
+
+def fit_exponents(results_df):
+    """Fit scaling exponents to the results of a sweep.
+
+    Parameters:
+        results_df (data frame): results of run_sweep
+
+    Returns:
+        pandas data frame with one row per dimension and measure, giving the
+            slope of log measure against log size over all sizes
+            ('exponent') and over the upper half of sizes
+            ('upper_exponent')
+    """
+    rows = []
+    for dimension in DIMENSIONS:
+        others = [d for d in DIMENSIONS if d != dimension]
+        mask = numpy.ones(len(results_df), dtype=bool)
+        for other in others:
+            mask &= results_df[other] == BASE_POINT[other]
+        dim_df = results_df[mask].sort_values(dimension)
+        if len(dim_df) < 2:
+            continue
+        for measure in MEASURES:
+            values = dim_df[[dimension, measure]].dropna()
+            values = values[values[measure] > 0]
+            if len(values) < 2:
+                continue
+            log_size = numpy.log(values[dimension].astype(float).values)
+            log_measure = numpy.log(values[measure].astype(float).values)
+            upper = len(values) / 2
+            if len(values) - upper < 2:
+                upper = len(values) - 2
+            rows.append({
+                'dimension': dimension,
+                'measure': measure,
+                'min_size': values[dimension].min(),
+                'max_size': values[dimension].max(),
+                'exponent': numpy.polyfit(log_size, log_measure, 1)[0],
+                'upper_exponent': numpy.polyfit(
+                    log_size[upper:], log_measure[upper:], 1)[0],
+            })
+    return pandas.DataFrame(rows, columns=[
+        'dimension', 'measure', 'min_size', 'max_size', 'exponent',
+        'upper_exponent'])
+
+
+def run_sweep(sizes=None, quick=False, seed=0):
+    """Run the model at each point of a one-at-a-time sweep.
+
+    Parameters:
+        sizes (dict): sizes of each dimension, 'num_months', 'n_grass' and
+            'n_classes'.  Defaults to SIZES, or QUICK_SIZES if quick
+        quick (boolean): use QUICK_SIZES if sizes are not supplied
+        seed (int): seed of synthetic inputs
+
+    Returns:
+        pandas data frame with one row per point: the sizes of the point
+            and its measures (see _run_point)
+    """
+    if sizes is None:
+        sizes = QUICK_SIZES if quick else SIZES
+    tasks = [(point, seed) for dimension, point in sweep_points(sizes)]
+    # a new worker process for each point, so that peak memory is the
+    # run's own
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        results = pool.map(_run_point, tasks, chunksize=1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return pandas.DataFrame(results, columns=DIMENSIONS + MEASURES + [
+        'io_bytes_written'])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Scaling of runs of the rangeland production model")
+    parser.add_argument(
+        'outdir', help="directory to write scaling_results.csv and "
+        "scaling_exponents.csv to")
+    parser.add_argument(
+        '--quick', action='store_true', help="run only the smaller sizes")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+    results_df = run_sweep(quick=args.quick, seed=args.seed)
+    exponents_df = fit_exponents(results_df)
+    results_df.to_csv(
+        os.path.join(args.outdir, 'scaling_results.csv'), index=False)
+    exponents_df.to_csv(
+        os.path.join(args.outdir, 'scaling_exponents.csv'), index=False)
+    print results_df.to_string(index=False)
+    print
+    print exponents_df.to_string(index=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,143 @@
+"""Run alternative continuations of the forage model from a shared history.
+
+Management alternatives often share the same history up to a branch step
+and differ only afterwards.  The shared history is run once, with the
+complete state of the simulation saved at the branch step (see
+args['save_state_step'] in forage.execute).  Each alternative is then run
+from the saved state (args['fork_state_dir']), in parallel, in a private
+workspace in which CENTURY executables are hard-linked rather than copied.
+The history is therefore simulated once rather than once per alternative.
+"""
+
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+import forage
+import forage_century_link_utils as cent
+import forage_metrics
+
+
+def _run_alternative(task):
+    """Run the forage model for one alternative, from the saved state.
+
+    Parameters:
+        task (tuple): (args, name, overrides, state_dir, workspace_root,
+            metrics), where args are model inputs, name identifies the
+            alternative, overrides is a dictionary of inputs that differ from
+            args in this alternative, state_dir contains the state saved at
+            the branch step, and metrics is True if progress of the
+            alternative is to be written (see forage_metrics)
+
+    Returns:
+        tuple (name, summary_df, totals), where summary_df gives summary
+            results of the alternative, including the shared history, and
+            totals are those of forage_metrics.run_totals, or None if
+            progress is not written
+    """
+    args, name, overrides, state_dir, workspace_root, metrics = task
+    args = dict(args)
+    args.update(overrides)
+    args['fork_state_dir'] = state_dir
+    workspace_dir = tempfile.mkdtemp(dir=workspace_root)
+    try:
+        args['century_dir'], args['input_dir'] = cent.copy_century_workspace(
+            args['century_dir'], args['input_dir'], workspace_dir, link=True)
+        args['outdir'] = os.path.join(args['outdir'], str(name))
+        args['metrics'] = metrics
+        summary_df = forage.execute(args)['summary_results']
+        totals = forage_metrics.run_totals() if metrics else None
+        return name, summary_df, totals
+    finally:
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+
+
+def run_scenario_tree(args, branch_step, alternatives, n_workers=None,
+                      workspace_dir=None, metrics_file=None):
+    """Run the forage model for alternatives that share the same history up
+    to branch_step.
+
+    The history (steps 0 to branch_step - 1) is run once, with outputs
+    written to 'history' in args['outdir'].  Each alternative continues
+    from the state at the end of the history, with outputs written to a
+    folder named for the alternative in args['outdir'].
+
+    Parameters:
+        args (dict): model inputs, see forage.execute.  args['num_months']
+            gives the length of the full run, history included
+        branch_step (int): first step at which alternatives may differ
+        alternatives (dict): inputs of each alternative that differ from
+            args, e.g. 'density_series' or 'grz_months', keyed by the name of
+            the alternative.  Inputs describing herbivores and grass types
+            are those of the history and cannot be changed
+        n_workers (int): number of worker processes. Defaults to the number
+            of CPUs
+        workspace_dir (string): directory where the history and alternatives
+            are run. Defaults to a temporary directory
+        metrics_file (string): if supplied, progress of the alternatives
+            (alternatives finished, alternatives per minute, estimated time
+            to completion, and steps, CENTURY and Python seconds and files
+            written by finished alternatives) is written to this file in the
+            Prometheus text format (see forage_metrics.BatchMetrics), and
+            progress of each alternative to metrics.prom in its output folder
+
+    Returns:
+        dictionary of pandas data frames giving summary results of each
+            alternative, including the shared history, keyed by name of the
+            alternative
+    """
+    if branch_step < 0 or branch_step > args[u'num_months']:
+        er = "Error: branch_step must be between 0 and num_months"
+        raise Exception(er)
+    if not os.path.exists(args['outdir']):
+        os.makedirs(args['outdir'])
+    remove_workspace = workspace_dir is None
+    if workspace_dir is None:
+        workspace_dir = tempfile.mkdtemp()
+    elif not os.path.exists(workspace_dir):
+        os.makedirs(workspace_dir)
+    pool = None
+    batch_metrics = None
+    try:
+        state_dir = os.path.join(workspace_dir, 'branch_state')
+        history_ws = tempfile.mkdtemp(dir=workspace_dir)
+        history_args = dict(args)
+        history_args['century_dir'], history_args['input_dir'] = \
+            cent.copy_century_workspace(
+                args['century_dir'], args['input_dir'], history_ws,
+                link=True)
+        history_args['num_months'] = branch_step
+        history_args['save_state_step'] = branch_step
+        history_args['save_state_dir'] = state_dir
+        history_args['outdir'] = os.path.join(args['outdir'], 'history')
+        forage.execute(history_args)
+        shutil.rmtree(history_ws, ignore_errors=True)
+
+        tasks = [
+            (args, name, overrides, state_dir, workspace_dir,
+             metrics_file is not None) for name, overrides in
+            sorted(alternatives.items())]
+        if metrics_file is not None:
+            batch_metrics = forage_metrics.BatchMetrics(
+                metrics_file, len(tasks), batch='scenario_tree')
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(n_workers)
+        results = {}
+        for name, summary_df, totals in pool.imap_unordered(
+                _run_alternative, tasks):
+            results[name] = summary_df
+            if batch_metrics is not None:
+                batch_metrics.add_run(totals)
+        pool.close()
+        pool.join()
+        pool = None
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if batch_metrics is not None:
+            batch_metrics.close()
+        if remove_workspace:
+            shutil.rmtree(workspace_dir, ignore_errors=True)
+    return results
@@ -0,0 +1,389 @@
+"""Global sensitivity analysis of the livestock model to parameters of Freer
+et al. 2012 and to herd inputs.
+
+Each factor of the analysis is a parameter varied uniformly between a lower
+and upper bound.  A factor is named either by a parameter of FreerParam (e.g.
+'CM2', 'CI1') or by a column of the herbivore table (e.g. 'weight',
+'qual_weight'), optionally prefixed by the label of one herbivore class
+('breeding_cow:weight') to restrict it to that class.  Outputs are the mean
+over the simulation of MEItotal, DPLS and forage intake for each herbivore
+class.
+
+The livestock model is evaluated against fixed CENTURY forage trajectories
+(forage.execute_from_trajectories), in batches of samples spread over a pool
+of worker processes.  The result of each batch is saved to a cache directory
+as it completes, so that an interrupted analysis resumes where it stopped.
+Elementary effects (Morris 1991) and first-order and total Sobol indices
+(Saltelli et al. 2010) are reported for each output and factor.
+"""
+
+import os
+import json
+import hashlib
+import multiprocessing
+
+import numpy
+import pandas
+
+import forage
+import forage_utils
+import freer_param as FreerParam
+
+# herbivore outputs summarized for each herbivore class
+_OUTPUTS = ['MEItotal', 'DPLS', 'intake_forage_per_indiv_kg']
+# parameters that HerbivoreClass reads directly from the herbivore table
+_HERD_PARAMS = ['CM2', 'CM12', 'CK13', 'CG2']
+
+# CENTURY outputs shared by all evaluations in a worker process
+_worker_century_outputs = None
+
+
+def parse_factors(factors):
+    """Check factors of the analysis and split each factor name into the
+    herbivore class it applies to (None for all classes) and parameter name.
+
+    Parameters:
+        factors (list): tuples (name, lower, upper)
+
+    Returns:
+        list of tuples (name, label, param, lower, upper)
+    """
+    parsed = []
+    for name, lower, upper in factors:
+        if ':' in name:
+            label, param = name.split(':', 1)
+        else:
+            label, param = None, name
+        if not upper > lower:
+            er = "Error: upper bound must exceed lower bound for %s" % name
+            raise ValueError(er)
+        parsed.append((name, label, param, float(lower), float(upper)))
+    return parsed
+
+
+def apply_sample(herbivore_input, parsed_factors, x):
+    """Herbivore inputs for one sample of the factors.
+
+    Parameters:
+        herbivore_input (list): dictionaries describing each herbivore
+            class, as read from the herbivore table
+        parsed_factors (list): factors, as returned by parse_factors
+        x (numpy array): sample, with one value between 0 and 1 per factor
+            giving its position between lower and upper bounds
+
+    Returns:
+        list of dictionaries, herbivore inputs for the sample
+
+    Raises:
+        ValueError if a factor is neither a parameter of FreerParam nor a
+            column of the herbivore table
+    """
+    sample_input = []
+    for herb_class in herbivore_input:
+        herb_class = dict(herb_class)
+        overrides = forage_utils.parse_fparam_overrides(
+            herb_class.get('FParam_overrides')) or {}
+        fparam = FreerParam.get_params(herb_class['type'])
+        for value, (name, label, param, lower, upper) in zip(
+                x, parsed_factors):
+            if label is not None and label != herb_class['label']:
+                continue
+            value = lower + value * (upper - lower)
+            if param in _HERD_PARAMS or (
+                    param in herb_class and not hasattr(fparam, param)):
+                herb_class[param] = value
+            elif hasattr(fparam, param):
+                overrides[param] = value
+            else:
+                er = ("Error: factor %s is neither a parameter of FreerParam "
+                      "nor a column of the herbivore table" % name)
+                raise ValueError(er)
+        herb_class['FParam_overrides'] = overrides
+        sample_input.append(herb_class)
+    return sample_input
+
+
+def output_names(herbivore_input):
+    """Names of the outputs summarized for each sample."""
+    return ['%s_%s' % (herb_class['label'], output) for herb_class in
+            herbivore_input for output in _OUTPUTS]
+
+
+def summarize_outputs(summary_df, names):
+    """Mean of each output over the steps of the simulation."""
+    return numpy.array(
+        [numpy.nanmean(summary_df[name].values.astype(float)) for name in
+         names])
+
+
+def morris_sample(n_factors, n_trajectories, n_levels=4, seed=0):
+    """Sample trajectories through the unit hypercube for the method of
+    elementary effects.  Each trajectory starts at a random point of a grid
+    with n_levels levels per factor and moves each factor in turn, in random
+    order, by delta = n_levels / (2 * (n_levels - 1)).
+
+    Returns:
+        tuple (samples, order, delta): samples has shape
+            (n_trajectories * (n_factors + 1), n_factors); order gives, for
+            each trajectory, the factor moved at each step
+    """
+    rng = numpy.random.RandomState(seed)
+    delta = n_levels / (2. * (n_levels - 1))
+    start_levels = numpy.arange(n_levels) / float(n_levels - 1)
+    start_levels = start_levels[start_levels + delta <= 1. + 1e-12]
+    samples = []
+    order = []
+    for _ in xrange(n_trajectories):
+        point = rng.choice(start_levels, n_factors)
+        perm = rng.permutation(n_factors)
+        samples.append(point.copy())
+        for factor in perm:
+            point = point.copy()
+            point[factor] += delta
+            samples.append(point)
+        order.append(perm)
+    return numpy.array(samples), numpy.array(order), delta
+
+
+def morris_indices(outputs, order, delta):
+    """Summarize elementary effects for each output and factor.
+
+    Parameters:
+        outputs (numpy array): outputs for samples from morris_sample, with
+            shape (n_samples, n_outputs)
+        order (numpy array): factor order of each trajectory
+        delta (float): step size of the trajectories
+
+    Returns:
+        tuple of arrays (mu, mu_star, sigma), each with shape
+            (n_outputs, n_factors)
+    """
+    n_trajectories, n_factors = order.shape
+    outputs = outputs.reshape(n_trajectories, n_factors + 1, -1)
+    effects = numpy.empty((n_trajectories, n_factors, outputs.shape[2]))
+    for traj in xrange(n_trajectories):
+        steps = (outputs[traj, 1:] - outputs[traj, :-1]) / delta
+        effects[traj, order[traj]] = steps
+    mu = effects.mean(axis=0).T
+    mu_star = numpy.abs(effects).mean(axis=0).T
+    sigma = effects.std(axis=0, ddof=1).T if n_trajectories > 1 else \
+        numpy.zeros_like(mu)
+    return mu, mu_star, sigma
+
+
+def sobol_sample(n_factors, n_samples, seed=0):
+    """Sample the unit hypercube for Sobol indices (Saltelli et al. 2010).
+    Two independent matrices A and B of n_samples rows are drawn; for each
+    factor i, the matrix AB_i is A with column i taken from B.
+
+    Returns:
+        array with shape (n_samples * (n_factors + 2), n_factors), stacking
+            A, B and AB_i for each factor
+    """
+    rng = numpy.random.RandomState(seed)
+    A = rng.uniform(size=(n_samples, n_factors))
+    B = rng.uniform(size=(n_samples, n_factors))
+    blocks = [A, B]
+    for factor in xrange(n_factors):
+        AB = A.copy()
+        AB[:, factor] = B[:, factor]
+        blocks.append(AB)
+    return numpy.vstack(blocks)
+
+
+def sobol_indices(outputs, n_factors):
+    """First-order and total Sobol indices from outputs of samples drawn by
+    sobol_sample.
+
+    Returns:
+        tuple of arrays (S1, ST), each with shape (n_outputs, n_factors)
+    """
+    outputs = outputs.reshape(n_factors + 2, -1, outputs.shape[-1])
+    f_A = outputs[0]
+    f_B = outputs[1]
+    variance = numpy.var(numpy.vstack([f_A, f_B]), axis=0)
+    S1 = numpy.empty((outputs.shape[2], n_factors))
+    ST = numpy.empty((outputs.shape[2], n_factors))
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        for factor in xrange(n_factors):
+            f_AB = outputs[factor + 2]
+            S1[:, factor] = numpy.mean(f_B * (f_AB - f_A), axis=0) / variance
+            ST[:, factor] = 0.5 * numpy.mean(
+                (f_A - f_AB) ** 2, axis=0) / variance
+    return S1, ST
+
+
+def _init_worker(century_outputs):
+    """Store CENTURY outputs in a worker process."""
+    global _worker_century_outputs
+    _worker_century_outputs = century_outputs
+
+
+def _evaluate_batch(task):
+    """Evaluate the livestock model for a batch of samples.
+
+    Parameters:
+        task (tuple): (args, herbivore_input, parsed_factors, samples)
+
+    Returns:
+        numpy array of outputs with one row per sample
+    """
+    args, herbivore_input, parsed_factors, samples = task
+    names = output_names(herbivore_input)
+    outputs = numpy.empty((len(samples), len(names)))
+    args = dict(args)
+    for index, x in enumerate(samples):
+        args['herbivore_inputs'] = apply_sample(
+            herbivore_input, parsed_factors, x)
+        summary_df, _ = forage.execute_from_trajectories(
+            args, _worker_century_outputs)
+        outputs[index] = summarize_outputs(summary_df, names)
+    return outputs
+
+
+class SensitivityAnalysis:
+
+    """Evaluate the livestock model over samples of the factors, in parallel
+    and with results cached on disk, and calculate sensitivity indices."""
+
+    def __init__(self, args, factors, century_outputs, n_workers=None,
+                 batch_size=20, cache_dir=None):
+        """Set up the analysis.
+
+        Parameters:
+            args (dict): model inputs, see forage.execute_from_trajectories
+            factors (list): tuples (name, lower, upper) describing the
+                factors to vary, see parse_factors
+            century_outputs (dict): CENTURY outputs for each grass type,
+                see forage.execute_from_trajectories
+            n_workers (int): number of worker processes. Defaults to the
+                number of CPUs
+            batch_size (int): number of samples evaluated by a worker at
+                once
+            cache_dir (string): directory where results of completed
+                batches are saved. If None, results are not saved
+        """
+        self.args = dict(args)
+        if args.get('herbivore_inputs') is not None:
+            self.herbivore_input = [dict(h) for h in args['herbivore_inputs']]
+        else:
+            self.herbivore_input = forage_utils.read_herbivore_csv(
+                args['herbivore_csv'])
+        self.factors = parse_factors(factors)
+        self.century_outputs = century_outputs
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+        self.cache_dir = cache_dir
+        self.outputs = output_names(self.herbivore_input)
+
+    def _cache_key(self, method, samples):
+        """Key identifying an analysis, so that cached results are only
+        reused for the same inputs and samples."""
+        content = json.dumps({
+            'method': method,
+            'args': sorted(
+                (str(k), repr(v)) for k, v in self.args.items() if k !=
+                'herbivore_inputs'),
+            'herbivore_input': repr(self.herbivore_input),
+            'factors': self.factors,
+            'century_outputs': forage.trajectory_digest(self.century_outputs),
+        }, sort_keys=True)
+        digest = hashlib.md5(content)
+        digest.update(samples.tobytes())
+        return digest.hexdigest()
+
+    def evaluate(self, samples, method='samples'):
+        """Evaluate the livestock model for each sample.
+
+        Parameters:
+            samples (numpy array): samples of the unit hypercube, with one
+                row per sample and one column per factor
+            method (string): name of the analysis, used in the cache key
+
+        Returns:
+            numpy array of outputs with one row per sample and one column per
+                output (see self.outputs)
+        """
+        batches = [
+            samples[start:start + self.batch_size] for start in
+            xrange(0, len(samples), self.batch_size)]
+        batch_dir = None
+        results = [None] * len(batches)
+        if self.cache_dir is not None:
+            batch_dir = os.path.join(
+                self.cache_dir, self._cache_key(method, samples))
+            if not os.path.exists(batch_dir):
+                os.makedirs(batch_dir)
+            for index in xrange(len(batches)):
+                saved = os.path.join(batch_dir, 'batch_%05d.npy' % index)
+                if os.path.isfile(saved):
+                    results[index] = numpy.load(saved)
+        pending = [
+            index for index in xrange(len(batches)) if results[index] is None]
+        if pending:
+            tasks = [
+                (self.args, self.herbivore_input, self.factors,
+                 batches[index]) for index in pending]
+            pool = multiprocessing.Pool(
+                self.n_workers, _init_worker, (self.century_outputs,))
+            try:
+                for index, outputs in zip(
+                        pending, pool.imap(_evaluate_batch, tasks)):
+                    results[index] = outputs
+                    if batch_dir is not None:
+                        saved = os.path.join(
+                            batch_dir, 'batch_%05d.npy' % index)
+                        with open(saved + '.tmp', 'wb') as new_file:
+                            numpy.save(new_file, outputs)
+                        os.rename(saved + '.tmp', saved)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        return numpy.vstack(results)
+
+    def morris(self, n_trajectories, n_levels=4, seed=0, save_as=None):
+        """Screen factors by the method of elementary effects.
+
+        Returns:
+            pandas data frame with one row per output and factor, giving the
+                mean ('mu') and standard deviation ('sigma') of elementary
+                effects and the mean of their absolute value ('mu_star')
+        """
+        samples, order, delta = morris_sample(
+            len(self.factors), n_trajectories, n_levels, seed)
+        outputs = self.evaluate(samples, 'morris')
+        mu, mu_star, sigma = morris_indices(outputs, order, delta)
+        return self._report(
+            {'mu': mu, 'mu_star': mu_star, 'sigma': sigma}, save_as)
+
+    def sobol(self, n_samples, seed=0, save_as=None):
+        """Calculate first-order ('S1') and total ('ST') Sobol indices.
+
+        Returns:
+            pandas data frame with one row per output and factor
+        """
+        samples = sobol_sample(len(self.factors), n_samples, seed)
+        outputs = self.evaluate(samples, 'sobol')
+        S1, ST = sobol_indices(outputs, len(self.factors))
+        return self._report({'S1': S1, 'ST': ST}, save_as)
+
+    def _report(self, indices, save_as):
+        """Arrange sensitivity indices in a data frame, optionally saving it
+        to csv."""
+        report_dict = {'output': [], 'factor': []}
+        for key in indices:
+            report_dict[key] = []
+        for o_index, output in enumerate(self.outputs):
+            for f_index, factor in enumerate(self.factors):
+                report_dict['output'].append(output)
+                report_dict['factor'].append(factor[0])
+                for key, values in indices.items():
+                    report_dict[key].append(values[o_index, f_index])
+        report_df = pandas.DataFrame(
+            report_dict, columns=['output', 'factor'] + sorted(indices))
+        if save_as is not None:
+            report_df.to_csv(save_as, index=False)
+        return report_df
@@ -0,0 +1,398 @@
+"""Statistical surrogate of monthly CENTURY forage growth.
+
+The surrogate predicts CENTURY outputs describing forage at the end of a
+month (live and standing dead biomass, and crude protein in each) from the
+same outputs at the end of the previous month, the weather of the month and
+the fraction of live and standing dead biomass removed by grazing in the
+month.  It is a ridge regression, fitted from CENTURY outputs of past coupled
+runs, and is intended for coarse screening: forage.execute can use it in
+place of launching CENTURY at each step (see args['century_surrogate']),
+while final runs use CENTURY itself.
+"""
+
+import os
+import re
+import glob
+import math
+
+import numpy
+import pandas
+
+import forage_century_link_utils as cent
+
+# smallest value predicted for any CENTURY output, so that crude protein
+# content of forage can be calculated from predictions
+_MIN_PREDICTED = 1e-6
+
+# CENTURY outputs predicted by the surrogate, as read by read_CENTURY_outputs
+_STATE = ['aglivc', 'stdedc', 'aglive1', 'stdede1']
+_WEATHER = ['prec', 'tmin', 'tmax']
+_FEATURES = _STATE + _WEATHER + [
+    'flgrem', 'fdgrem', 'live_removed', 'dead_removed', 'month_sin',
+    'month_cos']
+
+
+def read_site_climate(site_file):
+    """Read mean monthly precipitation and minimum and maximum temperature
+    from a CENTURY site file.
+
+    Returns:
+        pandas data frame indexed by month (1:12) with columns 'prec', 'tmin'
+            and 'tmax'
+    """
+    params = {}
+    with open(site_file, 'r') as read_file:
+        for line in read_file:
+            match = re.match(r"\s*(\S+)\s+'(\w+)\((\d+)\)'", line)
+            if match:
+                params[(match.group(2), int(match.group(3)))] = float(
+                    match.group(1))
+    months = range(1, 13)
+    return pandas.DataFrame({
+        'prec': [params[('PRECIP', m)] for m in months],
+        'tmin': [params[('TMN2M', m)] for m in months],
+        'tmax': [params[('TMX2M', m)] for m in months]}, index=months,
+        columns=_WEATHER)
+
+
+def read_monthly_weather(schedule, input_dir):
+    """Collect weather used by CENTURY for a schedule: values from the
+    weather file named in the schedule, if any, and mean monthly values from
+    the site file for months not covered by the weather file.
+
+    Returns:
+        dictionary of [prec, tmin, tmax] keyed by (year, month) for months in
+            the weather file, and by (None, month) for site means
+    """
+    site_file, weather_file = cent.get_site_weather_files(
+        schedule, input_dir)
+    weather = {}
+    climate = read_site_climate(site_file)
+    for month in climate.index:
+        weather[(None, month)] = climate.loc[month, _WEATHER].tolist()
+    if weather_file != 'NA':
+        wth_df = cent.read_weather_file(weather_file)
+        wth_df = wth_df.set_index(['variable', 'year'])
+        for year in wth_df.loc['prec'].index:
+            for month in range(1, 13):
+                try:
+                    weather[(year, month)] = [
+                        float(wth_df.loc[(var, year), month]) for var in
+                        _WEATHER]
+                except KeyError:
+                    continue
+    return weather
+
+
+def monthly_weather(weather, year, month):
+    """Weather in one month from a dictionary made by read_monthly_weather."""
+
+    try:
+        return weather[(year, month)]
+    except KeyError:
+        return weather[(None, month)]
+
+
+def read_removal(schedule, graz_file):
+    """Find the fraction of live and standing dead biomass removed by the
+    grazing events in a schedule.
+
+    Parameters:
+        schedule (string): path to a CENTURY schedule file
+        graz_file (string): path to the grazing parameter definition file
+            containing the grazing levels used in the schedule
+
+    Returns:
+        dictionary of (flgrem, fdgrem) keyed by (year, month)
+    """
+    graz_params = dict(
+        (code, dict(params)) for code, params in
+        cent.read_graz_blocks(graz_file).items())
+    header, blocks = cent.read_schedule_blocks(schedule)
+    removal = {}
+    for block in blocks:
+        for rel_year, month, lines in block['events']:
+            if 'GRAZ' not in lines[0]:
+                continue
+            code = lines[1].strip()
+            if code not in graz_params:
+                raise Exception(
+                    "Grazing level %s not found in %s" % (code, graz_file))
+            params = graz_params[code]
+            year = block['start_year'] + rel_year - 1
+            while year <= block['last_year']:
+                flgrem, fdgrem = removal.get((year, month), (0., 0.))
+                removal[(year, month)] = (
+                    min(flgrem + params['FLGREM'], 1.),
+                    min(fdgrem + params['FDGREM'], 1.))
+                year += block['repeats']
+    return removal
+
+
+def training_data(lis_file, schedule, graz_file, input_dir):
+    """Assemble monthly transitions of CENTURY outputs for fitting the
+    surrogate.
+
+    Parameters:
+        lis_file (string): path to a CENTURY .lis file
+        schedule (string): path to the schedule that produced lis_file
+        graz_file (string): path to the grazing parameter definition file
+            containing the grazing levels used in the schedule
+        input_dir (string): directory containing the site and weather files
+            named in the schedule
+
+    Returns:
+        pandas data frame with one row per pair of consecutive months,
+            containing 'year' and 'month' of the second month, CENTURY
+            outputs at the end of the first month, weather and removal in the
+            second month and CENTURY outputs at the end of the second month
+            ('next_aglivc', etc)
+    """
+    outputs = cent.read_CENTURY_outputs(lis_file, float('-inf'), float('inf'))
+    outputs = outputs[~outputs.index.duplicated(keep='first')]
+    weather = read_monthly_weather(schedule, input_dir)
+    removal = read_removal(schedule, graz_file)
+    columns = ['year', 'month'] + _STATE + _WEATHER + ['flgrem', 'fdgrem'] + [
+        'next_' + state for state in _STATE]
+    records = []
+    values = outputs[_STATE].values
+    times = outputs.index.values
+    for idx in xrange(1, len(times)):
+        if abs(times[idx] - times[idx - 1] - 1. / 12) > 0.02:
+            continue
+        year, month = cent.convert_to_year_month(times[idx])
+        flgrem, fdgrem = removal.get((year, month), (0., 0.))
+        records.append(
+            [year, month] + values[idx - 1].tolist() +
+            monthly_weather(weather, year, month) + [flgrem, fdgrem] +
+            values[idx].tolist())
+    return pandas.DataFrame(records, columns=columns)
+
+
+def read_run_archive(outdir, input_dir, label, graz_file):
+    """Assemble training data from the outputs of a coupled run of
+    forage.execute.
+
+    The CENTURY outputs of the last step of the run, and the schedule and
+    grazing parameters written at the last grazing event, describe the whole
+    run.
+
+    Parameters:
+        outdir (string): args['outdir'] of the run
+        input_dir (string): args['input_dir'] of the run
+        label (string): grass label
+        graz_file (string): grazing parameter definition file used by the
+            run, used if no grazing was added by the livestock model
+
+    Returns:
+        pandas data frame as returned by training_data
+    """
+    output_dirs = []
+    for path in glob.glob(os.path.join(outdir, 'CENTURY_outputs_m*_y*')):
+        match = re.search(r'_m(\d+)_y(\d+)$', path)
+        if match and os.path.isfile(os.path.join(path, label + '.lis')):
+            output_dirs.append(
+                (int(match.group(2)), int(match.group(1)), path))
+    if len(output_dirs) == 0:
+        raise Exception("No CENTURY outputs found in %s" % outdir)
+    lis_file = os.path.join(max(output_dirs)[2], label + '.lis')
+
+    def last_step(pattern):
+        steps = []
+        for path in glob.glob(os.path.join(outdir, pattern % '*')):
+            match = re.search(r'_(\d+)\.\w+$', path)
+            if match:
+                steps.append((int(match.group(1)), path))
+        if len(steps) == 0:
+            return None
+        return max(steps)[1]
+    schedule = last_step(label + '_%s.sch')
+    if schedule is None:
+        schedule = os.path.join(input_dir, label + '.sch')
+    added_graz = last_step('graz_%s.100')
+    if added_graz is not None:
+        graz_file = added_graz
+    return training_data(lis_file, schedule, graz_file, input_dir)
+
+
+def _design_matrix(data):
+    """Features of the surrogate for each row of a data frame containing
+    CENTURY outputs, weather and removal."""
+
+    angle = 2 * math.pi * numpy.asarray(data['month'], dtype=float) / 12.
+    columns = [numpy.asarray(data[name], dtype=float) for name in
+               _STATE + _WEATHER + ['flgrem', 'fdgrem']]
+    columns.append(columns[0] * columns[7])  # live biomass removed
+    columns.append(columns[1] * columns[8])  # standing dead removed
+    columns.append(numpy.sin(angle))
+    columns.append(numpy.cos(angle))
+    return numpy.column_stack(columns)
+
+
+class GrowthSurrogate:
+
+    """Ridge regression predicting CENTURY outputs at the end of a month
+    from CENTURY outputs at the end of the previous month, weather and
+    removal by grazing in the month.  Predictions are limited to the range
+    of CENTURY outputs in the training data."""
+
+    def __init__(self, alpha=1.0):
+        """Parameters:
+            alpha (float): ridge penalty, applied to standardized features
+        """
+        self.alpha = alpha
+        self.mean = None
+        self.scale = None
+        self.coef = None
+        self.intercept = None
+        self.lower = None
+        self.upper = None
+
+    def fit(self, data):
+        """Fit the surrogate to training data, as returned by training_data.
+
+        Modifies:
+            self.mean, self.scale, self.coef, self.intercept, self.lower,
+            self.upper
+
+        Returns:
+            self
+        """
+        x = _design_matrix(data)
+        y = data[['next_' + state for state in _STATE]].values.astype(float)
+        self.mean = x.mean(axis=0)
+        self.scale = x.std(axis=0)
+        self.scale[self.scale == 0] = 1.
+        z = (x - self.mean) / self.scale
+        self.intercept = y.mean(axis=0)
+        self.lower = numpy.maximum(y.min(axis=0), _MIN_PREDICTED)
+        self.upper = numpy.maximum(y.max(axis=0), self.lower)
+        gram = numpy.dot(z.T, z) + self.alpha * numpy.eye(z.shape[1])
+        self.coef = numpy.linalg.solve(
+            gram, numpy.dot(z.T, y - self.intercept))
+        return self
+
+    def predict(self, data):
+        """Predict CENTURY outputs at the end of the month for each row of a
+        data frame (or dictionary of arrays) containing 'month', CENTURY
+        outputs at the end of the previous month, weather and removal.
+
+        Returns:
+            numpy array with one row per row of data and one column for each
+                of 'aglivc', 'stdedc', 'aglive1' and 'stdede1'
+        """
+        if self.coef is None:
+            raise Exception("Surrogate has not been fitted")
+        z = (_design_matrix(data) - self.mean) / self.scale
+        return numpy.clip(
+            numpy.dot(z, self.coef) + self.intercept, self.lower, self.upper)
+
+    def step(self, row, weather, flgrem, fdgrem, month):
+        """Predict CENTURY outputs at the end of one month for one grass.
+
+        Parameters:
+            row (dict): CENTURY outputs at the end of the previous month,
+                containing 'aglivc', 'stdedc', 'aglive1' and 'stdede1'
+            weather (list): precipitation, minimum and maximum temperature in
+                the month
+            flgrem (float): fraction of live biomass removed in the month
+            fdgrem (float): fraction of standing dead biomass removed in the
+                month
+            month (int): month of the year, 1:12
+
+        Returns:
+            dictionary of predicted CENTURY outputs, with the keys of row
+        """
+        data = dict((state, [row[state]]) for state in _STATE)
+        data.update(dict((var, [val]) for var, val in zip(_WEATHER, weather)))
+        data.update({'flgrem': [flgrem], 'fdgrem': [fdgrem], 'month': [month]})
+        return dict(zip(_STATE, self.predict(data)[0].tolist()))
+
+    def error_report(self, data):
+        """Compare predictions of the surrogate with CENTURY outputs.
+
+        Returns:
+            pandas data frame with one row per CENTURY output, giving the
+                number of months compared, root mean square error, mean
+                absolute error, mean error (bias) and coefficient of
+                determination
+        """
+        predicted = self.predict(data)
+        observed = data[['next_' + state for state in _STATE]].values
+        error = predicted - observed
+        ss_tot = ((observed - observed.mean(axis=0)) ** 2).sum(axis=0)
+        ss_tot[ss_tot == 0] = numpy.nan
+        return pandas.DataFrame({
+            'output': _STATE,
+            'n_months': [len(data)] * len(_STATE),
+            'rmse': numpy.sqrt((error ** 2).mean(axis=0)),
+            'mae': numpy.abs(error).mean(axis=0),
+            'bias': error.mean(axis=0),
+            'r2': 1. - (error ** 2).sum(axis=0) / ss_tot},
+            columns=['output', 'n_months', 'rmse', 'mae', 'bias', 'r2'])
+
+    def save(self, save_as):
+        """Save a fitted surrogate to a numpy .npz file."""
+
+        numpy.savez(
+            save_as, alpha=self.alpha, mean=self.mean, scale=self.scale,
+            coef=self.coef, intercept=self.intercept, lower=self.lower,
+            upper=self.upper, features=numpy.array(_FEATURES))
+
+    @classmethod
+    def load(cls, npz_file):
+        """Load a surrogate saved by GrowthSurrogate.save."""
+
+        saved = numpy.load(npz_file)
+        if saved['features'].tolist() != _FEATURES:
+            raise Exception(
+                "Surrogate in %s was fitted with different features" %
+                npz_file)
+        surrogate = cls(float(saved['alpha']))
+        surrogate.mean = saved['mean']
+        surrogate.scale = saved['scale']
+        surrogate.coef = saved['coef']
+        surrogate.intercept = saved['intercept']
+        surrogate.lower = saved['lower']
+        surrogate.upper = saved['upper']
+        return surrogate
+
+
+def fit_surrogate(data, holdout=0.2, alpha=1.0, seed=None, outdir=None):
+    """Fit a surrogate to training data, holding out a random subset of
+    months to report the error of the surrogate against CENTURY.
+
+    Parameters:
+        data (pandas data frame or list of data frames): training data, as
+            returned by training_data or read_run_archive
+        holdout (float): fraction of months held out of fitting
+        alpha (float): ridge penalty
+        seed (int): seed for the random choice of holdout months
+        outdir (string): if supplied, the fitted surrogate is saved to
+            surrogate.npz and the error report to surrogate_error.csv in
+            this directory
+
+    Returns:
+        tuple (surrogate, report), where report is the error report of the
+            surrogate on holdout months
+    """
+    if isinstance(data, list):
+        data = pandas.concat(data, ignore_index=True)
+    data = data.reset_index(drop=True)
+    rng = numpy.random.RandomState(seed)
+    n_holdout = int(round(holdout * len(data)))
+    order = rng.permutation(len(data))
+    test = data.iloc[numpy.sort(order[:n_holdout])]
+    train = data.iloc[numpy.sort(order[n_holdout:])]
+    surrogate = GrowthSurrogate(alpha).fit(train)
+    if n_holdout > 0:
+        report = surrogate.error_report(test)
+    else:
+        report = surrogate.error_report(train)
+    if outdir is not None:
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        surrogate.save(os.path.join(outdir, 'surrogate.npz'))
+        report.to_csv(
+            os.path.join(outdir, 'surrogate_error.csv'), index=False)
+    return surrogate, report
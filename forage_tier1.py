@@ -0,0 +1,234 @@
+"""Tier 1 (IPCC 2006) livestock model applied to arrays of pixels or sites.
+
+The equations are those of HerdT1, VegT1, calc_energy_t1 and calc_DMI_t1 in
+forage_utils, evaluated with numpy for all pixels at once and stepped through
+time.  Pixels are processed in chunks, and inputs and outputs may be numpy
+memory maps (see load_inputs and the out_dir argument of run_tier1), so that
+memory use depends on the chunk size rather than on the number of pixels.
+The model is cheap enough to screen a whole region or country before running
+the tier 2 model, coupled with CENTURY, at the sites of interest.
+
+Inputs, one value per pixel, or one row per time step and one column per
+pixel for inputs that vary in time:
+    weight: initial average weight of animals (kg)
+    mature_weight: mature weight of females (kg)
+    forage_quality: energy content of forage (MJ per kg DM), or forage
+        quality as named in IPCC 2006 table 10.8 ('low', 'moderate', 'high',
+        'grain')
+    herd_size: number of animals on the pixel
+    standing_biomass: standing forage at the start of the simulation (kg)
+    growth (optional): forage growth on the pixel in each time step (kg)
+"""
+
+import os
+
+import numpy
+
+import forage_utils as forage
+
+_STATIC_INPUTS = ['weight', 'mature_weight', 'standing_biomass']
+_DYNAMIC_INPUTS = ['forage_quality', 'herd_size', 'growth']
+OUTPUTS = ['weight', 'standing_biomass', 'offtake', 'energy_intake']
+
+_ACTIVITY_TABLE = {  # IPCC 2006 table 10.5
+    'low': 0.0,
+    'moderate': 0.17,
+    'high': 0.36,
+}
+
+
+def energy_content(forage_quality):
+    """Energy content of forage (MJ per kg DM) given its forage quality.
+    Forage quality may be given as names of IPCC 2006 table 10.8, which are
+    looked up with calc_energy_t1, or as energy content.
+
+    Returns:
+        float array of energy content
+    """
+    forage_quality = numpy.asarray(forage_quality)
+    if forage_quality.dtype.kind not in 'SUO':
+        return forage_quality.astype(float)
+    names, inverse = numpy.unique(forage_quality, return_inverse=True)
+    energy = numpy.array([forage.calc_energy_t1(n) for n in names])
+    return energy[inverse].reshape(forage_quality.shape)
+
+
+def dmi_per_step(MJ_per_kg_DM, weight, days_per_step):
+    """Dry matter intake of an individual per time step (kg), from the
+    energy content of forage and average animal weight (IPCC 2006 eq 10.17;
+    see calc_DMI_t1)."""
+    indiv_DMI_daily = weight ** 0.75 * (
+        (0.2444 * MJ_per_kg_DM - 0.0111 * MJ_per_kg_DM ** 2 - 0.472) /
+        MJ_per_kg_DM)
+    return indiv_DMI_daily * days_per_step
+
+
+def maintenance_per_step(weight, days_per_step):
+    """Energy required by an individual for maintenance per time step
+    (IPCC 2006 eq. 10.3; see HerdT1.e_maintenance)."""
+    Cfi = 0.322  # IPCC 2006 table 10.4 (steer and non-lactating cows)
+    return Cfi * weight ** 0.75 * days_per_step
+
+
+def weight_change(MJ_per_indiv, maintenance, weight, mature_weight,
+                  activity, days_per_step):
+    """Change in weight of an individual over a time step, given energy
+    intake and maintenance requirements per time step (IPCC 2006 eq. 10.4,
+    10.6; see HerdT1.e_allocate).
+
+    Returns:
+        float array of change in weight (kg); zero where intake exactly
+            meets requirements or animal weight is zero
+    """
+    Ca = _ACTIVITY_TABLE[activity]
+    total = maintenance + Ca * maintenance
+    available_for_growth = MJ_per_indiv - total
+    available_daily = numpy.abs(available_for_growth) / days_per_step
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        weight_change_daily = (available_daily / (
+            22.02 * (weight / mature_weight) ** 0.75)) ** (1 / 1.097)
+    delta_weight = numpy.where(
+        (available_for_growth != 0) & (weight > 0),
+        weight_change_daily * days_per_step, 0.)
+    return numpy.where(available_for_growth < 0, -delta_weight, delta_weight)
+
+
+def load_inputs(input_dir):
+    """Open inputs saved as numpy arrays, one file per input named for the
+    input (e.g. weight.npy), as read-only memory maps.
+
+    Returns:
+        dictionary of arrays keyed by input name
+    """
+    inputs = {}
+    for name in _STATIC_INPUTS + _DYNAMIC_INPUTS:
+        npy_file = os.path.join(input_dir, '%s.npy' % name)
+        if os.path.isfile(npy_file):
+            inputs[name] = numpy.load(npy_file, mmap_mode='r')
+    return inputs
+
+
+def _check_inputs(inputs, n_steps):
+    """Check that all required inputs are supplied, with one value per
+    pixel (and one row per step for inputs that vary in time).
+
+    Returns:
+        number of pixels
+    """
+    for name in _STATIC_INPUTS + _DYNAMIC_INPUTS[:2]:
+        if name not in inputs:
+            er = "Error: input %s is required" % name
+            raise Exception(er)
+    n_pixels = len(inputs['weight'])
+    for name in _STATIC_INPUTS + _DYNAMIC_INPUTS:
+        if name not in inputs:
+            continue
+        shape = numpy.shape(inputs[name])
+        if name in _STATIC_INPUTS:
+            allowed = [(n_pixels, )]
+        else:
+            allowed = [(n_pixels, ), (n_steps, n_pixels)]
+        if shape not in allowed:
+            er = "Error: input %s has shape %s, expected one of %s" % (
+                name, shape, allowed)
+            raise Exception(er)
+    return n_pixels
+
+
+def _step_values(value, step, start, stop):
+    """Values of an input for a chunk of pixels at a time step."""
+    if value.ndim == 2:
+        return value[step, start:stop]
+    return value[start:stop]
+
+
+def _run_chunk(inputs, outputs, start, stop, n_steps, activity,
+               days_per_step):
+    """Run the tier 1 model for the pixels start:stop and write results
+    to outputs."""
+    weight = numpy.array(inputs['weight'][start:stop], dtype=float)
+    mature_weight = numpy.array(
+        inputs['mature_weight'][start:stop], dtype=float)
+    standing = numpy.array(inputs['standing_biomass'][start:stop],
+                           dtype=float)
+    quality = numpy.asarray(inputs['forage_quality'])
+    static_energy = None
+    if quality.ndim == 1:
+        static_energy = energy_content(quality[start:stop])
+    herd_size = numpy.asarray(inputs['herd_size'])
+    growth = inputs.get('growth')
+    for step in xrange(n_steps):
+        if static_energy is None:
+            MJ_per_kg_DM = energy_content(quality[step, start:stop])
+        else:
+            MJ_per_kg_DM = static_energy
+        n_animals = _step_values(herd_size, step, start, stop)
+        if growth is not None:
+            standing += _step_values(numpy.asarray(growth), step, start,
+                                     stop)
+        demand = dmi_per_step(MJ_per_kg_DM, weight, days_per_step) * (
+            n_animals)
+        # herds cannot eat more than the forage standing on the pixel
+        offtake = numpy.minimum(demand, numpy.maximum(standing, 0.))
+        standing -= offtake
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            MJ_per_indiv = numpy.where(
+                n_animals > 0, offtake * MJ_per_kg_DM / n_animals, 0.)
+        maintenance = maintenance_per_step(weight, days_per_step)
+        weight = numpy.maximum(weight + weight_change(
+            MJ_per_indiv, maintenance, weight, mature_weight, activity,
+            days_per_step), 0.)
+        outputs['weight'][step, start:stop] = weight
+        outputs['standing_biomass'][step, start:stop] = standing
+        outputs['offtake'][step, start:stop] = offtake
+        outputs['energy_intake'][step, start:stop] = MJ_per_indiv
+
+
+def run_tier1(inputs, n_steps, time_step='month', activity='moderate',
+              chunk_size=100000, out_dir=None):
+    """Run the tier 1 model for many pixels over n_steps time steps.
+
+    Parameters:
+        inputs (dict): arrays of inputs keyed by input name (see module
+            docstring), e.g. as returned by load_inputs
+        n_steps (int): number of time steps to run
+        time_step (string): length of a time step, 'day', 'week', 'month' or
+            'year'
+        activity (string): activity level of animals, 'low', 'moderate' or
+            'high' (IPCC 2006 table 10.5)
+        chunk_size (int): number of pixels processed at once
+        out_dir (string): if supplied, outputs are written to memory-mapped
+            files in this directory (e.g. weight.npy) instead of held in
+            memory
+
+    Returns:
+        dictionary of float32 arrays keyed by output name ('weight',
+            'standing_biomass', 'offtake', 'energy_intake'), with one row
+            per time step and one column per pixel.  Weight and standing
+            biomass are at the end of each step; offtake is by the herd on
+            the pixel and energy intake is per individual, during the step
+    """
+    if activity not in _ACTIVITY_TABLE:
+        er = "Error: activity must be one of %s" % sorted(_ACTIVITY_TABLE)
+        raise Exception(er)
+    days_per_step = forage._time_divisor_dict[time_step]
+    n_pixels = _check_inputs(inputs, n_steps)
+    outputs = {}
+    for name in OUTPUTS:
+        if out_dir is None:
+            outputs[name] = numpy.empty(
+                (n_steps, n_pixels), dtype=numpy.float32)
+        else:
+            if not os.path.exists(out_dir):
+                os.makedirs(out_dir)
+            outputs[name] = numpy.lib.format.open_memmap(
+                os.path.join(out_dir, '%s.npy' % name), mode='w+',
+                dtype=numpy.float32, shape=(n_steps, n_pixels))
+    for start in xrange(0, n_pixels, chunk_size):
+        stop = min(start + chunk_size, n_pixels)
+        _run_chunk(inputs, outputs, start, stop, n_steps, activity,
+                   days_per_step)
+    if out_dir is not None:
+        for name in OUTPUTS:
+            outputs[name].flush()
+    return outputs
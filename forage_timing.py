@@ -0,0 +1,163 @@
+"""Timers for phases of a model run.
+
+Phases of a run (CENTURY launches, reading CENTURY outputs, diet selection,
+etc.) are timed with the context manager phase, or with the decorator timed
+for functions that make up a whole phase.  Times are accumulated by model
+step and phase while timing is enabled, and written to a report by
+write_report.  When timing is disabled, as it is by default, a timed call
+costs one check of a module-level flag.
+
+Phases may be nested, e.g. reading CENTURY log files within a CENTURY
+launch: the time of a phase includes the time of phases nested inside it.
+
+While memory tracking is enabled (see forage_memory), memory use is also
+recorded over each phase, whether or not timing is enabled.
+"""
+
+import os
+import timeit
+import functools
+
+import pandas
+
+import forage_memory
+
+_timer = timeit.default_timer
+
+_enabled = False
+_step = -1
+_run_start = None
+# [number of calls, total seconds] keyed by (step, phase)
+_timings = {}
+
+
+def enable():
+    """Discard timings collected so far and start timing."""
+    global _enabled, _run_start
+    reset()
+    _run_start = _timer()
+    _enabled = True
+
+
+def disable():
+    """Stop timing.  Timings collected so far are kept."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Discard timings collected so far."""
+    global _step
+    _timings.clear()
+    _step = -1
+
+
+def set_step(step):
+    """Set the model step to which subsequent timings are attributed.  Step
+    -1 is the setup of a run, before the first step."""
+    global _step
+    _step = step
+
+
+def _record(name, seconds):
+    entry = _timings.get((_step, name))
+    if entry is None:
+        _timings[(_step, name)] = [1, seconds]
+    else:
+        entry[0] += 1
+        entry[1] += seconds
+
+
+class phase(object):
+
+    """Context manager timing the block it encloses as the phase name."""
+
+    __slots__ = ('name', 'start', 'memory')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.memory = None
+
+    def __enter__(self):
+        if _enabled:
+            self.start = _timer()
+        if forage_memory.is_enabled():
+            self.memory = forage_memory.sample()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if _enabled and self.start is not None:
+            _record(self.name, _timer() - self.start)
+        if forage_memory.is_enabled() and self.memory is not None:
+            forage_memory.phase_end(self.name, self.memory)
+        return False
+
+
+def timed(name):
+    """Decorator timing each call of a function as the phase name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not (_enabled or forage_memory.is_enabled()):
+                return func(*args, **kwargs)
+            memory = None
+            if forage_memory.is_enabled():
+                memory = forage_memory.sample()
+            start = _timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if _enabled:
+                    _record(name, _timer() - start)
+                if memory is not None and forage_memory.is_enabled():
+                    forage_memory.phase_end(name, memory)
+        return wrapper
+    return decorator
+
+
+def step_report():
+    """Timings collected so far, by model step and phase.
+
+    Returns:
+        pandas data frame with columns 'step', 'phase', 'calls' and
+            'seconds'
+    """
+    rows = [[step, name, entry[0], entry[1]] for (step, name), entry in
+            sorted(_timings.items())]
+    return pandas.DataFrame(
+        rows, columns=['step', 'phase', 'calls', 'seconds'])
+
+
+def phase_report():
+    """Timings collected so far, by phase, summed over model steps.
+
+    Returns:
+        pandas data frame with columns 'phase', 'calls', 'seconds',
+            'ms_per_call' and 'percent_of_run', giving time of each phase as
+            a percent of time elapsed since timing was enabled, sorted by
+            decreasing time
+    """
+    steps_df = step_report()
+    phase_df = steps_df.groupby('phase')[['calls', 'seconds']].sum()
+    phase_df = phase_df.sort_values('seconds', ascending=False).reset_index()
+    phase_df['ms_per_call'] = 1000. * phase_df['seconds'] / phase_df['calls']
+    if _run_start is not None:
+        run_seconds = _timer() - _run_start
+        phase_df['percent_of_run'] = 100. * phase_df['seconds'] / run_seconds
+    return phase_df
+
+
+def write_report(outdir):
+    """Write timings collected so far to 'profile_by_step.csv' and
+    'profile_by_phase.csv' in outdir (see step_report and phase_report)."""
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    step_report().to_csv(
+        os.path.join(outdir, 'profile_by_step.csv'), index=False)
+    phase_report().to_csv(
+        os.path.join(outdir, 'profile_by_phase.csv'), index=False)
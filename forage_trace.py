@@ -0,0 +1,138 @@
+"""Trace of the subprocesses and file operations of a model run.
+
+While tracing is enabled, one JSON record is written per event to a trace
+file: each CENTURY launch (batch file, grass label, commands, start and end
+time, exit status, size of the log file and number of times the log was
+read), each copy or move of a file with its size and duration, including
+failed attempts, and each edit of a schedule or grazing parameter file.
+Every record has the entries 'event', 'time' (seconds since the epoch),
+'step' (model step, -1 during setup of a run) and 'run' (identifier of the
+run).  Records are written as they occur, so that the trace of a run that
+stalls shows the operation it stalled in.
+
+A trace file is written per run: the trace of the previous run, if any, is
+kept as <trace_file>.1 (and older traces as .2, .3, ...; see enable).  When
+tracing is disabled, as it is by default, a traced operation costs one
+check of a module-level flag.  Copies and moves are counted in progress
+metrics (see forage_metrics) whether or not tracing is enabled.
+"""
+
+import os
+import json
+import time
+import shutil
+
+import forage_metrics
+
+_enabled = False
+_trace = None
+_run = None
+_step = -1
+
+
+def _rotate(trace_file, keep):
+    """Shift trace_file to trace_file.1, trace_file.1 to trace_file.2, etc.,
+    discarding traces older than keep runs."""
+    oldest = '%s.%d' % (trace_file, keep)
+    if os.path.isfile(oldest):
+        os.remove(oldest)
+    for index in xrange(keep - 1, 0, -1):
+        older = '%s.%d' % (trace_file, index)
+        if os.path.isfile(older):
+            os.rename(older, '%s.%d' % (trace_file, index + 1))
+    if os.path.isfile(trace_file):
+        if keep > 0:
+            os.rename(trace_file, trace_file + '.1')
+        else:
+            os.remove(trace_file)
+
+
+def enable(trace_file, keep=5, **run_info):
+    """Start tracing to trace_file, starting a new trace.
+
+    Parameters:
+        trace_file (string): path of the trace file
+        keep (int): number of traces of previous runs to keep
+        run_info: entries of the 'run_start' record, describing the run
+    """
+    global _enabled, _trace, _run, _step
+    if _enabled:
+        disable()
+    trace_dir = os.path.dirname(trace_file)
+    if trace_dir and not os.path.exists(trace_dir):
+        os.makedirs(trace_dir)
+    _rotate(trace_file, keep)
+    # line buffered, so that each record reaches the file when written
+    _trace = open(trace_file, 'w', 1)
+    _run = '%d-%d' % (os.getpid(), int(time.time() * 1000))
+    _step = -1
+    _enabled = True
+    event('run_start', **run_info)
+
+
+def disable():
+    """Stop tracing and close the trace file."""
+    global _enabled, _trace
+    if not _enabled:
+        return
+    event('run_end')
+    _enabled = False
+    _trace.close()
+    _trace = None
+
+
+def is_enabled():
+    return _enabled
+
+
+def set_step(step):
+    """Set the model step to which subsequent events are attributed."""
+    global _step
+    _step = step
+
+
+def event(name, **fields):
+    """Write a record of an event, with entries fields, to the trace."""
+    if not _enabled:
+        return
+    record = {'event': name, 'time': time.time(), 'step': _step, 'run': _run}
+    record.update(fields)
+    _trace.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def _traced(operation, name, src, dst, **fields):
+    """Perform a copy or move of src to dst, recording it as event name."""
+    if not _enabled:
+        operation(src, dst)
+        if forage_metrics.is_enabled():
+            forage_metrics.add_files()
+        return
+    size = _file_size(src)
+    start = time.time()
+    try:
+        operation(src, dst)
+    except (IOError, OSError) as error:
+        event(name, src=src, dst=dst, bytes=size, start=start,
+              end=time.time(), error=str(error), **fields)
+        raise
+    event(name, src=src, dst=dst, bytes=size, start=start, end=time.time(),
+          **fields)
+    if forage_metrics.is_enabled():
+        forage_metrics.add_files()
+
+
+def copyfile(src, dst, **fields):
+    """shutil.copyfile, recorded in the trace as a 'copy' event."""
+    _traced(shutil.copyfile, 'copy', src, dst, **fields)
+
+
+def move(src, dst, **fields):
+    """shutil.move, recorded in the trace as a 'move' event."""
+    _traced(shutil.move, 'move', src, dst, **fields)
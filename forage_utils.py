@@ -4,15 +4,23 @@
 
 import os
 import sys
+import json
 import math
 from operator import attrgetter
+import numpy
 import freer_param as FreerParam
+import forage_timing
 
-global _time_step
 global _time_divisor_dict
 
+# time step used by functions below when none is passed to them; functions
+# used by runs that may execute concurrently in one process take the time
+# step of the run as an argument instead
+_time_step = u'month'
+
 
 def set_time_step(step):
+    """Set the time step used by functions that are not passed one."""
     global _time_step
     _time_step = step
 
@@ -25,11 +33,12 @@ _time_divisor_dict = {
 }
 
 
-def find_steps_per_year():
+def find_steps_per_year(time_step=None):
 
     """This function takes a time step specified as a string (e.g. 'day',
     'week', month') and converts to numerical number of steps to execute
-    within a year.
+    within a year.  If time_step is None, the time step set by set_time_step
+    is used.
 
     Returns numerical time step."""
 
@@ -39,54 +48,76 @@ def find_steps_per_year():
         u'week': 52,
         u'day': 365,
     }
-    step_num = year_divisor_dict[_time_step]
+    step_num = year_divisor_dict[time_step or _time_step]
     return step_num
 
 
-def find_days_per_step():
+def find_days_per_step(time_step=None):
     """This function takes a time step specified as a string (e.g. 'day',
-    'week', month') and converts to number of days within the step.
+    'week', month') and converts to number of days within the step.  If
+    time_step is None, the time step set by set_time_step is used.
 
     Returns number of days in a step."""
 
-    days_in_step = _time_divisor_dict[_time_step]
+    days_in_step = _time_divisor_dict[time_step or _time_step]
     return days_in_step
 
 
-def convert_daily_to_step(daily_amount):
+def convert_daily_to_step(daily_amount, time_step=None):
 
     """Converts an amount calculated per day to the equivalent amount in
-    one time step of the model.
+    one time step of the model.  If time_step is None, the time step set by
+    set_time_step is used.
 
     Returns the amount per step.
     """
 
-    days_in_step = _time_divisor_dict[_time_step]
+    days_in_step = _time_divisor_dict[time_step or _time_step]
     amount_per_step = float(daily_amount) * float(days_in_step)
     return amount_per_step
 
 
-def convert_step_to_daily(step_amount):
+def convert_step_to_daily(step_amount, time_step=None):
 
     """Converts an amount calculated per time step to the equivalent amount per
-    day.
+    day.  If time_step is None, the time step set by set_time_step is used.
 
     Returns the amount per day.
     """
 
-    steps_in_day = 1.0/_time_divisor_dict[_time_step]
+    steps_in_day = 1.0/_time_divisor_dict[time_step or _time_step]
     amount_per_day = float(step_amount) * steps_in_day
     return amount_per_day
 
 
+def find_substeps_per_month(livestock_step):
+    """Find the number of livestock sub-steps taken within one CENTURY month
+    for a livestock time step specified as a string (e.g. 'day', 'week',
+    'month').  Sub-steps divide the month evenly, so a weekly sub-step is
+    slightly longer than 7 days.
+
+    Returns the number of sub-steps per month."""
+
+    if livestock_step not in (u'month', u'week', u'day'):
+        er = ("Error: livestock_step must be 'month', 'week' or 'day', not "
+              "%r" % (livestock_step,))
+        raise Exception(er)
+    n_substeps = int(round(
+        _time_divisor_dict[u'month'] / _time_divisor_dict[livestock_step]))
+    return max(n_substeps, 1)
+
+
 class HerdT1:
 
     """Herd class for tier 1 containing attributes and methods characteristic
-    of the livestock herd."""
+    of the livestock herd.  Energy and weight change are per time step of
+    time_step ('day', 'week', 'month' or 'year'); if time_step is None, the
+    time step set by set_time_step is used."""
 
-    def __init__(self, weight, f_m_weight):
+    def __init__(self, weight, f_m_weight, time_step=None):
         self.average_weight_kg = weight
         self.f_mature_weight_kg = f_m_weight
+        self.time_step = time_step
 
     def e_allocate(self, MJ_per_indiv, maintenance, activity):
         """Allocate energy consumed by herbivores among the herd.
@@ -115,12 +146,13 @@ class HerdT1:
             abs_available_for_growth = abs(available_for_growth)
 
         available_for_growth_daily = convert_step_to_daily(
-            abs_available_for_growth)
+            abs_available_for_growth, self.time_step)
         weight = self.average_weight_kg
         mature_weight = self.f_mature_weight_kg
         weight_change_daily = math.exp((math.log(available_for_growth_daily/(
             22.02 * ((weight/mature_weight) ** 0.75))))/1.097)  # IPCC eq. 10.6
-        delta_weight = convert_daily_to_step(weight_change_daily)
+        delta_weight = convert_daily_to_step(
+            weight_change_daily, self.time_step)
 
         if weight_loss:
             delta_weight = -delta_weight
@@ -133,18 +165,20 @@ class HerdT1:
         Cfi = 0.322  # IPCC 2006 table 10.4 (steer and non-lactating cows)
         weight = self.average_weight_kg
         NE_m_day = Cfi * weight ** 0.75  # IPCC 2006 eq. 10.3
-        maintenance = convert_daily_to_step(NE_m_day)
+        maintenance = convert_daily_to_step(NE_m_day, self.time_step)
         return maintenance
 
 
 class VegT1:
 
     """Vegetation class for tier 1 containing attributes and methods
-    characteristic of the vegetation."""
+    characteristic of the vegetation.  Intake is per time step of time_step;
+    if time_step is None, the time step set by set_time_step is used."""
 
-    def __init__(self, standing, quality):
+    def __init__(self, standing, quality, time_step=None):
         self.standing_veg = standing
         self.forage_quality = quality
+        self.time_step = time_step
 
     def offtake(self, DMI):
         """Remove vegetation selected by grazing herbivores.
@@ -175,7 +209,8 @@ class VegT1:
         indiv_DMI_daily = weight ** 0.75 * ((0.2444 * MJ_per_kg_DM - 0.0111 *
             MJ_per_kg_DM ** 2 - 0.472) / MJ_per_kg_DM)  # kg; IPCC 2006 eq 10.17
 
-        indiv_DMI_step = convert_daily_to_step(indiv_DMI_daily)
+        indiv_DMI_step = convert_daily_to_step(
+            indiv_DMI_daily, self.time_step)
         DMI = indiv_DMI_step * float(herd_size)
         diet = DMI * MJ_per_kg_DM
         self.standing_veg -= DMI  # offtake by the herd
@@ -196,17 +231,60 @@ def calc_energy_t1(forage_quality):
     return MJ_per_kg_DM
 
 
-def calc_DMI_t1(MJ_per_kg_DM, weight):
-    """Calculate dry matter intake (for tier 1) given the energy content of food
-    available and average animal weight."""
+def calc_DMI_t1(MJ_per_kg_DM, weight, time_step=None):
+    """Calculate dry matter intake (for tier 1) per time step of time_step given
+    the energy content of food available and average animal weight.  If
+    time_step is None, the time step set by set_time_step is used."""
 
     indiv_DMI_daily = float(weight) ** 0.75 * ((0.2444 * float(MJ_per_kg_DM) -
         0.0111 * float(MJ_per_kg_DM) ** 2. - 0.472) / float(MJ_per_kg_DM))  # IPCC 2006 eq 10.17
 
-    indiv_DMI_step = convert_daily_to_step(indiv_DMI_daily)
+    indiv_DMI_step = convert_daily_to_step(indiv_DMI_daily, time_step)
     return indiv_DMI_step
 
 
+def parse_fparam_overrides(overrides):
+    """Parse the parameter overrides of a herbivore class, as given in the
+    column 'FParam_overrides' of the herbivore table: json naming parameters
+    of Freer et al. 2012 and their values, e.g. {"CI1": 0.03}.  An empty
+    cell (NaN) or None means no overrides; a dictionary is copied.
+
+    Returns a dictionary of overrides, or None if there are none."""
+
+    if overrides is None:
+        return None
+    if isinstance(overrides, dict):
+        return dict(overrides)
+    if isinstance(overrides, basestring):
+        if not overrides.strip():
+            return None
+        parsed = json.loads(overrides)
+        if not isinstance(parsed, dict):
+            er = "Error: FParam_overrides must be a json object: %s" % (
+                overrides)
+            raise Exception(er)
+        return parsed
+    if isinstance(overrides, float) and math.isnan(overrides):
+        return None
+    er = "Error: FParam_overrides must be given as json: %r" % (overrides,)
+    raise Exception(er)
+
+
+def read_herbivore_csv(herbivore_csv):
+    """Read the herbivore table, with parameter overrides in the column
+    'FParam_overrides', if present, parsed by parse_fparam_overrides.
+
+    Returns a list of dictionaries, one per herbivore class."""
+
+    import pandas
+    herbivore_input = pandas.read_csv(herbivore_csv).to_dict(orient='records')
+    for herb_class in herbivore_input:
+        if 'FParam_overrides' in herb_class:
+            herb_class['FParam_overrides'] = parse_fparam_overrides(
+                herb_class['FParam_overrides'])
+    return herbivore_input
+
+
 class HerbivoreClass:
 
     """Herbivore class for tier 2 containing attributes and methods
@@ -216,6 +294,16 @@ class HerbivoreClass:
         global_SRW = 550.
         global_birth_weight = 34.7
         self.FParam = FreerParam.get_params(inputs_dict['type'])
+        # other parameters of Freer et al. 2012 may be overridden by name,
+        # e.g. for sensitivity analysis
+        overrides = parse_fparam_overrides(
+            inputs_dict.get('FParam_overrides'))
+        if overrides is not None:
+            for name, value in overrides.items():
+                if not hasattr(self.FParam, name):
+                    er = "Error: unknown parameter %s" % name
+                    raise Exception(er)
+                setattr(self.FParam, name, value)
         self.label = inputs_dict['label']
         self.stocking_density = inputs_dict['stocking_density']  # num animals per ha
         if inputs_dict['birth_weight'] > 0:
@@ -425,6 +513,220 @@ class HerbivoreClass:
             return 1.
 
 
+class HerbivoreCohorts:
+
+    """Array-backed container for many herbivore cohorts (e.g., herds broken
+    down by age, sex and breed).  Each cohort is described by the same inputs
+    as HerbivoreClass, but state is held in numpy arrays with one entry per
+    cohort so that the reproductive cycle and intake limits of all cohorts
+    are advanced at once.  Parameters from Freer et al. 2012 are held as
+    arrays in the dictionary `param`, keyed by parameter name."""
+
+    # parameters needed to advance cohort state and calculate intake limits
+    _param_names = [
+        'CN1', 'CN2', 'CN3', 'CI1', 'CI2', 'CI8', 'CI9', 'CI15', 'CI19',
+        'CI20', 'CR7', 'CP1', 'CP4', 'CP5', 'CP6', 'CP7', 'CP15', 'CM2',
+        'CM12', 'CK13', 'CG2']
+    # parameters that may be overridden by calibration inputs
+    _calibration_params = ['CM2', 'CM12', 'CK13', 'CG2']
+    # codes for reproductive status
+    NOT_REPRODUCING = 0
+    PREGNANT = 1
+    LACTATING = 2
+
+    def __init__(self, inputs_list):
+        """Build cohorts from a list of dictionaries, one per cohort, with
+        the same entries as the herbivore table read by execute."""
+
+        global_SRW = 550.
+        global_birth_weight = 34.7
+        n_cohorts = len(inputs_list)
+
+        def column(key, default=numpy.nan):
+            return numpy.array(
+                [_none_to_nan(inputs.get(key, default)) for inputs in
+                 inputs_list], dtype=float)
+
+        self.label = [inputs['label'] for inputs in inputs_list]
+        self.type = [inputs['type'] for inputs in inputs_list]
+        self.sex = numpy.array(
+            [inputs['sex'] for inputs in inputs_list], dtype=object)
+        self.stocking_density = column('stocking_density')
+        birth_weight = column('birth_weight')
+        self.Wbirth = numpy.where(
+            birth_weight > 0, birth_weight, global_birth_weight)
+        SRW = column('SRW')
+        self.SRW = numpy.where(SRW > 0, SRW, global_SRW)
+        self.SFW = column('SFW')
+        self.Wprev = column('weight')
+        self.W = self.Wprev.copy()
+        self.A = column('age')
+        sex_multiplier = numpy.ones(n_cohorts)
+        sex_multiplier[self.sex == 'entire_m'] = 1.4
+        sex_multiplier[self.sex == 'castrate'] = 1.2
+        sex_multiplier[self.sex == 'herd_average'] = 0.6323 + 0.1564 + 0.3071
+        sex_multiplier[self.sex == 'NA'] = (1. + 1.4) / 2
+        self.SRW = self.SRW * sex_multiplier
+        self.breeding = self.sex == 'breeding_female'
+        self.conception_step = column('conception_step')
+        self.calving_interval = column('calving_interval')
+        self.lactation_duration = column('lactation_duration')
+
+        # parameters are looked up once per herbivore type, then overridden
+        # by calibration inputs for individual cohorts
+        unique_types = sorted(set(self.type))
+        type_params = [FreerParam.get_params(t) for t in unique_types]
+        type_index = numpy.array(
+            [unique_types.index(t) for t in self.type], dtype=int)
+        self.param = {}
+        for name in self._param_names:
+            values = numpy.array(
+                [float(getattr(fparam, name, numpy.nan)) for fparam in
+                 type_params])
+            self.param[name] = values[type_index]
+        for index, inputs in enumerate(inputs_list):
+            overrides = parse_fparam_overrides(inputs.get('FParam_overrides'))
+            if overrides is None:
+                continue
+            fparam = type_params[type_index[index]]
+            for name, value in overrides.items():
+                if not hasattr(fparam, name):
+                    er = "Error: unknown parameter %s" % name
+                    raise Exception(er)
+                # parameters not used by cohorts have no effect
+                if name in self.param:
+                    self.param[name][index] = value
+        for name in self._calibration_params:
+            override = column(name)
+            supplied = ~numpy.isnan(override)
+            self.param[name][supplied] = override[supplied]
+        self.f_w = numpy.nan_to_num(column('quant_weight', 0.))
+        self.q_w = numpy.nan_to_num(column('qual_weight', 0.))
+
+        p = self.param
+        self.Nmax = self.SRW - (self.SRW - self.Wbirth) * numpy.exp(
+            (-p['CN1'] * self.A) / (self.SRW ** p['CN2']))  # eq 1
+        self.N = p['CN3'] * self.Nmax + (1. - p['CN3']) * self.Wprev
+        self.Z = self.N / self.SRW  # relative size
+        self.Z_abs = self.N / 542.  # absolute size
+        self.BC = self.W / self.N  # relative condition
+        self.D = numpy.full(n_cohorts, -1.)
+        self.reproductive_status = numpy.zeros(n_cohorts, dtype=int)
+        self.A_foet = numpy.zeros(n_cohorts)  # days since conception
+        self.A_y = numpy.zeros(n_cohorts)  # days since birth
+
+    @classmethod
+    def from_csv(cls, herbivore_csv):
+        """Build cohorts from a herbivore table in the format read by
+        execute, with one row per cohort."""
+
+        return cls(read_herbivore_csv(herbivore_csv))
+
+    def __len__(self):
+        return len(self.label)
+
+    def __repr__(self):
+        return '{}: {} cohorts, {} animals per ha'.format(
+            self.__class__.__name__, len(self),
+            numpy.nansum(self.stocking_density))
+
+    def update(self, model_step):
+        """Update reproductive status, days since conception, days since birth,
+        and weight including conceptus of all breeding female cohorts, as in
+        HerbivoreClass.update.
+
+        Parameters:
+            model step (int): timestep of the model relative to beginning month
+
+        Returns:
+            None
+        """
+        if not self.breeding.any():
+            return
+        months_of_pregnancy = 9
+        p = self.param
+        b = self.breeding
+        cycle_month_index = numpy.mod(
+            model_step - self.conception_step[b], self.calving_interval[b])
+        pregnant = cycle_month_index < months_of_pregnancy
+        lactating = (~pregnant) & (
+            cycle_month_index <
+            (months_of_pregnancy + self.lactation_duration[b]))
+        neither = ~(pregnant | lactating)
+
+        status = numpy.full(cycle_month_index.shape, self.NOT_REPRODUCING)
+        status[pregnant] = self.PREGNANT
+        status[lactating] = self.LACTATING
+        self.reproductive_status[b] = status
+
+        A_foet = self.A_foet[b]
+        A_foet[pregnant] = cycle_month_index[pregnant] * 30 + 1
+        A_foet[neither] = 0
+        self.A_foet[b] = A_foet
+        A_y = self.A_y[b]
+        A_y[lactating] = (
+            (cycle_month_index[lactating] - months_of_pregnancy) * 30 + 1)
+        A_y[neither] = 0
+        self.A_y[b] = A_y
+
+        RA = A_foet / p['CP1'][b]
+        BW = (1 - p['CP4'][b] + p['CP4'][b] * self.Z[b]) * (
+            p['CP15'][b] * self.SRW[b])
+        W_c = p['CP5'][b] * BW * numpy.exp(
+            p['CP6'][b] * (1 - numpy.exp(p['CP7'][b] * (1 - RA))))  # eq 62
+        self.W[b] = numpy.where(
+            pregnant, self.Wprev[b] + W_c, self.Wprev[b])
+
+    def calc_max_intake(self):
+        """Calculate the maximum potential daily intake of dry matter (kg) of
+        an individual in each cohort from size and condition, as in
+        HerbivoreClass.calc_max_intake.
+
+        Returns a numpy array of maximum kg dry matter intake per day."""
+
+        p = self.param
+        CF = numpy.where(
+            self.BC > 1.,
+            self.BC * (p['CI20'] - self.BC) / (p['CI20'] - 1.), 1.)
+        YF = 1.  # eq 4 gives a different value for unweaned animals
+        TF = 1.  # ignore effect of temperature on intake
+        LF = numpy.ones(len(self))
+        lac = self.reproductive_status == self.LACTATING
+        if lac.any():
+            BCpart = self.BC[lac]  # assumed body condition at parturition
+            Mi = self.A_y[lac] / p['CI8'][lac]
+            LA = 1. - p['CI15'][lac] + p['CI15'][lac] * BCpart
+            LF[lac] = 1. + p['CI19'][lac] * Mi ** p['CI9'][lac] * numpy.exp(
+                p['CI9'][lac] * (1 - Mi)) * LA
+        max_intake = (p['CI1'] * self.SRW * self.Z * (p['CI2'] - self.Z) *
+                      CF * YF * TF * LF)  # eq 2
+        max_intake[self.W <= self.Wbirth] = 0.
+        return max_intake
+
+    def calc_ZF(self):
+        """Calculate the factor adjusting intake for small absolute size of
+        each cohort, as in HerbivoreClass.calc_ZF.
+
+        Returns a numpy array."""
+
+        CR7 = self.param['CR7']
+        return numpy.where(self.Z_abs < CR7, 1. + (CR7 - self.Z_abs), 1.)
+
+    def calc_total_stocking_density(self):
+        """Calculate the total stocking density of herbivores across
+        cohorts."""
+
+        return float(numpy.nansum(self.stocking_density))
+
+
+def _none_to_nan(value):
+    """Convert missing values read from an input table to NaN."""
+
+    if value is None:
+        return numpy.nan
+    return value
+
+
 class SiteInfo:
 
     """This class holds information about the physical site."""
@@ -679,87 +981,224 @@ def calc_relative_height(available_forage):
     return rel_height
 
 
-def reduce_demand(diet_dict, stocking_density_dict, available_forage):
+def feed_type_labels(available_forage):
+    """Make the label used to identify each forage type in the intake
+    dictionary of a Diet, in the order of available_forage."""
+
+    return [';'.join([feed_type.label, feed_type.green_or_dead]) for
+            feed_type in available_forage]
+
+
+def build_intake_matrix(diet_dict, hclass_labels, f_labels):
+    """Arrange daily intake of each forage type by each herbivore class as a
+    matrix.
+
+    Parameters:
+        diet_dict (dict): dictionary of class Diet, keyed by herbivore label
+        hclass_labels (list): herbivore labels giving the order of rows
+        f_labels (list): forage type labels (see feed_type_labels) giving the
+            order of columns
+
+    Returns:
+        numpy array of shape (len(hclass_labels), len(f_labels)) containing
+            daily intake (kg) of each forage type by an individual of each
+            herbivore class. Forage types missing from a diet are filled with
+            0
+    """
+    intake = numpy.zeros((len(hclass_labels), len(f_labels)))
+    for h_index, hclass_label in enumerate(hclass_labels):
+        diet_intake = diet_dict[hclass_label].intake
+        for f_index, f_label in enumerate(f_labels):
+            intake[h_index, f_index] = diet_intake.get(f_label, 0.)
+    return intake
+
+
+def build_sd_vector(stocking_density_dict, hclass_labels):
+    """Arrange stocking density (animals per ha) of each herbivore class as a
+    vector in the order given by hclass_labels."""
+
+    return numpy.array(
+        [stocking_density_dict[hclass_label] for hclass_label in
+         hclass_labels], dtype=float)
+
+
+@forage_timing.timed('reduce_demand')
+def reduce_demand_matrix(intake, sd, biomass_avail, days_per_step=None):
+    """Ration intake of each forage type among herbivore classes.
+
+    Where total demand for a forage type across herbivore classes exceeds the
+    biomass available, intake of that forage type by each herbivore class is
+    reduced according to its proportion of total demand.
+
+    Parameters:
+        intake (numpy array): daily intake per individual, with one row per
+            herbivore class and one column per forage type
+        sd (numpy array): stocking density of each herbivore class
+        biomass_avail (numpy array): biomass of each forage type available
+            to herbivores for the step (kg/ha)
+        days_per_step (float): number of days in the model step. If None,
+            this is found from the model time step
+
+    Returns:
+        numpy array of rationed daily intake, of the same shape as intake
+    """
+    if days_per_step is None:
+        days_per_step = find_days_per_step()
+    intake = numpy.asarray(intake, dtype=float)
+    sd = numpy.asarray(sd, dtype=float)
+    biomass_avail = numpy.asarray(biomass_avail, dtype=float)
+    demand = numpy.dot(sd, intake) * days_per_step
+    over = demand > biomass_avail
+    if not over.any():
+        return intake.copy()
+    scale = numpy.ones(demand.shape)
+    scale[over] = biomass_avail[over] / demand[over]
+    rationed = intake * scale
+    # herbivore classes that are not present receive nothing once rationed
+    rationed[numpy.ix_(sd == 0, over)] = 0.
+    return rationed
+
+
+def aggregate_diet_matrix(intake, digestibility, crude_protein):
+    """Calculate total forage intake, average dry matter digestibility and
+    crude protein intake of each herbivore class from an intake matrix.
+
+    Parameters:
+        intake (numpy array): daily intake per individual, with one row per
+            herbivore class and one column per forage type
+        digestibility (numpy array): digestibility of each forage type
+        crude_protein (numpy array): crude protein of each forage type
+
+    Returns:
+        tuple of numpy arrays (If, DMDf, CPIf), each with one entry per
+            herbivore class
+    """
+    If = intake.sum(axis=1)
+    DMDf = numpy.dot(intake, digestibility)
+    CPIf = numpy.dot(intake, crude_protein)
+    fed = If > 0
+    DMDf[fed] = DMDf[fed] / If[fed]
+    return If, DMDf, CPIf
+
+
+def calc_total_intake_matrix(intake, sd, days_per_step=None):
+    """Calculate total intake of forage (kg/ha) across forage types and
+    herbivore classes in one model step, from an intake matrix."""
+
+    if days_per_step is None:
+        days_per_step = find_days_per_step()
+    return float(numpy.dot(sd, intake.sum(axis=1))) * days_per_step
+
+
+def calc_percent_consumed_matrix(intake, sd, biomass, days_per_step=None):
+    """Calculate the fraction of each forage type removed by all herbivore
+    classes in one model step, from an intake matrix.
+
+    Returns:
+        numpy array with one entry per forage type. Forage types with zero
+            biomass are assigned a fraction removed of 0
+    """
+    if days_per_step is None:
+        days_per_step = find_days_per_step()
+    biomass = numpy.asarray(biomass, dtype=float)
+    consumed = numpy.dot(sd, intake) * days_per_step
+    perc_removed = numpy.zeros(biomass.shape)
+    nonzero = biomass != 0
+    perc_removed[nonzero] = consumed[nonzero] / biomass[nonzero]
+    return perc_removed
+
+
+def update_diets_from_matrix(diet_dict, hclass_labels, f_labels, intake,
+                             digestibility, crude_protein):
+    """Write intake of each forage type from an intake matrix back into the
+    diet of each herbivore class, and recalculate total forage intake, dry
+    matter digestibility and crude protein intake of each diet.
+
+    Parameters:
+        diet_dict (dict): dictionary of class Diet, keyed by herbivore label
+        hclass_labels (list): herbivore labels giving the order of rows
+        f_labels (list): forage type labels giving the order of columns
+        intake (numpy array): daily intake per individual, with one row per
+            herbivore class and one column per forage type
+        digestibility (numpy array): digestibility of each forage type
+        crude_protein (numpy array): crude protein of each forage type
+
+    Modifies:
+        each Diet in diet_dict
+
+    Returns:
+        None
+    """
+    If, DMDf, CPIf = aggregate_diet_matrix(
+        intake, digestibility, crude_protein)
+    # store python floats, so that downstream calculations raise
+    # ZeroDivisionError on zero intake as they do for diets built by
+    # diet_selection_t2
+    for h_index, hclass_label in enumerate(hclass_labels):
+        diet = diet_dict[hclass_label]
+        for f_index, f_label in enumerate(f_labels):
+            diet.intake[f_label] = float(intake[h_index, f_index])
+        diet.If = float(If[h_index])
+        diet.DMDf = float(DMDf[h_index])
+        diet.CPIf = float(CPIf[h_index])
+
+
+@forage_timing.timed('reduce_demand')
+def reduce_demand(diet_dict, stocking_density_dict, available_forage,
+                  days_per_step=None):
     """Check whether demand is greater than available biomass for each forage
     type. If it is, reduce intake of that forage type for each herbivore type
-    according to its proportion of total demand for that forage type."""
+    according to its proportion of total demand for that forage type.  If
+    days_per_step is None, it is found from the model time step."""
 
-    for feed_type in available_forage:
-        label_string = '{};{}'.format(feed_type.label,
-                                      feed_type.green_or_dead)
-        available = feed_type.biomass_avail
-        demand = 0.
-        indiv_demand_dict = {}
-        for hclass_label in diet_dict.keys():
-            sd = stocking_density_dict[hclass_label]
-            intake_step = convert_daily_to_step(
-                             diet_dict[hclass_label].intake[label_string]) * sd
-            indiv_demand_dict[hclass_label] = intake_step
-            demand += intake_step
-        if demand > available:
-            for hclass_label in diet_dict.keys():
-                sd = stocking_density_dict[hclass_label]
-                intake_step = available * (indiv_demand_dict[hclass_label] /
-                                           demand)
-                try:
-                    intake_daily = convert_step_to_daily(intake_step) / sd
-                except ZeroDivisionError:
-                    intake_daily = 0
-                diet_dict[hclass_label].intake[label_string] = intake_daily
+    hclass_labels = list(diet_dict.keys())
+    f_labels = feed_type_labels(available_forage)
+    intake = build_intake_matrix(diet_dict, hclass_labels, f_labels)
+    sd = build_sd_vector(stocking_density_dict, hclass_labels)
+    biomass_avail = numpy.array(
+        [feed_type.biomass_avail for feed_type in available_forage])
+    intake = reduce_demand_matrix(intake, sd, biomass_avail, days_per_step)
 
     # recalculate all other quantities in diet
-    for hclass_label in diet_dict.keys():
-        diet_dict[hclass_label].If = 0.
-        diet_dict[hclass_label].DMDf = 0.
-        diet_dict[hclass_label].CPIf = 0.
-        for feed_type in available_forage:
-            label_string = '{};{}'.format(feed_type.label,
-                                          feed_type.green_or_dead)
-            intake_daily = diet_dict[hclass_label].intake[label_string]
-            diet_dict[hclass_label].If += intake_daily
-            diet_dict[hclass_label].DMDf += (intake_daily *
-                                             feed_type.digestibility)
-            diet_dict[hclass_label].CPIf += (intake_daily *
-                                             feed_type.crude_protein)
-        if diet_dict[hclass_label].If > 0:
-            diet_dict[hclass_label].DMDf = (diet_dict[hclass_label].DMDf /
-                                            diet_dict[hclass_label].If)
-
-
-def calc_total_intake(diet_dict, stocking_density_dict):
-    """Calculate total intake of forage across grass and herbivore types."""
-
-    total_intake = 0.
-    for hclass_label in diet_dict.keys():
-        sd = stocking_density_dict[hclass_label]
-        total_intake += convert_daily_to_step(diet_dict[hclass_label].If) * sd
-    return total_intake
-
-
-def calc_percent_consumed(available_forage, diet_dict, stocking_density_dict):
+    digestibility = numpy.array(
+        [feed_type.digestibility for feed_type in available_forage])
+    crude_protein = numpy.array(
+        [feed_type.crude_protein for feed_type in available_forage])
+    update_diets_from_matrix(
+        diet_dict, hclass_labels, f_labels, intake, digestibility,
+        crude_protein)
+
+
+def calc_total_intake(diet_dict, stocking_density_dict, days_per_step=None):
+    """Calculate total intake of forage across grass and herbivore types.  If
+    days_per_step is None, it is found from the model time step."""
+
+    hclass_labels = list(diet_dict.keys())
+    If = numpy.array(
+        [diet_dict[hclass_label].If for hclass_label in hclass_labels])
+    sd = build_sd_vector(stocking_density_dict, hclass_labels)
+    if days_per_step is None:
+        days_per_step = find_days_per_step()
+    return float(numpy.dot(sd, If)) * days_per_step
+
+
+def calc_percent_consumed(available_forage, diet_dict, stocking_density_dict,
+                          days_per_step=None):
     """Calculate percent of each forage type consumed through diet selection.
     This proportion is sent back to CENTURY as grazing intensity, in the form
     of the parameters flgrem (percent live biomass removed) and fdgrem (percent
-    standing dead biomass removed)."""
+    standing dead biomass removed).  If days_per_step is None, it is found
+    from the model time step."""
 
-    consumed_dict = {}
-    for feed_type in available_forage:
-        label_string = ';'.join([feed_type.label, feed_type.green_or_dead])
-        if feed_type.biomass == 0:
-            perc_removed = 0
-        else:
-            consumed = 0.
-            for hclass_label in diet_dict.keys():
-                sd = stocking_density_dict[hclass_label]
-                try:
-                    consumed += (convert_daily_to_step(
-                                            diet_dict[hclass_label].intake[
-                                            label_string]) * sd)
-                except KeyError:
-                    continue
-            perc_removed = float(consumed) / feed_type.biomass
-        consumed_dict[label_string] = perc_removed
-    return consumed_dict
+    hclass_labels = list(diet_dict.keys())
+    f_labels = feed_type_labels(available_forage)
+    intake = build_intake_matrix(diet_dict, hclass_labels, f_labels)
+    sd = build_sd_vector(stocking_density_dict, hclass_labels)
+    biomass = numpy.array(
+        [feed_type.biomass for feed_type in available_forage])
+    perc_removed = calc_percent_consumed_matrix(
+        intake, sd, biomass, days_per_step)
+    return dict(zip(f_labels, perc_removed.tolist()))
 
 
 def restrict_available_forage(available_forage, management_threshold):
@@ -833,6 +1272,50 @@ def update_feed_types(grass_list, available_forage):
     return available_forage
 
 
+def interpolate_feed_types(available_forage, start_biomass, end_biomass,
+                           start_cp, end_cp, fraction, depleted=None):
+    """Set biomass and crude protein of each forage type to values
+    interpolated between two CENTURY outputs, less biomass already removed by
+    herbivores.
+
+    Parameters:
+        available_forage (list): list of class FeedType
+        start_biomass (numpy array): biomass of each forage type (kg/ha) at
+            the earlier CENTURY output
+        end_biomass (numpy array): biomass of each forage type at the later
+            CENTURY output
+        start_cp (numpy array): crude protein of each forage type at the
+            earlier CENTURY output
+        end_cp (numpy array): crude protein of each forage type at the later
+            CENTURY output
+        fraction (float): position between the two outputs, where 0 gives
+            the earlier output and 1 gives the later output
+        depleted (numpy array): biomass of each forage type (kg/ha) already
+            removed by herbivores, or None if nothing has been removed
+
+    Modifies:
+        biomass, crude protein and relative availability of each FeedType in
+            available_forage
+
+    Returns:
+        modified available_forage, a list of class FeedType
+    """
+    remaining = 1. - fraction
+    biomass = end_biomass - remaining * (end_biomass - start_biomass)
+    if depleted is not None:
+        biomass = numpy.maximum(biomass - depleted, 0.)
+    crude_protein = end_cp - remaining * (end_cp - start_cp)
+    sum_biomass = biomass.sum()
+    for f_index, feed_type in enumerate(available_forage):
+        feed_type.biomass = biomass[f_index]
+        feed_type.crude_protein = crude_protein[f_index]
+        if sum_biomass > 0:
+            feed_type.rel_availability = biomass[f_index] / sum_biomass
+        else:
+            feed_type.rel_availability = 0.
+    return available_forage
+
+
 def calc_feed_types(grass_list):
     """Calculate initial available forage classes subject to diet selection,
     from grass output from CENTURY and user-defined percent initial biomass of
@@ -866,6 +1349,7 @@ def calc_feed_types(grass_list):
     return forage
 
 
+@forage_timing.timed('diet_intermediates')
 def calc_diet_intermediates(diet, herb_class, prop_legume,
                             DOY, site=None, supp=None):
     """This mess is necessary to calculate intermediate values that are used
@@ -1003,11 +1487,12 @@ def calc_diet_intermediates(diet, herb_class, prop_legume,
     return diet_interm
 
 
-def calc_delta_weight(diet_interm, herb_class):
+def calc_delta_weight(diet_interm, herb_class, time_step=None):
     """Calculate weight gain or loss from the diet selected by a herbivore
     class.  Energy is first allocated to maintenance, then to growth.  This
     function ignores energy and protein costs of pregnancy, wool growth, and
-    chilling. Also ignored is the potential nutrition gained from milk.
+    chilling. Also ignored is the potential nutrition gained from milk.  If
+    time_step is None, the time step set by set_time_step is used.
 
     Returns the change in weight (kg) in one day."""
 
@@ -1020,7 +1505,7 @@ def calc_delta_weight(diet_interm, herb_class):
         # in this boundary condition, intake is very low relative to
         # requirements and body condition is very poor, and yet delta_W is
         # calculated to be very large positive. We force starvation instead.
-        delta_W = -(convert_step_to_daily(herb_class.W))
+        delta_W = -(convert_step_to_daily(herb_class.W, time_step))
     else:
         delta_W = herb_class.FParam.CG13 * EBG  # eq 117, kg
     return delta_W
@@ -1085,9 +1570,11 @@ def check_initial_biomass(grass_list):
 
 
 def one_step(site, DOY, herb_class, available_forage, prop_legume,
-             supp_available, supp, intake=None, force_supp=None):
+             supp_available, supp, intake=None, force_supp=None,
+             time_step=None):
     """One step of the forage model, with one herbivore type, if available
-    forage does not change."""
+    forage does not change.  If time_step is None, the time step set by
+    set_time_step is used."""
 
     row = []
     herb_class.calc_distance_walked(site.S, herb_class.stocking_density,
@@ -1121,10 +1608,10 @@ def one_step(site, DOY, herb_class, available_forage, prop_legume,
                 diet_interm = calc_diet_intermediates(diet, herb_class,
                                                       prop_legume, DOY, site,
                                                       supp=supp)
-    delta_W = calc_delta_weight(diet_interm, herb_class)
-    delta_W_step = convert_daily_to_step(delta_W)
+    delta_W = calc_delta_weight(diet_interm, herb_class, time_step)
+    delta_W_step = convert_daily_to_step(delta_W, time_step)
     herb_class.update(delta_weight=delta_W_step,
-                      delta_time=find_days_per_step())
+                      delta_time=find_days_per_step(time_step))
 
     row.append(max_intake)
     row.append(diet.If)
@@ -0,0 +1,396 @@
+"""Synthetic inputs of the forage model, for benchmarks and load tests.
+
+From a seed and size parameters, the functions here write the inputs of a
+model run in the formats of the sample inputs: a grass table (as 0.csv), a
+herbivore table with many cohorts (as Ol_pej_herd.csv), CENTURY schedules
+with several blocks and many grazing events, site and weather files, and a
+supplement table.  write_workload writes a complete set of inputs and
+returns the model inputs for forage.execute.
+
+Where CENTURY is not installed, runs on these inputs may be made with the
+stand-in of forage_fake_century, whose CENTURY directory (see
+forage_fake_century.write_century_dir) defines the grazing levels used in
+the schedules.  To run the real CENTURY, supply a CENTURY directory that
+defines these levels, and a fix file.
+"""
+
+import os
+
+import numpy
+import pandas
+
+import forage_century_link_utils as cent
+import forage_fake_century
+
+GRASS_COLUMNS = [
+    'label', 'index', 'type', 'percent_biomass', 'DMD_green', 'DMD_dead',
+    'cprotein_green', 'cprotein_dead', 'green_gm2', 'dead_gm2',
+    'prev_g_gm2', 'prev_d_gm2', 'N_multiplier', 'n_mult']
+HERBIVORE_COLUMNS = [
+    'label', 'sex', 'age', 'weight', 'stocking_density', 'SRW', 'type',
+    'SFW', 'birth_weight', 'proportion_of_herd', 'conception_step',
+    'calving_interval', 'lactation_duration']
+SUPPLEMENT_COLUMNS = [
+    'digestibility', 'kg_per_day', 'M_per_d', 'ether_extract',
+    'crude_protein', 'rumen_degradability']
+
+# CENTURY schedules give years relative to the block in a field that allows
+# at most 9 years
+MAX_BLOCK_YEARS = 9
+# grazing levels defined by forage_fake_century.write_century_dir
+GRAZ_LEVELS = ['GL', 'GLP']
+FIX_FILE = 'drytrpfi.100'
+
+# mean monthly climate of the sample site
+_PRECIP = [1.36, 1.8, 3.36, 22.32, 3.12, 2.13, 2.62, 3.88, 3.33, 3.06,
+           16.53, 2.7]
+_TMIN = [6.8, 7.3, 8.6, 10.5, 10.2, 9.2, 9.4, 9.1, 8.5, 8.9, 9.4, 8.7]
+_TMAX = [26., 26.7, 26.6, 25.3, 24.8, 24.3, 23., 23.1, 24.9, 25.2, 24.,
+         24.3]
+# herd structure of the sample herd: (sex, share of cohorts, standard
+# reference weight of the breed)
+_HERD_STRUCTURE = [
+    ('entire_m', 0.06, 603),
+    ('breeding_female', 0.44, 604),
+    ('castrate', 0.25, 605),
+    ('heifer', 0.25, 606)]
+# animals per ha in the sample herd
+_STOCKING_DENSITY = 0.0687
+
+
+def site_climate(rng):
+    """Mean monthly climate of a synthetic site: that of the sample site,
+    with precipitation scaled and temperatures shifted at random.
+
+    Returns:
+        pandas data frame indexed by month (1:12) with columns 'prec',
+            'tmin' and 'tmax', as returned by forage_surrogate.read_site_climate
+    """
+    scale = rng.uniform(0.5, 1.5)
+    shift = rng.uniform(-3., 3.)
+    return pandas.DataFrame({
+        'prec': numpy.array(_PRECIP) * scale,
+        'tmin': numpy.array(_TMIN) + shift,
+        'tmax': numpy.array(_TMAX) + shift}, index=range(1, 13),
+        columns=['prec', 'tmin', 'tmax'])
+
+
+def write_site_file(site_file, climate):
+    """Write a CENTURY site file giving mean monthly climate.  Only the
+    climate parameters are written."""
+    with open(site_file, 'w') as site:
+        site.write('0.0   (generated)\n*** Climate parameters\n')
+        for param, column in [('PRECIP', 'prec'), ('TMN2M', 'tmin'),
+                              ('TMX2M', 'tmax')]:
+            for month in xrange(1, 13):
+                site.write('%-18.4f%s\n' % (
+                    climate.loc[month, column], "'%s(%d)'" % (param, month)))
+
+
+def write_weather_file(wth_file, first_year, last_year, climate, rng):
+    """Write a CENTURY weather file of monthly weather from first_year to
+    last_year, varying at random about the mean climate of the site."""
+    records = []
+    for year in xrange(first_year, last_year + 1):
+        prec = climate['prec'].values * rng.gamma(2., 0.5, 12)
+        tmin = climate['tmin'].values + rng.normal(0., 1., 12)
+        tmax = numpy.maximum(
+            climate['tmax'].values + rng.normal(0., 1., 12), tmin + 1.)
+        for variable, values in [('prec', prec), ('tmin', tmin),
+                                 ('tmax', tmax)]:
+            record = {'variable': variable, 'year': year}
+            record.update(zip(range(1, 13), values))
+            records.append(record)
+    weather_df = pandas.DataFrame(
+        records, columns=['variable', 'year'] + range(1, 13))
+    cent.write_weather_file(weather_df, wth_file)
+
+
+def _event_line(rel_year, month, event):
+    return '%4d %4d %s' % (rel_year, month, event)
+
+
+def write_schedule(schedule, first_year, last_year, rng, site_file='0.100',
+                   weather_file=None, graz_prob=0.3, graz_last_year=None,
+                   output_year=None, output_interval=1,
+                   block_years=MAX_BLOCK_YEARS):
+    """Write a CENTURY schedule from first_year to last_year, in blocks of
+    block_years years.  Each year has a growing season of crop TRC4,
+    starting in January and ending in December, and grazing events at the
+    levels GRAZ_LEVELS in each of the months February to November with
+    probability graz_prob, up to graz_last_year.  January and December are
+    never grazed.
+
+    The model adds grazing to the schedule in each month of a run, in the
+    latest month without grazing (see
+    forage_century_link_utils.find_target_month), so grazing events
+    scheduled within the period of a run would displace grazing by the
+    model into earlier months and, eventually, out of the block.  Schedules
+    for a run should therefore end scheduled grazing before the run starts.
+
+    Parameters:
+        schedule (string): path to the schedule file to write
+        first_year (int): first year of the schedule
+        last_year (int): last year of the schedule
+        rng (numpy.random.RandomState): source of random numbers
+        site_file (string): name of the site file
+        weather_file (string): name of the weather file, if weather is read
+            from file; otherwise mean climate of the site is used
+        graz_prob (float): probability of grazing in each month
+        graz_last_year (int): last year with grazing events. Defaults to
+            last_year
+        output_year (int): first year of output. Defaults to first_year
+        output_interval (int): months between outputs
+        block_years (int): years in each block, at most MAX_BLOCK_YEARS
+    """
+    if block_years < 1 or block_years > MAX_BLOCK_YEARS:
+        er = "Error: block_years must be between 1 and %d" % MAX_BLOCK_YEARS
+        raise Exception(er)
+    if graz_last_year is None:
+        graz_last_year = last_year
+    if output_year is None:
+        output_year = first_year
+    lines = [
+        '%-13d Starting year' % first_year,
+        '%-14d Last year' % last_year,
+        '%-13s Site file name' % site_file,
+        '0             Labeling type',
+        '-1            Labeling year',
+        '-1.00         Microcosm',
+        '-1            CO2 Systems',
+        '-1            pH shift',
+        '-1            Soil Warming',
+        '0             N input scalar option',
+        '0             OMAD scalar option',
+        '0             Climate scalar option',
+        '1             Initial system',
+        'TRC4         Initial crop',
+        '              Initial tree',
+        '',
+        'Year Month Option']
+    block = 0
+    for block_start in xrange(first_year, last_year + 1, block_years):
+        block += 1
+        block_last = min(block_start + block_years - 1, last_year)
+        n_years = block_last - block_start + 1
+        lines.extend([
+            '%-13d Block # simulations' % block,
+            '%-14d Last year' % block_last,
+            '%-13d Repeats # years' % n_years,
+            '%-13d Output starting year' % max(output_year, block_start),
+            '1             Output month',
+            '%-13d Output interval' % output_interval])
+        if weather_file is None:
+            lines.append('M             Weather choice')
+        elif block == 1:
+            lines.extend(['F             Weather choice', weather_file])
+        else:
+            lines.append('C             Weather choice')
+        for rel_year in xrange(1, n_years + 1):
+            lines.extend([_event_line(rel_year, 1, 'CROP'), 'TRC4',
+                          _event_line(rel_year, 1, 'FRST')])
+            for month in xrange(2, 12):
+                if (block_start + rel_year - 1 <= graz_last_year and
+                        rng.uniform() < graz_prob):
+                    lines.extend([
+                        _event_line(rel_year, month, 'GRAZ'),
+                        GRAZ_LEVELS[rng.randint(len(GRAZ_LEVELS))]])
+            lines.append(_event_line(rel_year, 12, 'LAST'))
+        lines.append('-999 -999 X')
+    with open(schedule, 'w') as sch:
+        sch.write('\n'.join(lines) + '\n')
+
+
+def _shares(n, rng):
+    """n random shares of a whole, rounded to 6 decimal places.  The shares
+    add to slightly more than 1 (by 1e-6), so that they add to at least 1
+    however they are read back (see forage_utils.check_initial_biomass)."""
+    if n == 1:
+        return [1.]
+    shares = [round(s, 6) for s in rng.dirichlet(numpy.ones(n) * 2.)]
+    shares[0] = round(shares[0] + 1. - sum(shares) + 1e-6, 6)
+    return shares
+
+
+def write_grass_csv(grass_csv, labels, rng):
+    """Write a grass table with one grass type per label, in the format of
+    the sample grass table.  Initial biomass is taken from CENTURY, and the
+    proportion of total biomass of each grass type is drawn at random."""
+    n_grass = len(labels)
+    cp_green = rng.uniform(0.08, 0.16, n_grass)
+    grass_df = pandas.DataFrame({
+        'label': labels,
+        'index': range(n_grass),
+        'type': [['C4', 'C3'][i] for i in rng.binomial(1, 0.2, n_grass)],
+        'percent_biomass': _shares(n_grass, rng),
+        'DMD_green': 0,
+        'DMD_dead': 0,
+        'cprotein_green': cp_green,
+        'cprotein_dead': cp_green * 0.1,
+        'green_gm2': 0,
+        'dead_gm2': 0,
+        'prev_g_gm2': 0,
+        'prev_d_gm2': 0,
+        'N_multiplier': rng.uniform(1.5, 2.5, n_grass),
+        'n_mult': 1.0}, columns=GRASS_COLUMNS)
+    grass_df.to_csv(grass_csv, index=False, float_format='%.6f')
+
+
+def write_herbivore_csv(herbivore_csv, n_classes, rng,
+                        total_density=_STOCKING_DENSITY):
+    """Write a herbivore table of n_classes cohorts of B. indicus cattle, in
+    the format of the sample herbivore table.  Cohorts are of the sexes of
+    the sample herd, in the same proportions, and of ages from 3 months to
+    10 years; weight follows age.  total_density (animals per ha) is shared
+    among cohorts at random."""
+    structure = numpy.array([s[1] for s in _HERD_STRUCTURE])
+    sex_index = rng.choice(
+        len(_HERD_STRUCTURE), size=n_classes, p=structure / structure.sum())
+    # every sex is represented in herds of at least 4 cohorts
+    if n_classes >= len(_HERD_STRUCTURE):
+        sex_index[:len(_HERD_STRUCTURE)] = range(len(_HERD_STRUCTURE))
+    records = []
+    shares = _shares(n_classes, rng)
+    for c_index in xrange(n_classes):
+        sex, share, SRW = _HERD_STRUCTURE[sex_index[c_index]]
+        if sex in ['entire_m', 'breeding_female']:
+            age = rng.randint(730, 3650)
+        else:
+            age = rng.randint(90, 1095)
+        weight = 34.7 + (SRW - 34.7) * (1. - numpy.exp(-age / 600.)) * (
+            rng.uniform(0.6, 0.8))
+        record = {
+            'label': '%s_%d' % (sex, c_index),
+            'sex': sex,
+            'age': age,
+            'weight': round(weight, 1),
+            'stocking_density': total_density * shares[c_index],
+            'SRW': SRW,
+            'type': 'B_indicus',
+            'SFW': numpy.nan,
+            'birth_weight': 34.7,
+            'proportion_of_herd': shares[c_index],
+            'conception_step': numpy.nan,
+            'calving_interval': numpy.nan,
+            'lactation_duration': numpy.nan}
+        if sex == 'breeding_female':
+            record.update({
+                'conception_step': -rng.randint(0, 9),
+                'calving_interval': rng.randint(12, 19),
+                'lactation_duration': rng.randint(6, 11)})
+        records.append(record)
+    herd_df = pandas.DataFrame(records, columns=HERBIVORE_COLUMNS)
+    herd_df.to_csv(herbivore_csv, index_label='index')
+
+
+def write_supplement_csv(supp_csv, rng):
+    """Write a supplement table with one supplement, offered daily, in the
+    format of the sample supplement table."""
+    supp_df = pandas.DataFrame({
+        'digestibility': [rng.uniform(0.55, 0.75)],
+        'kg_per_day': [rng.uniform(0.2, 1.5)],
+        'M_per_d': [rng.uniform(7., 11.)],
+        'ether_extract': [rng.uniform(0.02, 0.05)],
+        'crude_protein': [rng.uniform(0.1, 0.25)],
+        'rumen_degradability': [rng.uniform(0.4, 0.7)]},
+        columns=SUPPLEMENT_COLUMNS)
+    supp_df.to_csv(supp_csv, index=False, float_format='%.4f')
+
+
+def write_workload(workspace_dir, num_months=12, n_grass=1, n_classes=4,
+                   seed=0, start_year=2011, start_month=1, weather=True,
+                   supplement=True, graz_prob=0.3, spin_up_years=20,
+                   history_years=3, century_dir=None):
+    """Write a complete set of inputs for a model run.
+
+    Inputs are written to 'inputs' in workspace_dir: the grass table
+    'grass.csv', herbivore table 'herd.csv', supplement table 'supp.csv',
+    and for each grass type, a schedule covering the run (<label>.sch) and a
+    spin-up schedule of spin_up_years years (<label>_hist.sch), with its own
+    site file and weather file.  As in the sample inputs, the schedule of
+    the run starts history_years before the run, and grazing is scheduled
+    only before the start of the run (see write_schedule).
+
+    Parameters:
+        workspace_dir (string): directory to write inputs to
+        num_months (int): number of months of the run
+        n_grass (int): number of grass types
+        n_classes (int): number of herbivore classes
+        seed (int): seed of random numbers
+        start_year (int): first year of the run
+        start_month (int): first month of the run
+        weather (boolean): read weather of the run from weather files?  If
+            false, mean climate of the site is used
+        supplement (boolean): offer supplement?
+        graz_prob (float): probability of a grazing event in each month of
+            the schedules (see write_schedule)
+        spin_up_years (int): length of the spin-up schedule
+        history_years (int): years of the schedule of the run before the
+            start of the run
+        century_dir (string): CENTURY directory of the run.  If not
+            supplied, a CENTURY directory for the stand-in of
+            forage_fake_century is written to 'century' in workspace_dir
+
+    Returns:
+        dictionary of model inputs for forage.execute, with outputs written
+            to 'outputs' in workspace_dir
+    """
+    rng = numpy.random.RandomState(seed)
+    input_dir = os.path.join(workspace_dir, 'inputs')
+    if not os.path.exists(input_dir):
+        os.makedirs(input_dir)
+    if century_dir is None:
+        century_dir = os.path.join(workspace_dir, 'century')
+        forage_fake_century.write_century_dir(century_dir)
+        with open(os.path.join(input_dir, FIX_FILE), 'w') as fix:
+            fix.write('Fixed parameters (not read by the stand-in)\n')
+    first_year = start_year - history_years
+    last_year = start_year + (start_month + num_months - 2) / 12
+
+    # grass types are numbered, as in the sample inputs
+    labels = [str(g_index) for g_index in xrange(n_grass)]
+    write_grass_csv(os.path.join(input_dir, 'grass.csv'), labels, rng)
+    for label in labels:
+        site_file = label + '.100'
+        climate = site_climate(rng)
+        write_site_file(os.path.join(input_dir, site_file), climate)
+        weather_file = None
+        if weather:
+            weather_file = label + '.wth'
+            write_weather_file(
+                os.path.join(input_dir, weather_file), first_year,
+                last_year, climate, rng)
+        write_schedule(
+            os.path.join(input_dir, label + '.sch'), first_year, last_year,
+            rng, site_file, weather_file, graz_prob,
+            graz_last_year=start_year - 1)
+        write_schedule(
+            os.path.join(input_dir, label + '_hist.sch'),
+            first_year - spin_up_years, first_year - 1, rng, site_file,
+            graz_prob=graz_prob, output_year=first_year - 1,
+            output_interval=12)
+    write_herbivore_csv(os.path.join(input_dir, 'herd.csv'), n_classes, rng)
+    args = {
+        'latitude': rng.uniform(-5., 5.),
+        'prop_legume': 0.,
+        'steepness': 1.,
+        'DOY': 1,
+        'start_year': start_year,
+        'start_month': start_month,
+        'num_months': num_months,
+        'mgmt_threshold': 0.1,
+        'input_dir': input_dir,
+        'century_dir': century_dir,
+        'outdir': os.path.join(workspace_dir, 'outputs'),
+        'template_level': 'GH',
+        'fix_file': FIX_FILE,
+        'user_define_protein': 0,
+        'user_define_digestibility': 0,
+        'herbivore_csv': os.path.join(input_dir, 'herd.csv'),
+        'grass_csv': os.path.join(input_dir, 'grass.csv'),
+        'diet_verbose': 0,
+    }
+    if supplement:
+        args['supp_csv'] = os.path.join(input_dir, 'supp.csv')
+        write_supplement_csv(args['supp_csv'], rng)
+    return args
@@ -22,6 +22,69 @@ class RangelandProductionTests(unittest.TestCase):
         """Clean up workspace by deleting it."""
         shutil.rmtree(self.workspace_dir)
 
+    def _trajectory_inputs(self, num_months=12, aglive1=1., stdede1=0.2):
+        """Inputs of the livestock model for the sample herd and grass, and
+        constant CENTURY outputs for grass type '0' from 2013 to 2015: 100
+        g/m2 live and 50 g/m2 standing dead biomass, with the given nitrogen
+        content.
+
+        Returns:
+            tuple (forage_args, century_outputs), as taken by
+                forage.execute_from_trajectories
+        """
+        import pandas
+
+        if not os.path.exists(SAMPLE_INPUT_DIR):
+            self.fail(
+                "Sample input directory not found at %s" % SAMPLE_INPUT_DIR)
+        time_list = [
+            round(year + month / 12., 2) for year in xrange(2013, 2016)
+            for month in xrange(12)]
+        century_outputs = {'0': pandas.DataFrame({
+            'time': time_list,
+            'aglivc': [100.] * len(time_list),
+            'stdedc': [50.] * len(time_list),
+            'aglive1': [aglive1] * len(time_list),
+            'stdede1': [stdede1] * len(time_list)}).set_index('time')}
+        forage_args = {
+            'prop_legume': 0.0,
+            'steepness': 1.,
+            'DOY': 1,
+            'start_year': 2014,
+            'start_month': 1,
+            'num_months': num_months,
+            'mgmt_threshold': 300,
+            'user_define_protein': 0,
+            'user_define_digestibility': 0,
+            'herbivore_csv': os.path.join(SAMPLE_INPUT_DIR,
+                                          "Ol_pej_herd.csv"),
+            'grass_csv': os.path.join(SAMPLE_INPUT_DIR, "0.csv"),
+            'latitude': 0.13167,
+        }
+        return forage_args, century_outputs
+
+    def _fake_century_workload(self, workspace_dir=None, num_months=3,
+                               seed=0):
+        """Write synthetic inputs of a short run with one grass type and two
+        herbivore classes (see forage_workload.write_workload), and run the
+        stand-in for CENTURY of forage_fake_century in place of CENTURY
+        until the end of the test.
+
+        Returns:
+            dictionary of model inputs for forage.execute
+        """
+        import forage_fake_century
+        import forage_workload
+
+        if workspace_dir is None:
+            workspace_dir = self.workspace_dir
+        args = forage_workload.write_workload(
+            workspace_dir, num_months=num_months, n_grass=1, n_classes=2,
+            seed=seed, spin_up_years=5)
+        forage_fake_century.install()
+        self.addCleanup(forage_fake_century.uninstall)
+        return args
+
     def test_base_regression(self):
         """Rangeland production Forage Example Regression test."""
         if not os.path.exists(CENTURY_DIR):
@@ -57,7 +120,9 @@ class RangelandProductionTests(unittest.TestCase):
             'outdir': self.workspace_dir,
         }
 
-        forage.execute(forage_args)
+        results = forage.execute(forage_args)
+        self.assertAlmostEqual(
+            results['summary_results']['total_offtake'][12], 315.5265641)
         with open(
                 os.path.join(self.workspace_dir, 'summary_results.csv'),
                 'rb') as summary_results_file:
@@ -72,3 +137,1222 @@ class RangelandProductionTests(unittest.TestCase):
                 float(result['total_offtake']), 315.5265641)
             self.assertAlmostEqual(
                 float(result['cattle_gain_kg']), 3.805385098)
+
+    def test_reduce_demand_matrix(self):
+        """Rangeland production: ration demand among herbivore classes."""
+        import numpy
+        import forage_utils
+
+        # two herbivore classes eating two forage types; demand for the first
+        # forage type exceeds what is available
+        intake = numpy.array([[2., 1.], [1., 1.]])
+        sd = numpy.array([1., 0.5])
+        biomass_avail = numpy.array([25., 1000.])
+        rationed = forage_utils.reduce_demand_matrix(
+            intake, sd, biomass_avail, days_per_step=10.)
+        numpy.testing.assert_allclose(
+            numpy.dot(sd, rationed[:, 0]) * 10., 25.)
+        numpy.testing.assert_allclose(rationed[:, 1], intake[:, 1])
+
+        If, DMDf, CPIf = forage_utils.aggregate_diet_matrix(
+            rationed, numpy.array([0.6, 0.4]), numpy.array([0.1, 0.05]))
+        numpy.testing.assert_allclose(If, rationed.sum(axis=1))
+        numpy.testing.assert_allclose(
+            DMDf, (rationed[:, 0] * 0.6 + rationed[:, 1] * 0.4) / If)
+
+        perc_removed = forage_utils.calc_percent_consumed_matrix(
+            rationed, sd, numpy.array([50., 0.]), days_per_step=10.)
+        numpy.testing.assert_allclose(perc_removed, [0.5, 0.])
+
+    def test_execute_from_trajectories(self):
+        """Rangeland production: livestock model on stored CENTURY outputs."""
+        import pandas
+        import forage
+
+        forage_args, century_outputs = self._trajectory_inputs()
+        summary_df, removal_df = forage.execute_from_trajectories(
+            forage_args, century_outputs)
+        self.assertEqual(summary_df.shape[0], 13)
+        self.assertTrue(pandas.isnull(summary_df['total_offtake'].iloc[0]))
+        self.assertEqual(removal_df.shape[0], 12)
+        self.assertTrue((removal_df['0_flgrem'] > 0).all())
+        self.assertTrue((removal_df['0_flgrem'] < 1).all())
+
+    def test_livestock_substeps(self):
+        """Rangeland production: weekly and daily livestock sub-steps agree
+        with monthly steps on constant forage."""
+        import numpy
+        import forage
+        import forage_utils
+
+        forage_args, century_outputs = self._trajectory_inputs(num_months=6)
+        # forage grows through the period, so that diets are selected again
+        # within months of sub-steps
+        for step, time in enumerate(century_outputs['0'].index):
+            century_outputs['0'].loc[time, 'aglivc'] = 100. + 10. * step
+        summary = {}
+        for livestock_step in ['month', 'week', 'day']:
+            step_args = dict(forage_args)
+            step_args['livestock_step'] = livestock_step
+            summary[livestock_step], _ = forage.execute_from_trajectories(
+                step_args, century_outputs)
+        columns = [
+            column for column in summary['month'].columns if
+            column.endswith('_MEItotal') or column.endswith('_indiv_kg')]
+        columns.append('total_offtake')
+        for livestock_step in ['week', 'day']:
+            self.assertEqual(
+                list(summary[livestock_step].columns),
+                list(summary['month'].columns))
+            for column in columns:
+                numpy.testing.assert_allclose(
+                    summary[livestock_step][column].values[1:],
+                    summary['month'][column].values[1:], rtol=0.02)
+
+        self.assertEqual(forage_utils.find_substeps_per_month('week'), 4)
+        self.assertEqual(forage_utils.find_substeps_per_month('day'), 30)
+        for livestock_step in ['year', 'fortnight']:
+            with self.assertRaises(Exception):
+                forage_utils.find_substeps_per_month(livestock_step)
+
+    def test_management_optimizer(self):
+        """Rangeland production: search stocking density and grazing
+        calendar against stored CENTURY outputs."""
+        import forage_optimizer
+
+        forage_args, century_outputs = self._trajectory_inputs(num_months=6)
+        # residual biomass limits stocking density; forage of the sample is
+        # too poor for any sufficiency target above 0
+        optimizer = forage_optimizer.ManagementOptimizer(
+            forage_args, sufficiency_target=0., residual_target=1000.,
+            century_outputs=century_outputs, n_workers=2)
+        try:
+            density, metrics = optimizer.maximize_density(tolerance=1e-3)
+            self.assertTrue(optimizer.is_feasible(metrics))
+            self.assertGreaterEqual(metrics['min_residual'], 1000.)
+            # candidates grazing more animals in the same months as an
+            # infeasible candidate are not run
+            n_evaluated = optimizer.n_evaluated
+            n_pruned = optimizer.n_pruned
+            self.assertEqual(
+                optimizer.evaluate([(density * 10., None)]), [None])
+            self.assertEqual(optimizer.n_evaluated, n_evaluated)
+            self.assertEqual(optimizer.n_pruned, n_pruned + 1)
+            optimizer.cache.clear()
+            above = optimizer.evaluate([(density + 2e-3, None)])[0]
+            self.assertFalse(optimizer.is_feasible(above))
+
+            # grazing in more months removes more forage
+            months_of_year, calendar_metrics = optimizer.search_calendars(
+                density, calendars=[[1, 2], [1, 2, 3, 4, 5, 6], [3]])
+            self.assertEqual(months_of_year, [1, 2, 3, 4, 5, 6])
+            self.assertAlmostEqual(
+                calendar_metrics['total_offtake'], metrics['total_offtake'])
+
+            # without grazing, every density is feasible: the search stops
+            # at max_density
+            density, metrics = optimizer.maximize_density(
+                grz_months=[], max_density=50.)
+            self.assertEqual(density, 50.)
+            self.assertEqual(metrics['total_offtake'], 0.)
+        finally:
+            optimizer.close()
+
+    def test_herbivore_cohorts(self):
+        """Rangeland production: cohort arrays match HerbivoreClass."""
+        if not os.path.exists(SAMPLE_INPUT_DIR):
+            self.fail(
+                "Sample input directory not found at %s" % SAMPLE_INPUT_DIR)
+
+        import pandas
+        import forage_utils
+
+        herbivore_input = pandas.read_csv(
+            os.path.join(SAMPLE_INPUT_DIR, "Ol_pej_herd.csv")).to_dict(
+                orient='records')
+        cohorts = forage_utils.HerbivoreCohorts(herbivore_input)
+        herbivore_list = [
+            forage_utils.HerbivoreClass(herb_class) for herb_class in
+            herbivore_input]
+        for step in xrange(24):
+            cohorts.update(step)
+            max_intake = cohorts.calc_max_intake()
+            for index, herb_class in enumerate(herbivore_list):
+                herb_class.update(step)
+                self.assertAlmostEqual(cohorts.W[index], herb_class.W)
+                self.assertAlmostEqual(
+                    max_intake[index], herb_class.calc_max_intake())
+
+        # parameter overrides read from the herbivore table, as json or an
+        # empty cell
+        herd_df = pandas.DataFrame(herbivore_input)
+        herd_df['FParam_overrides'] = [None] * len(herd_df)
+        herd_df.loc[0, 'FParam_overrides'] = '{"CI1": 0.03}'
+        herd_csv = os.path.join(self.workspace_dir, 'herd_overrides.csv')
+        herd_df.to_csv(herd_csv, index=False)
+        cohorts = forage_utils.HerbivoreCohorts.from_csv(herd_csv)
+        read_input = forage_utils.read_herbivore_csv(herd_csv)
+        self.assertEqual(read_input[0]['FParam_overrides'], {'CI1': 0.03})
+        self.assertIsNone(read_input[1]['FParam_overrides'])
+        for index, herb_class in enumerate(read_input):
+            self.assertAlmostEqual(
+                cohorts.param['CI1'][index],
+                forage_utils.HerbivoreClass(herb_class).FParam.CI1)
+        self.assertEqual(cohorts.param['CI1'][0], 0.03)
+        herd_df.loc[0, 'FParam_overrides'] = '{"CI_1": 0.03}'
+        herd_df.to_csv(herd_csv, index=False)
+        with self.assertRaisesRegexp(Exception, 'unknown parameter CI_1'):
+            forage_utils.HerbivoreCohorts.from_csv(herd_csv)
+
+    def test_weather_ensemble(self):
+        """Rangeland production: ensemble weather and streaming quantiles."""
+        if not os.path.exists(SAMPLE_INPUT_DIR):
+            self.fail(
+                "Sample input directory not found at %s" % SAMPLE_INPUT_DIR)
+
+        import numpy
+        import forage_century_link_utils as cent
+        import forage_ensemble
+
+        wth_files = forage_ensemble.generate_weather_ensemble(
+            os.path.join(SAMPLE_INPUT_DIR, '0.wth'), 3, self.workspace_dir,
+            2011, 2016, method='perturb', seed=1)
+        member_df = cent.read_weather_file(wth_files[0])
+        self.assertEqual(sorted(set(member_df['year'])), range(2011, 2017))
+        self.assertTrue((member_df[range(1, 13)] >= 0).all().all())
+
+        schedule = os.path.join(self.workspace_dir, '0.sch')
+        shutil.copyfile(os.path.join(SAMPLE_INPUT_DIR, '0.sch'), schedule)
+        cent.set_schedule_weather_file(schedule, '0_0.wth')
+        site_file, weather_file = cent.get_site_weather_files(
+            schedule, self.workspace_dir)
+        self.assertEqual(weather_file, wth_files[0])
+
+        rng = numpy.random.RandomState(0)
+        stats = forage_ensemble.StreamingQuantiles((2,), [0.1, 0.5, 0.9])
+        samples = rng.normal(size=(2000, 2)) + numpy.array([0., 10.])
+        for row in samples:
+            stats.add(row)
+        numpy.testing.assert_allclose(
+            stats.quantiles(),
+            numpy.percentile(samples, [10, 50, 90], axis=0).T, atol=0.1)
+        numpy.testing.assert_allclose(stats.mean(), samples.mean(axis=0))
+
+    def test_run_weather_ensemble(self):
+        """Rangeland production: coupled runs of a weather ensemble."""
+        import numpy
+        import pandas
+        import forage_ensemble
+
+        args = self._fake_century_workload(num_months=2)
+        ensemble_df = forage_ensemble.run_weather_ensemble(
+            args, 3, method='perturb', percentiles=(50,), n_workers=2,
+            workspace_dir=os.path.join(self.workspace_dir, 'ensemble'))
+        self.assertEqual(list(ensemble_df['step']), [-1, 0, 1])
+        offtake = ensemble_df[['total_offtake_mean', 'total_offtake_p50']]
+        self.assertTrue(numpy.isfinite(offtake.values[1:]).all())
+        self.assertTrue((offtake.values[1:] > 0).all())
+        saved_df = pandas.read_csv(
+            os.path.join(args['outdir'], 'ensemble_summary.csv'))
+        self.assertEqual(list(saved_df.columns), list(ensemble_df.columns))
+
+        # failures of members are counted and reported
+        failing_args = dict(args)
+        failing_args['herbivore_csv'] = os.path.join(
+            self.workspace_dir, 'missing.csv')
+        with self.assertRaisesRegexp(
+                Exception, '3 of 3 ensemble members failed'):
+            forage_ensemble.run_weather_ensemble(
+                failing_args, 3, n_workers=2)
+
+    def test_sensitivity_indices(self):
+        """Rangeland production: sensitivity indices of a known function."""
+        if not os.path.exists(SAMPLE_INPUT_DIR):
+            self.fail(
+                "Sample input directory not found at %s" % SAMPLE_INPUT_DIR)
+
+        import numpy
+        import pandas
+        import forage_sensitivity
+
+        # f = x0 + 2 * x1: first-order indices 0.2 and 0.8, no interaction
+        samples = forage_sensitivity.sobol_sample(2, 4000, seed=1)
+        outputs = (samples[:, 0] + 2. * samples[:, 1])[:, numpy.newaxis]
+        S1, ST = forage_sensitivity.sobol_indices(outputs, 2)
+        numpy.testing.assert_allclose(S1[0], [0.2, 0.8], atol=0.05)
+        numpy.testing.assert_allclose(ST[0], [0.2, 0.8], atol=0.05)
+
+        samples, order, delta = forage_sensitivity.morris_sample(2, 5)
+        outputs = (samples[:, 0] + 2. * samples[:, 1])[:, numpy.newaxis]
+        mu, mu_star, sigma = forage_sensitivity.morris_indices(
+            outputs, order, delta)
+        numpy.testing.assert_allclose(mu_star[0], [1., 2.])
+
+        herbivore_input = pandas.read_csv(
+            os.path.join(SAMPLE_INPUT_DIR, "Ol_pej_herd.csv")).to_dict(
+                orient='records')
+        factors = forage_sensitivity.parse_factors(
+            [('CM2', 0.3, 0.4), ('CI1', 0.02, 0.03),
+             ('breeding_cow:weight', 300., 500.)])
+        sample_input = forage_sensitivity.apply_sample(
+            herbivore_input, factors, numpy.array([0.5, 0., 1.]))
+        for herb_class in sample_input:
+            self.assertAlmostEqual(herb_class['CM2'], 0.35)
+            self.assertEqual(herb_class['FParam_overrides'], {'CI1': 0.02})
+            if herb_class['label'] == 'breeding_cow':
+                self.assertEqual(herb_class['weight'], 500.)
+            else:
+                self.assertNotEqual(herb_class['weight'], 500.)
+        # overrides as read from a herbivore table are kept
+        herbivore_input[0]['FParam_overrides'] = '{"CM12": 0.5}'
+        herbivore_input[1]['FParam_overrides'] = float('nan')
+        sample_input = forage_sensitivity.apply_sample(
+            herbivore_input, factors, numpy.array([0.5, 0., 1.]))
+        self.assertEqual(
+            sample_input[0]['FParam_overrides'], {'CM12': 0.5, 'CI1': 0.02})
+        self.assertEqual(sample_input[1]['FParam_overrides'], {'CI1': 0.02})
+        typo = forage_sensitivity.parse_factors([('CI1_', 0.02, 0.03)])
+        self.assertRaises(
+            ValueError, forage_sensitivity.apply_sample, herbivore_input,
+            typo, numpy.array([0.5]))
+
+        # cached results are not reused for other CENTURY outputs
+        forage_args, century_outputs = self._trajectory_inputs()
+        keys = []
+        for aglive1 in [1., 2.]:
+            century_outputs['0']['aglive1'] = aglive1
+            analysis = forage_sensitivity.SensitivityAnalysis(
+                forage_args, [('CI1', 0.02, 0.03)], century_outputs)
+            keys.append(analysis._cache_key('sobol', samples))
+        self.assertNotEqual(keys[0], keys[1])
+
+    def test_calibration(self):
+        """Rangeland production: recover a parameter from model outputs."""
+        import pandas
+        import forage
+        import forage_calibration
+
+        forage_args, century_outputs = self._trajectory_inputs(num_months=6)
+        # observations simulated with CI1 = 0.028
+        herbivore_input = pandas.read_csv(
+            forage_args['herbivore_csv']).to_dict(orient='records')
+        true_args = dict(forage_args)
+        true_args['herbivore_inputs'] = [
+            dict(herb_class, FParam_overrides={'CI1': 0.028}) for
+            herb_class in herbivore_input]
+        summary_df, _ = forage.execute_from_trajectories(
+            true_args, century_outputs)
+        obs_list = []
+        for herb_class in herbivore_input:
+            column = herb_class['label'] + '_intake_forage_per_indiv_kg'
+            for step in xrange(6):
+                obs_list.append({
+                    'step': step, 'label': herb_class['label'],
+                    'variable': 'intake_forage_per_indiv_kg',
+                    'value': summary_df[column].iloc[step + 1]})
+        calibration = forage_calibration.Calibration(
+            forage_args, pandas.DataFrame(obs_list), century_outputs,
+            parameters=[('CI1', 0.015, 0.035)], n_workers=2)
+        result = calibration.fit(max_evaluations=100, outdir=self.workspace_dir)
+        self.assertAlmostEqual(result['parameters']['CI1'], 0.028, places=4)
+
+        # cached evaluations are not reused on different CENTURY outputs
+        _, other_outputs = self._trajectory_inputs(num_months=6, aglive1=2.)
+        other_calibration = forage_calibration.Calibration(
+            forage_args, pandas.DataFrame(obs_list), other_outputs,
+            parameters=[('CI1', 0.015, 0.035)], n_workers=1)
+        self.assertNotEqual(
+            other_calibration._signature, calibration._signature)
+
+        calibrated_args = dict(forage_args)
+        calibrated_args['herbivore_csv'] = os.path.join(
+            self.workspace_dir, 'herbivore_calibrated.csv')
+        for herb_class in forage._read_herbivores(calibrated_args):
+            self.assertAlmostEqual(herb_class.FParam.CI1, 0.028, places=4)
+
+        # the calibrated herbivore table can be calibrated again
+        recalibration = forage_calibration.Calibration(
+            calibrated_args, pandas.DataFrame(obs_list), century_outputs,
+            parameters=[('CM2', 0.3, 0.4), ('CI1', 0.015, 0.035)],
+            n_workers=2)
+        for herb_class in recalibration.herbivore_input:
+            self.assertAlmostEqual(
+                herb_class['FParam_overrides']['CI1'], 0.028, places=4)
+        result = recalibration.fit(
+            max_evaluations=100,
+            outdir=os.path.join(self.workspace_dir, 'recalibrated'))
+        self.assertAlmostEqual(result['parameters']['CI1'], 0.028, places=3)
+
+    def test_split_schedule(self):
+        """Rangeland production: split a schedule and edit grazing history."""
+        if not os.path.exists(SAMPLE_INPUT_DIR):
+            self.fail(
+                "Sample input directory not found at %s" % SAMPLE_INPUT_DIR)
+
+        import forage_century_link_utils as cent
+        import forage_history
+
+        schedule = os.path.join(SAMPLE_INPUT_DIR, '0.sch')
+        header, blocks = cent.read_schedule_blocks(schedule)
+        pre_blocks, post_blocks = cent.split_schedule_blocks(blocks, 2014)
+        pre_schedule = os.path.join(self.workspace_dir, 'pre.sch')
+        post_schedule = os.path.join(self.workspace_dir, 'post.sch')
+        cent.write_schedule_blocks(header, pre_blocks, pre_schedule)
+        cent.write_schedule_blocks(header, post_blocks, post_schedule)
+        pre_df = cent.read_block_schedule(pre_schedule)
+        post_df = cent.read_block_schedule(post_schedule)
+        self.assertEqual(pre_df['block_end_year'].tolist(), [2013])
+        self.assertEqual(post_df['block_start_year'].tolist(), [2014])
+        self.assertEqual(post_df['block_rpt_year'].tolist(), [3])
+        orig_events = cent.read_events(schedule)
+        post_events = cent.read_events(post_schedule)
+        self.assertEqual(
+            len(orig_events), len(cent.read_events(pre_schedule)) +
+            len(post_events))
+
+        # window of 12 months ending May 2015, which has no grazing
+        first_month, first_year, emp_month, emp_year = (
+            forage_history.find_window(2015.42, 12))
+        self.assertEqual((first_month, first_year), (6, 2014))
+        window = forage_history.window_months(
+            first_month, first_year, emp_month, emp_year, 2014)
+        block, n_available = forage_history.edit_window(
+            post_blocks[0], window, 'GNEW', 2)
+        self.assertEqual(n_available, 12)
+        cent.write_schedule_blocks(header, [block], post_schedule)
+        graz_df = cent.read_graz_level(post_schedule)
+        self.assertEqual(
+            graz_df[['relative_year', 'month']].values.tolist(),
+            [[2, 4], [2, 5]])
+        self.assertEqual(set(graz_df['grazing_level']), set(['GNEW']))
+
+    def test_grazing_history_calibration(self):
+        """Rangeland production: calibrate grazing before a measurement."""
+        import pandas
+        import forage_century_link_utils as cent
+        import forage_history
+
+        args = self._fake_century_workload()
+
+        def calibration(empirical_biomass):
+            return forage_history.GrazingHistoryCalibration(
+                '0', args['century_dir'], args['input_dir'],
+                args['fix_file'], 2010.50, empirical_biomass, n_months=6,
+                template_level='GH', n_workers=3,
+                workspace_dir=os.path.join(
+                    self.workspace_dir, 'history_%d' % empirical_biomass))
+
+        # biomass falls with grazing intensity and with events added
+        probe = calibration(0.)
+        biomass = probe.evaluate(
+            [(0, 0.), (0, forage_history._MAX_FLGREM),
+             (3, forage_history._MAX_FLGREM)])
+        probe.close()
+        self.assertGreater(biomass[0], biomass[1])
+        self.assertGreater(biomass[1], biomass[2])
+
+        # the measurement lies within the range of grazing intensities
+        target = 0.5 * (biomass[0] + biomass[1])
+        result = calibration(target).calibrate()
+        self.assertTrue(result['converged'])
+        self.assertEqual(result['n_added'], 0)
+        self.assertLess(abs(result['error']), 0.05 * target)
+
+        # heaviest grazing in scheduled events leaves too much biomass, so
+        # events are added; each candidate is recorded once
+        target = biomass[2] * 1.02
+        outdir = os.path.join(self.workspace_dir, 'history_outputs')
+        added = calibration(target)
+        result = added.calibrate(outdir=outdir)
+        self.assertTrue(result['converged'])
+        self.assertEqual(result['n_added'], 3)
+        history_df = pandas.read_csv(
+            os.path.join(outdir, 'calibration_history.csv'))
+        self.assertEqual(len(history_df), 9)
+        self.assertEqual(
+            sorted(history_df.loc[history_df['n_added'] > 0, 'n_added']),
+            [1, 2, 3, 3, 3, 3])
+        # the window, January to June 2010, had one scheduled event and
+        # starts the last block of the calibrated schedule
+        graz_df = cent.read_graz_level(
+            os.path.join(outdir, '0_calibrated.sch'))
+        window_df = graz_df[
+            (graz_df['block_end_year'] == 2011) &
+            (graz_df['relative_year'] == 1) & (graz_df['month'] <= 6)]
+        self.assertEqual(len(window_df), 4)
+        self.assertEqual(len(set(window_df['grazing_level'])), 1)
+        self.assertNotIn(
+            window_df['grazing_level'].iloc[0], ['GH', 'GL', 'GLP'])
+
+    def test_century_run_cache(self):
+        """Rangeland production: key and reuse cached CENTURY runs."""
+        if not os.path.exists(SAMPLE_INPUT_DIR):
+            self.fail(
+                "Sample input directory not found at %s" % SAMPLE_INPUT_DIR)
+
+        import forage_century_link_utils as cent
+
+        century_dir = os.path.join(self.workspace_dir, 'century')
+        os.makedirs(century_dir)
+        for file_name in ['0.sch', '0.wth', '0.100', 'drytrpfi.100']:
+            shutil.copyfile(
+                os.path.join(SAMPLE_INPUT_DIR, file_name),
+                os.path.join(century_dir, file_name))
+        graz_file = os.path.join(century_dir, 'graz.100')
+        level = ("%.5f           'FLGREM'\n%.5f           'FDGREM'\n"
+                 "0.00000           'GRZEFF'\n")
+        with open(graz_file, 'w') as new_file:
+            new_file.write('GLP   (orig)\n' + level % (0.1, 0.01))
+            new_file.write('GX1   (new)\n' + level % (0.1, 0.01))
+            new_file.write('GX2   (new)\n' + level % (0.2, 0.01))
+        cent.write_century_bat(
+            century_dir, '0.bat', '0', '0', 'drytrpfi.100', 'outvars.txt')
+        bat_file = os.path.join(century_dir, '0.bat')
+        schedule = os.path.join(century_dir, '0.sch')
+        site_file = os.path.join(century_dir, '0.100')
+        os.utime(site_file, (1000000000, 1000000000))
+        with open(schedule, 'rb') as read_file:
+            sch_text = read_file.read()
+
+        cache = cent.CenturyRunCache(
+            os.path.join(self.workspace_dir, 'cache'), max_entries=1)
+        key = cache.key(bat_file, century_dir)
+        # renaming a grazing level with the same parameters keeps the key
+        with open(schedule, 'wb') as new_file:
+            new_file.write(sch_text.replace('GLP', 'GX1'))
+        self.assertEqual(cache.key(bat_file, century_dir), key)
+        with open(schedule, 'wb') as new_file:
+            new_file.write(sch_text.replace('GLP', 'GX2'))
+        other_key = cache.key(bat_file, century_dir)
+        self.assertNotEqual(other_key, key)
+        # a site file rewritten at the same size and modification time
+        # changes the key
+        with open(site_file, 'rb') as read_file:
+            site_text = read_file.read()
+        with open(site_file, 'wb') as new_file:
+            new_file.write(site_text[::-1])
+        os.utime(site_file, (1000000000, 1000000000))
+        self.assertNotEqual(cache.key(bat_file, century_dir), other_key)
+        with open(site_file, 'wb') as new_file:
+            new_file.write(site_text)
+        self.assertEqual(cache.key(bat_file, century_dir), other_key)
+
+        self.assertFalse(cache.fetch(key, century_dir, '0'))
+        with open(os.path.join(century_dir, '0.lis'), 'w') as new_file:
+            new_file.write('outputs\n')
+        cache.store(key, century_dir, '0')
+        os.remove(os.path.join(century_dir, '0.lis'))
+        self.assertTrue(cache.fetch(key, century_dir, '0'))
+        with open(os.path.join(century_dir, '0.lis'), 'r') as read_file:
+            self.assertEqual(read_file.read(), 'outputs\n')
+        # the least recently used run is discarded
+        cache.store(other_key, century_dir, '0')
+        self.assertFalse(cache.fetch(key, century_dir, '0'))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        self.assertEqual(
+            cent.CenturyRunCache(self.workspace_dir, quantum=0.05)
+            .quantize_removal({'0;green': 0.12, '0;dead': 0.01}),
+            {'0;green': 0.1, '0;dead': 0.})
+
+    def test_growth_surrogate(self):
+        """Rangeland production: fit and apply a surrogate of CENTURY."""
+        if not os.path.exists(SAMPLE_INPUT_DIR):
+            self.fail(
+                "Sample input directory not found at %s" % SAMPLE_INPUT_DIR)
+
+        import numpy
+        import pandas
+        import forage_surrogate
+
+        graz_file = os.path.join(self.workspace_dir, 'graz.100')
+        with open(graz_file, 'w') as new_file:
+            new_file.write(
+                "GLP   (orig)\n0.10000           'FLGREM'\n"
+                "0.01000           'FDGREM'\n")
+        removal = forage_surrogate.read_removal(
+            os.path.join(SAMPLE_INPUT_DIR, '0.sch'), graz_file)
+        self.assertEqual(removal[(2011, 4)], (0.1, 0.01))
+        self.assertNotIn((2014, 4), removal)
+        weather = forage_surrogate.read_monthly_weather(
+            os.path.join(SAMPLE_INPUT_DIR, '0.sch'), SAMPLE_INPUT_DIR)
+        self.assertAlmostEqual(
+            forage_surrogate.monthly_weather(weather, 2012, 4)[0], 22.32)
+
+        # live biomass grows with rainfall and is reduced by grazing
+        rng = numpy.random.RandomState(0)
+        n_months = 200
+        data = pandas.DataFrame({
+            'year': 2000, 'month': rng.randint(1, 13, n_months),
+            'aglivc': rng.uniform(50, 300, n_months),
+            'stdedc': rng.uniform(50, 300, n_months),
+            'prec': rng.uniform(0, 20, n_months),
+            'tmin': 10., 'tmax': 25.,
+            'flgrem': rng.uniform(0, 0.3, n_months), 'fdgrem': 0.})
+        data['aglive1'] = 0.1 * data['aglivc']
+        data['stdede1'] = 0.05 * data['stdedc']
+        data['next_aglivc'] = (
+            0.9 * data['aglivc'] + 5 * data['prec'] -
+            data['flgrem'] * data['aglivc'])
+        data['next_stdedc'] = 0.95 * data['stdedc'] + 0.05 * data['aglivc']
+        data['next_aglive1'] = 0.1 * data['next_aglivc']
+        data['next_stdede1'] = 0.05 * data['next_stdedc']
+        surrogate, report = forage_surrogate.fit_surrogate(
+            data, alpha=1e-6, seed=0, outdir=self.workspace_dir)
+        self.assertTrue((report['r2'] > 0.99).all())
+        loaded = forage_surrogate.GrowthSurrogate.load(
+            os.path.join(self.workspace_dir, 'surrogate.npz'))
+        predicted = loaded.step(
+            {'aglivc': 200., 'stdedc': 100., 'aglive1': 20., 'stdede1': 5.},
+            [10., 10., 25.], 0.1, 0., 6)
+        self.assertAlmostEqual(predicted['aglivc'], 210., delta=1.)
+        self.assertAlmostEqual(predicted['stdedc'], 105., delta=1.)
+
+    def test_diet_table(self):
+        """Rangeland production: interpolate diets from a diet table."""
+        import numpy
+        import forage
+        import forage_diet_table
+
+        # live biomass with more protein than dead, inside the grid
+        forage_args, century_outputs = self._trajectory_inputs(
+            aglive1=8., stdede1=1.)
+        grid = {
+            'biomass': [100., 1000., 2000., 4000.],
+            'crude_protein': [0.02, 0.05, 0.1, 0.2]}
+        save_as = os.path.join(self.workspace_dir, 'diet_table.npz')
+        forage.tabulate_diets(forage_args, grid, save_as)
+        table = forage_diet_table.DietTable.load(save_as)
+
+        summary_df, removal_df = forage.execute_from_trajectories(
+            forage_args, century_outputs)
+        forage_args['diet_table'] = table
+        table_summary_df, table_removal_df = forage.execute_from_trajectories(
+            forage_args, century_outputs)
+        self.assertEqual(table.n_fallbacks, 0)
+        self.assertGreater(table.n_lookups, 0)
+        numpy.testing.assert_allclose(
+            table_summary_df['total_offtake'].values[1:],
+            summary_df['total_offtake'].values[1:], rtol=0.05)
+        numpy.testing.assert_allclose(
+            table_removal_df['0_flgrem'], removal_df['0_flgrem'], rtol=0.05)
+
+        # between grid points, and outside the grid
+        responses = table.interpolate_points(
+            'steer', 0, [[1500., 0.08, 500., 0.02], [5000., 0.08, 500., 0.02]])
+        self.assertTrue(numpy.isfinite(responses[0]).all())
+        self.assertTrue(numpy.isnan(responses[1]).all())
+
+        forage_args['prop_legume'] = 0.5
+        with self.assertRaises(Exception):
+            forage.execute_from_trajectories(
+                forage_args, century_outputs)
+
+    def test_tier1(self):
+        """Rangeland production: vectorized tier 1 model."""
+        import numpy
+        import forage_utils
+        import forage_tier1
+
+        n_steps = 6
+        inputs = {
+            'weight': numpy.array([200., 350., 420., 300., 150.]),
+            'mature_weight': numpy.array([450., 450., 500., 400., 300.]),
+            'forage_quality': numpy.array(
+                ['low', 'moderate', 'high', 'moderate', 'low']),
+            'herd_size': numpy.array([10., 20., 5., 0., 50.]),
+            'standing_biomass': numpy.array([1e5, 1e5, 1e5, 1e5, 500.]),
+        }
+        outputs = forage_tier1.run_tier1(inputs, n_steps, chunk_size=2)
+
+        # pixels with enough forage match the scalar tier 1 equations, at
+        # the time step passed to them
+        for time_step in ['month', 'week']:
+            step_outputs = outputs
+            if time_step != 'month':
+                step_outputs = forage_tier1.run_tier1(
+                    inputs, n_steps, time_step=time_step)
+            for pixel in xrange(3):
+                herd = forage_utils.HerdT1(
+                    inputs['weight'][pixel], inputs['mature_weight'][pixel],
+                    time_step)
+                MJ_per_kg_DM = forage_utils.calc_energy_t1(
+                    inputs['forage_quality'][pixel])
+                for step in xrange(n_steps):
+                    DMI = forage_utils.calc_DMI_t1(
+                        MJ_per_kg_DM, herd.average_weight_kg, time_step)
+                    herd.average_weight_kg += herd.e_allocate(
+                        DMI * MJ_per_kg_DM, herd.e_maintenance(), 'moderate')
+                    self.assertAlmostEqual(
+                        step_outputs['weight'][step, pixel],
+                        herd.average_weight_kg,
+                        delta=1e-4 * herd.average_weight_kg)
+
+        # no animals, no offtake; offtake limited by standing biomass
+        self.assertTrue((outputs['offtake'][:, 3] == 0).all())
+        self.assertTrue((outputs['standing_biomass'] >= 0).all())
+        self.assertAlmostEqual(outputs['offtake'][:, 4].sum(), 500., 3)
+
+        # memory-mapped inputs and outputs give the same results
+        input_dir = os.path.join(self.workspace_dir, 'tier1_inputs')
+        os.makedirs(input_dir)
+        inputs['forage_quality'] = forage_tier1.energy_content(
+            numpy.tile(inputs['forage_quality'], (n_steps, 1)))
+        for name, values in inputs.items():
+            numpy.save(os.path.join(input_dir, '%s.npy' % name), values)
+        mapped = forage_tier1.run_tier1(
+            forage_tier1.load_inputs(input_dir), n_steps, chunk_size=3,
+            out_dir=os.path.join(self.workspace_dir, 'tier1_outputs'))
+        for name in forage_tier1.OUTPUTS:
+            numpy.testing.assert_allclose(mapped[name], outputs[name])
+
+    def test_linked_workspace(self):
+        """Rangeland production: workspaces with hard-linked files."""
+        import forage_century_link_utils as cent
+
+        century_dir = os.path.join(self.workspace_dir, 'century_src')
+        input_dir = os.path.join(self.workspace_dir, 'input_src')
+        os.makedirs(os.path.join(century_dir, 'sub'))
+        os.makedirs(input_dir)
+        for path in [os.path.join(century_dir, 'century_46.exe'),
+                     os.path.join(century_dir, 'graz.100'),
+                     os.path.join(century_dir, 'sub', 'crop.100'),
+                     os.path.join(century_dir, '0_hist.bin'),
+                     os.path.join(century_dir, '0.lis'),
+                     os.path.join(input_dir, '0_hist.bin'),
+                     os.path.join(input_dir, '0.sch')]:
+            with open(path, 'w') as new_file:
+                new_file.write('contents\n')
+        ws_century_dir, ws_input_dir = cent.copy_century_workspace(
+            century_dir, input_dir, os.path.join(self.workspace_dir, 'ws'),
+            link=True)
+        for src_dir, ws_dir, file_name, linked in [
+                (century_dir, ws_century_dir, 'century_46.exe', True),
+                (century_dir, ws_century_dir, 'graz.100', False),
+                (century_dir, ws_century_dir, os.path.join('sub', 'crop.100'),
+                 False),
+                (century_dir, ws_century_dir, '0_hist.bin', False),
+                (century_dir, ws_century_dir, '0.lis', False),
+                (input_dir, ws_input_dir, '0_hist.bin', False),
+                (input_dir, ws_input_dir, '0.sch', False)]:
+            ws_file = os.path.join(ws_dir, file_name)
+            self.assertTrue(os.path.isfile(ws_file))
+            if hasattr(os, 'link'):
+                self.assertEqual(
+                    os.path.samefile(
+                        os.path.join(src_dir, file_name), ws_file), linked)
+
+        # CENTURY results restored in the workspace leave the originals, e.g.
+        # those left by a crashed run, unchanged
+        with open(os.path.join(ws_century_dir, '0_hist.bin'), 'w') as ws_bin:
+            ws_bin.write('restored\n')
+        with open(os.path.join(century_dir, '0_hist.bin'), 'r') as src_bin:
+            self.assertEqual(src_bin.read(), 'contents\n')
+
+    def test_forked_run(self):
+        """Rangeland production: a run forked from a saved state matches the
+        run it was forked from."""
+        import pandas
+        import forage
+
+        args = self._fake_century_workload(num_months=6)
+        state_dir = os.path.join(self.workspace_dir, 'state')
+        saving_args = dict(args)
+        saving_args['save_state_step'] = 3
+        saving_args['save_state_dir'] = state_dir
+        expected = forage.execute(saving_args)['summary_results']
+
+        forked_args = dict(args)
+        forked_args['fork_state_dir'] = state_dir
+        forked_args['outdir'] = os.path.join(self.workspace_dir, 'forked')
+        forked = forage.execute(forked_args)['summary_results']
+        self.assertGreater(expected['total_offtake'].sum(), 0)
+        pandas.testing.assert_frame_equal(forked, expected)
+
+        # the saved state describes this run only
+        forked_args['num_months'] = 2
+        with self.assertRaisesRegexp(Exception, 'after the last step'):
+            forage.execute(forked_args)
+
+    def test_phase_timing(self):
+        """Rangeland production: timing phases of a run."""
+        import pandas
+        import forage_timing
+
+        @forage_timing.timed('work')
+        def work(x):
+            return x + 1
+
+        forage_timing.reset()
+        self.assertEqual(work(1), 2)
+        with forage_timing.phase('block'):
+            work(1)
+        self.assertEqual(len(forage_timing.step_report()), 0)
+
+        forage_timing.enable()
+        try:
+            work(1)
+            forage_timing.set_step(0)
+            with forage_timing.phase('block'):
+                work(1)
+                work(2)
+            forage_timing.write_report(self.workspace_dir)
+        finally:
+            forage_timing.disable()
+        steps_df = pandas.read_csv(
+            os.path.join(self.workspace_dir, 'profile_by_step.csv'))
+        self.assertEqual(
+            steps_df[['step', 'phase', 'calls']].values.tolist(),
+            [[-1, 'work', 1], [0, 'block', 1], [0, 'work', 2]])
+        phase_df = pandas.read_csv(
+            os.path.join(self.workspace_dir, 'profile_by_phase.csv'))
+        self.assertEqual(
+            phase_df.set_index('phase')['calls'].to_dict(),
+            {'work': 3, 'block': 1})
+        self.assertTrue((phase_df['seconds'] >= 0).all())
+
+    def test_benchmarks(self):
+        """Rangeland production: microbenchmarks and baseline comparison."""
+        import json
+        import sys
+        import StringIO
+        import forage_benchmark
+
+        results_json = os.path.join(self.workspace_dir, 'results.json')
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            forage_benchmark.main(
+                [results_json, '--quick', '--min-time', '0', '--repeats',
+                 '1', '--quiet'])
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(printed, '')
+        with open(results_json, 'r') as results_file:
+            results = json.load(results_file)
+        functions = set(
+            b['function'] for b in results['benchmarks'].values())
+        self.assertEqual(functions, set([
+            'diet_selection_t2', 'calc_diet_intermediates', 'reduce_demand',
+            'calc_relative_height', 'update_feed_types',
+            'read_CENTURY_outputs', 'read_events', 'read_graz_level',
+            'find_target_month', 'modify_schedule', 'add_new_graz_level']))
+        self.assertIn('reduce_demand[n_classes=4,n_grass=1]',
+                      results['benchmarks'])
+        self.assertTrue(all(
+            b['seconds'] > 0 for b in results['benchmarks'].values()))
+
+        # a baseline twice as fast flags every benchmark as a regression
+        baseline = json.loads(json.dumps(results))
+        for name in baseline['benchmarks']:
+            baseline['benchmarks'][name]['seconds'] /= 2.
+        comparison = forage_benchmark.compare_to_baseline(
+            results, baseline, threshold=0.5)
+        self.assertEqual(len(comparison), len(results['benchmarks']))
+        self.assertTrue(all(c['regression'] for c in comparison))
+        comparison = forage_benchmark.compare_to_baseline(
+            results, baseline, threshold=1.5)
+        self.assertFalse(any(c['regression'] for c in comparison))
+
+    def test_scaling_benchmark(self):
+        """Rangeland production: end-to-end scaling against a CENTURY
+        stand-in."""
+        import forage_scaling
+
+        results_df = forage_scaling.run_sweep(sizes={
+            'num_months': [12, 24], 'n_grass': [1, 2], 'n_classes': [1, 2]})
+        self.assertEqual(len(results_df), 4)
+        self.assertTrue((results_df['wall_seconds'] > 0).all())
+        self.assertTrue((results_df['files_written'] > 0).all())
+        exponents_df = forage_scaling.fit_exponents(results_df)
+        self.assertEqual(
+            set(exponents_df['dimension']),
+            set(['num_months', 'n_grass', 'n_classes']))
+        months = exponents_df.set_index(['dimension', 'measure'])
+        self.assertGreater(
+            months.loc[('num_months', 'bytes_written'), 'exponent'], 1.)
+
+    def test_synthetic_workload(self):
+        """Rangeland production: synthetic inputs are read by the CENTURY
+        link and run by the model."""
+        import pandas
+        import forage
+        import forage_century_link_utils as cent
+        import forage_fake_century
+        import forage_workload
+
+        args = forage_workload.write_workload(
+            self.workspace_dir, num_months=24, n_grass=2, n_classes=12,
+            seed=3, spin_up_years=12)
+        herd_df = pandas.read_csv(args['herbivore_csv'])
+        self.assertEqual(
+            list(herd_df.columns), ['index'] +
+            forage_workload.HERBIVORE_COLUMNS)
+        self.assertEqual(len(herd_df), 12)
+        self.assertEqual(
+            set(herd_df['sex']),
+            set(['entire_m', 'breeding_female', 'castrate', 'heifer']))
+        grass_df = pandas.read_csv(args['grass_csv'])
+        self.assertEqual(
+            list(grass_df.columns), forage_workload.GRASS_COLUMNS)
+
+        schedule = os.path.join(args['input_dir'], '0.sch')
+        header, blocks = cent.read_schedule_blocks(schedule)
+        self.assertEqual(
+            [(b['start_year'], b['last_year']) for b in blocks],
+            [(2008, 2012)])
+        header, blocks = cent.read_schedule_blocks(
+            os.path.join(args['input_dir'], '0_hist.sch'))
+        self.assertEqual(
+            [(b['start_year'], b['last_year']) for b in blocks],
+            [(1996, 2004), (2005, 2007)])
+        events = cent.read_graz_level(schedule)
+        self.assertGreater(len(events), 0)
+        # grazing is scheduled only before the start of the run
+        self.assertTrue((events['relative_year'] <= 3).all())
+        site_file, weather_file = cent.get_site_weather_files(
+            schedule, args['input_dir'])
+        weather_df = cent.read_weather_file(weather_file)
+        self.assertEqual(
+            sorted(set(weather_df['year'])), range(2008, 2013))
+        self.assertEqual(
+            sorted(cent.read_graz_params(
+                os.path.join(args['century_dir'], 'graz.100')).index),
+            ['GH', 'GL', 'GLP'])
+
+        forage_fake_century.install()
+        try:
+            summary_df = forage.execute(args)['summary_results']
+        finally:
+            forage_fake_century.uninstall()
+        self.assertEqual(len(summary_df), 25)
+        self.assertTrue((summary_df['0_green_kgha'] > 0).all())
+        offtake = summary_df['total_offtake'].dropna()
+        self.assertEqual(len(offtake), 24)
+        self.assertTrue((offtake > 0).all())
+        # supplement is offered
+        self.assertIn('supp_csv', args)
+        self.assertTrue(os.path.isfile(os.path.join(
+            args['outdir'], 'CENTURY_outputs_m12_y2012', '1.lis')))
+
+    def test_trace(self):
+        """Rangeland production: JSON-lines trace of CENTURY launches and
+        file operations."""
+        import json
+        import forage
+        import forage_trace
+
+        args = self._fake_century_workload(num_months=2)
+        args['trace'] = 1
+        forage.execute(dict(args))
+        forage.execute(dict(args))
+        self.assertFalse(forage_trace.is_enabled())
+        trace_file = os.path.join(args['outdir'], 'trace.jsonl')
+        self.assertTrue(os.path.isfile(trace_file + '.1'))
+        with open(trace_file, 'r') as trace:
+            records = [json.loads(line) for line in trace]
+        self.assertEqual(records[0]['event'], 'run_start')
+        self.assertEqual(records[-1]['event'], 'run_end')
+        self.assertEqual(len(set(r['run'] for r in records)), 1)
+        launches = [r for r in records if r['event'] == 'century_end']
+        # spin-up and extend runs, then one run per step
+        self.assertEqual([r['step'] for r in launches], [-1, -1, 0, 1])
+        self.assertTrue(all(r['success'] for r in launches))
+        self.assertTrue(all(r['end'] >= r['start'] for r in launches))
+        moves = [r for r in records if r['event'] == 'move' and
+                 r['step'] == 0]
+        self.assertEqual(
+            sorted(os.path.basename(r['src']) for r in moves),
+            ['0.bin', '0.lis', '0_log.txt'])
+        self.assertTrue(all(r['attempt'] == 1 for r in moves))
+        lis_move = [r for r in moves if r['src'].endswith('.lis')][0]
+        self.assertEqual(lis_move['bytes'], os.path.getsize(lis_move['dst']))
+        self.assertEqual(
+            sorted(set(r['event'] for r in records if r['step'] == 1)),
+            ['century_end', 'century_start', 'copy', 'graz_edit', 'move',
+             'schedule_edit'])
+
+        # failed operations are recorded, and raised
+        forage_trace.enable(trace_file, keep=0)
+        try:
+            self.assertRaises(
+                IOError, forage_trace.move,
+                os.path.join(self.workspace_dir, 'missing.lis'),
+                os.path.join(self.workspace_dir, 'moved.lis'), attempt=1)
+        finally:
+            forage_trace.disable()
+        self.assertFalse(os.path.isfile(trace_file + '.1.1'))
+        with open(trace_file, 'r') as trace:
+            records = [json.loads(line) for line in trace]
+        self.assertEqual(
+            [r['event'] for r in records], ['run_start', 'move', 'run_end'])
+        self.assertIn('error', records[1])
+
+    def test_memory_profile(self):
+        """Rangeland production: memory use of a run by step and phase."""
+        import pandas
+        import forage
+        import forage_memory
+
+        args = self._fake_century_workload(num_months=2)
+        args['memory_profile'] = 1
+        forage.execute(args)
+        self.assertFalse(forage_memory.is_enabled())
+        steps_df = pandas.read_csv(
+            os.path.join(args['outdir'], 'memory_by_step.csv'))
+        self.assertEqual(list(steps_df['step']), [-1, 0, 1, 2])
+        self.assertTrue((steps_df['peak_rss_mb'] > 0).all())
+        self.assertTrue((steps_df['peak_rss_mb'].diff().dropna() >= 0).all())
+        phase_df = pandas.read_csv(
+            os.path.join(args['outdir'], 'memory_by_phase.csv'))
+        self.assertEqual(
+            list(phase_df[phase_df['phase'] == 'century_process']['step']),
+            [-1, 0, 1])
+        self.assertTrue((phase_df['peak_increase_mb'] >= 0).all())
+        self.assertTrue('diet_selection' in set(phase_df['phase']))
+
+        # tracing started elsewhere is left running
+        tracemalloc = forage_memory.tracemalloc
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            try:
+                forage_memory.enable()
+                forage_memory.disable()
+                self.assertTrue(tracemalloc.is_tracing())
+            finally:
+                tracemalloc.stop()
+
+        self.assertEqual(forage_memory.workers_for_memory(
+            100., available_mb=1000., headroom=0.2), 8)
+        self.assertEqual(forage_memory.workers_for_memory(
+            100., available_mb=1000., max_workers=4), 4)
+        self.assertEqual(forage_memory.workers_for_memory(
+            2000., available_mb=1000.), 1)
+
+    def test_progress_metrics(self):
+        """Rangeland production: progress metrics in Prometheus text
+        format."""
+        import forage
+        import forage_metrics
+        import forage_scenarios
+
+        def read_metrics(metrics_file):
+            values = {}
+            with open(metrics_file, 'r') as read_file:
+                for line in read_file:
+                    if line.startswith('#'):
+                        continue
+                    name, value = line.split()
+                    values[name.split('{')[0]] = float(value)
+            return values
+
+        args = self._fake_century_workload()
+        args['metrics'] = 1
+        forage.execute(dict(args))
+        metrics_file = os.path.join(args['outdir'], 'metrics.prom')
+        values = read_metrics(metrics_file)
+        self.assertFalse(forage_metrics.is_enabled())
+        self.assertEqual(values['forage_step'], 3)
+        self.assertEqual(values['forage_steps'], 3)
+        self.assertEqual(values['forage_eta_seconds'], 0)
+        self.assertEqual(values['forage_run_finished'], 1)
+        self.assertGreater(values['forage_steps_per_minute'], 0)
+        self.assertGreater(values['forage_century_seconds_total'], 0)
+        self.assertGreater(values['forage_python_seconds_total'], 0)
+        # 3 CENTURY outputs moved per step, and the summary results
+        self.assertGreater(values['forage_files_written_total'], 3 * 3)
+        self.assertGreater(values['forage_total_offtake'], 0)
+        self.assertEqual(
+            [f for f in os.listdir(args['outdir']) if f.endswith('.tmp')],
+            [])
+
+        batch_file = os.path.join(self.workspace_dir, 'batch.prom')
+        forage_scenarios.run_scenario_tree(
+            args, 1, {'a': {}, 'b': {}}, n_workers=1,
+            metrics_file=batch_file)
+        values = read_metrics(batch_file)
+        self.assertEqual(values['forage_batch_runs'], 2)
+        self.assertEqual(values['forage_batch_runs_finished_total'], 2)
+        self.assertEqual(values['forage_batch_steps_total'], 2 * 2)
+        self.assertEqual(values['forage_batch_finished'], 1)
+        self.assertTrue(os.path.isfile(
+            os.path.join(args['outdir'], 'a', 'metrics.prom')))
+
+        self.assertEqual(
+            forage_metrics.format_metrics(
+                [('m', 'gauge', 'help', float('nan')), ('n', 'gauge', 'h',
+                                                         None)],
+                {'outdir': 'C:\\a "b"'}),
+            '# HELP m help\n# TYPE m gauge\nm{outdir="C:\\\\a \\"b\\""} NaN\n')
+
+    def test_simulation_steps(self):
+        """Rangeland production: a run advanced step by step, and restarted
+        with changed inputs, matches runs of execute."""
+        import pandas
+        import forage
+
+        args = self._fake_century_workload()
+        expected = forage.execute(dict(args))['summary_results']
+        changed_args = dict(args)
+        changed_args['mgmt_threshold'] = 300.
+        changed = forage.execute(changed_args)['summary_results']
+
+        sim_args = dict(args)
+        sim_args['outdir'] = os.path.join(self.workspace_dir, 'sim')
+        simulation = forage.Simulation(sim_args)
+        self.assertRaises(Exception, simulation.step)
+        simulation.setup()
+        self.assertEqual(simulation.state()['step'], 0)
+        self.assertEqual(simulation.step(), 1)
+        self.assertEqual(
+            len(simulation.state()['results_dict']['total_offtake']), 2)
+        self.assertEqual(simulation.run(), 3)
+        self.assertTrue(simulation.is_complete())
+        self.assertRaises(Exception, simulation.step)
+        pandas.testing.assert_frame_equal(
+            simulation.results()['summary_results'], expected)
+
+        self.assertRaises(
+            Exception, simulation.restart, {'grass_csv': 'other.csv'})
+        simulation.restart({
+            'mgmt_threshold': 300.,
+            'outdir': os.path.join(self.workspace_dir, 'sim_changed')})
+        self.assertEqual(simulation.state()['step'], 0)
+        simulation.run()
+        results = simulation.close()
+        pandas.testing.assert_frame_equal(
+            results['summary_results'], changed)
+        self.assertFalse(
+            (changed['total_offtake'] == expected['total_offtake']).all())
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.workspace_dir, 'sim_changed', 'summary_results.csv')))
+        self.assertFalse(os.path.isfile(os.path.join(
+            args['century_dir'], 'graz_orig.100')))
+        self.assertFalse(os.path.isfile(os.path.join(
+            args['input_dir'], '0.bat')))
+
+    def test_concurrent_runs(self):
+        """Rangeland production: runs executing concurrently in threads of
+        one process do not interfere."""
+        import threading
+        import pandas
+        import forage
+        import forage_utils
+        import forage_century_link_utils as cent
+
+        args_list = [
+            self._fake_century_workload(
+                os.path.join(self.workspace_dir, str(seed)), seed=seed) for
+            seed in [0, 1]]
+        try:
+            expected = [
+                forage.execute(dict(args))['summary_results'] for args in
+                args_list]
+            # process-wide settings are not used by runs
+            forage_utils.set_time_step('day')
+            cent.set_century_directory(None)
+            results = [None] * len(args_list)
+            errors = []
+
+            def run(index):
+                try:
+                    results[index] = forage.execute(
+                        dict(args_list[index]))['summary_results']
+                except Exception as error:
+                    errors.append(error)
+            threads = [
+                threading.Thread(target=run, args=(index,)) for index in
+                xrange(len(args_list))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            forage_utils.set_time_step('month')
+        self.assertEqual(errors, [])
+        for result, expected_df in zip(results, expected):
+            pandas.testing.assert_frame_equal(result, expected_df)
+
+        # instrumentation is process-wide, so instrumented runs may not
+        # overlap other runs
+        args = dict(args_list[0])
+        args['outdir'] = os.path.join(self.workspace_dir, 'overlap')
+        simulation = forage.Simulation(dict(args))
+        simulation.setup()
+        try:
+            profiled_args = dict(args_list[1])
+            profiled_args['profile'] = 1
+            with self.assertRaisesRegexp(Exception, 'whole process'):
+                forage.execute(profiled_args)
+        finally:
+            simulation.close()
+        profiled = forage.Simulation(profiled_args)
+        profiled.setup()
+        try:
+            with self.assertRaisesRegexp(Exception, 'whole process'):
+                forage.execute(dict(args))
+        finally:
+            profiled.close()
+        forage.execute(dict(args))
+
+    def test_grid_groups(self):
+        """Rangeland production: pixels of a grid with identical inputs are
+        simulated once, and receive the results of their group."""
+        import numpy
+        import forage
+        import forage_grid
+        import forage_workload
+
+        args = self._fake_century_workload()
+        rng = numpy.random.RandomState(1)
+        forage_workload.write_site_file(
+            os.path.join(self.workspace_dir, 'wet.100'),
+            forage_workload.site_climate(rng))
+        site = numpy.zeros((4, 5), dtype=int)
+        site[:, 3:] = 1
+        site[0, 0] = forage_grid.NODATA
+        stocking = numpy.repeat(0.05, 20).reshape(4, 5)
+        stocking[2:, :] = 0.1
+        tables = {'site': {0: '0.100', 1: os.path.join(
+            self.workspace_dir, 'wet.100')}}
+        out_dir = os.path.join(self.workspace_dir, 'grid')
+        groups_df = forage_grid.run_grid(
+            args, {'site': site, 'stocking': stocking}, tables,
+            out_dir=out_dir, block_rows=3, n_workers=2)
+        direct_args = dict(args)
+        direct_args['density_series'] = dict(
+            (step, 0.1) for step in xrange(args['num_months']))
+        direct_df = forage.execute(direct_args)['summary_results']
+
+        self.assertEqual(len(groups_df), 4)
+        self.assertEqual(groups_df['n_pixels'].sum(), 19)
+        group_id = numpy.load(os.path.join(out_dir, 'group_id.npy'))
+        self.assertEqual(group_id[0, 0], -1)
+        self.assertEqual(len(numpy.unique(group_id[group_id >= 0])), 4)
+        offtake = numpy.load(os.path.join(out_dir, 'total_offtake.npy'))
+        self.assertEqual(offtake.shape, (3, 4, 5))
+        self.assertTrue(numpy.all(numpy.isnan(offtake[:, 0, 0])))
+        # pixels of a group share its results
+        numpy.testing.assert_array_equal(offtake[:, 0, 1], offtake[:, 1, 2])
+        numpy.testing.assert_array_equal(offtake[:, 2, 0], offtake[:, 3, 2])
+        self.assertFalse(numpy.allclose(offtake[:, 0, 1], offtake[:, 2, 0]))
+        green = numpy.load(os.path.join(out_dir, 'green_kgha.npy'))
+        self.assertFalse(numpy.array_equal(green[:, 2, 0], green[:, 2, 4]))
+        # results of a group are those of a run with its inputs
+        expected = forage_grid.grid_values(
+            direct_df, forage_grid.DEFAULT_OUTPUTS)
+        numpy.testing.assert_allclose(offtake[:, 2, 0], expected[0],
+                                      rtol=1e-6)
+        numpy.testing.assert_allclose(green[:, 2, 0], expected[1], rtol=1e-6)
+
+        # failed groups are counted and reported
+        failing_args = dict(args)
+        failing_args['herbivore_csv'] = os.path.join(
+            self.workspace_dir, 'missing.csv')
+        with self.assertRaisesRegexp(
+                Exception, '4 of 4 groups of pixels failed; group 0'):
+            forage_grid.run_grid(
+                failing_args, {'site': site, 'stocking': stocking}, tables,
+                out_dir=os.path.join(self.workspace_dir, 'failing_grid'),
+                block_rows=3, n_workers=2)